@@ -63,8 +63,10 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'users.middleware.FeatureFlagMiddleware',  # Request-scoped feature flags
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'metrics.middleware.MetricValueCacheMiddleware',  # Request-scoped metric value cache
 ]
 
 ROOT_URLCONF = 'EqTrak.urls'
@@ -194,6 +196,23 @@ MARKET_DATA_PROVIDER = os.getenv('MARKET_DATA_PROVIDER', 'yahoo')  # Default dat
 MARKET_DATA_REFRESH_INTERVAL = 24  # Hours between auto-refresh
 MARKET_DATA_PRICE_STALENESS = 3  # Days before prices considered stale
 
+# Provider request limits as (requests per second, burst size), shared by all
+# threads of a process; see market_data.ratelimit for the defaults
+MARKET_DATA_RATE_LIMITS = {}
+
+# Alpha Vantage connections: seconds to wait for a response and connections
+# kept alive by the session shared across threads
+ALPHA_VANTAGE_TIMEOUT = int(os.getenv('ALPHA_VANTAGE_TIMEOUT', '10'))
+ALPHA_VANTAGE_POOL_SIZE = int(os.getenv('ALPHA_VANTAGE_POOL_SIZE', '10'))
+
+# Performance recalculation: run queued recalculations in a background
+# thread after commit instead of in the committing thread
+PERFORMANCE_RECALC_IN_BACKGROUND = os.getenv('PERFORMANCE_RECALC_IN_BACKGROUND', 'False') == 'True'
+
+# Feature flags: seconds each process keeps system settings and user toggles
+# cached, bounding how long a change made in another process goes unseen
+FEATURE_FLAG_CACHE_TTL = int(os.getenv('FEATURE_FLAG_CACHE_TTL', '30'))
+
 # Crispy Forms settings
 CRISPY_ALLOWED_TEMPLATE_PACKS = "bootstrap5"
 CRISPY_TEMPLATE_PACK = "bootstrap5"
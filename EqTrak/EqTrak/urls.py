@@ -20,6 +20,7 @@ from django.conf import settings
 from django.conf.urls.static import static
 from portfolio import views
 from users.views import SignUpView
+from performance.urls import api_urlpatterns as performance_api_urls
 
 # Add a root URL pattern to redirect to portfolio
 urlpatterns = [
@@ -32,4 +33,5 @@ urlpatterns = [
     path('metrics/', include('metrics.urls')),
     path('users/', include('users.urls')),  # Include users app URLs
     path('user-metrics/', include('user_metrics.urls', namespace='user_metrics')),
+    path('performance/', include((performance_api_urls, 'performance'))),  # Performance API only
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
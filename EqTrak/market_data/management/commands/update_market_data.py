@@ -1,7 +1,11 @@
 from django.core.management.base import BaseCommand
 import logging
 
-from market_data.tasks import update_price_data_for_active_securities
+from market_data.providers.factory import get_provider
+from market_data.ratelimit import configure_rate_limit
+from market_data.tasks import (
+    REFRESH_ATTEMPTS, REFRESH_WORKERS, backfill_price_history, update_price_data_for_active_securities
+)
 from market_data.models import Security, MarketDataSettings
 from market_data.services import MarketDataService
 
@@ -13,6 +17,20 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('--symbol', type=str, help='Update a specific security by symbol')
         parser.add_argument('--force', action='store_true', help='Force update even if updates are disabled')
+        parser.add_argument('--workers', type=int, default=None,
+                            help=f'Securities refreshed at once (default {REFRESH_WORKERS})')
+        parser.add_argument('--rate', type=float, default=None,
+                            help='Provider requests per second (default from MARKET_DATA_RATE_LIMITS)')
+        parser.add_argument('--burst', type=int, default=None,
+                            help='Provider requests allowed at once (default from MARKET_DATA_RATE_LIMITS)')
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help="Symbols per quote request (default: the provider's batch size)")
+        parser.add_argument('--attempts', type=int, default=None,
+                            help=f'Attempts per security before giving up (default {REFRESH_ATTEMPTS})')
+        parser.add_argument('--history', action='store_true',
+                            help="Backfill the prices missing from the last year's history instead")
+        parser.add_argument('--full', action='store_true',
+                            help='With --history, fetch and rewrite the whole year')
         
     def handle(self, *args, **options):
         symbol = options.get('symbol')
@@ -23,7 +41,17 @@ class Command(BaseCommand):
             self.stdout.write(self.style.WARNING("Market data updates are currently disabled. Use --force to override."))
             return
             
-        if symbol:
+        if options['rate'] is not None or options['burst'] is not None:
+            provider_name = get_provider().rate_limit_name
+            if provider_name:
+                configure_rate_limit(provider_name, options['rate'], options['burst'])
+        
+        if options['history']:
+            securities = Security.objects.filter(symbol__iexact=symbol) if symbol else None
+            self.stdout.write("Backfilling price history...")
+            saved_count = backfill_price_history(securities, full=options['full'])
+            self.stdout.write(self.style.SUCCESS(f"Saved {saved_count} prices"))
+        elif symbol:
             try:
                 security = Security.objects.get(symbol__iexact=symbol)
                 self.stdout.write(f"Updating data for {security.symbol}...")
@@ -35,6 +63,11 @@ class Command(BaseCommand):
                 self.stdout.write(self.style.ERROR(f"Security not found: {symbol}"))
         else:
             self.stdout.write("Updating price data for all active securities...")
-            updated, failed = update_price_data_for_active_securities(user=None)
-            self.stdout.write(self.style.SUCCESS(f"Updated: {updated}, Failed: {failed}"))
+            report = update_price_data_for_active_securities(
+                user=None, max_workers=options['workers'], attempts=options['attempts'],
+                batch_size=options['batch_size']
+            )
+            self.stdout.write(self.style.SUCCESS(report.summary()))
+            for failed_symbol, error in sorted(report.failed.items()):
+                self.stdout.write(self.style.ERROR(f"  {failed_symbol}: {error}"))
 
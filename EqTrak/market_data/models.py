@@ -1,6 +1,7 @@
 import uuid
-from django.db import models
+from django.db import models, transaction
 from django.utils.translation import gettext_lazy as _
+from users import flags
 
 class Security(models.Model):
     """
@@ -65,6 +66,9 @@ class PriceData(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    # Fields overwritten when bulk_store() hits an existing (security, date) row
+    UPSERT_FIELDS = ['open', 'high', 'low', 'close', 'adj_close', 'volume', 'source', 'updated_at']
+    
     class Meta:
         verbose_name = _('Price Data')
         verbose_name_plural = _('Price Data')
@@ -76,6 +80,49 @@ class PriceData(models.Model):
         
     def __str__(self):
         return f"{self.security.symbol} - {self.date}: {self.close}"
+    
+    @classmethod
+    def bulk_store(cls, prices, batch_size=500):
+        """
+        Insert or update many prices with batched statements.
+        
+        Prices are upserted on their (security, date) key; an existing row
+        keeps its primary key and creation time and gets the UPSERT_FIELDS
+        overwritten. Save signals are not sent. Instead prices_stored is sent
+        once, with the first date written for each symbol.
+        
+        Args:
+            prices: Iterable of unsaved PriceData instances, with their
+                security loaded
+            batch_size: Maximum number of rows per INSERT statement
+            
+        Returns:
+            Number of prices written
+        """
+        from .signals import prices_stored
+        
+        # Keep the last price given for each key
+        prices_by_key = {(price.security_id, price.date): price for price in prices}
+        if not prices_by_key:
+            return 0
+        
+        with transaction.atomic():
+            cls.objects.bulk_create(
+                prices_by_key.values(),
+                batch_size=batch_size,
+                update_conflicts=True,
+                unique_fields=['security', 'date'],
+                update_fields=cls.UPSERT_FIELDS
+            )
+        
+        first_dates = {}
+        for price in prices_by_key.values():
+            symbol = price.security.symbol
+            if symbol not in first_dates or price.date < first_dates[symbol]:
+                first_dates[symbol] = price.date
+        prices_stored.send(sender=cls, first_dates=first_dates)
+        
+        return len(prices_by_key)
 
 
 class MarketDataSettings(models.Model):
@@ -97,8 +144,8 @@ class MarketDataSettings(models.Model):
     
     @classmethod
     def is_updates_enabled(cls):
-        """Check if market data updates are enabled"""
-        return cls.get_instance().updates_enabled
+        """Check if market data updates are enabled, cached by the feature flag service"""
+        return flags.is_system_enabled('market_data')
     
     @classmethod
     def set_updates_enabled(cls, enabled):
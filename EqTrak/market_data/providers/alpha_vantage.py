@@ -1,6 +1,10 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import date, datetime, timedelta
 import logging
+import threading
+import time
 from typing import Dict, List, Any, Optional
 from decimal import Decimal
 from django.conf import settings
@@ -9,16 +13,130 @@ from .base import MarketDataProviderBase
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_BASE_URL = "https://www.alphavantage.co/query"
+
+# Seconds to wait for a connection or a response
+DEFAULT_TIMEOUT = 10
+
+# Connections kept alive by the shared session
+DEFAULT_POOL_SIZE = 10
+
+# Status codes retried by the shared session, with backoff
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(pool_size: int = DEFAULT_POOL_SIZE) -> requests.Session:
+    """
+    Get the session shared by all providers and threads of the process.
+    
+    The session keeps up to pool_size connections alive, so requests reuse
+    them instead of opening a new connection each time, and retries failed
+    connections and 429/5xx responses with exponential backoff.
+    """
+    with _sessions_lock:
+        session = _sessions.get(pool_size)
+        if session is None:
+            retry = Retry(
+                total=3, backoff_factor=1, status_forcelist=RETRY_STATUSES,
+                allowed_methods=frozenset(['GET']), raise_on_status=False
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[pool_size] = session
+        return session
+
+def _rate_limit_note(data: Any) -> Optional[str]:
+    """
+    Get the message of a rate limited response, None for other responses.
+    """
+    if not isinstance(data, dict):
+        return None
+    if "Note" in data:
+        return data["Note"]
+    information = data.get("Information", "")
+    if "rate limit" in information.lower() or "call frequency" in information.lower():
+        return information
+    return None
+
 class AlphaVantageProvider(MarketDataProviderBase):
     """
     Market data provider implementation using Alpha Vantage API.
     https://www.alphavantage.co/documentation/
     """
     
-    def __init__(self):
-        """Initialize the Alpha Vantage provider."""
+    rate_limit_name = 'alpha_vantage'
+    
+    # Symbols per REALTIME_BULK_QUOTES request, the most the endpoint accepts
+    batch_size = 100
+    
+    def __init__(self, base_url=None, timeout=None, max_retries=3, retry_delay=15, pool_size=None):
+        """
+        Initialize the Alpha Vantage provider.
+        
+        Args:
+            base_url: Query endpoint (default the ALPHA_VANTAGE_BASE_URL setting)
+            timeout: Seconds to wait for a connection or a response
+                (default the ALPHA_VANTAGE_TIMEOUT setting)
+            max_retries: Retries of a request answered with a rate limit note
+            retry_delay: Seconds before the first of those retries, doubled
+                for every further one
+            pool_size: Connections kept alive to the endpoint
+                (default the ALPHA_VANTAGE_POOL_SIZE setting)
+        """
         self.api_key = None
-        self.base_url = "https://www.alphavantage.co/query"
+        self.base_url = base_url or getattr(settings, 'ALPHA_VANTAGE_BASE_URL', DEFAULT_BASE_URL)
+        self.timeout = timeout or getattr(settings, 'ALPHA_VANTAGE_TIMEOUT', DEFAULT_TIMEOUT)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.session = get_session(pool_size or getattr(settings, 'ALPHA_VANTAGE_POOL_SIZE', DEFAULT_POOL_SIZE))
+    
+    def _get(self, params: Dict[str, str], error: str) -> Dict[str, Any]:
+        """
+        Query the API over the shared session.
+        
+        Connection errors and 429/5xx responses are retried by the session.
+        Alpha Vantage answers requests over its rate limit with HTTP 200 and
+        a "Note" or "Information" message instead of data, so those are
+        retried here, with exponential backoff.
+        
+        Args:
+            params: Query parameters, including the function and API key
+            error: Start of the message of the errors raised
+            
+        Returns:
+            Dict with the decoded response
+            
+        Raises:
+            ValueError: If the request fails or stays rate limited
+        """
+        for attempt in range(self.max_retries + 1):
+            self._throttle()
+            try:
+                response = self.session.get(self.base_url, params=params, timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                raise ValueError(f"{error}: {e}")
+            if response.status_code != 200:
+                raise ValueError(f"{error}: HTTP {response.status_code}")
+            
+            try:
+                data = response.json()
+            except ValueError:
+                raise ValueError(f"{error}: invalid response")
+            
+            note = _rate_limit_note(data)
+            if note is None:
+                return data
+            # Waiting doesn't help once the daily allowance is used up
+            if attempt < self.max_retries and 'per day' not in note.lower():
+                delay = self.retry_delay * 2 ** attempt
+                logger.warning(f"Alpha Vantage rate limit hit ({note}), retrying in {delay} seconds")
+                time.sleep(delay)
+            else:
+                raise ValueError(f"{error}: rate limited ({note})")
     
     def _check_api_key(self):
         """Check if API key is set and raise error if not."""
@@ -47,11 +165,7 @@ class AlphaVantageProvider(MarketDataProviderBase):
             "apikey": self.api_key
         }
         
-        response = requests.get(self.base_url, params=params)
-        if response.status_code != 200:
-            raise ValueError(f"Failed to retrieve data for {symbol}: HTTP {response.status_code}")
-        
-        data = response.json()
+        data = self._get(params, f"Failed to retrieve data for {symbol}")
         
         # Check if we got valid data
         if "Symbol" not in data:
@@ -87,11 +201,7 @@ class AlphaVantageProvider(MarketDataProviderBase):
             "apikey": self.api_key
         }
         
-        response = requests.get(self.base_url, params=params)
-        if response.status_code != 200:
-            raise ValueError(f"Failed to retrieve latest price for {symbol}: HTTP {response.status_code}")
-        
-        data = response.json()
+        data = self._get(params, f"Failed to retrieve latest price for {symbol}")
         
         # Check if we got valid data
         if "Global Quote" not in data or not data["Global Quote"]:
@@ -117,6 +227,67 @@ class AlphaVantageProvider(MarketDataProviderBase):
             "change_percent": change_percent
         }
     
+    def get_latest_prices(self, symbols: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Get the latest prices of many securities with the REALTIME_BULK_QUOTES
+        endpoint, up to batch_size symbols per request.
+        
+        The endpoint needs a premium API key. With other keys it answers with
+        a message instead of quotes and the symbols are looked up one at a
+        time with GLOBAL_QUOTE.
+        
+        Args:
+            symbols: Ticker symbols to look up
+            
+        Returns:
+            Dict mapping each symbol with a price to its price data
+            
+        Raises:
+            ValueError: If the API key is not set
+        """
+        self._check_api_key()
+        
+        symbols = list(dict.fromkeys(symbol.upper() for symbol in symbols))
+        prices = {}
+        for i in range(0, len(symbols), self.batch_size):
+            chunk = symbols[i:i + self.batch_size]
+            params = {
+                "function": "REALTIME_BULK_QUOTES",
+                "symbol": ",".join(chunk),
+                "apikey": self.api_key
+            }
+            
+            try:
+                data = self._get(params, "Failed to retrieve bulk quotes")
+            except ValueError as e:
+                data = {"message": str(e)}
+            quotes = data.get("data")
+            if not isinstance(quotes, list):
+                reason = data.get("message") or data.get("Information") or "no quotes"
+                logger.info(f"Bulk quotes unavailable ({reason}), fetching {len(chunk)} symbols one at a time")
+                prices.update(super().get_latest_prices(chunk))
+                continue
+            
+            for quote in quotes:
+                symbol = quote.get("symbol", "").upper()
+                if symbol not in chunk or quote.get("close") in (None, ""):
+                    continue
+                price = float(quote["close"])
+                change = float(quote.get("change") or 0)
+                change_percent = (change / (price - change)) * 100 if price != change else 0
+                prices[symbol] = {
+                    "date": (quote.get("timestamp") or datetime.now().strftime("%Y-%m-%d"))[:10],
+                    "open": float(quote.get("open") or 0),
+                    "high": float(quote.get("high") or 0),
+                    "low": float(quote.get("low") or 0),
+                    "close": price,
+                    "adj_close": price,
+                    "volume": int(float(quote.get("volume") or 0)),
+                    "change": change,
+                    "change_percent": change_percent
+                }
+        return prices
+    
     def get_historical_prices(
         self, 
         symbol: str, 
@@ -147,11 +318,7 @@ class AlphaVantageProvider(MarketDataProviderBase):
             "apikey": self.api_key
         }
         
-        response = requests.get(self.base_url, params=params)
-        if response.status_code != 200:
-            raise ValueError(f"Failed to retrieve historical prices for {symbol}: HTTP {response.status_code}")
-        
-        data = response.json()
+        data = self._get(params, f"Failed to retrieve historical prices for {symbol}")
         
         # Check if we got valid data
         if "Time Series (Daily)" not in data:
@@ -202,11 +369,7 @@ class AlphaVantageProvider(MarketDataProviderBase):
             "apikey": self.api_key
         }
         
-        response = requests.get(self.base_url, params=params)
-        if response.status_code != 200:
-            raise ValueError(f"Failed to search securities: HTTP {response.status_code}")
-        
-        data = response.json()
+        data = self._get(params, "Failed to search securities")
         
         # Check if we got valid data
         if "bestMatches" not in data:
@@ -1,6 +1,48 @@
 from abc import ABC, abstractmethod
 from typing import Dict, List, Any, Optional, Tuple
 from datetime import date, datetime, timedelta
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Columnar price history: one record per day, in date order
+PRICE_DTYPE = np.dtype([
+    ('date', 'datetime64[D]'),
+    ('open', 'f8'),
+    ('high', 'f8'),
+    ('low', 'f8'),
+    ('close', 'f8'),
+    ('adj_close', 'f8'),
+    ('volume', 'i8'),
+])
+
+def rows_to_array(rows: List[Dict[str, Any]]) -> np.ndarray:
+    """
+    Convert a list of daily price dictionaries to a PRICE_DTYPE array.
+    """
+    return np.array([
+        (row['date'], row['open'], row['high'], row['low'], row['close'],
+         row.get('adj_close', row['close']), row.get('volume') or 0)
+        for row in rows
+    ], dtype=PRICE_DTYPE)
+
+def array_to_rows(prices: np.ndarray) -> List[Dict[str, Any]]:
+    """
+    Convert a PRICE_DTYPE array to the list of daily price dictionaries
+    returned by get_historical_prices().
+    """
+    columns = [prices[name].tolist() for name in PRICE_DTYPE.names[1:]]
+    return [
+        {
+            'date': day, 'open': open_, 'high': high, 'low': low,
+            'close': close, 'adj_close': adj_close, 'volume': volume
+        }
+        for day, open_, high, low, close, adj_close, volume in zip(
+            np.datetime_as_string(prices['date']).tolist(), *columns
+        )
+    ]
 
 class MarketDataProviderBase(ABC):
     """
@@ -8,6 +50,25 @@ class MarketDataProviderBase(ABC):
     All concrete providers must implement these methods.
     """
     
+    # Name of the shared rate limit the provider's requests count against
+    rate_limit_name = None
+    
+    # Most symbols requested at once by the batch methods
+    batch_size = 100
+    
+    def _throttle(self, request_count=1):
+        """
+        Wait for the provider's rate limit before making requests.
+        
+        Args:
+            request_count: Number of requests about to be made
+        """
+        if self.rate_limit_name:
+            from ..ratelimit import get_rate_limiter
+            limiter = get_rate_limiter(self.rate_limit_name)
+            for _ in range(request_count):
+                limiter.acquire()
+    
     @abstractmethod
     def get_security_info(self, symbol: str) -> Dict[str, Any]:
         """
@@ -63,6 +124,83 @@ class MarketDataProviderBase(ABC):
         """
         pass
 
+    def get_latest_prices(self, symbols: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Get the latest available prices of many securities.
+        
+        The default implementation calls get_latest_price() for each symbol.
+        Providers with a multi-symbol endpoint override it.
+        
+        Args:
+            symbols: Ticker symbols to look up
+            
+        Returns:
+            Dict mapping each symbol with a price to its price information,
+            as returned by get_latest_price(). Symbols without data are left out.
+        """
+        prices = {}
+        for symbol in symbols:
+            try:
+                prices[symbol] = self.get_latest_price(symbol)
+            except ValueError as e:
+                logger.warning(f"No latest price for {symbol}: {e}")
+        return prices
+    
+    def get_historical_prices_bulk(self,
+                                   symbols: List[str],
+                                   start_date: Optional[date] = None,
+                                   end_date: Optional[date] = None) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Get historical price data of many securities.
+        
+        The default implementation calls get_historical_prices() for each
+        symbol. Providers with a multi-symbol endpoint override it.
+        
+        Args:
+            symbols: Ticker symbols
+            start_date: Start date for data (optional)
+            end_date: End date for data (optional)
+            
+        Returns:
+            Dict mapping each symbol with data to its list of daily prices,
+            as returned by get_historical_prices(). Symbols without data are
+            left out.
+        """
+        history = {}
+        for symbol in symbols:
+            try:
+                rows = self.get_historical_prices(symbol, start_date=start_date, end_date=end_date)
+            except ValueError as e:
+                logger.warning(f"No historical prices for {symbol}: {e}")
+                continue
+            if rows:
+                history[symbol] = rows
+        return history
+    
+    def get_historical_price_arrays_bulk(self,
+                                         symbols: List[str],
+                                         start_date: Optional[date] = None,
+                                         end_date: Optional[date] = None) -> Dict[str, np.ndarray]:
+        """
+        Get historical price data of many securities as PRICE_DTYPE arrays.
+        
+        The default implementation converts the result of
+        get_historical_prices_bulk(). Providers that receive columnar data
+        override it to skip the per-day dictionaries.
+        
+        Args:
+            symbols: Ticker symbols
+            start_date: Start date for data (optional)
+            end_date: End date for data (optional)
+            
+        Returns:
+            Dict mapping each symbol with data to its array of daily prices
+        """
+        return {
+            symbol: rows_to_array(rows)
+            for symbol, rows in self.get_historical_prices_bulk(symbols, start_date, end_date).items()
+        }
+    
     @abstractmethod
     def search_securities(self, query: str) -> List[Dict[str, Any]]:
         """
@@ -1,22 +1,32 @@
 import yfinance as yf
 from typing import Dict, List, Any, Optional, Tuple
 from datetime import date, datetime, timedelta
+import numpy as np
 import pandas as pd
 import logging
+import threading
 import time
 import requests
 from urllib3.exceptions import MaxRetryError, NewConnectionError
 
-from .base import MarketDataProviderBase
+from .base import PRICE_DTYPE, MarketDataProviderBase, array_to_rows
 
 logger = logging.getLogger(__name__)
 
+# Serializes yf.download() calls, which spread each call over threads of their own
+_download_lock = threading.Lock()
+
 class YahooFinanceProvider(MarketDataProviderBase):
     """
     Yahoo Finance implementation of the market data provider.
     Uses the yfinance library to fetch data from Yahoo Finance.
     """
     
+    rate_limit_name = 'yahoo'
+    
+    # Symbols per yf.download() call
+    batch_size = 200
+    
     def __init__(self, max_retries=3, retry_delay=2, timeout=10):
         """
         Initialize the Yahoo Finance provider
@@ -30,15 +40,20 @@ class YahooFinanceProvider(MarketDataProviderBase):
         self.retry_delay = retry_delay
         self.timeout = timeout
     
-    def _execute_with_retry(self, func, *args, **kwargs):
+    def _execute_with_retry(self, func, *args, request_count=1, **kwargs):
         """
         Execute a function with retry logic
+        
+        Args:
+            request_count: Number of Yahoo requests the function makes, taken
+                from the rate limit before every attempt
         """
         retries = 0
         last_error = None
         
         while retries < self.max_retries:
             try:
+                self._throttle(request_count)
                 return func(*args, **kwargs)
             except (requests.exceptions.RequestException, MaxRetryError, NewConnectionError, ConnectionError) as e:
                 last_error = e
@@ -126,7 +141,8 @@ class YahooFinanceProvider(MarketDataProviderBase):
                 ticker = yf.Ticker(symbol)
                 # If dates are provided, use them; otherwise use period
                 if start_date and end_date:
-                    return ticker.history(start=start_date, end=end_date)
+                    # Yahoo's end date is exclusive
+                    return ticker.history(start=start_date, end=end_date + timedelta(days=1))
                 else:
                     return ticker.history(period=period)
             
@@ -135,24 +151,120 @@ class YahooFinanceProvider(MarketDataProviderBase):
             if hist.empty:
                 return []
                 
-            # Convert DataFrame to list of dictionaries
-            result = []
-            for date_idx, row in hist.iterrows():
-                price_data = {
-                    'date': date_idx.date().isoformat(),
-                    'open': float(row['Open']),
-                    'high': float(row['High']),
-                    'low': float(row['Low']),
-                    'close': float(row['Close']),
-                    'adj_close': float(row['Close']),  # Yahoo already adjusts Close
-                    'volume': int(row['Volume'])
-                }
-                result.append(price_data)
-            
-            return result
+            return array_to_rows(self._history_to_array(hist))
         except Exception as e:
             logger.error(f"Error fetching historical prices for {symbol}: {str(e)}")
             raise ValueError(f"Unable to retrieve historical prices for {symbol}: {str(e)}")
+    
+    def get_latest_prices(self, symbols: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Get the latest available prices of many securities with multi-ticker
+        downloads of the last few days
+        """
+        prices = {}
+        for chunk in self._chunks(symbols):
+            # The last day may not have traded yet everywhere
+            for symbol, hist in self._download(chunk, period='5d').items():
+                prices[symbol] = array_to_rows(self._history_to_array(hist.iloc[-1:]))[0]
+        return prices
+    
+    def get_historical_prices_bulk(self,
+                                   symbols: List[str],
+                                   start_date: Optional[date] = None,
+                                   end_date: Optional[date] = None) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Get historical price data of many securities with multi-ticker downloads
+        """
+        return {
+            symbol: array_to_rows(prices)
+            for symbol, prices in self.get_historical_price_arrays_bulk(symbols, start_date, end_date).items()
+        }
+    
+    def get_historical_price_arrays_bulk(self,
+                                         symbols: List[str],
+                                         start_date: Optional[date] = None,
+                                         end_date: Optional[date] = None) -> Dict[str, np.ndarray]:
+        """
+        Get historical price data of many securities as PRICE_DTYPE arrays,
+        converted column by column from multi-ticker downloads
+        """
+        if start_date and end_date:
+            # Yahoo's end date is exclusive
+            dates = {'start': start_date, 'end': end_date + timedelta(days=1)}
+        else:
+            dates = {'period': 'max'}
+        
+        history = {}
+        for chunk in self._chunks(symbols):
+            for symbol, hist in self._download(chunk, **dates).items():
+                history[symbol] = self._history_to_array(hist)
+        return history
+    
+    def _chunks(self, symbols):
+        symbols = list(dict.fromkeys(symbol.upper() for symbol in symbols))
+        return [symbols[i:i + self.batch_size] for i in range(0, len(symbols), self.batch_size)]
+    
+    def _download(self, symbols: List[str], **kwargs) -> Dict[str, pd.DataFrame]:
+        """
+        Download daily prices of many symbols with one yf.download() call.
+        
+        Returns:
+            Dict mapping each symbol with data to its frame of prices, without
+            the days the symbol didn't trade
+        """
+        def fetch_download():
+            # yf.download() keeps its results in module globals
+            with _download_lock:
+                return yf.download(
+                    symbols, group_by='ticker', auto_adjust=True, actions=False,
+                    progress=False, timeout=self.timeout, **kwargs
+                )
+        
+        try:
+            # yfinance still requests every symbol's chart separately
+            data = self._execute_with_retry(fetch_download, request_count=len(symbols))
+        except Exception as e:
+            logger.error(f"Error downloading prices for {len(symbols)} symbols: {str(e)}")
+            return {}
+        
+        if data.empty:
+            return {}
+        if isinstance(data.columns, pd.MultiIndex):
+            downloaded = set(data.columns.get_level_values(0))
+            frames = {symbol: data[symbol] for symbol in symbols if symbol in downloaded}
+        else:
+            frames = {symbols[0]: data}
+        
+        result = {}
+        for symbol, hist in frames.items():
+            hist = hist.dropna(subset=['Close'])
+            if not hist.empty:
+                result[symbol] = hist
+        missing = len(symbols) - len(result)
+        if missing:
+            logger.warning(f"No prices downloaded for {missing} of {len(symbols)} symbols")
+        return result
+    
+    @staticmethod
+    def _history_to_array(hist: pd.DataFrame) -> np.ndarray:
+        """
+        Convert a frame of daily prices to a PRICE_DTYPE array, column by column
+        """
+        index = hist.index
+        if getattr(index, 'tz', None) is not None:
+            # Bars are stamped at midnight exchange time, keep that day
+            index = index.tz_localize(None)
+        
+        prices = np.empty(len(hist), dtype=PRICE_DTYPE)
+        prices['date'] = index.values.astype('datetime64[D]')
+        prices['open'] = hist['Open'].to_numpy(dtype=float)
+        prices['high'] = hist['High'].to_numpy(dtype=float)
+        prices['low'] = hist['Low'].to_numpy(dtype=float)
+        prices['close'] = hist['Close'].to_numpy(dtype=float)
+        # Yahoo already adjusts Close
+        prices['adj_close'] = prices['close']
+        prices['volume'] = np.nan_to_num(hist['Volume'].to_numpy(dtype=float))
+        return prices
 
     def search_securities(self, query: str) -> List[Dict[str, Any]]:
         """
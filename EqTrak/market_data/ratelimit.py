@@ -0,0 +1,129 @@
+"""
+Request rate limits of the market data providers.
+
+Every provider has one token bucket shared by all threads of the process.
+Each request takes a token and waits for one when the bucket is empty, so
+a provider sees at most `burst` requests at once and `rate` requests per
+second on average, however many threads are refreshing prices.
+
+Settings:
+    MARKET_DATA_RATE_LIMITS: Dict mapping a provider name to a tuple of
+        (requests per second, burst size), overriding DEFAULT_RATE_LIMITS
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Provider name -> (requests per second, burst size)
+DEFAULT_RATE_LIMITS = {
+    'yahoo': (2.0, 5),
+    # The free Alpha Vantage tier allows 5 requests per minute
+    'alpha_vantage': (5 / 60, 1),
+}
+
+# Limit of providers missing from the settings
+FALLBACK_RATE_LIMIT = (1.0, 1)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket.
+
+    Starts full, refills continuously at `rate` tokens per second and holds
+    at most `capacity` tokens.
+    """
+
+    def __init__(self, rate, capacity=1, clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError("Rate must be positive")
+        self.rate = float(rate)
+        self.capacity = max(float(capacity), 1.0)
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self.capacity
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def try_acquire(self, tokens=1):
+        """
+        Take tokens if they are available right away.
+
+        Returns:
+            bool: True if the tokens were taken
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1):
+        """
+        Take tokens, waiting until they are available.
+
+        Returns:
+            Seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                delay = (tokens - self._tokens) / self.rate
+            # Sleep outside the lock, other threads may take the tokens first
+            self._sleep(delay)
+            waited += delay
+
+
+def _get_limits(provider_name):
+    """Configured (requests per second, burst size) of a provider"""
+    limits = {**DEFAULT_RATE_LIMITS, **getattr(settings, 'MARKET_DATA_RATE_LIMITS', {})}
+    return limits.get(provider_name, FALLBACK_RATE_LIMIT)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(provider_name):
+    """
+    Get the shared token bucket of a provider, creating it on first use.
+
+    Args:
+        provider_name: Provider name, as in the MARKET_DATA_PROVIDER setting
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(provider_name)
+        if limiter is None:
+            rate, burst = _get_limits(provider_name)
+            limiter = _limiters[provider_name] = TokenBucket(rate, burst)
+        return limiter
+
+
+def configure_rate_limit(provider_name, rate=None, burst=None):
+    """
+    Replace the token bucket of a provider for the rest of the process.
+
+    Args:
+        provider_name: Provider name
+        rate: Requests per second (default: the configured rate)
+        burst: Requests allowed at once (default: the configured burst size)
+    """
+    default_rate, default_burst = _get_limits(provider_name)
+    rate = rate or default_rate
+    burst = burst or default_burst
+    with _limiters_lock:
+        _limiters[provider_name] = TokenBucket(rate, burst)
+    logger.info(f"Rate limit of {provider_name} set to {rate} requests per second, bursts of {burst}")
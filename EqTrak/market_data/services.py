@@ -10,7 +10,8 @@ from django.db.models import Q
 from django.conf import settings
 from django.contrib.auth.models import User
 
-from .models import Security, PriceData, MarketDataSettings
+from users import flags
+from .models import Security, PriceData
 from .providers.factory import get_provider
 
 logger = logging.getLogger(__name__)
@@ -152,6 +153,7 @@ class MarketDataService:
                         'change_percent': ((price_data.close - price_data.open) / price_data.open * 100) 
                                          if price_data.open and price_data.open != 0 else 0,
                         'volume': price_data.volume,
+                        'source': price_data.source,
                         'timestamp': timezone.now().isoformat()
                     }
             except Exception as e:
@@ -189,6 +191,7 @@ class MarketDataService:
             'change': price_data.get('change', None),
             'change_percent': price_data.get('change_percent', None),
             'volume': price_data.get('volume', None),
+            'source': provider.__class__.__name__,
             'timestamp': timezone.now().isoformat()
         }
         
@@ -295,20 +298,9 @@ class MarketDataService:
         Returns:
             bool: True if updates are enabled, False otherwise
         """
-        # System-wide setting takes precedence - if disabled at system level, nothing can override it
-        if not MarketDataSettings.is_updates_enabled():
-            return False
-            
-        # If no user provided, return system setting
-        if user is None:
-            return True
-            
-        # Check user-specific setting
-        try:
-            return user.settings.market_data_enabled
-        except (AttributeError, Exception):
-            # Default to True if user settings don't exist
-            return True
+        # System-wide setting takes precedence - if disabled at system level, nothing can override it.
+        # Users without settings default to enabled; both are cached by the flag service
+        return flags.is_enabled('market_data', user=user)
             
     @staticmethod
     @check_market_data_access
@@ -349,6 +341,39 @@ class MarketDataService:
             logger.error(f"Error refreshing data for {getattr(security, 'symbol', security)}: {e}")
             return False
 
+    @staticmethod
+    def store_latest_prices(securities, prices: Dict[str, Dict[str, Any]], source: str) -> set:
+        """
+        Store the latest prices of many securities, as fetched by a provider's
+        get_latest_prices().
+        
+        Args:
+            securities: Security objects the prices were fetched for
+            prices: Dict mapping symbols to price data
+            source: Name of the provider the prices came from
+            
+        Returns:
+            set: IDs of the securities a price was stored for
+        """
+        rows = []
+        for security in securities:
+            price_data = prices.get(security.symbol)
+            if price_data is None:
+                continue
+            rows.append(PriceData(
+                security=security,
+                date=date.fromisoformat(price_data['date']),
+                open=price_data['open'],
+                high=price_data['high'],
+                low=price_data['low'],
+                close=price_data['close'],
+                adj_close=price_data.get('adj_close', price_data['close']),
+                volume=price_data.get('volume', 0),
+                source=source
+            ))
+        PriceData.bulk_store(rows)
+        return {price.security_id for price in rows}
+
     @staticmethod
     @check_market_data_access
     def sync_price_with_metrics(position, user=None):
@@ -382,36 +407,21 @@ class MarketDataService:
                 logger.warning(f"Could not get latest price for {position.ticker}: {e}")
                 return None
             
-            # Find "Market Price" metric - using name field instead of code
-            # Based on the error message, 'code' field doesn't exist
-            try:
-                # Try by name first
-                market_price_metric = MetricType.objects.get(
-                    name='Market Price',
-                    scope_type='POSITION',
-                    is_system=True
-                )
-            except MetricType.DoesNotExist:
-                try:
-                    # If that fails, try by metric_id if that's what's being used
-                    market_price_metric = MetricType.objects.get(
-                        metric_id='MARKET_PRICE',
-                        scope_type='POSITION',
-                        is_system=True
-                    )
-                except MetricType.DoesNotExist:
-                    logger.error("Market Price metric type not found")
-                    return None
+            # Find the "Market Price" metric in the metric type registry
+            market_price_metric = MetricType.get_system_metric('Market Price', scope_type='POSITION')
+            if not market_price_metric:
+                logger.error("Market Price metric type not found")
+                return None
             
-            # Create or update the metric value
-            metric_value, created = MetricValue.objects.update_or_create(
+            # Create or update the market price for the price date, with the
+            # save signals that queue the position's performance
+            metric_value = MetricValue.store(MetricValue(
                 metric_type=market_price_metric,
                 position=position,
-                defaults={
-                    'value': latest_price['price'],
-                    'value_date': date.fromisoformat(latest_price['date']),
-                }
-            )
+                date=date.fromisoformat(latest_price['date']),
+                value=latest_price['price'],
+                source=latest_price['source']
+            ))
             
             logger.debug(f"Updated market price metric for {position.ticker}: {metric_value.value}")
             return metric_value
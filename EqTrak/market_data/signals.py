@@ -3,12 +3,17 @@ Signal handlers for the market_data app.
 These signals allow other components to respond to market data changes.
 """
 import logging
-from django.db.models.signals import post_save
-from django.dispatch import receiver
-from .models import PriceData
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import Signal, receiver
+from users import flags
+from .models import PriceData, MarketDataSettings
 
 logger = logging.getLogger(__name__)
 
+# Sent by PriceData.bulk_store(), which bypasses the save signals, with
+# first_dates mapping each symbol written to the earliest date written
+prices_stored = Signal()
+
 @receiver(post_save, sender=PriceData)
 def price_data_updated(sender, instance, created, **kwargs):
     """
@@ -18,4 +23,12 @@ def price_data_updated(sender, instance, created, **kwargs):
     action = "created" if created else "updated"
     logger.debug(f"Price data {action}: {instance.security.symbol} at ${instance.close}")
     
-    # In the future, additional notification logic could be added here 
\ No newline at end of file
+    # In the future, additional notification logic could be added here 
+
+@receiver(post_save, sender=MarketDataSettings)
+@receiver(post_delete, sender=MarketDataSettings)
+def invalidate_market_data_flag(sender, instance, **kwargs):
+    """
+    Drop the cached system setting so the change applies right away.
+    """
+    flags.cache.invalidate_system('market_data')
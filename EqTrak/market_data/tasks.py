@@ -1,10 +1,13 @@
 import logging
 from datetime import date, datetime, timedelta
 from typing import Optional, List
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import time
 
+import numpy as np
 from django.conf import settings
-from django.db import transaction
+from django.db import connections, transaction
+from django.db.models import Count, Max, Min
 from django.utils import timezone
 from django.contrib.auth.models import User
 
@@ -14,7 +17,100 @@ from .providers.factory import get_provider
 
 logger = logging.getLogger(__name__)
 
-def update_price_data_for_active_securities(user=None):
+# Longest run of calendar days without prices that isn't a hole in the
+# history: a long weekend around a holiday
+MAX_PRICE_GAP_DAYS = 4
+
+# Weekday market holidays a year, which leave no prices
+HOLIDAYS_PER_YEAR = 10
+
+# Securities refreshed at once by update_price_data_for_active_securities()
+REFRESH_WORKERS = 8
+
+# Attempts per security before it counts as failed
+REFRESH_ATTEMPTS = 3
+
+# Seconds before retrying a security, doubled after every further failure
+REFRESH_RETRY_DELAY = 1.0
+
+class RefreshReport:
+    """
+    Outcome of refreshing the active securities.
+    """
+    
+    def __init__(self):
+        self.updated = []
+        self.failed = {}
+        self.retries = 0
+        self.batches = 0
+        self.fallbacks = 0
+        self.elapsed = 0.0
+    
+    @property
+    def updated_count(self):
+        return len(self.updated)
+    
+    @property
+    def failed_count(self):
+        return len(self.failed)
+    
+    def summary(self):
+        """One line summary of the refresh"""
+        return (f"Updated: {self.updated_count}, Failed: {self.failed_count}, "
+                f"Batches: {self.batches}, Refreshed individually: {self.fallbacks}, "
+                f"Retries: {self.retries}, Elapsed: {self.elapsed:.1f}s")
+
+def _refresh_batch(provider, securities, attempts, retry_delay):
+    """
+    Fetch and store the latest prices of a batch of securities in a worker
+    thread, retrying the provider call with exponential backoff.
+    
+    Returns:
+        Tuple of (IDs of the securities updated, retries made)
+    """
+    try:
+        symbols = [security.symbol for security in securities]
+        for attempt in range(1, attempts + 1):
+            try:
+                prices = provider.get_latest_prices(symbols)
+                break
+            except Exception as e:
+                logger.warning(f"Batch of {len(symbols)} quotes failed (attempt {attempt}/{attempts}): {e}")
+                if attempt == attempts:
+                    return set(), attempt - 1
+                time.sleep(retry_delay * 2 ** (attempt - 1))
+        
+        stored = MarketDataService.store_latest_prices(securities, prices, provider.__class__.__name__)
+        return stored, attempt - 1
+    finally:
+        connections.close_all()
+
+def _refresh_with_retry(security, user, attempts, retry_delay):
+    """
+    Refresh one security in a worker thread, retrying with exponential backoff.
+    
+    Returns:
+        Tuple of (attempts made, error message or None on success)
+    """
+    try:
+        error = None
+        for attempt in range(1, attempts + 1):
+            try:
+                if MarketDataService.refresh_security_data(security, user):
+                    return attempt, None
+                error = "Refresh failed"
+            except Exception as e:
+                error = str(e)
+            
+            if attempt < attempts:
+                time.sleep(retry_delay * 2 ** (attempt - 1))
+        return attempts, error
+    finally:
+        # Worker threads have their own connections
+        connections.close_all()
+
+def update_price_data_for_active_securities(user=None, max_workers=None, attempts=None, retry_delay=None,
+                                            batch_size=None):
     """
     Update price data for all active securities.
     This function can be called:
@@ -22,90 +118,255 @@ def update_price_data_for_active_securities(user=None):
     - Scheduled via cron/Celery
     - In response to user refresh request
     
+    Latest prices are fetched in batches with the provider's multi-symbol
+    quotes. Securities missing from their batch's quotes are then refreshed
+    one at a time, security information included. Both run concurrently on a
+    pool of threads, paced by the provider's shared rate limit (see
+    market_data.ratelimit).
+    
     Args:
         user: Optional user context. If provided, will check user-specific settings.
+        max_workers: Batches or securities refreshed at once (default REFRESH_WORKERS)
+        attempts: Attempts per batch or security (default REFRESH_ATTEMPTS)
+        retry_delay: Seconds before the first retry (default REFRESH_RETRY_DELAY)
+        batch_size: Symbols per batch (default: the provider's batch_size)
+        
+    Returns:
+        RefreshReport
     """
+    report = RefreshReport()
+    
     # Check if updates are enabled at system level
     if not MarketDataSettings.is_updates_enabled():
         logger.warning("Market data updates are disabled at system level. Skipping update.")
-        return 0, 0
+        return report
         
     # If user provided, check user-specific setting
     if user and not MarketDataService.is_updates_enabled(user):
         logger.info(f"Market data updates disabled for user {user.username}. Skipping update.")
-        return 0, 0
+        return report
         
     logger.info("Updating price data for active securities")
-    active_securities = Security.objects.filter(active=True)
-    updated = 0
-    failed = 0
-    
-    for security in active_securities:
-        try:
-            updated_ok = MarketDataService.refresh_security_data(security, user)
-            if updated_ok:
-                updated += 1
+    started_at = time.monotonic()
+    active_securities = list(Security.objects.filter(active=True))
+    attempts = attempts or REFRESH_ATTEMPTS
+    retry_delay = REFRESH_RETRY_DELAY if retry_delay is None else retry_delay
+    
+    provider = get_provider(user=user)
+    batch_size = batch_size or provider.batch_size
+    batches = [active_securities[i:i + batch_size] for i in range(0, len(active_securities), batch_size)]
+    
+    with ThreadPoolExecutor(max_workers=max_workers or REFRESH_WORKERS) as executor:
+        batch_futures = {
+            executor.submit(_refresh_batch, provider, batch, attempts, retry_delay): batch
+            for batch in batches
+        }
+        remaining = []
+        for future in as_completed(batch_futures):
+            stored, retries = future.result()
+            report.batches += 1
+            report.retries += retries
+            for security in batch_futures[future]:
+                if security.pk in stored:
+                    report.updated.append(security.symbol)
+                else:
+                    remaining.append(security)
+        
+        report.fallbacks = len(remaining)
+        futures = {
+            executor.submit(_refresh_with_retry, security, user, attempts, retry_delay): security
+            for security in remaining
+        }
+        for future in as_completed(futures):
+            security = futures[future]
+            made, error = future.result()
+            report.retries += made - 1
+            if error is None:
+                report.updated.append(security.symbol)
             else:
-                failed += 1
-                
-            # Prevent hitting rate limits
-            time.sleep(0.5)
-            
-        except Exception as e:
-            logger.error(f"Error updating {security.symbol}: {e}")
-            failed += 1
+                logger.error(f"Error updating {security.symbol} after {made} attempts: {error}")
+                report.failed[security.symbol] = error
     
-    logger.info(f"Price update completed. Updated: {updated}, Failed: {failed}")
-    return updated, failed
+    report.elapsed = time.monotonic() - started_at
+    logger.info(f"Price update completed. {report.summary()}")
+    return report
 
-def fetch_price_history(security_id, start_date=None, end_date=None):
+def _missing_ranges(securities, start_date, end_date, include_head=False):
+    """
+    Find the date ranges missing from the stored price history of securities.
+    
+    A summary query gets each security's first and last stored date and
+    number of prices within the range. The days after the last price are
+    missing. Only securities with fewer prices than business days, beyond
+    what holidays explain, get their dates loaded to find holes of more than
+    MAX_PRICE_GAP_DAYS calendar days.
+    
+    Args:
+        securities: Security objects
+        start_date: First day of the range
+        end_date: Last day of the range
+        include_head: Also count the days before the first stored price as
+            missing, for ranges starting before the history was fetched
+        
+    Returns:
+        Dict mapping security IDs to lists of (first, last) missing date
+        ranges; securities with complete histories are left out
+    """
+    summaries = {
+        security_id: (first, last, rows)
+        for security_id, first, last, rows in PriceData.objects.filter(
+            security__in=securities, date__range=(start_date, end_date)
+        ).order_by().values('security_id').annotate(
+            first=Min('date'), last=Max('date'), rows=Count('*')
+        ).values_list('security_id', 'first', 'last', 'rows')
+    }
+    
+    missing = {}
+    suspects = []
+    for security in securities:
+        if security.pk not in summaries:
+            missing[security.pk] = [(start_date, end_date)]
+            continue
+        first, last, rows = summaries[security.pk]
+        ranges = []
+        if include_head and (first - start_date).days > MAX_PRICE_GAP_DAYS:
+            ranges.append((start_date, first - timedelta(days=1)))
+        if last < end_date:
+            ranges.append((last + timedelta(days=1), end_date))
+        if ranges:
+            missing[security.pk] = ranges
+        
+        business_days = int(np.busday_count(first, last + timedelta(days=1)))
+        holidays = HOLIDAYS_PER_YEAR * ((last - first).days + 1) / 365
+        if business_days - rows > holidays:
+            suspects.append(security.pk)
+    
+    if suspects:
+        dates = {}
+        for security_id, price_date in PriceData.objects.filter(
+            security__in=suspects, date__range=(start_date, end_date)
+        ).order_by('security_id', 'date').values_list('security_id', 'date'):
+            dates.setdefault(security_id, []).append(price_date)
+        for security_id, security_dates in dates.items():
+            for previous, following in zip(security_dates, security_dates[1:]):
+                if (following - previous).days > MAX_PRICE_GAP_DAYS:
+                    missing.setdefault(security_id, []).append(
+                        (previous + timedelta(days=1), following - timedelta(days=1))
+                    )
+    
+    return missing
+
+def _price_data_from_array(security, prices, source):
+    """
+    Build unsaved PriceData rows from a PRICE_DTYPE array of a security.
+    """
+    # Rounded to the stored precision, so the fields convert exactly
+    columns = [np.round(prices[name], 4).tolist() for name in ('open', 'high', 'low', 'close', 'adj_close')]
+    return [
+        PriceData(
+            security=security, date=day, open=open_, high=high, low=low,
+            close=close, adj_close=adj_close, volume=volume, source=source
+        )
+        for day, open_, high, low, close, adj_close, volume in zip(
+            prices['date'].tolist(), *columns, prices['volume'].tolist()
+        )
+    ]
+
+def backfill_price_history(securities=None, start_date=None, end_date=None, full=False, user=None):
+    """
+    Fetch the missing price history of many securities.
+    
+    Only the days missing from the stored history are requested (see
+    _missing_ranges()): normally the days since the last stored price. The
+    securities missing the same range are fetched together with the
+    provider's bulk history method, batch_size symbols at a time, and each
+    chunk's prices are upserted as soon as they are fetched. A chunk that
+    fails is logged and skipped.
+    
+    Args:
+        securities: Security objects (default all active securities)
+        start_date: Optional start date (defaults to 1 year ago). When given,
+            days missing before the first stored price are fetched too.
+        end_date: Optional end date (defaults to today)
+        full: Fetch and rewrite the whole range, stored prices included
+        user: Optional user context for the provider preference
+        
+    Returns:
+        Number of prices written
+    """
+    securities = list(Security.objects.filter(active=True) if securities is None else securities)
+    end_date = end_date or date.today()
+    include_head = start_date is not None
+    start_date = start_date or end_date - timedelta(days=365)
+    
+    if full:
+        missing = {security.pk: [(start_date, end_date)] for security in securities}
+    else:
+        missing = _missing_ranges(securities, start_date, end_date, include_head=include_head)
+    
+    securities_by_range = {}
+    for security in securities:
+        for date_range in missing.get(security.pk, []):
+            securities_by_range.setdefault(date_range, []).append(security)
+    
+    provider = get_provider(user=user)
+    saved_count = 0
+    failed_chunks = 0
+    for (range_start, range_end), range_securities in securities_by_range.items():
+        # Each chunk is stored as soon as it is fetched
+        for i in range(0, len(range_securities), provider.batch_size):
+            chunk = range_securities[i:i + provider.batch_size]
+            try:
+                saved_count += _backfill_chunk(provider, chunk, range_start, range_end)
+            except Exception as e:
+                failed_chunks += 1
+                logger.error(f"Error backfilling {len(chunk)} securities from {range_start} to {range_end}: {e}")
+    
+    logger.info(f"Backfilled {saved_count} prices for {len(securities)} securities "
+                f"in {len(securities_by_range)} date ranges, {failed_chunks} chunks failed")
+    return saved_count
+
+def _backfill_chunk(provider, securities, range_start, range_end):
+    """
+    Fetch and store the prices of securities within one date range.
+    
+    Returns:
+        Number of prices written
+    """
+    by_symbol = {security.symbol: security for security in securities}
+    history = provider.get_historical_price_arrays_bulk(
+        list(by_symbol), start_date=range_start, end_date=range_end
+    )
+    source = provider.__class__.__name__
+    prices = []
+    for symbol, price_array in history.items():
+        security = by_symbol.get(symbol)
+        if security is None:
+            continue
+        # Providers may return more days than asked for
+        days = price_array['date']
+        price_array = price_array[(days >= np.datetime64(range_start)) & (days <= np.datetime64(range_end))]
+        prices.extend(_price_data_from_array(security, price_array, source))
+    return PriceData.bulk_store(prices)
+
+def fetch_price_history(security_id, start_date=None, end_date=None, full=False):
     """
     Fetch complete price history for a security.
-    This is typically used when adding a new security.
+    This is typically used when adding a new security. Only the days missing
+    from the stored history are requested, see backfill_price_history().
     
     Args:
         security_id: UUID of the security
         start_date: Optional start date (defaults to 1 year ago)
         end_date: Optional end date (defaults to today)
+        full: Fetch and rewrite the whole range, stored prices included
     """
     try:
         security = Security.objects.get(id=security_id)
         
-        if not end_date:
-            end_date = date.today()
-            
-        if not start_date:
-            # Default to 1 year history
-            start_date = end_date - timedelta(days=365)
-            
-        logger.info(f"Fetching price history for {security.symbol} from {start_date} to {end_date}")
-        
-        provider = get_provider()
-        price_data_list = provider.get_historical_prices(
-            security.symbol,
-            start_date=start_date,
-            end_date=end_date
-        )
-        
-        # Process and save the price data
-        saved_count = 0
-        with transaction.atomic():
-            for price_data in price_data_list:
-                price_date = date.fromisoformat(price_data['date'])
-                PriceData.objects.update_or_create(
-                    security=security,
-                    date=price_date,
-                    defaults={
-                        'open': price_data['open'],
-                        'high': price_data['high'],
-                        'low': price_data['low'],
-                        'close': price_data['close'],
-                        'adj_close': price_data['adj_close'],
-                        'volume': price_data['volume'],
-                        'source': provider.__class__.__name__
-                    }
-                )
-                saved_count += 1
+        logger.info(f"Fetching price history for {security.symbol} from {start_date or 'a year ago'} "
+                    f"to {end_date or 'today'}")
+        saved_count = backfill_price_history([security], start_date=start_date, end_date=end_date, full=full)
         
         logger.info(f"Successfully saved {saved_count} price records for {security.symbol}")
         return saved_count
@@ -113,4 +374,3 @@ def fetch_price_history(security_id, start_date=None, end_date=None):
     except Exception as e:
         logger.error(f"Error fetching price history: {e}")
         raise
-
@@ -1,3 +1,274 @@
-from django.test import TestCase
+import datetime
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+import requests
+from django.test import SimpleTestCase, TestCase
+
+from .models import PriceData, Security
+from .providers.alpha_vantage import AlphaVantageProvider
+from .providers.base import MarketDataProviderBase, rows_to_array
+from .providers.yahoo import YahooFinanceProvider
+from .services import MarketDataService
+from .ratelimit import TokenBucket
+from .tasks import backfill_price_history, update_price_data_for_active_securities
+
+
+class TokenBucketTests(TestCase):
+    def test_bursts_then_waits_for_refill(self):
+        now = [0.0]
+
+        def sleep(seconds):
+            now[0] += seconds
+
+        bucket = TokenBucket(rate=2, capacity=3, clock=lambda: now[0], sleep=sleep)
+        self.assertEqual([bucket.acquire() for _ in range(3)], [0, 0, 0])
+        self.assertFalse(bucket.try_acquire())
+        self.assertAlmostEqual(bucket.acquire(), 0.5)
+        now[0] += 10
+        # Refills up to its capacity only
+        self.assertEqual(sum(bucket.try_acquire() for _ in range(5)), 3)
+
+
+class BatchProvider(MarketDataProviderBase):
+    """Provider quoting odd-numbered symbols only, failing its first batch call"""
+    batch_size = 5
+
+    def __init__(self):
+        self.batch_calls = []
+        self.lock = threading.Lock()
+
+    def get_latest_prices(self, symbols):
+        with self.lock:
+            self.batch_calls.append(list(symbols))
+            if len(self.batch_calls) == 1:
+                raise ValueError('Temporarily unavailable')
+        return {
+            symbol: {'date': '2024-01-02', 'open': 10, 'high': 11, 'low': 9, 'close': 10.5, 'volume': 100}
+            for symbol in symbols if int(symbol[3:]) % 2
+        }
+
+    def get_security_info(self, symbol):
+        raise NotImplementedError
+
+    def get_latest_price(self, symbol):
+        raise NotImplementedError
+
+    def get_historical_prices(self, symbol, start_date=None, end_date=None, period='max'):
+        raise NotImplementedError
+
+    def search_securities(self, query):
+        return []
+
+
+class ConcurrentRefreshTests(TestCase):
+    def setUp(self):
+        for index in range(12):
+            Security.objects.create(symbol=f'SYM{index}', name=f'Security {index}', security_type='stock')
+
+    def test_batches_then_refreshes_missing_symbols_with_retries(self):
+        calls = {}
+        lock = threading.Lock()
+
+        def refresh(security, user=None):
+            with lock:
+                calls[security.symbol] = calls.get(security.symbol, 0) + 1
+                count = calls[security.symbol]
+            # SYM0 always fails, SYM2 fails once
+            return security.symbol != 'SYM0' and (security.symbol != 'SYM2' or count > 1)
+
+        def store(securities, prices, source):
+            return {security.pk for security in securities if security.symbol in prices}
+
+        provider = BatchProvider()
+        # Worker threads can't write while the test case holds its transaction
+        with mock.patch('market_data.tasks.get_provider', return_value=provider), \
+                mock.patch('market_data.tasks.MarketDataService.store_latest_prices', side_effect=store), \
+                mock.patch('market_data.tasks.MarketDataService.refresh_security_data', side_effect=refresh), \
+                mock.patch('market_data.tasks.MarketDataSettings.is_updates_enabled', return_value=True):
+            report = update_price_data_for_active_securities(max_workers=4, attempts=3, retry_delay=0)
+
+        # 3 batches of at most 5 symbols, one of them retried
+        self.assertEqual(len(provider.batch_calls), 4)
+        self.assertEqual(report.batches, 3)
+        # Even symbols are missing from the quotes and refreshed one at a time
+        self.assertEqual(report.fallbacks, 6)
+        self.assertEqual(set(calls), {f'SYM{index}' for index in range(0, 12, 2)})
+        self.assertEqual(report.updated_count, 11)
+        self.assertEqual(list(report.failed), ['SYM0'])
+        self.assertEqual(calls['SYM0'], 3)
+        self.assertEqual(report.retries, 1 + 2 + 1)
+
+    def test_stores_batch_quotes(self):
+        securities = list(Security.objects.order_by('symbol'))
+        prices = {'SYM1': {'date': '2024-01-02', 'open': 10, 'high': 11, 'low': 9, 'close': 10.5, 'volume': 100}}
+        stored = MarketDataService.store_latest_prices(securities, prices, 'BatchProvider')
+        self.assertEqual(stored, {Security.objects.get(symbol='SYM1').pk})
+        price = PriceData.objects.get()
+        self.assertEqual((price.date, float(price.close), price.source), (datetime.date(2024, 1, 2), 10.5, 'BatchProvider'))
+
+
+class HistoryProvider(BatchProvider):
+    """Provider with a price for every business day of the requested ranges"""
+
+    def get_historical_prices_bulk(self, symbols, start_date=None, end_date=None):
+        self.batch_calls.append((sorted(symbols), start_date, end_date))
+        if 'FAIL' in symbols:
+            raise ValueError('Provider error')
+        days = np.arange(start_date, end_date + datetime.timedelta(days=1), dtype='datetime64[D]')
+        rows = [
+            {'date': str(day), 'open': 10, 'high': 11, 'low': 9, 'close': 10.5, 'adj_close': 10.5, 'volume': 100}
+            for day in days[np.is_busday(days)]
+        ]
+        return {symbol: rows for symbol in symbols}
+
+
+class BackfillTests(TestCase):
+    def setUp(self):
+        self.security = Security.objects.create(symbol='HIST', name='History', security_type='stock')
+        days = np.arange('2024-01-02', '2024-02-01', dtype='datetime64[D]')
+        # January with a hole in the third week
+        stored = [day.item() for day in days[np.is_busday(days)] if not 15 <= day.item().day <= 19]
+        PriceData.objects.bulk_create([
+            PriceData(security=self.security, date=day, open=1, high=1, low=1, close=1, adj_close=1, volume=1)
+            for day in stored
+        ])
+        self.stored_count = len(stored)
+
+    def test_fetches_only_the_missing_tail_and_holes(self):
+        provider = HistoryProvider()
+        with mock.patch('market_data.tasks.get_provider', return_value=provider), \
+                mock.patch('performance.signals.SnapshotService.invalidate_tickers') as invalidate:
+            saved = backfill_price_history([self.security], end_date=datetime.date(2024, 2, 9))
+
+        self.assertEqual(sorted(call[1:] for call in provider.batch_calls), [
+            (datetime.date(2024, 1, 13), datetime.date(2024, 1, 21)),
+            (datetime.date(2024, 2, 1), datetime.date(2024, 2, 9)),
+        ])
+        self.assertEqual(saved, 5 + 7)
+        self.assertEqual(PriceData.objects.count(), self.stored_count + 12)
+        # Stored prices are left alone
+        self.assertEqual(PriceData.objects.filter(close=1).count(), self.stored_count)
+        # Once per stored chunk
+        self.assertEqual(sorted(call.args[0]['HIST'] for call in invalidate.call_args_list),
+                         [datetime.date(2024, 1, 15), datetime.date(2024, 2, 1)])
+
+        # Nothing is missing anymore
+        provider.batch_calls = []
+        with mock.patch('market_data.tasks.get_provider', return_value=provider):
+            self.assertEqual(backfill_price_history([self.security], end_date=datetime.date(2024, 2, 9)), 0)
+        self.assertEqual(provider.batch_calls, [])
+
+    def test_failed_chunk_keeps_the_others(self):
+        failing = Security.objects.create(symbol='FAIL', name='Failing', security_type='stock')
+        provider = HistoryProvider()
+        with mock.patch('market_data.tasks.get_provider', return_value=provider):
+            saved = backfill_price_history([failing, self.security], end_date=datetime.date(2024, 2, 9))
+
+        # The failing security's whole year is one range, HIST's two are stored
+        self.assertEqual(len(provider.batch_calls), 3)
+        self.assertEqual(saved, 12)
+        self.assertFalse(PriceData.objects.filter(security=failing).exists())
+
+
+class YahooConversionTests(SimpleTestCase):
+    def test_download_converts_column_by_column(self):
+        index = pd.DatetimeIndex(['2024-01-02', '2024-01-03', '2024-01-04'], tz='America/New_York')
+        frame = pd.DataFrame({
+            ('AAA', 'Open'): [1.0, 2.0, 3.0], ('AAA', 'High'): [1.5, 2.5, 3.5], ('AAA', 'Low'): [0.5, 1.5, 2.5],
+            ('AAA', 'Close'): [1.25, 2.25, 3.25], ('AAA', 'Volume'): [100.0, np.nan, 300.0],
+            ('BBB', 'Open'): [np.nan, 5.0, 6.0], ('BBB', 'High'): [np.nan, 5.5, 6.5],
+            ('BBB', 'Low'): [np.nan, 4.5, 5.5], ('BBB', 'Close'): [np.nan, 5.25, 6.25],
+            ('BBB', 'Volume'): [np.nan, 10.0, 20.0],
+        }, index=index)
+
+        provider = YahooFinanceProvider()
+        with mock.patch('yfinance.download', return_value=frame), mock.patch.object(provider, '_throttle'):
+            arrays = provider.get_historical_price_arrays_bulk(
+                ['AAA', 'BBB'], datetime.date(2024, 1, 2), datetime.date(2024, 1, 4)
+            )
+            rows = provider.get_historical_prices_bulk(['AAA', 'BBB'], datetime.date(2024, 1, 2), datetime.date(2024, 1, 4))
+
+        self.assertEqual(arrays['AAA']['date'].tolist(), [datetime.date(2024, 1, day) for day in (2, 3, 4)])
+        self.assertEqual(arrays['AAA']['volume'].tolist(), [100, 0, 300])
+        # BBB didn't trade on the first day
+        self.assertEqual(len(arrays['BBB']), 2)
+        self.assertEqual(rows['BBB'][0], {
+            'date': '2024-01-03', 'open': 5.0, 'high': 5.5, 'low': 4.5,
+            'close': 5.25, 'adj_close': 5.25, 'volume': 10
+        })
+        np.testing.assert_array_equal(rows_to_array(rows['AAA']), arrays['AAA'])
+
+
+class YahooRetryTests(SimpleTestCase):
+    def test_connection_errors_are_retried(self):
+        provider = YahooFinanceProvider(max_retries=3, retry_delay=0)
+        fetch = mock.Mock(side_effect=[requests.exceptions.ConnectionError('reset'), 'data'])
+        with mock.patch.object(provider, '_throttle') as throttle:
+            self.assertEqual(provider._execute_with_retry(fetch, request_count=2), 'data')
+        self.assertEqual(fetch.call_count, 2)
+        throttle.assert_called_with(2)
+
+        fetch = mock.Mock(side_effect=requests.exceptions.ConnectionError('reset'))
+        with mock.patch.object(provider, '_throttle'), self.assertRaises(requests.exceptions.ConnectionError):
+            provider._execute_with_retry(fetch)
+        self.assertEqual(fetch.call_count, 3)
+
+
+class StubAlphaVantageHandler(BaseHTTPRequestHandler):
+    """Answers with the queued (status, payload) responses of its server"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.client_address, self.path))
+        status, payload = self.server.responses.pop(0)
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class AlphaVantageSessionTests(SimpleTestCase):
+    quote = {'Global Quote': {'02. open': '10', '03. high': '11', '04. low': '9', '05. price': '10.5',
+                              '06. volume': '100', '09. change': '0.5'}}
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubAlphaVantageHandler)
+        self.server.requests = []
+        self.server.responses = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        throttle = mock.patch.object(AlphaVantageProvider, '_throttle')
+        throttle.start()
+        self.addCleanup(throttle.stop)
+        self.provider = AlphaVantageProvider(
+            base_url=f'http://127.0.0.1:{self.server.server_port}/query', retry_delay=0, pool_size=2
+        )
+        self.provider.api_key = 'test'
+
+    def test_retries_rate_limit_notes_over_one_connection(self):
+        self.server.responses = [(200, {'Note': 'Our standard API call frequency is 5 calls per minute'}),
+                                 (503, {}), (200, self.quote), (200, self.quote)]
+        self.assertEqual(self.provider.get_latest_price('IBM')['close'], 10.5)
+        self.assertEqual(self.provider.get_latest_price('MSFT')['close'], 10.5)
+
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertIn('function=GLOBAL_QUOTE', self.server.requests[0][1])
+        # Kept alive and reused by every request
+        self.assertEqual(len({address for address, _ in self.server.requests}), 1)
+
+    def test_gives_up_when_rate_limited_for_the_day(self):
+        self.server.responses = [(200, {'Information': 'Our standard API rate limit is 25 requests per day.'})]
+        with self.assertRaisesMessage(ValueError, 'rate limited'):
+            self.provider.get_latest_price('IBM')
+        self.assertEqual(len(self.server.requests), 1)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class MetricsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'metrics'
+
+    def ready(self):
+        """Connect the metric value cache invalidation signals"""
+        import metrics.signals
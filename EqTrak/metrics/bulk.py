@@ -0,0 +1,121 @@
+"""
+Bulk computation of the standard position metrics.
+
+Computes shares, average price, cost basis and current value for every
+position of a portfolio from the positions' running totals, so the number of
+queries does not depend on the number of positions or transactions.
+"""
+from django.db.models import F, OuterRef, Subquery
+
+from .models import LatestMetricValue, MetricType
+
+# Computation sources of the metrics computed here
+BULK_SOURCES = ('shares', 'avg_price', 'cost_basis', 'current_value')
+
+
+def compute_position_metrics_bulk(portfolio, active_only=True):
+    """
+    Compute the standard position metrics for every position of a portfolio.
+
+    Args:
+        portfolio: Portfolio instance
+        active_only: Only include active positions (default True)
+
+    Returns:
+        Dict mapping position_id to a dict keyed by computation source
+        ('shares', 'avg_price', 'cost_basis', 'current_value') plus 'market_price'
+    """
+    positions = portfolio.position_set.all()
+    if active_only:
+        positions = positions.filter(is_active=True)
+    return compute_metrics_for_positions(positions)
+
+
+def compute_metrics_for_positions(positions):
+    """
+    Compute the standard position metrics for a queryset or list of positions.
+
+    Reads the positions' running totals (PositionAggregate) with the latest
+    Market Price value attached from the latest value projection, in one query.
+
+    Args:
+        positions: Position queryset, or an iterable of Position instances
+
+    Returns:
+        Dict mapping position_id to a dict of metric values keyed by computation source
+    """
+    from portfolio.models import Position, PositionAggregate
+
+    if not hasattr(positions, 'annotate'):
+        position_ids = [position.pk for position in positions]
+        if not position_ids:
+            return {}
+        positions = Position.objects.filter(pk__in=position_ids)
+
+    rows = positions.order_by().annotate(
+        shares=F('aggregate__total_shares'),
+        bought=F('aggregate__total_buy_quantity'),
+        buy_cost=F('aggregate__total_buy_cost'),
+        open_cost=F('aggregate__open_cost'),
+    )
+
+    market_price_metric = MetricType.get_system_metric('Market Price', scope_type='POSITION')
+    if market_price_metric:
+        latest_price = LatestMetricValue.objects.filter(
+            metric_type=market_price_metric,
+            position=OuterRef('pk')
+        ).values('metric_value__value')[:1]
+        rows = rows.annotate(market_price=Subquery(latest_price))
+
+    fields = ['position_id', 'shares', 'bought', 'buy_cost', 'open_cost']
+    if market_price_metric:
+        fields.append('market_price')
+
+    rows = list(rows.values(*fields))
+    missing = [row['position_id'] for row in rows if row['shares'] is None]
+    if missing:
+        # Positions without running totals yet are summed here, not stored:
+        # reads never write
+        totals = {
+            aggregate.position_id: aggregate
+            for aggregate in PositionAggregate.compute(Position.objects.filter(pk__in=missing))
+        }
+        for row in rows:
+            aggregate = totals.get(row['position_id'])
+            if aggregate is not None:
+                row.update(
+                    shares=aggregate.total_shares,
+                    bought=aggregate.total_buy_quantity,
+                    buy_cost=aggregate.total_buy_cost
+                )
+
+    results = {}
+    for row in rows:
+        results[row['position_id']] = _position_metrics_from_totals(
+            shares=row['shares'] or 0,
+            bought=row['bought'] or 0,
+            buy_cost=row['buy_cost'] or 0,
+            open_cost=row['open_cost'],
+            market_price=row.get('market_price')
+        )
+    return results
+
+
+def _position_metrics_from_totals(shares, bought, buy_cost, open_cost, market_price):
+    """
+    Derive the position metrics from a position's running totals.
+
+    Mirrors the per-position computations in MetricType so both paths
+    produce the same values.
+    """
+    from portfolio.models import PositionAggregate
+
+    avg_price = PositionAggregate.average_price(shares, bought, buy_cost, open_cost)
+
+    return {
+        'shares': shares,
+        'avg_price': avg_price,
+        'cost_basis': shares * avg_price,
+        'current_value': shares * market_price if market_price is not None else None,
+        'market_price': market_price,
+    }
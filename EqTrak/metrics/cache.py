@@ -0,0 +1,86 @@
+"""
+Request-scoped memoization of metric values.
+
+Templates and views ask for the same metric of the same object many times
+while rendering a page. While a cache is active (see MetricValueCacheMiddleware
+or the metric_value_cache() context manager), MetricType.compute_value and
+MetricType.get_latest_value memoize their results per target and metric.
+
+Entries are grouped by scope and target so writes can invalidate only what
+they affect; the signal handlers in metrics.signals take care of that.
+Outside an active cache nothing is memoized.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Sentinel returned by MetricValueCache.get() for missing entries, since
+# None is a legitimate cached value
+MISSING = object()
+
+# Scopes whose cached values depend on values of the given scope
+DEPENDENT_SCOPES = {
+    'POSITION': ['PORTFOLIO', 'TRANSACTION'],
+    'TRANSACTION': [],
+    'PORTFOLIO': [],
+}
+
+_active_cache = ContextVar('metric_value_cache', default=None)
+
+
+class MetricValueCache:
+    """
+    In-memory store of metric values for the current request.
+
+    Entries are stored as {scope_type: {target_pk: {key: value}}}.
+    """
+
+    def __init__(self):
+        self._entries = {scope_type: {} for scope_type in DEPENDENT_SCOPES}
+
+    def get(self, scope_type, target_pk, key):
+        """Get a cached value, or MISSING if it is not cached"""
+        return self._entries.get(scope_type, {}).get(target_pk, {}).get(key, MISSING)
+
+    def set(self, scope_type, target_pk, key, value):
+        """Store a value for a target"""
+        self._entries.setdefault(scope_type, {}).setdefault(target_pk, {})[key] = value
+
+    def invalidate(self, scope_type, target_pk):
+        """
+        Drop the cached values of a target and of every scope derived from it.
+
+        Position values feed portfolio totals and transaction performance, so
+        invalidating a position also clears the portfolio and transaction entries.
+        """
+        self._entries.get(scope_type, {}).pop(target_pk, None)
+        for dependent_scope in DEPENDENT_SCOPES.get(scope_type, []):
+            self._entries[dependent_scope] = {}
+
+    def clear(self):
+        """Drop all cached values"""
+        for scope_type in self._entries:
+            self._entries[scope_type] = {}
+
+
+def get_active_cache():
+    """Get the metric value cache of the current request, or None if inactive"""
+    return _active_cache.get()
+
+
+@contextmanager
+def metric_value_cache():
+    """
+    Activate a metric value cache for the duration of the block.
+
+    Nested blocks reuse the outer cache.
+    """
+    if _active_cache.get() is not None:
+        yield _active_cache.get()
+        return
+
+    cache = MetricValueCache()
+    token = _active_cache.set(cache)
+    try:
+        yield cache
+    finally:
+        _active_cache.reset(token)
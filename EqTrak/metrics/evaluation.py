@@ -0,0 +1,224 @@
+"""
+Metric evaluation engine.
+
+Builds the dependency graph between the metric types of a scope once,
+orders it topologically and evaluates every computed metric for one or
+more targets in a single pass. Intermediate values (shares, average price,
+...) are memoized per target so each one is computed exactly once, and the
+standard position metrics of a batch are seeded from one aggregate query.
+Formula metrics are evaluated a column at a time over all targets, after the
+metrics they reference.
+"""
+import heapq
+import logging
+
+from .formulas import FormulaError, evaluate_formula, get_compiled_formula
+from .models import MetricType
+
+logger = logging.getLogger(__name__)
+
+
+class EvaluationContext:
+    """
+    Per-target memo shared by all metric computations in one evaluation pass.
+
+    Attributes:
+        target: The object (position, portfolio or transaction) being evaluated
+        metrics_by_source: Mapping of computation_source to the system metric
+            that provides it, or None to fall back to database lookups
+        values: Computed values keyed by computation_source
+    """
+
+    def __init__(self, target, metrics_by_source=None):
+        self.target = target
+        self.metrics_by_source = metrics_by_source
+        self.values = {}
+
+
+class MetricEvaluator:
+    """
+    Evaluates all metrics of a scope in dependency order.
+
+    Usage:
+        evaluator = MetricEvaluator('POSITION')
+        values = evaluator.evaluate(position)            # {MetricType: value}
+        values_by_pk = evaluator.evaluate_many(positions)  # {pk: {MetricType: value}}
+    """
+
+    def __init__(self, scope_type, metric_types=None):
+        """
+        Build the dependency graph for a scope.
+
+        Args:
+            scope_type: One of MetricType.SCOPE_TYPES ('POSITION', 'PORTFOLIO', 'TRANSACTION')
+            metric_types: Optional iterable of MetricType instances to evaluate.
+                Defaults to every metric of the scope.
+        """
+        if metric_types is None:
+            metric_types = MetricType.objects.filter(
+                scope_type=scope_type
+            ).prefetch_related('computation_dependencies').order_by('computation_order', 'name')
+
+        self.scope_type = scope_type
+        self.metric_types = list(metric_types)
+
+        # The system metric providing each computation source, used to resolve
+        # dependencies without querying the database
+        self.metrics_by_source = {}
+        for metric in self.metric_types:
+            if metric.is_system and metric.computation_source:
+                self.metrics_by_source.setdefault(metric.computation_source, metric)
+
+        self.ordered_metrics = self._sort_metrics()
+
+    def _get_dependencies(self, metric):
+        """Get the metrics (within this evaluator) that a metric depends on"""
+        known = {m.metric_id for m in self.metric_types}
+        dependencies = []
+
+        for dependency in metric.computation_dependencies.all():
+            if dependency.metric_id in known and dependency.metric_id != metric.metric_id:
+                dependencies.append(dependency.metric_id)
+
+        for source in MetricType.SOURCE_DEPENDENCIES.get(metric.computation_source, []):
+            dependency = self.metrics_by_source.get(source)
+            if dependency is not None and dependency.metric_id != metric.metric_id:
+                dependencies.append(dependency.metric_id)
+
+        if metric.formula:
+            try:
+                references = get_compiled_formula(metric).dependencies
+            except FormulaError:
+                references = []
+            for dependency in references:
+                if dependency.metric_id in known and dependency.metric_id != metric.metric_id:
+                    dependencies.append(dependency.metric_id)
+
+        return dependencies
+
+    def _sort_metrics(self):
+        """
+        Topologically sort the metrics of this evaluator.
+
+        Ties are broken by computation_order and name so the order is stable.
+        Metrics that are part of a dependency cycle are appended at the end
+        in computation order and resolved on demand.
+        """
+        metrics_by_id = {m.metric_id: m for m in self.metric_types}
+        position = {m.metric_id: index for index, m in enumerate(self.metric_types)}
+        dependents = {metric_id: [] for metric_id in metrics_by_id}
+        remaining = {}
+
+        for metric in self.metric_types:
+            dependencies = set(self._get_dependencies(metric))
+            remaining[metric.metric_id] = len(dependencies)
+            for dependency_id in dependencies:
+                dependents[dependency_id].append(metric.metric_id)
+
+        def sort_key(metric_id):
+            metric = metrics_by_id[metric_id]
+            return (metric.computation_order, metric.name, position[metric_id])
+
+        ready = [(sort_key(metric_id), metric_id) for metric_id, count in remaining.items() if count == 0]
+        heapq.heapify(ready)
+
+        ordered = []
+        while ready:
+            _, metric_id = heapq.heappop(ready)
+            ordered.append(metrics_by_id[metric_id])
+            for dependent_id in dependents[metric_id]:
+                remaining[dependent_id] -= 1
+                if remaining[dependent_id] == 0:
+                    heapq.heappush(ready, (sort_key(dependent_id), dependent_id))
+
+        if len(ordered) < len(self.metric_types):
+            cyclic = sorted(
+                (metric_id for metric_id, count in remaining.items() if count > 0),
+                key=sort_key
+            )
+            logger.warning(
+                f"Dependency cycle between {self.scope_type} metrics: "
+                f"{', '.join(metrics_by_id[metric_id].name for metric_id in cyclic)}"
+            )
+            ordered.extend(metrics_by_id[metric_id] for metric_id in cyclic)
+
+        return ordered
+
+    def _prefetch(self, targets):
+        """
+        Load the values shared by all computations for a batch of targets.
+
+        Returns:
+            Dict mapping target pk to known values keyed by computation_source
+        """
+        if self.scope_type == 'POSITION':
+            from .bulk import compute_metrics_for_positions
+            return compute_metrics_for_positions(targets)
+        return {}
+
+    def evaluate(self, target):
+        """
+        Evaluate every computed metric for a single target.
+
+        Args:
+            target: Position, portfolio or transaction matching the evaluator scope
+
+        Returns:
+            Dict mapping MetricType to its computed value (None if unavailable)
+        """
+        return self.evaluate_many([target])[target.pk]
+
+    def evaluate_many(self, targets):
+        """
+        Evaluate every computed metric for a list of targets.
+
+        Args:
+            targets: Iterable of objects matching the evaluator scope
+
+        Returns:
+            Dict mapping each target's primary key to a {MetricType: value} dict
+        """
+        targets = list(targets)
+        if not targets:
+            return {}
+
+        known_values = self._prefetch(targets)
+
+        results = {}
+        for target in targets:
+            context = EvaluationContext(target, self.metrics_by_source)
+            for source, value in known_values.get(target.pk, {}).items():
+                if source in self.metrics_by_source:
+                    context.values[source] = value
+            values = {}
+
+            for metric in self.ordered_metrics:
+                if not metric.is_computed or metric.formula:
+                    continue
+
+                is_provider = self.metrics_by_source.get(metric.computation_source) is metric
+                if is_provider and metric.computation_source in context.values:
+                    # Already resolved as a dependency of an earlier metric
+                    values[metric] = context.values[metric.computation_source]
+                    continue
+
+                value = metric.compute_value(target, context=context)
+                values[metric] = value
+                if is_provider:
+                    context.values[metric.computation_source] = value
+
+            results[target.pk] = values
+
+        # Formulas read the columns computed above and those of earlier formulas
+        for metric in self.ordered_metrics:
+            if not (metric.is_computed and metric.formula):
+                continue
+            known_columns = {
+                known.metric_id: {pk: values[known] for pk, values in results.items()}
+                for known in self.metric_types
+                if known in results[targets[0].pk]
+            }
+            for pk, value in evaluate_formula(metric, targets, known_columns).items():
+                results[pk][metric] = value
+
+        return results
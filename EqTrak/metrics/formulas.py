@@ -0,0 +1,388 @@
+"""
+Formula metrics.
+
+A computed MetricType can define its value as an arithmetic expression over
+other metrics of the same scope, e.g. ``Current Value / Cost Basis - 1`` or
+``Market Price * Shares``.
+
+Formulas are parsed by a small recursive-descent parser into a tree of
+Number, Reference, UnaryOp, BinaryOp and Call nodes. Nothing is ever passed
+to eval(): only numbers, metric references, + - * / ^, parentheses and the
+functions in FUNCTIONS are accepted. The tree is then compiled into a chain of
+closures operating on NumPy arrays, so one call evaluates the formula for a
+whole column of targets. Missing inputs, division by zero and other invalid
+results yield None for the affected targets only.
+
+References are metric names of the formula's scope (user metrics included),
+or computation sources such as ``shares`` or ``avg price``. Names containing
+operator characters are written in brackets: ``[Position Gain/Loss] * 2``.
+"""
+import logging
+import re
+from collections import namedtuple
+from contextvars import ContextVar
+from decimal import Decimal
+from functools import lru_cache
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Nodes of a parsed formula
+Number = namedtuple('Number', ['value'])
+Reference = namedtuple('Reference', ['name'])
+UnaryOp = namedtuple('UnaryOp', ['op', 'operand'])
+BinaryOp = namedtuple('BinaryOp', ['op', 'left', 'right'])
+Call = namedtuple('Call', ['function', 'args'])
+
+OPERATORS = {
+    '+': np.add,
+    '-': np.subtract,
+    '*': np.multiply,
+    '/': np.divide,
+    '^': np.power,
+}
+
+# Functions available in formulas: name -> (numpy function, min args, max args)
+FUNCTIONS = {
+    'abs': (lambda args: np.abs(args[0]), 1, 1),
+    'sqrt': (lambda args: np.sqrt(args[0]), 1, 1),
+    'min': (lambda args: np.minimum.reduce(np.broadcast_arrays(*args)), 1, None),
+    'max': (lambda args: np.maximum.reduce(np.broadcast_arrays(*args)), 1, None),
+}
+
+# Results are stored in MetricValue.value, which keeps 6 decimal places
+RESULT_PLACES = 6
+
+TOKEN_PATTERN = re.compile(r"""
+    \s*(?:
+        (?P<number>\d+(?:\.\d*)?|\.\d+)
+      | \[(?P<bracketed>[^\]]+)\]
+      | (?P<name>[A-Za-z_]\w*(?:[ \t]+[A-Za-z_]\w*)*)
+      | (?P<op>\*\*|[-+*/^(),])
+    )
+""", re.VERBOSE)
+
+# Formula metrics being evaluated, to stop reference cycles
+_evaluating = ContextVar('evaluating_formulas', default=frozenset())
+
+
+class FormulaError(ValueError):
+    """Raised for formulas that cannot be parsed or resolved"""
+
+
+def tokenize(text):
+    """
+    Split a formula into (kind, value) tokens.
+
+    Raises:
+        FormulaError: On characters that are not part of the formula language
+    """
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = TOKEN_PATTERN.match(text, position)
+        if not match or match.end() == position:
+            raise FormulaError(f"Unexpected character {text[position:].strip()[:1]!r} at position {position}")
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'bracketed':
+            kind, value = 'name', value.strip()
+        elif kind == 'op' and value == '**':
+            value = '^'
+        tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+
+class _Parser:
+    """Recursive-descent parser for the formula grammar"""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.index = 0
+
+    def peek(self):
+        return self.tokens[self.index] if self.index < len(self.tokens) else (None, None)
+
+    def take(self, value=None):
+        kind, token = self.peek()
+        if kind is None or (value is not None and token != value):
+            expected = f"{value!r}" if value else "a value"
+            found = f"{token!r}" if token else "end of formula"
+            raise FormulaError(f"Expected {expected} but found {found}")
+        self.index += 1
+        return kind, token
+
+    def parse(self):
+        if not self.tokens:
+            raise FormulaError("Formula is empty")
+        node = self.expression()
+        if self.index < len(self.tokens):
+            raise FormulaError(f"Unexpected {self.peek()[1]!r}")
+        return node
+
+    def expression(self):
+        node = self.term()
+        while self.peek() in (('op', '+'), ('op', '-')):
+            _, op = self.take()
+            node = BinaryOp(op, node, self.term())
+        return node
+
+    def term(self):
+        node = self.unary()
+        while self.peek() in (('op', '*'), ('op', '/')):
+            _, op = self.take()
+            node = BinaryOp(op, node, self.unary())
+        return node
+
+    def unary(self):
+        if self.peek() in (('op', '-'), ('op', '+')):
+            _, op = self.take()
+            return UnaryOp(op, self.unary())
+        return self.power()
+
+    def power(self):
+        node = self.atom()
+        if self.peek() == ('op', '^'):
+            self.take()
+            # Right associative, and binds tighter than unary minus on its left
+            node = BinaryOp('^', node, self.unary())
+        return node
+
+    def atom(self):
+        kind, token = self.take()
+        if kind == 'number':
+            return Number(float(token))
+        if kind == 'name':
+            if token.lower() in FUNCTIONS and self.peek() == ('op', '('):
+                return self.call(token.lower())
+            return Reference(token)
+        if token == '(':
+            node = self.expression()
+            self.take(')')
+            return node
+        raise FormulaError(f"Unexpected {token!r}")
+
+    def call(self, function):
+        self.take('(')
+        args = [self.expression()]
+        while self.peek() == ('op', ','):
+            self.take()
+            args.append(self.expression())
+        self.take(')')
+
+        _, min_args, max_args = FUNCTIONS[function]
+        if len(args) < min_args or (max_args is not None and len(args) > max_args):
+            raise FormulaError(f"Wrong number of arguments for {function}()")
+        return Call(function, tuple(args))
+
+
+@lru_cache(maxsize=256)
+def parse_formula(text):
+    """
+    Parse a formula into its node tree.
+
+    Returns:
+        Root node of the formula
+
+    Raises:
+        FormulaError: If the formula is not valid
+    """
+    return _Parser(tokenize(text)).parse()
+
+
+def get_references(node):
+    """Get the metric names referenced by a node tree, in order of appearance"""
+    if isinstance(node, Reference):
+        return [node.name]
+    if isinstance(node, UnaryOp):
+        return get_references(node.operand)
+    if isinstance(node, BinaryOp):
+        return get_references(node.left) + get_references(node.right)
+    if isinstance(node, Call):
+        return [name for arg in node.args for name in get_references(arg)]
+    return []
+
+
+def resolve_reference(name, scope_type):
+    """
+    Find the metric a formula reference points to.
+
+    Args:
+        name: Metric name or computation source as written in the formula
+        scope_type: Scope of the formula's metric
+
+    Returns:
+        MetricType instance or None
+    """
+    from .registry import registry
+
+    metric = registry.get_by_name(name, scope_type=scope_type, is_system=None)
+    if metric is None:
+        source = '_'.join(name.lower().split())
+        metric = registry.get_by_source(source, scope_type)
+    return metric
+
+
+class CompiledFormula:
+    """
+    A parsed formula with its references resolved, ready to be evaluated
+    for many targets at once.
+
+    Attributes:
+        text: The formula as written
+        dependencies: MetricType instances referenced by the formula
+    """
+
+    def __init__(self, text, scope_type):
+        """
+        Raises:
+            FormulaError: If the formula is invalid or references an unknown metric
+        """
+        self.text = text
+        node = parse_formula(text)
+
+        metrics = {}
+        for name in get_references(node):
+            metric = resolve_reference(name, scope_type)
+            if metric is None:
+                raise FormulaError(f"Unknown metric {name!r}")
+            if metric.data_type == 'MEMO':
+                raise FormulaError(f"Memo metric {name!r} has no numeric value")
+            metrics[name] = metric
+
+        self.dependencies = list({metric.metric_id: metric for metric in metrics.values()}.values())
+        self._evaluate = self._compile(node, metrics)
+
+    def _compile(self, node, metrics):
+        """Turn a node tree into a function of the input columns"""
+        if isinstance(node, Number):
+            value = node.value
+            return lambda columns: value
+        if isinstance(node, Reference):
+            metric_id = metrics[node.name].metric_id
+            return lambda columns: columns[metric_id]
+        if isinstance(node, UnaryOp):
+            operand = self._compile(node.operand, metrics)
+            if node.op == '-':
+                return lambda columns: np.negative(operand(columns))
+            return operand
+        if isinstance(node, BinaryOp):
+            function = OPERATORS[node.op]
+            left = self._compile(node.left, metrics)
+            right = self._compile(node.right, metrics)
+            return lambda columns: function(left(columns), right(columns))
+        if isinstance(node, Call):
+            function = FUNCTIONS[node.function][0]
+            args = [self._compile(arg, metrics) for arg in node.args]
+            return lambda columns: function([arg(columns) for arg in args])
+        raise FormulaError(f"Unsupported formula element {node!r}")
+
+    def evaluate(self, columns, size):
+        """
+        Evaluate the formula over columns of input values.
+
+        Args:
+            columns: Dict mapping dependency metric_id to a list of values
+                (numbers or None), all of length size
+            size: Number of targets
+
+        Returns:
+            List of Decimal results, None where an input is missing or the
+            result is not a finite number
+        """
+        arrays = {
+            metric_id: np.array([np.nan if value is None else float(value) for value in values], dtype=float)
+            for metric_id, values in columns.items()
+        }
+        with np.errstate(all='ignore'):
+            result = np.broadcast_to(np.asarray(self._evaluate(arrays), dtype=float), (size,))
+
+        return [
+            Decimal(f"{value:.{RESULT_PLACES}f}") if np.isfinite(value) else None
+            for value in result
+        ]
+
+
+def get_compiled_formula(metric_type):
+    """
+    Get the compiled formula of a metric type.
+
+    The compiled formula is cached on the instance, so each registry snapshot
+    compiles every formula once.
+
+    Raises:
+        FormulaError: If the formula is invalid
+    """
+    cached = getattr(metric_type, '_compiled_formula', None)
+    if cached is not None and cached.text == metric_type.formula:
+        return cached
+
+    compiled = CompiledFormula(metric_type.formula, metric_type.scope_type)
+    metric_type._compiled_formula = compiled
+    return compiled
+
+
+def evaluate_formula(metric_type, targets, known_columns=None):
+    """
+    Evaluate a formula metric for many targets in one pass.
+
+    Args:
+        metric_type: MetricType with a formula
+        targets: List of targets matching the metric's scope
+        known_columns: Optional dict mapping metric_id to {target_pk: value}
+            for inputs that are already computed
+
+    Returns:
+        Dict mapping target primary keys to values (None where unavailable)
+    """
+    from .models import LatestMetricValue
+
+    targets = list(targets)
+    empty = {target.pk: None for target in targets}
+    if not targets:
+        return empty
+
+    try:
+        compiled = get_compiled_formula(metric_type)
+    except FormulaError as e:
+        logger.warning(f"Invalid formula for metric {metric_type.name}: {e}")
+        return empty
+
+    evaluating = _evaluating.get()
+    if metric_type.metric_id in evaluating:
+        logger.warning(f"Formula of metric {metric_type.name} references itself")
+        return empty
+
+    known_columns = known_columns or {}
+    token = _evaluating.set(evaluating | {metric_type.metric_id})
+    try:
+        columns = {}
+        stored = []
+        for dependency in compiled.dependencies:
+            if dependency.metric_id in known_columns:
+                columns[dependency.metric_id] = known_columns[dependency.metric_id]
+            elif dependency.is_computed:
+                columns[dependency.metric_id] = dependency.compute_values(targets)
+            else:
+                stored.append(dependency)
+
+        if stored:
+            # Latest values of all stored inputs in one query
+            latest_values = LatestMetricValue.fetch(stored, targets)
+            for dependency in stored:
+                column = {}
+                for target in targets:
+                    latest = latest_values.get((dependency.metric_id, target.pk))
+                    column[target.pk] = latest.value if latest else None
+                columns[dependency.metric_id] = column
+    finally:
+        _evaluating.reset(token)
+
+    results = compiled.evaluate(
+        {metric_id: [column.get(target.pk) for target in targets] for metric_id, column in columns.items()},
+        len(targets)
+    )
+    return {target.pk: value for target, value in zip(targets, results)}
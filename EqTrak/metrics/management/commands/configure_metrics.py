@@ -5,6 +5,7 @@ from django.core.management.base import BaseCommand, CommandError
 from django.core.management import call_command
 from django.conf import settings
 from django.apps import apps
+from django.utils import timezone
 
 logger = logging.getLogger(__name__)
 
@@ -170,7 +171,10 @@ class Command(BaseCommand):
                 self.stdout.write(self.style.WARNING(f"No metric found with key: {key}"))
                 continue
                 
-            metrics.update(is_active=activate)
-            count += metrics.count()
+            count += metrics.update(is_active=activate, updated_at=timezone.now())
+        
+        # Queryset updates bypass the save signals
+        from metrics.registry import registry
+        registry.invalidate()
             
         self.stdout.write(self.style.SUCCESS(f"{action} {count} metrics")) 
\ No newline at end of file
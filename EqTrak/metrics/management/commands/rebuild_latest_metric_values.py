@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.apps import apps
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Rebuild the latest metric value projection from all metric values'
+
+    def handle(self, *args, **options):
+        LatestMetricValue = apps.get_model('metrics', 'LatestMetricValue')
+        
+        row_count = LatestMetricValue.rebuild()
+        
+        self.stdout.write(self.style.SUCCESS(
+            f'Successfully rebuilt {row_count} latest metric values.'
+        ))
+        logger.info(f'Rebuilt {row_count} latest metric values')
@@ -0,0 +1,15 @@
+from .cache import metric_value_cache
+
+
+class MetricValueCacheMiddleware:
+    """
+    Activate a metric value cache for each request so repeated metric
+    lookups while rendering a page hit memory instead of the database.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with metric_value_cache():
+            return self.get_response(request)
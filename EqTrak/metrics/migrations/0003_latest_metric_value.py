@@ -0,0 +1,102 @@
+# Generated by Django 4.2.10 on 2026-10-18 01:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def populate_latest_values(apps, schema_editor):
+    """Build the latest value projection from the existing metric values"""
+    MetricValue = apps.get_model('metrics', 'MetricValue')
+    LatestMetricValue = apps.get_model('metrics', 'LatestMetricValue')
+
+    rows = {}
+    values = MetricValue.objects.order_by('-date', '-created_at').values_list(
+        'value_id', 'metric_type_id', 'position_id', 'portfolio_id', 'transaction_id', 'date', 'created_at'
+    )
+    for value_id, metric_type_id, position_id, portfolio_id, transaction_id, date, created_at in values.iterator():
+        key = (metric_type_id, position_id, portfolio_id, transaction_id)
+        if key not in rows:
+            rows[key] = LatestMetricValue(
+                metric_type_id=metric_type_id,
+                position_id=position_id,
+                portfolio_id=portfolio_id,
+                transaction_id=transaction_id,
+                metric_value_id=value_id,
+                date=date,
+                value_created_at=created_at
+            )
+    LatestMetricValue.objects.bulk_create(rows.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metrics', '0002_add_key_and_is_active_fields'),
+        ('portfolio', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LatestMetricValue',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('value_created_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='metrictype',
+            name='computation_source',
+            field=models.CharField(blank=True, choices=[('shares', 'Total Shares'), ('avg_price', 'Average Price'), ('cost_basis', 'Cost Basis'), ('current_value', 'Current Value'), ('position_gain', 'Position Gain/Loss'), ('total_value', 'Total Portfolio Value'), ('cash_balance', 'Cash Balance'), ('portfolio_return', 'Portfolio Return'), ('time_weighted_return', 'Time-Weighted Return'), ('transaction_impact', 'Transaction Impact'), ('fee_percentage', 'Fee Percentage')], max_length=50, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='metricvalue',
+            index=models.Index(fields=['metric_type', 'position', 'date'], name='metric_value_position_date'),
+        ),
+        migrations.AddIndex(
+            model_name='metricvalue',
+            index=models.Index(fields=['metric_type', 'portfolio', 'date'], name='metric_value_portfolio_date'),
+        ),
+        migrations.AddIndex(
+            model_name='metricvalue',
+            index=models.Index(fields=['metric_type', 'transaction', 'date'], name='metric_value_txn_date'),
+        ),
+        migrations.AddField(
+            model_name='latestmetricvalue',
+            name='metric_type',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='latest_values', to='metrics.metrictype'),
+        ),
+        migrations.AddField(
+            model_name='latestmetricvalue',
+            name='metric_value',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='metrics.metricvalue'),
+        ),
+        migrations.AddField(
+            model_name='latestmetricvalue',
+            name='portfolio',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='portfolio.portfolio'),
+        ),
+        migrations.AddField(
+            model_name='latestmetricvalue',
+            name='position',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='portfolio.position'),
+        ),
+        migrations.AddField(
+            model_name='latestmetricvalue',
+            name='transaction',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='portfolio.transaction'),
+        ),
+        migrations.AddConstraint(
+            model_name='latestmetricvalue',
+            constraint=models.UniqueConstraint(condition=models.Q(('position__isnull', False)), fields=('metric_type', 'position'), name='latest_metric_value_unique_position'),
+        ),
+        migrations.AddConstraint(
+            model_name='latestmetricvalue',
+            constraint=models.UniqueConstraint(condition=models.Q(('portfolio__isnull', False)), fields=('metric_type', 'portfolio'), name='latest_metric_value_unique_portfolio'),
+        ),
+        migrations.AddConstraint(
+            model_name='latestmetricvalue',
+            constraint=models.UniqueConstraint(condition=models.Q(('transaction__isnull', False)), fields=('metric_type', 'transaction'), name='latest_metric_value_unique_transaction'),
+        ),
+        migrations.RunPython(populate_latest_values, migrations.RunPython.noop),
+    ]
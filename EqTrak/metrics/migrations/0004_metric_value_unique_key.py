@@ -0,0 +1,84 @@
+# Generated by Django 4.2.10 on 2026-10-18 01:30
+
+import logging
+
+from django.db import migrations, models
+
+logger = logging.getLogger(__name__)
+
+
+def deduplicate_metric_values(apps, schema_editor):
+    """
+    Give every metric value a scenario and keep only the newest value per
+    (metric type, target, date, scenario) so the unique constraints can be added.
+
+    The newest value is also the one the latest value projection points at,
+    so the projection stays valid. Memo text of the deleted values is
+    appended to the kept value's text, newest first, and every deleted value
+    is logged with the value kept in its place, so it can be restored by hand.
+    """
+    MetricValue = apps.get_model('metrics', 'MetricValue')
+    MetricValue.objects.filter(scenario__isnull=True).update(scenario='BASE')
+    MetricValue.objects.filter(scenario='').update(scenario='BASE')
+
+    kept = {}
+    merged_texts = {}
+    duplicate_ids = []
+    values = MetricValue.objects.order_by('-created_at', '-updated_at').values_list(
+        'value_id', 'metric_type_id', 'position_id', 'portfolio_id', 'transaction_id', 'date', 'scenario',
+        'value', 'text_value', 'source', 'created_at'
+    )
+    for value_id, metric_type_id, position_id, portfolio_id, transaction_id, date, scenario, \
+            value, text_value, source, created_at in values.iterator():
+        key = (metric_type_id, position_id, portfolio_id, transaction_id, date, scenario)
+        if key not in kept:
+            kept[key] = value_id
+            merged_texts[value_id] = [text_value] if text_value else []
+            continue
+        duplicate_ids.append(value_id)
+        if text_value and text_value not in merged_texts[kept[key]]:
+            merged_texts[kept[key]].append(text_value)
+        logger.warning(
+            f"Deleting duplicate metric value {value_id} (metric type {metric_type_id}, "
+            f"target {position_id or portfolio_id or transaction_id}, {date}, {scenario}): "
+            f"value={value} text_value={text_value!r} source={source} created_at={created_at}, "
+            f"keeping {kept[key]}"
+        )
+
+    for value_id, texts in merged_texts.items():
+        if len(texts) > 1:
+            MetricValue.objects.filter(value_id=value_id).update(text_value='\n\n'.join(texts))
+
+    for start in range(0, len(duplicate_ids), 500):
+        MetricValue.objects.filter(value_id__in=duplicate_ids[start:start + 500]).delete()
+    if duplicate_ids:
+        logger.warning(f"Deleted {len(duplicate_ids)} duplicate metric values")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metrics', '0003_latest_metric_value'),
+        ('portfolio', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(deduplicate_metric_values, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='metricvalue',
+            name='scenario',
+            field=models.CharField(choices=[('BASE', 'Base Case'), ('BULL', 'Bull Case'), ('BEAR', 'Bear Case')], default='BASE', max_length=10),
+        ),
+        migrations.AddConstraint(
+            model_name='metricvalue',
+            constraint=models.UniqueConstraint(fields=('metric_type', 'position', 'date', 'scenario'), name='metric_value_unique_position_date'),
+        ),
+        migrations.AddConstraint(
+            model_name='metricvalue',
+            constraint=models.UniqueConstraint(fields=('metric_type', 'portfolio', 'date', 'scenario'), name='metric_value_unique_portfolio_date'),
+        ),
+        migrations.AddConstraint(
+            model_name='metricvalue',
+            constraint=models.UniqueConstraint(fields=('metric_type', 'transaction', 'date', 'scenario'), name='metric_value_unique_transaction_date'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.10 on 2026-10-18 01:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metrics', '0004_metric_value_unique_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='metrictype',
+            name='formula',
+            field=models.TextField(blank=True, help_text='Expression computing the metric from other metrics of its scope, e.g. Current Value / Cost Basis - 1', null=True),
+        ),
+    ]
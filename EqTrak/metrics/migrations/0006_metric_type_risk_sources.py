@@ -0,0 +1,18 @@
+# Generated by Django 4.2.10 on 2026-10-18 10:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metrics', '0005_metric_type_formula'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='metrictype',
+            name='computation_source',
+            field=models.CharField(blank=True, choices=[('shares', 'Total Shares'), ('avg_price', 'Average Price'), ('cost_basis', 'Cost Basis'), ('current_value', 'Current Value'), ('position_gain', 'Position Gain/Loss'), ('total_value', 'Total Portfolio Value'), ('cash_balance', 'Cash Balance'), ('portfolio_return', 'Portfolio Return'), ('time_weighted_return', 'Time-Weighted Return'), ('volatility', 'Annualized Volatility'), ('max_drawdown', 'Maximum Drawdown'), ('sharpe_ratio', 'Sharpe Ratio'), ('sortino_ratio', 'Sortino Ratio'), ('beta', 'Beta'), ('historical_var', 'Historical Value at Risk'), ('parametric_var', 'Parametric Value at Risk'), ('transaction_impact', 'Transaction Impact'), ('fee_percentage', 'Fee Percentage')], max_length=50, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.10 on 2026-10-18 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metrics', '0006_metric_type_risk_sources'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='metrictype',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
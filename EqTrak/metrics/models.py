@@ -1,8 +1,9 @@
-from django.db import models
+from django.db import models, transaction
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.core.exceptions import ValidationError
 import uuid
 from django.apps import apps
+from .cache import get_active_cache, MISSING
 
 class MetricType(models.Model):
     SCOPE_TYPES = [
@@ -33,11 +34,28 @@ class MetricType(models.Model):
         ('cash_balance', 'Cash Balance'),
         ('portfolio_return', 'Portfolio Return'),
         ('time_weighted_return', 'Time-Weighted Return'),
+        # Risk metrics of positions and portfolios
+        ('volatility', 'Annualized Volatility'),
+        ('max_drawdown', 'Maximum Drawdown'),
+        ('sharpe_ratio', 'Sharpe Ratio'),
+        ('sortino_ratio', 'Sortino Ratio'),
+        ('beta', 'Beta'),
+        ('historical_var', 'Historical Value at Risk'),
+        ('parametric_var', 'Parametric Value at Risk'),
         # Transaction metrics
         ('transaction_impact', 'Transaction Impact'),
         ('fee_percentage', 'Fee Percentage')
     ]
     
+    # Implicit dependencies between computation sources, in addition to the
+    # explicit computation_dependencies relation
+    SOURCE_DEPENDENCIES = {
+        'avg_price': ['shares'],
+        'cost_basis': ['shares', 'avg_price'],
+        'current_value': ['shares'],
+        'total_value': ['cash_balance'],
+    }
+    
     metric_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     key = models.CharField(max_length=100, unique=True, null=True, blank=True, help_text="Unique identifier for the metric")
     name = models.CharField(max_length=100)
@@ -51,17 +69,36 @@ class MetricType(models.Model):
     computation_source = models.CharField(max_length=50, choices=COMPUTATION_SOURCES, null=True, blank=True)
     computation_dependencies = models.ManyToManyField('self', symmetrical=False, blank=True)
     computation_order = models.IntegerField(default=0)
+    formula = models.TextField(
+        null=True, blank=True,
+        help_text="Expression computing the metric from other metrics of its scope, e.g. Current Value / Cost Basis - 1"
+    )
+    updated_at = models.DateTimeField(auto_now=True)
     
     class Meta:
         ordering = ['computation_order', 'name']
 
+    def clean(self):
+        """Validate the formula against the metrics of the scope"""
+        super().clean()
+        
+        if not self.formula:
+            return
+            
+        from .formulas import CompiledFormula, FormulaError
+        try:
+            compiled = CompiledFormula(self.formula, self.scope_type)
+        except FormulaError as e:
+            raise ValidationError({'formula': str(e)})
+            
+        if any(dependency.metric_id == self.metric_id for dependency in compiled.dependencies):
+            raise ValidationError({'formula': "A formula cannot reference its own metric."})
+
     @classmethod
     def get_system_metric(cls, name, scope_type=None):
         """Get a system metric by name and optional scope type"""
-        query = {'name': name, 'is_system': True}
-        if scope_type:
-            query['scope_type'] = scope_type
-        return cls.objects.filter(**query).first()
+        from .registry import registry
+        return registry.get_by_name(name, scope_type=scope_type or None, is_system=True)
 
     @classmethod
     def get_metrics_for_scope(cls, scope_type, include_system=True):
@@ -90,8 +127,15 @@ class MetricType(models.Model):
             # If we can't access the performance service, assume disabled
             return False
 
-    def compute_value(self, target_object):
-        """Compute the metric value for a target object (position, transaction, or portfolio)"""
+    def compute_value(self, target_object, context=None):
+        """
+        Compute the metric value for a target object (position, transaction, or portfolio)
+        
+        Args:
+            target_object: The object to compute the metric for
+            context: Optional EvaluationContext used to share intermediate
+                values between metrics evaluated in the same pass
+        """
         if not self.is_computed:
             return None
             
@@ -99,23 +143,134 @@ class MetricType(models.Model):
         if not self._validate_scope(target_object):
             return None
             
+        # Reuse a value computed earlier in the same request
+        cache = get_active_cache()
+        if cache is not None:
+            cached_value = cache.get(self.scope_type, target_object.pk, ('computed', self.metric_id))
+            if cached_value is not MISSING:
+                return cached_value
+            
+        value = self._compute_value(target_object, context)
+        
+        if cache is not None:
+            cache.set(self.scope_type, target_object.pk, ('computed', self.metric_id), value)
+        return value
+
+    def compute_values(self, target_objects):
+        """
+        Compute the metric value for many target objects of the same scope.
+        
+        Uses a registered batch provider when there is one, so a whole column
+        costs one provider call, and otherwise computes each target with
+        compute_value(). Values are read from and stored in the request cache.
+        
+        Args:
+            target_objects: Iterable of targets matching the metric's scope
+            
+        Returns:
+            Dict mapping target primary keys to values (None where unavailable)
+        """
+        target_objects = list(target_objects)
+        values = {target.pk: None for target in target_objects}
+        if not self.is_computed:
+            return values
+            
+        cache = get_active_cache()
+        missing = []
+        for target in target_objects:
+            if not self._validate_scope(target):
+                continue
+            cached_value = MISSING
+            if cache is not None:
+                cached_value = cache.get(self.scope_type, target.pk, ('computed', self.metric_id))
+            if cached_value is MISSING:
+                missing.append(target)
+            else:
+                values[target.pk] = cached_value
+        if not missing:
+            return values
+            
+        from .bulk import BULK_SOURCES, compute_metrics_for_positions
+        from .providers import compute_metric_values
+        computed = compute_metric_values(self.name, missing) or {}
+        
+        # Targets the providers left empty fall back to the internal
+        # computations, in bulk for formulas and the standard position metrics
+        fallback = [target for target in missing if computed.get(target.pk) is None]
+        if fallback and self.formula:
+            from .formulas import evaluate_formula
+            computed.update(evaluate_formula(self, fallback))
+        elif fallback and self.scope_type == 'POSITION' and self.computation_source in BULK_SOURCES:
+            bulk_values = compute_metrics_for_positions(fallback)
+            for target in fallback:
+                computed[target.pk] = bulk_values.get(target.pk, {}).get(self.computation_source)
+        else:
+            for target in fallback:
+                computed[target.pk] = self._compute_builtin(target)
+            
+        for target in missing:
+            value = computed.get(target.pk)
+            values[target.pk] = value
+            if cache is not None:
+                cache.set(self.scope_type, target.pk, ('computed', self.metric_id), value)
+        return values
+
+    @classmethod
+    def prime_cache(cls, metric_types, targets):
+        """
+        Load the values of the given metrics for many targets into the request cache.
+        
+        Computed metrics are evaluated a column at a time with compute_values(),
+        stored metrics are read with LatestMetricValue.prime_cache(). Does
+        nothing when no request cache is active.
+        """
+        if get_active_cache() is None:
+            return
+            
+        targets = list(targets)
+        if not targets:
+            return
+            
+        metric_types = [metric for metric in metric_types if metric._validate_scope(targets[0])]
+        LatestMetricValue.prime_cache(metric_types, targets)
+        computed = {
+            metric: metric.compute_values(targets)
+            for metric in metric_types
+            if metric.is_computed
+        }
+        if not computed:
+            return
+            
+        cache = get_active_cache()
+        for metric, values in computed.items():
+            for target in targets:
+                cache.set(metric.scope_type, target.pk, ('computed', metric.metric_id), values.get(target.pk))
+
+    def _compute_value(self, target_object, context=None):
+        """Compute the metric value without consulting the request cache"""
         # Try using an external provider first (if registered)
         from .providers import compute_metric_value
         external_value = compute_metric_value(self.name, target_object)
         if external_value is not None:
             return external_value
             
-        # Fall back to internal computation methods for standard metrics
-        if self.computation_source == 'shares':
-            return self._compute_shares(target_object)
+        return self._compute_builtin(target_object, context)
+
+    def _compute_builtin(self, target_object, context=None):
+        """Compute a standard metric with the internal computation methods"""
+        if self.formula:
+            from .formulas import evaluate_formula
+            return evaluate_formula(self, [target_object])[target_object.pk]
+        elif self.computation_source == 'shares':
+            return self._compute_shares(target_object, context)
         elif self.computation_source == 'avg_price':
-            return self._compute_avg_price(target_object)
+            return self._compute_avg_price(target_object, context)
         elif self.computation_source == 'cost_basis':
-            return self._compute_cost_basis(target_object)
+            return self._compute_cost_basis(target_object, context)
         elif self.computation_source == 'current_value':
-            return self._compute_current_value(target_object)
+            return self._compute_current_value(target_object, context)
         elif self.computation_source == 'total_value':
-            return self._compute_portfolio_value(target_object)
+            return self._compute_portfolio_value(target_object, context)
         elif self.computation_source == 'transaction_impact':
             return self._compute_transaction_impact(target_object)
             
@@ -135,10 +290,21 @@ class MetricType(models.Model):
 
     def get_latest_value(self, target_object):
         """Get the most recent value for this metric and target object"""
-        return MetricValue.objects.filter(
+        cache = get_active_cache()
+        if cache is not None:
+            cached_value = cache.get(self.scope_type, target_object.pk, ('latest', self.metric_id))
+            if cached_value is not MISSING:
+                return cached_value
+            
+        latest = LatestMetricValue.objects.filter(
             metric_type=self,
             **self._get_target_field(target_object)
-        ).order_by('-date', '-created_at').first()
+        ).select_related('metric_value').first()
+        latest_value = latest.metric_value if latest else None
+        
+        if cache is not None:
+            cache.set(self.scope_type, target_object.pk, ('latest', self.metric_id), latest_value)
+        return latest_value
 
     def _get_target_field(self, target_object):
         """Get the field name and value for the target object based on scope"""
@@ -150,57 +316,58 @@ class MetricType(models.Model):
             return {'transaction': target_object}
         return {}
 
-    def _get_dependency_value(self, target_object, computation_source):
+    def _get_dependency_value(self, target_object, computation_source, context=None):
         """Get the most recent value of a dependency metric"""
-        dependency = MetricType.objects.filter(
-            computation_source=computation_source,
-            is_system=True,
-            scope_type=self.scope_type
-        ).first()
+        if context is not None and computation_source in context.values:
+            return context.values[computation_source]
+            
+        if context is not None and context.metrics_by_source is not None:
+            dependency = context.metrics_by_source.get(computation_source)
+        else:
+            from .registry import registry
+            dependency = registry.get_by_source(computation_source, self.scope_type)
         
         if not dependency:
             return None
             
         if dependency.is_computed:
-            return dependency.compute_value(target_object)
+            value = dependency.compute_value(target_object, context=context)
+        else:
+            latest_value = dependency.get_latest_value(target_object)
+            value = latest_value.value if latest_value else None
             
-        latest_value = dependency.get_latest_value(target_object)
-        return latest_value.value if latest_value else None
+        if context is not None:
+            context.values[computation_source] = value
+        return value
 
-    def _compute_shares(self, position):
-        """Calculate total shares from transactions"""
-        transactions = position.transaction_set.filter(status='COMPLETED')
-        total_shares = sum(t.shares_impact for t in transactions)
-        return total_shares
+    def _compute_shares(self, position, context=None):
+        """Get total shares from the position's running totals"""
+        from portfolio.models import PositionAggregate
+        return PositionAggregate.get_for_position(position).total_shares
 
-    def _compute_avg_price(self, position):
+    def _compute_avg_price(self, position, context=None):
         """Calculate average purchase price"""
-        shares = self._get_dependency_value(position, 'shares')
+        shares = self._get_dependency_value(position, 'shares', context)
         if not shares or shares == 0:
             return 0
             
-        transactions = position.transaction_set.filter(
-            status='COMPLETED',
-            transaction_type='BUY'
-        )
-        total_cost = sum(t.total_with_fees for t in transactions)
-        total_shares_bought = sum(t.quantity for t in transactions)
-        
-        return total_cost / total_shares_bought if total_shares_bought > 0 else 0
+        # Cost of the open tax lots per share held
+        from portfolio.models import PositionAggregate
+        return PositionAggregate.get_for_position(position).avg_price
 
-    def _compute_cost_basis(self, position):
+    def _compute_cost_basis(self, position, context=None):
         """Calculate total cost basis"""
-        shares = self._get_dependency_value(position, 'shares')
-        avg_price = self._get_dependency_value(position, 'avg_price')
+        shares = self._get_dependency_value(position, 'shares', context)
+        avg_price = self._get_dependency_value(position, 'avg_price', context)
         
         if shares is None or avg_price is None:
             return None
             
         return shares * avg_price
 
-    def _compute_current_value(self, position):
+    def _compute_current_value(self, position, context=None):
         """Calculate current position value"""
-        shares = self._get_dependency_value(position, 'shares')
+        shares = self._get_dependency_value(position, 'shares', context)
         market_price = position.get_latest_market_price()
         
         if shares is None or market_price is None:
@@ -208,18 +375,18 @@ class MetricType(models.Model):
             
         return shares * market_price
 
-    def _compute_portfolio_value(self, portfolio):
+    def _compute_portfolio_value(self, portfolio, context=None):
         """Calculate total portfolio value"""
         total_value = 0
         
         # Get cash balance
-        cash_balance = self._get_dependency_value(portfolio, 'cash_balance') or 0
+        cash_balance = self._get_dependency_value(portfolio, 'cash_balance', context) or 0
         total_value += cash_balance
         
-        # Add up all position values
-        for position in portfolio.position_set.filter(is_active=True):
-            position_value = position.get_metric_value('Current Value', system_only=True) or 0
-            total_value += position_value
+        # Add up all position values, computed for all positions at once
+        from .bulk import compute_position_metrics_bulk
+        for position_values in compute_position_metrics_bulk(portfolio).values():
+            total_value += position_values['current_value'] or 0
         
         return total_value
 
@@ -245,6 +412,13 @@ class MetricValue(models.Model):
         ('BULL', 'Bull Case'),
         ('BEAR', 'Bear Case')
     ]
+    DEFAULT_SCENARIO = 'BASE'
+    
+    # Target foreign keys, exactly one of which is set
+    TARGET_FIELDS = ['position', 'portfolio', 'transaction']
+    
+    # Fields overwritten when bulk_store() hits an existing (metric, target, date, scenario) row
+    UPSERT_FIELDS = ['value', 'text_value', 'source', 'confidence', 'is_forecast', 'notes', 'updated_at']
     
     value_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     # Target object references - only one should be set based on metric_type.scope_type
@@ -265,7 +439,7 @@ class MetricValue(models.Model):
         blank=True
     )
     is_forecast = models.BooleanField(default=False)
-    scenario = models.CharField(max_length=10, choices=SCENARIOS, null=True, blank=True)
+    scenario = models.CharField(max_length=10, choices=SCENARIOS, default=DEFAULT_SCENARIO)
     notes = models.TextField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -290,6 +464,18 @@ class MetricValue(models.Model):
                 ),
                 name='metric_value_single_target'
             )
+        ] + [
+            # One value per metric, target, date and scenario
+            models.UniqueConstraint(
+                fields=['metric_type', target_field, 'date', 'scenario'],
+                name=f'metric_value_unique_{target_field}_date'
+            )
+            for target_field in ['position', 'portfolio', 'transaction']
+        ]
+        indexes = [
+            models.Index(fields=['metric_type', 'position', 'date'], name='metric_value_position_date'),
+            models.Index(fields=['metric_type', 'portfolio', 'date'], name='metric_value_portfolio_date'),
+            models.Index(fields=['metric_type', 'transaction', 'date'], name='metric_value_txn_date'),
         ]
     
     def clean(self):
@@ -299,25 +485,31 @@ class MetricValue(models.Model):
         if not self.metric_type_id:
             return
             
+        # Validate against the registry's metric type and the target ids so
+        # validation does not load any related objects
+        metric_type = self._get_metric_type()
+        if not self.scenario:
+            self.scenario = self.DEFAULT_SCENARIO
+            
         # Validate that only one target is set
         targets = [
-            bool(self.position),
-            bool(self.portfolio),
-            bool(self.transaction)
+            self.position_id is not None,
+            self.portfolio_id is not None,
+            self.transaction_id is not None
         ]
         if sum(targets) != 1:
             raise ValidationError('Exactly one target (position, portfolio, or transaction) must be set')
         
         # Validate that the target matches the metric type's scope
-        if self.metric_type.scope_type == 'POSITION' and not self.position:
+        if metric_type.scope_type == 'POSITION' and self.position_id is None:
             raise ValidationError({'position': 'Position is required for position-scoped metrics'})
-        elif self.metric_type.scope_type == 'PORTFOLIO' and not self.portfolio:
+        elif metric_type.scope_type == 'PORTFOLIO' and self.portfolio_id is None:
             raise ValidationError({'portfolio': 'Portfolio is required for portfolio-scoped metrics'})
-        elif self.metric_type.scope_type == 'TRANSACTION' and not self.transaction:
+        elif metric_type.scope_type == 'TRANSACTION' and self.transaction_id is None:
             raise ValidationError({'transaction': 'Transaction is required for transaction-scoped metrics'})
         
         # Validate value based on data type
-        if self.metric_type.data_type == 'MEMO':
+        if metric_type.data_type == 'MEMO':
             if not self.text_value and not self.value:
                 raise ValidationError('Text value is required for memo-type metrics')
             self.value = None  # Clear numeric value for memo types
@@ -326,10 +518,447 @@ class MetricValue(models.Model):
                 raise ValidationError('Numeric value is required for non-memo metrics')
             self.text_value = None  # Clear text value for non-memo types
     
+    def _get_metric_type(self):
+        """Get the metric type, preferring the loaded instance, then the registry"""
+        if self._meta.get_field('metric_type').is_cached(self):
+            return self.metric_type
+            
+        from .registry import registry
+        metric_type = registry.get(self.metric_type_id)
+        if metric_type is None:
+            return self.metric_type
+        self.metric_type = metric_type
+        return metric_type
+    
+    def get_target_field(self):
+        """Get the name of the target foreign key that is set, or None"""
+        for target_field in self.TARGET_FIELDS:
+            if getattr(self, f'{target_field}_id') is not None:
+                return target_field
+        return None
+    
+    def get_key_filter(self):
+        """Lookup arguments of the (metric_type, target, date, scenario) key of this value"""
+        target_field = self.get_target_field()
+        return {
+            'metric_type_id': self.metric_type_id,
+            f'{target_field}_id': getattr(self, f'{target_field}_id'),
+            'date': self.date,
+            'scenario': self.scenario,
+        }
+    
+    def is_duplicate(self):
+        """Whether another value is stored for the same (metric_type, target, date, scenario)"""
+        return MetricValue.objects.filter(**self.get_key_filter()).exclude(pk=self.pk).exists()
+    
+    @classmethod
+    def store(cls, metric_value):
+        """
+        Insert a metric value or replace the one stored for the same
+        (metric_type, target, date, scenario) key.
+
+        Unlike bulk_store(), the value is written with save(), so the save
+        signals are sent and every post_save handler runs. The replaced row
+        keeps its primary key and creation time.
+
+        Returns:
+            The stored MetricValue instance
+
+        Raises:
+            ValidationError: If the value fails validation
+        """
+        metric_value.clean()
+        with transaction.atomic():
+            existing = cls.objects.select_for_update().filter(
+                **metric_value.get_key_filter()
+            ).values_list('value_id', 'created_at').first()
+            if existing is not None:
+                metric_value.value_id, metric_value.created_at = existing
+                metric_value._state.adding = False
+            metric_value.save()
+        return metric_value
+
+    @classmethod
+    def bulk_store(cls, values, batch_size=500):
+        """
+        Insert or update many metric values with batched statements.
+        
+        Values are validated in memory and upserted on their
+        (metric_type, target, date, scenario) key; an existing row keeps its
+        primary key and creation time and gets the UPSERT_FIELDS overwritten.
+        Save signals are not sent: the latest value projection and the
+        request cache are updated here, but no other post_save handler of
+        MetricValue runs. Use store() for values that need them.
+        
+        Args:
+            values: Iterable of unsaved MetricValue instances
+            batch_size: Maximum number of rows per INSERT statement
+            
+        Returns:
+            List of the stored MetricValue instances, with the primary keys
+            of their database rows
+            
+        Raises:
+            ValidationError: If any value fails validation; nothing is written
+        """
+        # Validate everything first and keep the last value written for each key
+        values_by_key = {}
+        for metric_value in values:
+            metric_value.clean()
+            target_field = metric_value.get_target_field()
+            key = (
+                metric_value.metric_type_id, target_field,
+                getattr(metric_value, f'{target_field}_id'),
+                metric_value.date, metric_value.scenario
+            )
+            values_by_key[key] = metric_value
+        
+        if not values_by_key:
+            return []
+        
+        groups = {}
+        for (metric_type_id, target_field, target_id, value_date, scenario), metric_value in values_by_key.items():
+            groups.setdefault(target_field, []).append(metric_value)
+        
+        with transaction.atomic():
+            for target_field, group in groups.items():
+                cls.objects.bulk_create(
+                    group,
+                    batch_size=batch_size,
+                    update_conflicts=True,
+                    unique_fields=['metric_type', target_field, 'date', 'scenario'],
+                    update_fields=cls.UPSERT_FIELDS
+                )
+                cls._load_stored_keys(target_field, group)
+            
+            LatestMetricValue.record_many(values_by_key.values())
+        
+        cache = get_active_cache()
+        if cache is not None:
+            for (metric_type_id, target_field, target_id, value_date, scenario) in values_by_key:
+                cache.invalidate(target_field.upper(), target_id)
+        
+        return list(values_by_key.values())
+    
+    @classmethod
+    def _load_stored_keys(cls, target_field, group):
+        """
+        Copy the primary key and creation time of the stored rows onto the instances.
+        
+        Rows that already existed keep their original primary key, which
+        bulk_create cannot report back for updated rows.
+        """
+        target_attr = f'{target_field}_id'
+        rows = cls.objects.filter(
+            metric_type_id__in={metric_value.metric_type_id for metric_value in group},
+            date__in={metric_value.date for metric_value in group},
+            **{f'{target_attr}__in': {getattr(metric_value, target_attr) for metric_value in group}}
+        ).values_list('value_id', 'metric_type_id', target_attr, 'date', 'scenario', 'created_at')
+        stored = {
+            (metric_type_id, target_id, value_date, scenario): (value_id, created_at)
+            for value_id, metric_type_id, target_id, value_date, scenario, created_at in rows
+        }
+        
+        for metric_value in group:
+            key = (metric_value.metric_type_id, getattr(metric_value, target_attr), metric_value.date, metric_value.scenario)
+            if key in stored:
+                metric_value.value_id, metric_value.created_at = stored[key]
+                metric_value._state.adding = False
+                metric_value._loaded_date = metric_value.date
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored date so saves that keep it can skip projection updates
+        instance._loaded_date = instance.__dict__.get('date')
+        return instance
+    
     def save(self, *args, **kwargs):
         self.clean()
         super().save(*args, **kwargs)
+        self._loaded_date = self.date
     
     def __str__(self):
         target = self.position or self.portfolio or self.transaction
         return f"{self.metric_type.name} for {target} on {self.date}"
+
+
+class LatestMetricValue(models.Model):
+    """
+    Projection of the most recent MetricValue per metric type and target.
+    
+    Maintained by the MetricValue save/delete signal handlers so the latest
+    value of a metric is a single indexed lookup instead of an ordered scan
+    of its history. Writes that bypass signals (queryset updates, bulk_create)
+    must call refresh() or rebuild() afterwards.
+    """
+    TARGET_FIELDS = MetricValue.TARGET_FIELDS
+    
+    metric_type = models.ForeignKey(MetricType, on_delete=models.CASCADE, related_name='latest_values')
+    position = models.ForeignKey('portfolio.Position', on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    portfolio = models.ForeignKey('portfolio.Portfolio', on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    transaction = models.ForeignKey('portfolio.Transaction', on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    metric_value = models.OneToOneField(MetricValue, on_delete=models.CASCADE, related_name='+')
+    # Copied from the metric value to compare against new writes without a join
+    date = models.DateField()
+    value_created_at = models.DateTimeField()
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['metric_type', target_field],
+                condition=models.Q(**{f'{target_field}__isnull': False}),
+                name=f'latest_metric_value_unique_{target_field}'
+            )
+            for target_field in ['position', 'portfolio', 'transaction']
+        ]
+    
+    def __str__(self):
+        return f"Latest {self.metric_type_id} on {self.date}"
+    
+    @staticmethod
+    def get_target_filter(metric_value):
+        """Get the target filter of a metric value, e.g. {'position_id': ...}"""
+        for target_field in LatestMetricValue.TARGET_FIELDS:
+            target_id = getattr(metric_value, f'{target_field}_id')
+            if target_id is not None:
+                return {f'{target_field}_id': target_id}
+        return {}
+    
+    @classmethod
+    def record(cls, metric_value, created=True):
+        """
+        Update the projection after a metric value was saved.
+        
+        Args:
+            metric_value: The saved MetricValue instance
+            created: Whether the metric value was just created
+        """
+        target = cls.get_target_filter(metric_value)
+        if not target:
+            return
+            
+        if not created and getattr(metric_value, '_loaded_date', None) == metric_value.date:
+            # Neither the date nor the creation time changed, so the ordering is unchanged
+            return
+            
+        # get_or_create() retries the lookup when a concurrent save inserted the row first
+        current, inserted = cls.objects.get_or_create(
+            metric_type_id=metric_value.metric_type_id,
+            **target,
+            defaults={
+                'metric_value': metric_value,
+                'date': metric_value.date,
+                'value_created_at': metric_value.created_at,
+            }
+        )
+        if inserted:
+            return
+        if current.metric_value_id == metric_value.pk:
+            if metric_value.date < current.date:
+                # The latest value moved back in time, another value may be newer now
+                cls.refresh(metric_value.metric_type_id, **target)
+            elif metric_value.date != current.date:
+                current.date = metric_value.date
+                current.save(update_fields=['date'])
+        else:
+            # Compare in the UPDATE so a newer value stored concurrently is kept
+            cls.objects.filter(
+                models.Q(date__lt=metric_value.date) |
+                models.Q(date=metric_value.date, value_created_at__lte=metric_value.created_at),
+                pk=current.pk
+            ).update(
+                metric_value=metric_value,
+                date=metric_value.date,
+                value_created_at=metric_value.created_at
+            )
+    
+    @classmethod
+    def record_many(cls, metric_values):
+        """
+        Update the projection after a batch of metric values was stored.
+        
+        Uses one query to load the current rows and one statement each to
+        replace the outdated ones, however many values were stored.
+        
+        Args:
+            metric_values: Iterable of stored MetricValue instances with their
+                primary keys and creation times set
+        """
+        # The newest stored value for each metric type and target
+        newest = {}
+        for metric_value in metric_values:
+            target_field = metric_value.get_target_field()
+            key = (target_field, metric_value.metric_type_id, getattr(metric_value, f'{target_field}_id'))
+            if key not in newest or (metric_value.date, metric_value.created_at) > (newest[key].date, newest[key].created_at):
+                newest[key] = metric_value
+        
+        stale_ids = []
+        new_rows = []
+        for target_field in cls.TARGET_FIELDS:
+            candidates = {key: value for key, value in newest.items() if key[0] == target_field}
+            if not candidates:
+                continue
+                
+            current_rows = cls.objects.filter(
+                metric_type_id__in={key[1] for key in candidates},
+                **{f'{target_field}_id__in': {key[2] for key in candidates}}
+            )
+            current = {
+                (target_field, row.metric_type_id, getattr(row, f'{target_field}_id')): row
+                for row in current_rows
+            }
+            
+            for key, metric_value in candidates.items():
+                row = current.get(key)
+                if row is not None:
+                    if row.metric_value_id == metric_value.pk:
+                        continue
+                    if (metric_value.date, metric_value.created_at) < (row.date, row.value_created_at):
+                        continue
+                    stale_ids.append(row.pk)
+                    
+                new_rows.append(cls(
+                    metric_type_id=metric_value.metric_type_id,
+                    metric_value_id=metric_value.pk,
+                    date=metric_value.date,
+                    value_created_at=metric_value.created_at,
+                    **{f'{target_field}_id': key[2]}
+                ))
+        
+        if stale_ids:
+            cls.objects.filter(pk__in=stale_ids).delete()
+        if new_rows:
+            cls.objects.bulk_create(new_rows, batch_size=500)
+    
+    @classmethod
+    def forget(cls, metric_value):
+        """
+        Update the projection after a metric value was deleted.
+        
+        The projection row of a deleted latest value is removed by the cascade,
+        so only targets left without a row need recomputing.
+        """
+        target = cls.get_target_filter(metric_value)
+        if not target:
+            return
+            
+        if not cls.objects.filter(metric_type_id=metric_value.metric_type_id, **target).exists():
+            cls.refresh(metric_value.metric_type_id, **target)
+    
+    @classmethod
+    def refresh(cls, metric_type_id, **target):
+        """
+        Recompute the projection row of one metric type and target.
+        
+        Args:
+            metric_type_id: Primary key of the metric type
+            **target: Target filter, e.g. position_id=...
+        """
+        latest = MetricValue.objects.filter(
+            metric_type_id=metric_type_id, **target
+        ).order_by('-date', '-created_at').first()
+        
+        if latest is None:
+            cls.objects.filter(metric_type_id=metric_type_id, **target).delete()
+            return
+            
+        cls.objects.update_or_create(
+            metric_type_id=metric_type_id,
+            defaults={
+                'metric_value': latest,
+                'date': latest.date,
+                'value_created_at': latest.created_at,
+            },
+            **target
+        )
+    
+    @classmethod
+    def rebuild(cls):
+        """
+        Rebuild the whole projection from MetricValue.
+        
+        Returns:
+            Number of projection rows created
+        """
+        rows = {}
+        values = MetricValue.objects.order_by('-date', '-created_at').values_list(
+            'value_id', 'metric_type_id', 'position_id', 'portfolio_id', 'transaction_id', 'date', 'created_at'
+        )
+        for value_id, metric_type_id, position_id, portfolio_id, transaction_id, date, created_at in values.iterator():
+            key = (metric_type_id, position_id, portfolio_id, transaction_id)
+            if key not in rows:
+                rows[key] = cls(
+                    metric_type_id=metric_type_id,
+                    position_id=position_id,
+                    portfolio_id=portfolio_id,
+                    transaction_id=transaction_id,
+                    metric_value_id=value_id,
+                    date=date,
+                    value_created_at=created_at
+                )
+        
+        cls.objects.all().delete()
+        cls.objects.bulk_create(rows.values(), batch_size=500)
+        return len(rows)
+    
+    @classmethod
+    def fetch(cls, metric_types, targets):
+        """
+        Get the latest values of several metrics for several targets in one query.
+        
+        Args:
+            metric_types: Iterable of MetricType instances
+            targets: Iterable of positions, portfolios or transactions
+            
+        Returns:
+            Dict mapping (metric_id, target pk) to the latest MetricValue
+        """
+        metric_types = list(metric_types)
+        target_ids = [target.pk for target in targets]
+        results = {}
+        
+        for scope_type in {metric.scope_type for metric in metric_types}:
+            target_field = scope_type.lower()
+            if target_field not in cls.TARGET_FIELDS:
+                continue
+                
+            rows = cls.objects.filter(
+                metric_type__in=[metric for metric in metric_types if metric.scope_type == scope_type],
+                **{f'{target_field}_id__in': target_ids}
+            ).select_related('metric_value')
+            for row in rows:
+                results[(row.metric_type_id, getattr(row, f'{target_field}_id'))] = row.metric_value
+        
+        return results
+    
+    @classmethod
+    def prime_cache(cls, metric_types, targets):
+        """
+        Load the latest values of the given metrics into the request cache.
+        
+        Subsequent MetricType.get_latest_value calls for these pairs are then
+        answered from memory. Does nothing when no request cache is active.
+        """
+        cache = get_active_cache()
+        if cache is None:
+            return
+            
+        targets = list(targets)
+        if not targets:
+            return
+            
+        metric_types = [
+            metric for metric in metric_types
+            if not metric.is_computed and metric._validate_scope(targets[0])
+        ]
+        if not metric_types:
+            return
+            
+        latest_values = cls.fetch(metric_types, targets)
+        for metric in metric_types:
+            for target in targets:
+                cache.set(
+                    metric.scope_type, target.pk, ('latest', metric.metric_id),
+                    latest_values.get((metric.metric_id, target.pk))
+                )
@@ -3,12 +3,21 @@ Metric computation provider system.
 
 This module provides a simple registry for external metric computation providers,
 allowing other apps to register functions that can compute specific metric values.
+
+Providers come in two forms: per-object providers take a single target object
+and return its value, batch providers take a list of targets and return a dict
+mapping each target's primary key to its value. Batch providers let a whole
+column of a table be computed with one call.
 """
 
 # Dictionary mapping metric names to computation functions
 # Format: {'Metric Name': computation_function}
 METRIC_PROVIDERS = {}
 
+# Dictionary mapping metric names to batch computation functions
+# Format: {'Metric Name': batch_computation_function}
+BATCH_METRIC_PROVIDERS = {}
+
 def register_provider(metric_name, provider_function):
     """
     Register a function that can compute values for a specific metric.
@@ -23,6 +32,21 @@ def register_provider(metric_name, provider_function):
     global METRIC_PROVIDERS
     METRIC_PROVIDERS[metric_name] = provider_function
     
+def register_batch_provider(metric_name, provider_function):
+    """
+    Register a function that can compute values of a metric for many targets at once.
+    
+    Args:
+        metric_name: The name of the metric
+        provider_function: A function that takes a list of target objects and
+            returns a dict mapping target primary keys to values
+            
+    Returns:
+        None
+    """
+    global BATCH_METRIC_PROVIDERS
+    BATCH_METRIC_PROVIDERS[metric_name] = provider_function
+    
 def get_provider(metric_name):
     """
     Get the provider function for a specific metric.
@@ -35,10 +59,29 @@ def get_provider(metric_name):
     """
     return METRIC_PROVIDERS.get(metric_name)
     
+def get_batch_provider(metric_name):
+    """
+    Get the batch provider function for a specific metric.
+    
+    Args:
+        metric_name: The name of the metric
+        
+    Returns:
+        Function or None if no batch provider is registered
+    """
+    return BATCH_METRIC_PROVIDERS.get(metric_name)
+    
+def has_provider(metric_name):
+    """Check if any provider is registered for a metric"""
+    return metric_name in METRIC_PROVIDERS or metric_name in BATCH_METRIC_PROVIDERS
+    
 def compute_metric_value(metric_name, target_object):
     """
     Compute a metric value using the registered provider.
     
+    Falls back to the batch provider with a single target when no
+    per-object provider is registered.
+    
     Args:
         metric_name: The name of the metric
         target_object: The object to compute the metric for
@@ -49,4 +92,34 @@ def compute_metric_value(metric_name, target_object):
     provider = get_provider(metric_name)
     if provider:
         return provider(target_object)
-    return None 
\ No newline at end of file
+        
+    batch_provider = get_batch_provider(metric_name)
+    if batch_provider:
+        return batch_provider([target_object]).get(target_object.pk)
+    return None
+    
+def compute_metric_values(metric_name, target_objects):
+    """
+    Compute a metric for many targets using the registered providers.
+    
+    Uses the batch provider when one is registered, otherwise calls the
+    per-object provider for each target.
+    
+    Args:
+        metric_name: The name of the metric
+        target_objects: List of objects to compute the metric for
+        
+    Returns:
+        Dict mapping target primary keys to computed values (None where
+        unavailable), or None if no provider is registered
+    """
+    target_objects = list(target_objects)
+    batch_provider = get_batch_provider(metric_name)
+    if batch_provider:
+        values = batch_provider(target_objects)
+        return {target.pk: values.get(target.pk) for target in target_objects}
+        
+    provider = get_provider(metric_name)
+    if provider:
+        return {target.pk: provider(target) for target in target_objects}
+    return None
@@ -0,0 +1,133 @@
+"""
+In-process registry of metric types.
+
+Metric types only change through configure_metrics, the admin and the
+user_metrics forms, yet they are looked up by name on nearly every metric
+access. The registry loads all of them once per process and indexes them by
+(name, scope_type, is_system), key and computation_source.
+
+The signal handlers in metrics.signals call invalidate() whenever a metric type
+is saved or deleted, reloading the registry of the current process. Other
+worker processes compare the number of metric types and their latest
+updated_at, read from the database, with the version they loaded and reload
+when it changed, at most VERSION_CHECK_INTERVAL seconds later.
+"""
+import logging
+import threading
+import time
+
+from django.db.models import Count, Max
+
+logger = logging.getLogger(__name__)
+
+# Minimum number of seconds between two checks of the stored version
+VERSION_CHECK_INTERVAL = 1.0
+
+
+class MetricTypeRegistry:
+    """
+    Lazily loaded, indexed snapshot of all MetricType rows.
+
+    Lookups return the same shared instances to every caller, so callers
+    must not modify them without saving (which invalidates the registry).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._version = None
+        self._last_check = 0.0
+        self._by_id = {}
+        self._by_name = {}
+        self._by_key = {}
+        self._by_source = {}
+
+    def _get_stored_version(self):
+        """
+        Get the version of the stored metric types.
+
+        Saving a metric type moves its updated_at forward and deleting one
+        lowers the count, so any change made by any process changes the version.
+        """
+        from .models import MetricType
+
+        version = MetricType.objects.aggregate(count=Count('pk'), updated_at=Max('updated_at'))
+        return version['count'], version['updated_at']
+
+    def _load(self):
+        """Load and index every metric type"""
+        from .models import MetricType
+
+        by_id, by_name, by_key, by_source = {}, {}, {}, {}
+        for metric in MetricType.objects.order_by('computation_order', 'name', 'pk'):
+            by_id[metric.pk] = metric
+            by_name.setdefault((metric.name, metric.is_system), []).append(metric)
+            if metric.key:
+                by_key[metric.key] = metric
+            if metric.computation_source:
+                by_source.setdefault((metric.computation_source, metric.scope_type, metric.is_system), metric)
+
+        self._by_id, self._by_name, self._by_key, self._by_source = by_id, by_name, by_key, by_source
+        self._loaded = True
+        logger.debug(f"Loaded {len(by_id)} metric types into the registry")
+
+    def _ensure_loaded(self):
+        """Load the registry if needed, reloading when another process changed it"""
+        now = time.monotonic()
+        if self._loaded and now - self._last_check < VERSION_CHECK_INTERVAL:
+            return
+
+        with self._lock:
+            version = self._get_stored_version()
+            self._last_check = now
+            if not self._loaded or version != self._version:
+                self._load()
+                self._version = version
+
+    def get(self, metric_id):
+        """Get a metric type by primary key, or None"""
+        self._ensure_loaded()
+        return self._by_id.get(metric_id)
+
+    def get_by_name(self, name, scope_type=None, is_system=True):
+        """
+        Get the first metric type with a given name.
+
+        Args:
+            name: Metric name
+            scope_type: Optional scope to restrict the lookup to
+            is_system: Match system metrics (True), user metrics (False) or both (None)
+
+        Returns:
+            MetricType instance or None, following the default model ordering
+        """
+        self._ensure_loaded()
+        flags = [True, False] if is_system is None else [is_system]
+        candidates = [
+            metric
+            for flag in flags
+            for metric in self._by_name.get((name, flag), [])
+            if scope_type is None or metric.scope_type == scope_type
+        ]
+        if is_system is None:
+            candidates.sort(key=lambda metric: (metric.computation_order, metric.name))
+        return candidates[0] if candidates else None
+
+    def get_by_key(self, key):
+        """Get a metric type by its unique key, or None"""
+        self._ensure_loaded()
+        return self._by_key.get(key)
+
+    def get_by_source(self, computation_source, scope_type, is_system=True):
+        """Get the metric type providing a computation source in a scope, or None"""
+        self._ensure_loaded()
+        return self._by_source.get((computation_source, scope_type, is_system))
+
+    def invalidate(self):
+        """Drop the local snapshot, other processes see the change in the database"""
+        with self._lock:
+            self._loaded = False
+            self._by_id, self._by_name, self._by_key, self._by_source = {}, {}, {}, {}
+
+
+registry = MetricTypeRegistry()
@@ -0,0 +1,91 @@
+"""
+Signal handlers for the metrics app.
+
+Keeps the request-scoped metric value cache coherent when metric values,
+transactions, positions or prices are written during the same request, and
+the metric type registry and latest value projection coherent when metric
+types and values change.
+"""
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from market_data.signals import prices_stored
+from .cache import get_active_cache
+from .models import LatestMetricValue, MetricType, MetricValue
+from .registry import registry
+
+
+@receiver([post_save, post_delete], sender=MetricType)
+def invalidate_metric_type_registry(sender, instance, **kwargs):
+    """Reload the metric type registry after a metric type changes"""
+    registry.invalidate()
+
+
+@receiver(post_save, sender=MetricValue)
+def record_latest_metric_value(sender, instance, created, raw=False, **kwargs):
+    """Keep the latest value projection up to date"""
+    if raw:
+        return
+    LatestMetricValue.record(instance, created=created)
+
+
+@receiver(post_delete, sender=MetricValue)
+def refresh_latest_metric_value(sender, instance, **kwargs):
+    """Point the projection at the next most recent value"""
+    LatestMetricValue.forget(instance)
+
+
+@receiver([post_save, post_delete], sender=MetricValue)
+def invalidate_metric_value(sender, instance, **kwargs):
+    """Invalidate cached values of the metric value's target"""
+    cache = get_active_cache()
+    if cache is None:
+        return
+
+    if instance.position_id:
+        cache.invalidate('POSITION', instance.position_id)
+    elif instance.portfolio_id:
+        cache.invalidate('PORTFOLIO', instance.portfolio_id)
+    elif instance.transaction_id:
+        cache.invalidate('TRANSACTION', instance.transaction_id)
+
+
+@receiver([post_save, post_delete], sender='portfolio.Transaction')
+def invalidate_transaction(sender, instance, **kwargs):
+    """Invalidate cached values of the transaction and its position"""
+    cache = get_active_cache()
+    if cache is None:
+        return
+
+    cache.invalidate('TRANSACTION', instance.pk)
+    cache.invalidate('POSITION', instance.position_id)
+
+
+@receiver([post_save, post_delete], sender='portfolio.Position')
+def invalidate_position(sender, instance, **kwargs):
+    """Invalidate cached values of the position (e.g. when it is deactivated)"""
+    cache = get_active_cache()
+    if cache is None:
+        return
+
+    cache.invalidate('POSITION', instance.pk)
+
+
+@receiver([post_save, post_delete], sender='market_data.PriceData')
+def invalidate_price_data(sender, instance, **kwargs):
+    """Prices can affect any valuation, so drop everything"""
+    cache = get_active_cache()
+    if cache is None:
+        return
+
+    cache.clear()
+
+
+@receiver(prices_stored)
+def invalidate_stored_prices(sender, **kwargs):
+    """Prices stored in bulk send no save signals, drop everything as well"""
+    cache = get_active_cache()
+    if cache is None:
+        return
+
+    cache.clear()
@@ -1,3 +1,386 @@
+import datetime
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db.models.signals import post_save
 from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from market_data.models import PriceData, Security
+from portfolio.models import Portfolio, Position, Transaction
+from .bulk import compute_position_metrics_bulk
+from .cache import metric_value_cache
+from .evaluation import MetricEvaluator
+from .formulas import CompiledFormula, FormulaError
+from .models import LatestMetricValue, MetricType, MetricValue
+from .providers import BATCH_METRIC_PROVIDERS, register_batch_provider
+from .registry import registry
+
+
+class MetricEvaluatorTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='evaluator', password='password')
+        self.portfolio = Portfolio.objects.create(user=user, name='Test Portfolio')
+        self.position = Position.objects.create(
+            portfolio=self.portfolio, ticker='AAPL', position_type='STOCK'
+        )
+        for quantity, price, transaction_type in [(10, 100, 'BUY'), (10, 200, 'BUY'), (5, 250, 'SELL')]:
+            Transaction.objects.create(
+                position=self.position,
+                transaction_type=transaction_type,
+                quantity=Decimal(quantity),
+                price=Decimal(price),
+                date=datetime.date(2024, 1, 1),
+                status='COMPLETED'
+            )
+
+    def test_dependencies_are_ordered_before_dependents(self):
+        names = [metric.name for metric in MetricEvaluator('POSITION').ordered_metrics]
+        self.assertLess(names.index('Total Shares'), names.index('Average Purchase Price'))
+        self.assertLess(names.index('Average Purchase Price'), names.index('Cost Basis'))
+        self.assertLess(names.index('Market Price'), names.index('Current Value'))
+
+    def test_evaluate_position(self):
+        values = {
+            metric.name: value
+            for metric, value in MetricEvaluator('POSITION').evaluate(self.position).items()
+        }
+        self.assertEqual(values['Total Shares'], Decimal('15'))
+        # FIFO: the sale consumed half of the 100 lot
+        self.assertEqual(values['Average Purchase Price'], Decimal('2500') / 15)
+        self.assertAlmostEqual(values['Cost Basis'], Decimal('2500'), places=20)
+        self.assertIsNone(values['Current Value'])
+
+    def test_standard_metrics_loaded_in_one_pass(self):
+        evaluator = MetricEvaluator('POSITION', MetricType.objects.filter(
+            scope_type='POSITION', computation_source__in=['shares', 'avg_price', 'cost_basis']
+        ))
+        MetricType.get_system_metric('Market Price', scope_type='POSITION')
+        # One aggregate query, none per dependency
+        with self.assertNumQueries(1):
+            evaluator.evaluate(self.position)
+
+    def test_cycle_keeps_all_metrics(self):
+        first = MetricType.objects.create(name='First', scope_type='POSITION', data_type='RATIO')
+        second = MetricType.objects.create(name='Second', scope_type='POSITION', data_type='RATIO')
+        first.computation_dependencies.add(second)
+        second.computation_dependencies.add(first)
+
+        evaluator = MetricEvaluator('POSITION')
+        self.assertEqual(len(evaluator.ordered_metrics), len(evaluator.metric_types))
+
+
+class BulkPositionMetricsTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='bulk', password='password')
+        self.portfolio = Portfolio.objects.create(user=user, name='Bulk Portfolio')
+        market_price = MetricType.objects.get(name='Market Price', scope_type='POSITION', is_system=True)
+        for index in range(5):
+            position = Position.objects.create(
+                portfolio=self.portfolio, ticker=f'T{index}', position_type='STOCK'
+            )
+            for quantity, price, transaction_type in [(10, 100 + index, 'BUY'), (4, 90, 'BUY'), (3, 150, 'SELL')]:
+                Transaction.objects.create(
+                    position=position,
+                    transaction_type=transaction_type,
+                    quantity=Decimal(quantity),
+                    price=Decimal(price),
+                    fees=Decimal('1.50'),
+                    date=datetime.date(2024, 1, 1),
+                    status='COMPLETED'
+                )
+            MetricValue.objects.create(
+                position=position, metric_type=market_price,
+                date=datetime.date(2024, 2, 1), value=Decimal(120 + index)
+            )
+
+    def test_matches_per_position_computation(self):
+        results = compute_position_metrics_bulk(self.portfolio)
+        self.assertEqual(len(results), 5)
+
+        for position in self.portfolio.position_set.all():
+            values = results[position.position_id]
+            for name, source in [('Total Shares', 'shares'), ('Average Purchase Price', 'avg_price'),
+                                 ('Cost Basis', 'cost_basis'), ('Current Value', 'current_value')]:
+                metric = MetricType.objects.get(name=name, scope_type='POSITION', is_system=True)
+                expected = metric.compute_value(position)
+                self.assertAlmostEqual(float(values[source]), float(expected), places=4)
+
+    def test_query_count_is_constant(self):
+        MetricType.get_system_metric('Market Price', scope_type='POSITION')
+        with self.assertNumQueries(1):
+            compute_position_metrics_bulk(self.portfolio)
+
+    def test_compute_values_uses_batch_provider(self):
+        metric = MetricType.objects.create(
+            name='Batch Metric', scope_type='POSITION', data_type='RATIO', is_computed=True
+        )
+        calls = []
+
+        def batch_provider(positions):
+            calls.append(len(positions))
+            return {position.pk: Decimal(position.ticker[1:]) for position in positions}
+
+        register_batch_provider(metric.name, batch_provider)
+        self.addCleanup(BATCH_METRIC_PROVIDERS.pop, metric.name)
+
+        positions = list(self.portfolio.position_set.all())
+        values = metric.compute_values(positions)
+        self.assertEqual(calls, [5])
+        self.assertEqual(values, {position.pk: Decimal(position.ticker[1:]) for position in positions})
+        self.assertEqual(metric.compute_value(positions[0]), Decimal(positions[0].ticker[1:]))
+
+    def test_standard_columns_are_computed_in_bulk(self):
+        cost_basis = MetricType.get_system_metric('Cost Basis', scope_type='POSITION')
+        positions = list(self.portfolio.position_set.all())
+        with self.assertNumQueries(1):
+            values = cost_basis.compute_values(positions)
+        for position in positions:
+            self.assertAlmostEqual(float(values[position.pk]), float(cost_basis.compute_value(position)), places=4)
+
+
+class MetricValueCacheTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='cache', password='password')
+        portfolio = Portfolio.objects.create(user=user, name='Cache Portfolio')
+        self.position = Position.objects.create(portfolio=portfolio, ticker='MSFT', position_type='STOCK')
+        self.market_price = MetricType.objects.get(name='Market Price', scope_type='POSITION', is_system=True)
+        MetricValue.objects.create(
+            position=self.position, metric_type=self.market_price,
+            date=datetime.date(2024, 1, 1), value=Decimal('100')
+        )
+
+    def test_latest_value_is_memoized_within_block(self):
+        with metric_value_cache():
+            self.market_price.get_latest_value(self.position)
+            with self.assertNumQueries(0):
+                latest = self.market_price.get_latest_value(self.position)
+        self.assertEqual(latest.value, Decimal('100'))
+
+    def test_write_invalidates_target(self):
+        with metric_value_cache():
+            self.assertEqual(self.position.get_latest_market_price(), Decimal('100'))
+            MetricValue.objects.create(
+                position=self.position, metric_type=self.market_price,
+                date=datetime.date(2024, 2, 1), value=Decimal('110')
+            )
+            self.assertEqual(self.position.get_latest_market_price(), Decimal('110'))
+
+    def test_bulk_writes_invalidate(self):
+        security = Security.objects.create(symbol='MSFT', name='Microsoft', security_type='STOCK')
+        with metric_value_cache():
+            self.assertEqual(self.position.get_latest_market_price(), Decimal('100'))
+            MetricValue.bulk_store([MetricValue(
+                position=self.position, metric_type=self.market_price,
+                date=datetime.date(2024, 2, 1), value=Decimal('110')
+            )])
+            self.assertEqual(self.position.get_latest_market_price(), Decimal('110'))
+
+            PriceData.bulk_store([PriceData(
+                security=security, date=datetime.date(2024, 2, 1), open=110, high=110, low=110,
+                close=110, adj_close=110, volume=1000
+            )])
+            with self.assertNumQueries(1):
+                self.market_price.get_latest_value(self.position)
+
+
+class MetricTypeRegistryTests(TestCase):
+    def test_system_metric_lookup_is_cached(self):
+        MetricType.get_system_metric('Market Price', scope_type='POSITION')
+        with self.assertNumQueries(0):
+            metric = MetricType.get_system_metric('Market Price', scope_type='POSITION')
+        self.assertEqual(metric.scope_type, 'POSITION')
+        self.assertTrue(metric.is_system)
+
+    def test_saving_metric_type_invalidates(self):
+        # The test transaction is rolled back without signals, so reload afterwards
+        self.addCleanup(registry.invalidate)
+        self.assertIsNone(MetricType.get_system_metric('Registry Test'))
+        MetricType.objects.create(name='Registry Test', scope_type='PORTFOLIO', data_type='RATIO', is_system=True)
+        self.assertIsNotNone(MetricType.get_system_metric('Registry Test', scope_type='PORTFOLIO'))
+
+    def test_change_in_another_process_reloads(self):
+        self.addCleanup(registry.invalidate)
+        metric = MetricType.get_system_metric('Market Price', scope_type='POSITION')
+        # A queryset update sends no signal, like a save in another process
+        MetricType.objects.filter(pk=metric.pk).update(description='Changed', updated_at=timezone.now())
+        self.assertNotEqual(MetricType.get_system_metric('Market Price', scope_type='POSITION').description, 'Changed')
+
+        registry._last_check = 0.0
+        self.assertEqual(MetricType.get_system_metric('Market Price', scope_type='POSITION').description, 'Changed')
+
+
+class LatestMetricValueTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='latest', password='password')
+        portfolio = Portfolio.objects.create(user=user, name='Latest Portfolio')
+        self.position = Position.objects.create(portfolio=portfolio, ticker='IBM', position_type='STOCK')
+        self.market_price = MetricType.objects.get(name='Market Price', scope_type='POSITION', is_system=True)
+
+    def _store(self, day, value):
+        return MetricValue.objects.create(
+            position=self.position, metric_type=self.market_price,
+            date=datetime.date(2024, 1, day), value=Decimal(value)
+        )
+
+    def test_tracks_latest_by_date(self):
+        self._store(10, '100')
+        self._store(5, '90')
+        self.assertEqual(self.market_price.get_latest_value(self.position).value, Decimal('100'))
+
+        newest = self._store(20, '110')
+        self.assertEqual(self.market_price.get_latest_value(self.position).value, Decimal('110'))
+
+        newest.date = datetime.date(2024, 1, 1)
+        newest.save()
+        self.assertEqual(self.market_price.get_latest_value(self.position).value, Decimal('100'))
+
+    def test_delete_falls_back_to_previous_value(self):
+        self._store(5, '90')
+        self._store(10, '100').delete()
+        self.assertEqual(self.market_price.get_latest_value(self.position).value, Decimal('90'))
+
+        MetricValue.objects.filter(position=self.position).delete()
+        self.assertIsNone(self.market_price.get_latest_value(self.position))
+        self.assertFalse(LatestMetricValue.objects.exists())
+
+    def test_rebuild_matches_signal_maintenance(self):
+        for day, value in [(3, '1'), (9, '3'), (6, '2')]:
+            self._store(day, value)
+        self.assertEqual(LatestMetricValue.rebuild(), 1)
+        self.assertEqual(self.market_price.get_latest_value(self.position).value, Decimal('3'))
+
+
+class MetricValueBulkStoreTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='bulkstore', password='password')
+        portfolio = Portfolio.objects.create(user=user, name='Bulk Store Portfolio')
+        self.positions = [
+            Position.objects.create(portfolio=portfolio, ticker=f'B{index}', position_type='STOCK')
+            for index in range(3)
+        ]
+        self.market_price = MetricType.objects.get(name='Market Price', scope_type='POSITION', is_system=True)
+
+    def _values(self, day, price):
+        return [
+            MetricValue(position=position, metric_type=self.market_price,
+                        date=datetime.date(2024, 3, day), value=Decimal(price))
+            for position in self.positions
+        ]
+
+    def test_upserts_on_date_and_updates_latest(self):
+        MetricValue.bulk_store(self._values(1, '10'))
+        first_ids = set(MetricValue.objects.values_list('value_id', flat=True))
+
+        stored = MetricValue.bulk_store(self._values(1, '11') + self._values(2, '12'))
+        self.assertEqual(MetricValue.objects.count(), 6)
+        self.assertTrue(first_ids <= {metric_value.pk for metric_value in stored})
+        self.assertEqual(MetricValue.objects.get(value_id=next(iter(first_ids))).value, Decimal('11'))
+
+        for position in self.positions:
+            self.assertEqual(self.market_price.get_latest_value(position).value, Decimal('12'))
+
+    def test_scenario_defaults_to_base(self):
+        stored = MetricValue.bulk_store(self._values(1, '10'))
+        self.assertTrue(all(metric_value.scenario == 'BASE' for metric_value in stored))
+
+    def test_invalid_value_writes_nothing(self):
+        values = self._values(1, '10')
+        values[-1].value = None
+        with self.assertRaises(ValidationError):
+            MetricValue.bulk_store(values)
+        self.assertFalse(MetricValue.objects.exists())
+
+    def test_query_count_does_not_grow_with_batch(self):
+        MetricValue.bulk_store(self._values(1, '10'))
+        # Savepoint, upsert, reload keys, load projection, delete stale rows,
+        # insert new rows, release savepoint
+        with self.assertNumQueries(7):
+            MetricValue.bulk_store(self._values(2, '11'))
+
+    def test_store_replaces_value_and_sends_signals(self):
+        first = MetricValue.store(self._values(1, '10')[0])
+        received = []
+        receiver = lambda sender, instance, created, **kwargs: received.append((instance.pk, created))
+        post_save.connect(receiver, sender=MetricValue)
+        self.addCleanup(post_save.disconnect, receiver, sender=MetricValue)
+
+        stored = MetricValue.store(self._values(1, '11')[0])
+        self.assertEqual(received, [(first.pk, False)])
+        self.assertEqual((stored.pk, stored.created_at), (first.pk, first.created_at))
+        self.assertEqual(MetricValue.objects.get().value, Decimal('11'))
+        self.assertEqual(self.market_price.get_latest_value(self.positions[0]).value, Decimal('11'))
+
+    def test_create_view_rejects_same_day_value(self):
+        memo = MetricType.objects.create(name='Thesis', scope_type='POSITION', data_type='MEMO')
+        position = self.positions[0]
+        self.client.login(username='bulkstore', password='password')
+        url = reverse('metrics:metric_value_create', args=[position.portfolio_id, position.pk]) + f'?metric_type={memo.pk}'
+        data = {'text_value': 'Buy', 'date': '2024-03-01', 'notes': ''}
+
+        self.assertEqual(self.client.post(url, data).status_code, 302)
+        response = self.client.post(url, dict(data, text_value='Sell'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['form'].has_error('date'))
+        self.assertEqual(list(MetricValue.objects.filter(metric_type=memo).values_list('text_value', flat=True)), ['Buy'])
+
+
+class FormulaMetricTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='formula', password='password')
+        self.portfolio = Portfolio.objects.create(user=user, name='Formula Portfolio')
+        market_price = MetricType.objects.get(name='Market Price', scope_type='POSITION', is_system=True)
+        self.positions = []
+        for index, price in enumerate([Decimal('150'), None]):
+            position = Position.objects.create(portfolio=self.portfolio, ticker=f'F{index}', position_type='STOCK')
+            Transaction.objects.create(
+                position=position, transaction_type='BUY', quantity=Decimal('10'),
+                price=Decimal('100'), date=datetime.date(2024, 1, 1), status='COMPLETED'
+            )
+            if price is not None:
+                MetricValue.objects.create(
+                    position=position, metric_type=market_price,
+                    date=datetime.date(2024, 2, 1), value=price
+                )
+            self.positions.append(position)
+        self.addCleanup(registry.invalidate)
+
+    def _formula_metric(self, name, formula):
+        return MetricType.objects.create(
+            name=name, scope_type='POSITION', data_type='RATIO', is_computed=True, formula=formula
+        )
+
+    def test_parse_errors(self):
+        for formula in ['Cost Basis +', '__import__("os")', 'Unknown Metric * 2', 'max()', '(Shares']:
+            with self.assertRaises(FormulaError, msg=formula):
+                CompiledFormula(formula, 'POSITION')
+
+    def test_operator_precedence(self):
+        metric = self._formula_metric('Precedence', '-2 ^ 2 + 3 * (1 + 1) / 2 + max(Shares, 1)')
+        self.assertEqual(metric.compute_value(self.positions[0]), Decimal('9'))
+
+    def test_evaluated_in_bulk_with_system_metrics(self):
+        gain = self._formula_metric('Gain Ratio', 'Current Value / Cost Basis - 1')
+        doubled = self._formula_metric('Doubled Gain', '[Gain Ratio] * 2')
+        value = self._formula_metric('Value Check', 'Market Price * Shares')
+
+        evaluator = MetricEvaluator('POSITION')
+        names = [metric.name for metric in evaluator.ordered_metrics]
+        self.assertLess(names.index('Gain Ratio'), names.index('Doubled Gain'))
+
+        results = evaluator.evaluate_many(self.positions)
+        first, second = (results[position.pk] for position in self.positions)
+        self.assertEqual(first[gain], Decimal('0.5'))
+        self.assertEqual(first[doubled], Decimal('1'))
+        self.assertEqual(first[value], Decimal('1500'))
+        # No market price: the formulas depending on it have no value
+        self.assertIsNone(second[gain])
+        self.assertIsNone(second[doubled])
 
-# Create your tests here.
+    def test_self_reference_is_rejected(self):
+        metric = self._formula_metric('Loop', 'Shares')
+        metric.formula = 'Loop + 1'
+        with self.assertRaises(ValidationError):
+            metric.full_clean()
@@ -2,7 +2,8 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from portfolio.models import Portfolio, Position, Transaction
-from .models import MetricType, MetricValue
+from .models import LatestMetricValue, MetricType, MetricValue
+from .evaluation import MetricEvaluator
 from .forms import MetricTypeForm, MetricValueForm, MetricUpdateForm
 import datetime
 from itertools import groupby
@@ -31,14 +32,14 @@ def position_metrics(request, portfolio_id, position_id):
     portfolio = get_object_or_404(Portfolio, portfolio_id=portfolio_id, user=request.user)
     position = get_object_or_404(Position, position_id=position_id, portfolio=portfolio)
     
-    # Get position-scoped metrics ordered by computation_order
-    all_metrics = MetricType.objects.filter(scope_type='POSITION').order_by('computation_order', 'name')
+    # Evaluate all position-scoped metrics in dependency order
+    evaluator = MetricEvaluator('POSITION')
+    computed_values = evaluator.evaluate(position)
     metrics_by_type = {}
     
-    for metric in all_metrics:
+    for metric in evaluator.metric_types:
         if metric.is_computed:
-            # Compute the value
-            value = metric.compute_value(position)
+            value = computed_values.get(metric)
             if value is not None:
                 computed_value = MetricValue(
                     position=position,
@@ -145,27 +146,30 @@ def metric_value_create(request, portfolio_id, position_id=None):
             
             metric_value.metric_type = metric_type
             metric_value.source = 'USER'
-            metric_value.save()
-            messages.success(request, f'{metric_type.name} value added successfully!')
+            if metric_value.is_duplicate():
+                form.add_error('date', f'A {metric_type.name} value is already stored for this date. Edit it instead.')
+            else:
+                metric_value.save()
+                messages.success(request, f'{metric_type.name} value added successfully!')
             
-            # Redirect based on scope type
-            if metric_type.scope_type == 'TRANSACTION':
-                if position_id:  # Ensure position_id is not None
-                    return redirect('metrics:transaction_metrics', 
-                                  portfolio_id=portfolio_id, 
-                                  position_id=position_id,
-                                  transaction_id=transaction.transaction_id)
-                else:
+                # Redirect based on scope type
+                if metric_type.scope_type == 'TRANSACTION':
+                    if position_id:  # Ensure position_id is not None
+                        return redirect('metrics:transaction_metrics', 
+                                      portfolio_id=portfolio_id, 
+                                      position_id=position_id,
+                                      transaction_id=transaction.transaction_id)
+                    else:
+                        return redirect('metrics:portfolio_metrics', portfolio_id=portfolio_id)
+                elif metric_type.scope_type == 'POSITION':
+                    if position and position_id:  # Ensure position_id is not None
+                        return redirect('metrics:position_metrics', 
+                                      portfolio_id=portfolio_id, 
+                                      position_id=position_id)
+                    else:
+                        return redirect('metrics:portfolio_metrics', portfolio_id=portfolio_id)
+                else:  # PORTFOLIO scope
                     return redirect('metrics:portfolio_metrics', portfolio_id=portfolio_id)
-            elif metric_type.scope_type == 'POSITION':
-                if position and position_id:  # Ensure position_id is not None
-                    return redirect('metrics:position_metrics', 
-                                  portfolio_id=portfolio_id, 
-                                  position_id=position_id)
-                else:
-                    return redirect('metrics:portfolio_metrics', portfolio_id=portfolio_id)
-            else:  # PORTFOLIO scope
-                return redirect('metrics:portfolio_metrics', portfolio_id=portfolio_id)
     else:
         form = MetricValueForm(
             metric_type=metric_type,
@@ -248,27 +252,30 @@ def metric_value_edit(request, portfolio_id, position_id=None, value_id=None):
                 # Don't set or clear position/portfolio - should be None already from model validation
                 pass
             
-            metric_value.save()
-            messages.success(request, f'{metric_value.metric_type.name} value updated successfully!')
+            if metric_value.is_duplicate():
+                form.add_error('date', f'A {metric_value.metric_type.name} value is already stored for this date.')
+            else:
+                metric_value.save()
+                messages.success(request, f'{metric_value.metric_type.name} value updated successfully!')
             
-            # Redirect based on scope type
-            if metric_value.metric_type.scope_type == 'TRANSACTION':
-                if position_id:  # Ensure position_id is not None
-                    return redirect('metrics:transaction_metrics', 
-                                  portfolio_id=portfolio_id, 
-                                  position_id=position_id,
-                                  transaction_id=metric_value.transaction.transaction_id)
-                else:
+                # Redirect based on scope type
+                if metric_value.metric_type.scope_type == 'TRANSACTION':
+                    if position_id:  # Ensure position_id is not None
+                        return redirect('metrics:transaction_metrics', 
+                                      portfolio_id=portfolio_id, 
+                                      position_id=position_id,
+                                      transaction_id=metric_value.transaction.transaction_id)
+                    else:
+                        return redirect('metrics:portfolio_metrics', portfolio_id=portfolio_id)
+                elif metric_value.metric_type.scope_type == 'POSITION':
+                    if position_id:  # Ensure position_id is not None
+                        return redirect('metrics:position_metrics', 
+                                      portfolio_id=portfolio_id, 
+                                      position_id=position_id)
+                    else:
+                        return redirect('metrics:portfolio_metrics', portfolio_id=portfolio_id)
+                else:  # PORTFOLIO scope
                     return redirect('metrics:portfolio_metrics', portfolio_id=portfolio_id)
-            elif metric_value.metric_type.scope_type == 'POSITION':
-                if position_id:  # Ensure position_id is not None
-                    return redirect('metrics:position_metrics', 
-                                  portfolio_id=portfolio_id, 
-                                  position_id=position_id)
-                else:
-                    return redirect('metrics:portfolio_metrics', portfolio_id=portfolio_id)
-            else:  # PORTFOLIO scope
-                return redirect('metrics:portfolio_metrics', portfolio_id=portfolio_id)
     else:
         form = MetricValueForm(instance=metric_value, metric_type=metric_value.metric_type)
     
@@ -311,9 +318,12 @@ def metric_update(request, portfolio_id, position_id, metric_type_id):
             metric.position = position
             metric.metric_type = metric_type
             metric.source = 'USER'
-            metric.save()
-            messages.success(request, f'{metric_type.name} updated successfully.')
-            return redirect('portfolio:position_detail', portfolio_id=portfolio_id, position_id=position_id)
+            if metric.is_duplicate():
+                form.add_error('date', f'A {metric_type.name} value is already stored for this date.')
+            else:
+                metric.save()
+                messages.success(request, f'{metric_type.name} updated successfully.')
+                return redirect('portfolio:position_detail', portfolio_id=portfolio_id, position_id=position_id)
     else:
         initial_data = {}
         if metric:
@@ -355,13 +365,19 @@ def metric_types_list(request):
 
 def get_position_metrics(position):
     """Get all metrics for a position"""
-    # Get only position-scoped metrics
-    metric_types = MetricType.objects.filter(scope_type='POSITION').order_by('computation_order', 'name')
+    # Evaluate all position-scoped metrics in dependency order
+    evaluator = MetricEvaluator('POSITION')
+    computed_values = evaluator.evaluate(position)
+    # Latest stored values of all non-computed metrics in one query
+    latest_values = LatestMetricValue.fetch(
+        [metric_type for metric_type in evaluator.metric_types if not metric_type.is_computed],
+        [position]
+    )
     position_metrics = []
     
-    for metric_type in metric_types:
+    for metric_type in evaluator.metric_types:
         if metric_type.is_computed:
-            computed_value = metric_type.compute_value(position)
+            computed_value = computed_values.get(metric_type)
             metric = MetricValue(
                 position=position,
                 metric_type=metric_type,
@@ -371,10 +387,7 @@ def get_position_metrics(position):
             )
             position_metrics.append(metric)
         else:
-            latest_metric = MetricValue.objects.filter(
-                position=position,
-                metric_type=metric_type
-            ).order_by('-date', '-created_at').first()
+            latest_metric = latest_values.get((metric_type.metric_id, position.pk))
             
             if not latest_metric:
                 latest_metric = MetricValue(
@@ -499,8 +512,8 @@ def transaction_metrics(request, portfolio_id, position_id, transaction_id):
                 )
                 metrics_by_type[metric] = [empty_value]
     
-    # Calculate transaction performance
-    performance_data = PerformanceService.calculate_transaction_performance(transaction, user=request.user)
+    # Stored transaction performance, kept current by the recalculation queue
+    performance_data = PerformanceService.get_stored_performance(transaction, user=request.user)
     
     # Check if performance is enabled
     is_performance_enabled = PerformanceService.is_performance_enabled(user=request.user)
@@ -564,13 +577,19 @@ def portfolio_metrics(request, portfolio_id):
 
 def get_portfolio_metrics(portfolio):
     """Get all metrics for a portfolio"""
-    # Get only portfolio-scoped metrics
-    metric_types = MetricType.objects.filter(scope_type='PORTFOLIO').order_by('computation_order', 'name')
+    # Evaluate all portfolio-scoped metrics in dependency order
+    evaluator = MetricEvaluator('PORTFOLIO')
+    computed_values = evaluator.evaluate(portfolio)
+    # Latest stored values of all non-computed metrics in one query
+    latest_values = LatestMetricValue.fetch(
+        [metric_type for metric_type in evaluator.metric_types if not metric_type.is_computed],
+        [portfolio]
+    )
     portfolio_metrics = []
     
-    for metric_type in metric_types:
+    for metric_type in evaluator.metric_types:
         if metric_type.is_computed:
-            computed_value = metric_type.compute_value(portfolio)
+            computed_value = computed_values.get(metric_type)
             metric = MetricValue(
                 portfolio=portfolio,
                 metric_type=metric_type,
@@ -580,10 +599,7 @@ def get_portfolio_metrics(portfolio):
             )
             portfolio_metrics.append(metric)
         else:
-            latest_metric = MetricValue.objects.filter(
-                portfolio=portfolio,
-                metric_type=metric_type
-            ).order_by('-date', '-created_at').first()  # Ensure ordering by both date and created_at
+            latest_metric = latest_values.get((metric_type.metric_id, portfolio.pk))
             
             if not latest_metric:
                 latest_metric = MetricValue(
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import PerformanceSettings, PerformanceMetric
+from .models import PerformanceSettings, PerformanceMetric, PortfolioSnapshot
 
 @admin.register(PerformanceSettings)
 class PerformanceSettingsAdmin(admin.ModelAdmin):
@@ -20,10 +20,19 @@ class PerformanceSettingsAdmin(admin.ModelAdmin):
 @admin.register(PerformanceMetric)
 class PerformanceMetricAdmin(admin.ModelAdmin):
     list_display = [
-        'id', 'content_type', 'object_id', 'cost_basis', 
+        'id', 'portfolio', 'position', 'transaction', 'cost_basis', 
         'current_value', 'absolute_gain_loss', 'percentage_gain_loss', 
         'calculation_date', 'is_realized'
     ]
-    list_filter = ['content_type', 'is_realized', 'calculation_date']
+    list_filter = ['is_realized', 'calculation_date']
+    list_select_related = ['portfolio__user', 'position__portfolio', 'transaction__position']
+    raw_id_fields = ['portfolio', 'position', 'transaction']
     readonly_fields = ['calculation_date']
-    search_fields = ['object_id']
+    search_fields = ['portfolio__name', 'position__ticker']
+
+@admin.register(PortfolioSnapshot)
+class PortfolioSnapshotAdmin(admin.ModelAdmin):
+    list_display = ['portfolio', 'date', 'market_value', 'cash_flow', 'cost_basis', 'calculation_date']
+    list_filter = ['date']
+    readonly_fields = ['calculation_date']
+    search_fields = ['portfolio__name']
@@ -0,0 +1,433 @@
+"""
+Benchmark-relative performance and attribution.
+
+Measures each portfolio against its benchmark security (Portfolio.benchmark,
+or the PERFORMANCE_BENCHMARK_SYMBOL setting when none is attached) over the
+trailing ATTRIBUTION_WINDOW_DAYS:
+
+- active return: time-weighted portfolio return, from the stored
+  PortfolioSnapshot series, minus the benchmark's price return
+- tracking error: annualized standard deviation of the daily active returns
+  on the benchmark's trading days
+- information ratio: annualized mean active return per unit of tracking error
+- Brinson-Fachler attribution of the active return of the holdings to
+  allocation and selection effects per segment, the segments being security
+  types or position tags (Portfolio.attribution_group)
+
+A single benchmark security holds its whole weight in its own segment. The
+other segments have no benchmark holdings and are treated as earning
+nothing, so weight moved out of the benchmark's segment shows up as
+allocation, and the return earned there as selection (including
+interaction). Daily effects are linked over the window with Carino's
+logarithmic factors, so they add up to the active return of the holdings.
+The holdings are valued from PortfolioHistory with end-of-day prices, which
+leaves out trading within the day, so the attributed total differs slightly
+from the snapshot active return.
+
+run_nightly() analyzes all portfolios in chunks, optionally spread over a
+process pool, and stores the results as portfolio-scoped metric values with
+bulk writes.
+"""
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+from decimal import Decimal
+
+import numpy as np
+from django.db import connections
+
+from .integration import (
+    ACTIVE_RETURN,
+    ALLOCATION_EFFECT,
+    INFORMATION_RATIO,
+    SELECTION_EFFECT,
+    TRACKING_ERROR,
+    batched_metric_writes,
+    store_metric_value,
+)
+from .models import PortfolioSnapshot
+from .returns import PortfolioHistory, _as_float, _to_days
+from .risk import MIN_OBSERVATIONS, TRADING_DAYS_PER_YEAR, _get_benchmark_symbol, _sample
+from .snapshots import SnapshotService
+
+logger = logging.getLogger(__name__)
+
+# Calendar days analyzed, ending on the analysis date
+ATTRIBUTION_WINDOW_DAYS = 365
+
+# Portfolios analyzed together by run_nightly()
+CHUNK_SIZE = 200
+
+# Segment of positions without a tag
+UNTAGGED = 'untagged'
+
+# Result field -> (metric name, stored as a percentage)
+RESULT_METRICS = {
+    'active_return': (ACTIVE_RETURN, True),
+    'tracking_error': (TRACKING_ERROR, True),
+    'information_ratio': (INFORMATION_RATIO, False),
+    'allocation': (ALLOCATION_EFFECT, True),
+    'selection': (SELECTION_EFFECT, True),
+}
+
+
+def brinson_fachler(portfolio_weights, portfolio_returns, benchmark_weights, benchmark_returns):
+    """
+    Daily Brinson-Fachler effects of many segments at once.
+
+    Args:
+        portfolio_weights: Segment weights in the portfolio (days x segments)
+        portfolio_returns: Segment returns in the portfolio (days x segments)
+        benchmark_weights: Segment weights in the benchmark (days x segments)
+        benchmark_returns: Segment returns in the benchmark (days x segments)
+
+    Returns:
+        Tuple of allocation and selection effects (days x segments), the
+        selection including the interaction effect
+    """
+    benchmark_total = np.sum(benchmark_weights * benchmark_returns, axis=1, keepdims=True)
+    allocation = (portfolio_weights - benchmark_weights) * (benchmark_returns - benchmark_total)
+    selection = portfolio_weights * (portfolio_returns - benchmark_returns)
+    return allocation, selection
+
+
+def carino_factors(portfolio_returns, benchmark_returns):
+    """
+    Carino linking factors of daily returns.
+
+    Scaling each day's effects by its factor divided by the factor of the
+    whole period makes them add up to the difference of the cumulative
+    returns.
+
+    Returns:
+        Tuple of the daily factors and the factor of the whole period
+    """
+    def factor(portfolio, benchmark):
+        portfolio = np.asarray(portfolio, dtype=float)
+        benchmark = np.asarray(benchmark, dtype=float)
+        difference = portfolio - benchmark
+        with np.errstate(divide='ignore', invalid='ignore'):
+            logarithmic = (np.log1p(portfolio) - np.log1p(benchmark)) / difference
+        return np.where(np.abs(difference) > 1e-12, logarithmic, 1 / (1 + portfolio))
+
+    total = factor(np.prod(1 + portfolio_returns) - 1, np.prod(1 + benchmark_returns) - 1)
+    return factor(portfolio_returns, benchmark_returns), float(total)
+
+
+def active_statistics(portfolio_levels, benchmark_levels):
+    """
+    Active return, tracking error and information ratio of two value series
+    sampled on the same trading days.
+
+    Returns:
+        Dict of the statistics as fractions, None where there is not enough data
+    """
+    portfolio_returns = portfolio_levels[1:] / portfolio_levels[:-1] - 1
+    benchmark_returns = benchmark_levels[1:] / benchmark_levels[:-1] - 1
+    active = portfolio_returns - benchmark_returns
+    active = active[np.isfinite(active)]
+
+    results = {'active_return': None, 'tracking_error': None, 'information_ratio': None}
+    if len(active) < MIN_OBSERVATIONS:
+        return results
+
+    results['active_return'] = float(
+        portfolio_levels[-1] / portfolio_levels[0] - benchmark_levels[-1] / benchmark_levels[0]
+    )
+    tracking_error = float(np.std(active, ddof=1) * np.sqrt(TRADING_DAYS_PER_YEAR))
+    results['tracking_error'] = tracking_error
+    if tracking_error > 0:
+        results['information_ratio'] = float(np.mean(active) * TRADING_DAYS_PER_YEAR / tracking_error)
+    return results
+
+
+class AttributionService:
+    """
+    Service computing benchmark-relative performance and attribution.
+    """
+
+    @classmethod
+    def analyze(cls, portfolios, end_date=None):
+        """
+        Analyze portfolios against their benchmarks with shared queries.
+
+        Args:
+            portfolios: Iterable of Portfolio instances
+            end_date: Last day analyzed (default today)
+
+        Returns:
+            Dict mapping portfolio_id to a dict with the benchmark symbol,
+            active_return, tracking_error, information_ratio, allocation and
+            selection (fractions, None where unavailable) and segments,
+            mapping each segment to its weights, returns and effects
+        """
+        from market_data.models import Security
+        from portfolio.models import Position
+
+        portfolios = list(portfolios)
+        if not portfolios:
+            return {}
+        end_date = end_date or date.today()
+        first_date = end_date - timedelta(days=ATTRIBUTION_WINDOW_DAYS)
+        first_day = _to_day(first_date)
+        end_day = _to_day(end_date)
+
+        default_benchmark = Security.objects.filter(
+            symbol=_get_benchmark_symbol(), active=True
+        ).order_by('created_at').first()
+        benchmarks = {portfolio.pk: cls.get_benchmark(portfolio, default_benchmark) for portfolio in portfolios}
+        benchmark_series = PortfolioHistory.load_price_series(
+            sorted(set(symbol for symbol, _ in benchmarks.values())), first_day, end_day
+        )
+        snapshots = cls._load_snapshot_levels(portfolios, first_date, end_date)
+        histories = PortfolioHistory.build_many(
+            portfolios, end_date=end_date, start_dates={portfolio.pk: first_date for portfolio in portfolios}
+        )
+
+        # Segment of every position, by security type and by tag
+        positions = {
+            position_id: (ticker, position_type, tag)
+            for position_id, ticker, position_type, tag in Position.objects.filter(
+                portfolio__in=portfolios
+            ).values_list('position_id', 'ticker', 'position_type', 'tag')
+        }
+        security_types = dict(Security.objects.filter(
+            symbol__in={ticker for ticker, _, _ in positions.values()}, active=True
+        ).order_by('-created_at').values_list('symbol', 'security_type'))
+
+        results = {}
+        for portfolio in portfolios:
+            symbol, benchmark_segment = benchmarks[portfolio.pk]
+            series = benchmark_series.get(symbol)
+            result = {
+                'benchmark': symbol,
+                'active_return': None, 'tracking_error': None, 'information_ratio': None,
+                'allocation': None, 'selection': None, 'segments': {},
+            }
+            if series is not None:
+                if portfolio.pk in snapshots:
+                    result.update(cls._compare(snapshots[portfolio.pk], series))
+                history = histories.get(portfolio.pk)
+                if history is not None:
+                    if portfolio.attribution_group == 'TAG':
+                        labels = [positions[pk][2] or UNTAGGED for pk in history.position_ids]
+                    else:
+                        labels = [
+                            security_types.get(positions[pk][0], positions[pk][1].lower())
+                            for pk in history.position_ids
+                        ]
+                    result.update(cls._attribute(history, labels, series, benchmark_segment))
+            results[portfolio.pk] = result
+        return results
+
+    @staticmethod
+    def get_benchmark(portfolio, default_benchmark=None):
+        """
+        Get the benchmark symbol of a portfolio and the segment it belongs to
+        under the portfolio's attribution grouping.
+
+        Args:
+            portfolio: Portfolio instance
+            default_benchmark: Security used when the portfolio has no benchmark
+        """
+        benchmark = portfolio.benchmark or default_benchmark
+        if benchmark is None:
+            return _get_benchmark_symbol(), None
+        # A benchmark security has no position tag
+        segment = benchmark.security_type if portfolio.attribution_group == 'SECURITY_TYPE' else None
+        return benchmark.symbol, segment
+
+    @staticmethod
+    def _load_snapshot_levels(portfolios, first_date, end_date):
+        """
+        Load the time-weighted value index of portfolios from their snapshots.
+
+        Money invested on a day counts from the start of the day and money
+        returned from its end, as in PortfolioHistory.daily_returns().
+
+        Returns:
+            Dict mapping portfolio_id to (day numbers, index levels)
+        """
+        rows = PortfolioSnapshot.objects.filter(
+            portfolio__in=portfolios, date__range=(first_date, end_date)
+        ).order_by('portfolio_id', 'date').values_list(
+            'portfolio_id', 'date', _as_float('market_value'), _as_float('cash_flow')
+        )
+        by_portfolio = {}
+        for portfolio_id, day, market_value, cash_flow in rows:
+            by_portfolio.setdefault(portfolio_id, []).append((day, market_value, cash_flow))
+
+        levels = {}
+        for portfolio_id, snapshots in by_portfolio.items():
+            days = _to_days(day for day, _, _ in snapshots)
+            values = np.array([value for _, value, _ in snapshots], dtype=float)
+            flows = np.array([flow for _, _, flow in snapshots], dtype=float)
+            invested = values[:-1] + np.maximum(flows[1:], 0)
+            ending = values[1:] + np.maximum(-flows[1:], 0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                returns = np.where(invested > 0, ending / invested - 1, 0.0)
+            levels[portfolio_id] = (days, np.concatenate(([1.0], np.cumprod(1 + returns))))
+        return levels
+
+    @staticmethod
+    def _compare(portfolio_levels, benchmark_series):
+        """Active statistics on the benchmark's trading days within the snapshots"""
+        days, levels = portfolio_levels
+        benchmark_days, benchmark_prices = benchmark_series
+        grid = benchmark_days[(benchmark_days >= days[0]) & (benchmark_days <= days[-1])]
+        if len(grid) < 2:
+            return {}
+        return active_statistics(_sample(days, levels, grid), _sample(benchmark_days, benchmark_prices, grid))
+
+    @staticmethod
+    def _attribute(history, labels, benchmark_series, benchmark_segment):
+        """
+        Brinson-Fachler attribution of a history's holdings.
+
+        Each day's segment weights are the values at the previous close and
+        segment returns the price moves of the shares held over the day.
+        """
+        segments = list(dict.fromkeys(labels))
+        if benchmark_segment not in segments:
+            segments.append(benchmark_segment)
+        membership = np.zeros((len(labels), len(segments)))
+        membership[np.arange(len(labels)), [segments.index(label) for label in labels]] = 1
+
+        holdings = history.holdings[:-1]
+        start_values = np.nan_to_num(holdings * history.prices[:-1]) @ membership
+        gains = np.nan_to_num(holdings * (history.prices[1:] - history.prices[:-1])) @ membership
+        total_values = start_values.sum(axis=1)
+        invested = total_values > 0
+        if invested.sum() < MIN_OBSERVATIONS:
+            return {}
+        start_values, gains, total_values = start_values[invested], gains[invested], total_values[invested]
+
+        history_days = _to_day(history.start_date) + np.arange(history.days)
+        benchmark_levels = _sample(*benchmark_series, history_days)
+        benchmark_returns = np.nan_to_num(benchmark_levels[1:] / benchmark_levels[:-1] - 1)[invested]
+
+        portfolio_weights = start_values / total_values[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            portfolio_returns = np.where(start_values > 0, gains / start_values, 0.0)
+        benchmark_column = np.array([segment == benchmark_segment for segment in segments], dtype=float)
+        benchmark_weights = np.broadcast_to(benchmark_column, portfolio_weights.shape)
+        segment_benchmark_returns = benchmark_returns[:, None] * benchmark_column
+        # Segments the portfolio doesn't hold on a day earn their benchmark return
+        portfolio_returns = np.where(start_values > 0, portfolio_returns, segment_benchmark_returns)
+
+        allocation, selection = brinson_fachler(
+            portfolio_weights, portfolio_returns, benchmark_weights, segment_benchmark_returns
+        )
+        total_returns = gains.sum(axis=1) / total_values
+        factors, total_factor = carino_factors(total_returns, benchmark_returns)
+        allocation = factors @ allocation / total_factor
+        selection = factors @ selection / total_factor
+
+        growth = np.prod(1 + portfolio_returns, axis=0) - 1
+        return {
+            'allocation': float(allocation.sum()),
+            'selection': float(selection.sum()),
+            'segments': {
+                segment or 'benchmark': {
+                    'portfolio_weight': float(portfolio_weights[-1, index]),
+                    'benchmark_weight': float(benchmark_column[index]),
+                    'portfolio_return': float(growth[index]),
+                    'allocation': float(allocation[index]),
+                    'selection': float(selection[index]),
+                }
+                for index, segment in enumerate(segments)
+            },
+        }
+
+    @classmethod
+    def store_results(cls, portfolios, results, value_date=None):
+        """
+        Store analysis results as portfolio-scoped metric values, in bulk.
+
+        Returns:
+            Number of metric values written
+        """
+        value_date = value_date or date.today()
+        written = 0
+        with batched_metric_writes():
+            for portfolio in portfolios:
+                result = results.get(portfolio.pk)
+                if result is None:
+                    continue
+                for field, (metric_name, percentage) in RESULT_METRICS.items():
+                    value = result.get(field)
+                    if value is None:
+                        continue
+                    value = Decimal(str(round(value * 100 if percentage else value, 6)))
+                    if store_metric_value(metric_name, portfolio, value, value_date=value_date) is not None:
+                        written += 1
+        return written
+
+    @classmethod
+    def process_portfolios(cls, portfolio_ids, end_date=None):
+        """
+        Bring the snapshots of portfolios up to date, analyze them and store
+        the results.
+
+        Returns:
+            Dict with the numbers of portfolios analyzed and values stored
+        """
+        from portfolio.models import Portfolio
+
+        portfolios = list(Portfolio.objects.filter(pk__in=portfolio_ids).select_related('benchmark'))
+        SnapshotService.roll_forward(portfolios, end_date=end_date)
+        results = cls.analyze(portfolios, end_date=end_date)
+        return {
+            'portfolios': len(results),
+            'values': cls.store_results(portfolios, results, value_date=end_date),
+        }
+
+    @classmethod
+    def run_nightly(cls, processes=None, chunk_size=None, end_date=None):
+        """
+        Analyze all portfolios of all users.
+
+        Args:
+            processes: Number of worker processes to spread the chunks over
+                (default: run in this process)
+            chunk_size: Number of portfolios per chunk
+            end_date: Last day analyzed (default today)
+
+        Returns:
+            Dict with the numbers of portfolios analyzed and values stored
+        """
+        from portfolio.models import Portfolio
+
+        chunk_size = chunk_size or CHUNK_SIZE
+        portfolio_ids = list(Portfolio.objects.order_by('pk').values_list('pk', flat=True))
+        chunks = [portfolio_ids[i:i + chunk_size] for i in range(0, len(portfolio_ids), chunk_size)]
+
+        if processes and processes > 1 and len(chunks) > 1:
+            from .services import _init_recalculation_worker
+
+            # Workers open their own connections
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=processes, initializer=_init_recalculation_worker) as executor:
+                chunk_results = list(executor.map(_process_chunk, chunks, [end_date] * len(chunks)))
+        else:
+            chunk_results = [cls.process_portfolios(chunk, end_date) for chunk in chunks]
+
+        results = {'portfolios': 0, 'values': 0}
+        for chunk_result in chunk_results:
+            for key in results:
+                results[key] += chunk_result[key]
+        logger.info(f"Analyzed {results['portfolios']} portfolios against their benchmarks, "
+                    f"stored {results['values']} metric values")
+        return results
+
+
+def _process_chunk(portfolio_ids, end_date):
+    """Analyze one chunk of portfolios in a worker process"""
+    try:
+        return AttributionService.process_portfolios(portfolio_ids, end_date)
+    finally:
+        connections.close_all()
+
+
+def _to_day(value):
+    return int(np.datetime64(value, 'D').astype(np.int64))
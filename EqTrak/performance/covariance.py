@@ -0,0 +1,406 @@
+"""
+Covariance and correlation matrices of portfolio holdings.
+
+Builds the aligned daily return matrix of a set of securities from stored
+prices and estimates their covariance and correlation over a trailing window
+of trading days (the days with a stored price for any of them), optionally
+with exponential weighting and shrinkage.
+
+Matrices are cached in process memory keyed by (securities, window, decay,
+shrinkage, last price date), so repeated views and other risk metrics share
+them. The running sums behind a matrix are kept as well: when new days of
+prices land, they are advanced one day at a time in O(n^2) instead of being
+recomputed from the whole window. Price corrections within the window, seen
+through the signal handlers of this process, drop the affected entries.
+
+Example:
+    matrix = CovarianceService.for_portfolio(portfolio, decay=0.94, shrinkage='auto')
+    matrix.correlation
+    matrix.volatility({'AAPL': 6000, 'MSFT': 4000})
+"""
+import copy
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .returns import PortfolioHistory, _forward_fill
+from .risk import TRADING_DAYS_PER_YEAR, _sample
+
+logger = logging.getLogger(__name__)
+
+# Trading days of returns in the default window
+DEFAULT_WINDOW = 252
+
+# Matrices and running sums kept per process
+MAX_CACHED_MATRICES = 64
+
+# Full recomputation after this many windows of incremental updates, which
+# bounds the floating point drift of the running sums
+REBUILD_AFTER_WINDOWS = 1
+
+
+class ReturnStatistics:
+    """
+    Running weighted sums of a window of daily returns.
+
+    With weights w (1 for every day, or decay**age with exponential
+    weighting) the statistics are the weight sums, the weighted sums of the
+    returns and the weighted sums of their outer products. Advancing by one
+    day adds the new day's terms and removes the oldest day's, in O(n^2).
+    """
+
+    def __init__(self, returns, decay=None):
+        """
+        Args:
+            returns: Returns (days x securities), oldest first
+            decay: Optional daily decay factor of the exponential weighting
+        """
+        self.decay = decay
+        self.window = returns.shape[0]
+        # Window kept as a ring buffer, _head being the oldest row
+        self.returns = np.array(returns, dtype=float)
+        self._head = 0
+        self._rebuild()
+
+    def _weights(self):
+        """Weights of the window's rows, oldest first"""
+        if self.decay is None:
+            return np.ones(self.window)
+        return self.decay ** np.arange(self.window - 1, -1, -1, dtype=float)
+
+    def _ordered_returns(self):
+        return np.roll(self.returns, -self._head, axis=0)
+
+    def _rebuild(self):
+        weights = self._weights()
+        returns = self._ordered_returns()
+        self.weight_sum = weights.sum()
+        self.squared_weight_sum = np.sum(weights ** 2)
+        self.sums = weights @ returns
+        self.products = (returns * weights[:, None]).T @ returns
+        self._advances = 0
+
+    def advance(self, row):
+        """Slide the window by one day, dropping the oldest day's returns"""
+        factor = 1.0 if self.decay is None else self.decay
+        oldest = self.returns[self._head]
+        oldest_weight = factor ** (self.window - 1)
+
+        self.sums = factor * (self.sums - oldest_weight * oldest) + row
+        self.products = factor * (self.products - oldest_weight * np.outer(oldest, oldest)) + np.outer(row, row)
+        self.returns[self._head] = row
+        self._head = (self._head + 1) % self.window
+
+        self._advances += 1
+        if self._advances >= REBUILD_AFTER_WINDOWS * self.window:
+            self._rebuild()
+
+    def covariance(self):
+        """Weighted sample covariance (unbiased for equal weights)"""
+        mean = self.sums / self.weight_sum
+        biased = self.products / self.weight_sum - np.outer(mean, mean)
+        correction = self.weight_sum ** 2 / (self.weight_sum ** 2 - self.squared_weight_sum)
+        return biased * correction
+
+    def shrinkage_intensity(self, covariance):
+        """
+        Ledoit-Wolf intensity of shrinking towards a scaled identity matrix.
+
+        Uses sum_t w_t ||y_t y_t' - S||^2 = sum_t w_t ||y_t||^4 - ||S||^2 for
+        the demeaned returns y_t, so the estimate costs O(days x n) on top
+        of the covariance.
+        """
+        weights = self._weights() / self.weight_sum
+        returns = self._ordered_returns() - self.sums / self.weight_sum
+        biased = covariance * (1 - self.squared_weight_sum / self.weight_sum ** 2)
+        target = np.trace(biased) / len(biased)
+
+        distance = np.sum((biased - target * np.eye(len(biased))) ** 2)
+        if distance == 0:
+            return 0.0
+        fourth_moment = weights @ np.sum(returns ** 2, axis=1) ** 2
+        # Effective number of observations of the weighting
+        observations = 1 / np.sum(weights ** 2)
+        dispersion = max(fourth_moment - np.sum(biased ** 2), 0) / observations
+        return float(min(dispersion, distance) / distance)
+
+
+class CovarianceMatrix:
+    """
+    Covariance and correlation of daily returns.
+
+    Attributes:
+        symbols: Securities in the order of the matrix rows and columns
+        covariance: Daily return covariance (n x n)
+        correlation: Return correlation (n x n), NaN for securities without
+            variance
+        observations: Trading days of returns in the window
+        last_date: Last price date the matrix was computed with
+        shrinkage: Shrinkage intensity applied, 0 without shrinkage
+    """
+
+    def __init__(self, symbols, covariance, observations, last_date, shrinkage=0.0):
+        self.symbols = list(symbols)
+        self.covariance = covariance
+        self.observations = observations
+        self.last_date = last_date
+        self.shrinkage = shrinkage
+
+        deviations = np.sqrt(np.diag(covariance))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            correlation = covariance / np.outer(deviations, deviations)
+        correlation[~np.isfinite(correlation)] = np.nan
+        np.fill_diagonal(correlation, np.where(deviations > 0, 1.0, np.nan))
+        self.correlation = correlation
+
+    def volatility(self, weights, annualize=True):
+        """
+        Volatility of a portfolio of the securities.
+
+        Args:
+            weights: Dict mapping symbol to weight or market value; symbols
+                outside the matrix are ignored
+            annualize: Scale the daily volatility to a year of trading days
+
+        Returns:
+            Volatility as a fraction, or None without weights
+        """
+        vector = np.array([float(weights.get(symbol) or 0) for symbol in self.symbols])
+        total = vector.sum()
+        if total == 0:
+            return None
+        vector /= total
+        variance = max(float(vector @ self.covariance @ vector), 0.0)
+        scale = TRADING_DAYS_PER_YEAR if annualize else 1
+        return float(np.sqrt(variance * scale))
+
+    def to_dict(self):
+        """Plain representation, NaN as None, e.g. for a JSON response"""
+        def rows(matrix):
+            return [[None if np.isnan(value) else float(value) for value in row] for row in matrix]
+
+        return {
+            'symbols': self.symbols,
+            'observations': self.observations,
+            'last_date': self.last_date.isoformat() if self.last_date else None,
+            'shrinkage': self.shrinkage,
+            'covariance': rows(self.covariance),
+            'correlation': rows(self.correlation),
+        }
+
+
+class _Entry:
+    """Running statistics of a set of securities and the prices they end with"""
+
+    def __init__(self, statistics, last_day, last_levels):
+        self.statistics = statistics
+        self.last_day = last_day
+        self.last_levels = last_levels
+
+    def copy(self):
+        return _Entry(copy.deepcopy(self.statistics), self.last_day, self.last_levels)
+
+
+class CovarianceService:
+    """
+    Covariance matrices of sets of securities, cached per process.
+    """
+
+    _lock = threading.Lock()
+    # {(symbols, window, decay): _Entry}
+    _entries = OrderedDict()
+    # {(symbols, window, decay, shrinkage, last_date): CovarianceMatrix}
+    _matrices = OrderedDict()
+    # Bumped by every invalidation, builds started before one are not cached
+    _generation = 0
+
+    @classmethod
+    def for_portfolio(cls, portfolio, **options):
+        """
+        Get the covariance matrix of a portfolio's active positions.
+
+        Args:
+            portfolio: Portfolio instance
+            **options: window, decay and shrinkage, see for_symbols()
+        """
+        tickers = portfolio.position_set.filter(is_active=True).exclude(ticker='').values_list('ticker', flat=True)
+        return cls.for_symbols(set(tickers), **options)
+
+    @classmethod
+    def for_symbols(cls, symbols, window=DEFAULT_WINDOW, decay=None, shrinkage=None):
+        """
+        Get the covariance matrix of securities' daily returns.
+
+        Days before a security's first stored price count as zero returns.
+
+        Args:
+            symbols: Iterable of security symbols
+            window: Trading days of returns
+            decay: Optional daily decay factor of exponential weighting, e.g. 0.94
+            shrinkage: None, an intensity between 0 and 1, or 'auto' for the
+                Ledoit-Wolf intensity, shrinking towards a scaled identity
+
+        Returns:
+            CovarianceMatrix, or None when no security has prices
+        """
+        from market_data.models import PriceData
+
+        if decay is not None and not 0 < decay < 1:
+            raise ValueError("decay must be between 0 and 1")
+        if shrinkage not in (None, 'auto') and not (isinstance(shrinkage, (int, float)) and 0 <= shrinkage <= 1):
+            raise ValueError("shrinkage must be between 0 and 1, or 'auto'")
+
+        symbols = tuple(sorted(set(symbols)))
+        if not symbols or window < 2:
+            return None
+        # Walks the date index back from the latest price, cheaper than Max()
+        # over the prices of every security
+        last_date = PriceData.objects.filter(
+            security__symbol__in=symbols, security__active=True
+        ).order_by('-date').values_list('date', flat=True).first()
+        if last_date is None:
+            return None
+
+        key = (symbols, window, decay, shrinkage, last_date)
+        entry_key = (symbols, window, decay)
+        with cls._lock:
+            matrix = cls._matrices.get(key)
+            if matrix is not None:
+                cls._matrices.move_to_end(key)
+                return matrix
+            # Advanced on a copy, other threads keep reading the cached one
+            entry = cls._entries.get(entry_key)
+            entry = entry.copy() if entry is not None else None
+            generation = cls._generation
+
+        # Prices are loaded and the statistics computed without holding the
+        # lock, so a slow build does not block the cache hits of other threads
+        entry = cls._get_entry(entry, symbols, window, decay, _to_day(last_date))
+        if entry is None:
+            return None
+
+        statistics = entry.statistics
+        covariance = statistics.covariance()
+        intensity = 0.0
+        if shrinkage == 'auto':
+            intensity = statistics.shrinkage_intensity(covariance)
+        elif shrinkage:
+            intensity = float(shrinkage)
+        if intensity:
+            target = np.trace(covariance) / len(covariance)
+            covariance = (1 - intensity) * covariance + intensity * target * np.eye(len(covariance))
+
+        matrix = CovarianceMatrix(symbols, covariance, statistics.window, last_date, intensity)
+        with cls._lock:
+            # Prices invalidated during the build may not be in the result
+            if generation == cls._generation:
+                cls._remember(cls._entries, entry_key, entry)
+                cls._remember(cls._matrices, key, matrix)
+        return matrix
+
+    @classmethod
+    def invalidate_security(cls, symbol, price_date):
+        """
+        Drop the cached matrices of a security whose price changed on a day
+        they were computed with. Prices after their last day are picked up
+        incrementally instead.
+        """
+        day = _to_day(price_date)
+        with cls._lock:
+            cls._generation += 1
+            for key in [key for key, entry in cls._entries.items() if symbol in key[0] and day <= entry.last_day]:
+                del cls._entries[key]
+            for key in [key for key in cls._matrices if symbol in key[0] and price_date <= key[4]]:
+                del cls._matrices[key]
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._generation += 1
+            cls._entries.clear()
+            cls._matrices.clear()
+
+    @classmethod
+    def _get_entry(cls, entry, symbols, window, decay, last_day):
+        """Get the running statistics up to last_day, advancing the cached entry or building them"""
+        if entry is not None and entry.statistics.window < window:
+            # Built from a shorter history than the window, grow it instead
+            entry = None
+        if entry is not None and entry.last_day < last_day:
+            if not cls._advance(entry, symbols, last_day):
+                entry = None
+        if entry is None or entry.last_day != last_day:
+            entry = cls._build(symbols, window, decay, last_day)
+        return entry
+
+    @classmethod
+    def _build(cls, symbols, window, decay, last_day):
+        """Compute the statistics of the window ending on last_day from scratch"""
+        # Calendar days covering the window's trading days, with room for holidays
+        first_day = last_day - int(window * 365.25 / TRADING_DAYS_PER_YEAR * 1.1) - 7
+        series = PortfolioHistory.load_price_series(symbols, first_day, last_day)
+        if not series:
+            return None
+
+        grid = np.unique(np.concatenate([days for days, _ in series.values()]))
+        grid = grid[(grid >= first_day) & (grid <= last_day)][-(window + 1):]
+        if len(grid) < 3:
+            return None
+        levels = _forward_fill(np.column_stack([
+            _sample(*series[symbol], grid) if symbol in series else np.full(len(grid), np.nan)
+            for symbol in symbols
+        ]))
+        returns = _daily_returns(levels[:-1], levels[1:])
+
+        logger.debug(f"Built covariance statistics of {len(symbols)} securities over {len(returns)} days")
+        return _Entry(ReturnStatistics(returns, decay), int(grid[-1]), levels[-1])
+
+    @classmethod
+    def _advance(cls, entry, symbols, last_day):
+        """
+        Advance the statistics by the trading days after their last day.
+
+        Returns:
+            False when a rebuild is cheaper, i.e. a whole window has passed
+        """
+        series = PortfolioHistory.load_price_series(symbols, entry.last_day + 1, last_day)
+        grid = np.unique(np.concatenate([days for days, _ in series.values()] or [np.array([], dtype=np.int64)]))
+        grid = grid[grid > entry.last_day]
+        if len(grid) >= entry.statistics.window:
+            return False
+
+        previous = entry.last_levels
+        for day in grid:
+            levels = np.array([
+                _sample(*series[symbol], np.array([day]))[0] if symbol in series else np.nan
+                for symbol in symbols
+            ])
+            levels = np.where(np.isnan(levels), previous, levels)
+            entry.statistics.advance(_daily_returns(previous, levels))
+            previous = levels
+
+        entry.last_levels = previous
+        entry.last_day = last_day
+        logger.debug(f"Advanced covariance statistics of {len(symbols)} securities by {len(grid)} days")
+        return True
+
+    @staticmethod
+    def _remember(cache, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > MAX_CACHED_MATRICES:
+            cache.popitem(last=False)
+
+
+def _to_day(value):
+    return int(np.datetime64(value, 'D').astype(np.int64))
+
+
+def _daily_returns(previous, current):
+    """Returns between two price rows, zero where either price is missing"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = current / previous - 1
+    returns[~np.isfinite(returns)] = 0.0
+    return returns
@@ -6,8 +6,11 @@ and the metrics storage system, providing a clean boundary between
 performance business logic and metrics storage.
 """
 import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import date
 from metrics.models import MetricType, MetricValue
+from metrics.registry import registry
 from .models import PerformanceSettings
 
 logger = logging.getLogger(__name__)
@@ -21,6 +24,33 @@ PORTFOLIO_TWR = 'Portfolio Time-Weighted Return'
 TRANSACTION_GAIN = 'Transaction Gain/Loss'
 TRANSACTION_GAIN_ABSOLUTE = 'Transaction Gain/Loss (Absolute)'
 
+# Risk metric names, shared by the position and portfolio scopes, mapped to
+# their field of a risk panel (see risk.py)
+RISK_METRICS = {
+    'Annualized Volatility': 'volatility',
+    'Maximum Drawdown': 'max_drawdown',
+    'Sharpe Ratio': 'sharpe_ratio',
+    'Sortino Ratio': 'sortino_ratio',
+    'Beta': 'beta',
+    'Historical VaR (95%)': 'historical_var',
+    'Parametric VaR (95%)': 'parametric_var',
+}
+
+# Benchmark-relative metric names, stored nightly for portfolios (see attribution.py)
+ACTIVE_RETURN = 'Active Return'
+TRACKING_ERROR = 'Tracking Error'
+INFORMATION_RATIO = 'Information Ratio'
+ALLOCATION_EFFECT = 'Allocation Effect'
+SELECTION_EFFECT = 'Selection Effect'
+
+BENCHMARK_METRICS = [
+    ACTIVE_RETURN,
+    TRACKING_ERROR,
+    INFORMATION_RATIO,
+    ALLOCATION_EFFECT,
+    SELECTION_EFFECT
+]
+
 # List of all performance-related metrics
 PERFORMANCE_METRICS = [
     POSITION_GAIN,
@@ -30,7 +60,35 @@ PERFORMANCE_METRICS = [
     PORTFOLIO_TWR,
     TRANSACTION_GAIN,
     TRANSACTION_GAIN_ABSOLUTE
-]
+] + list(RISK_METRICS) + BENCHMARK_METRICS
+
+# Metric values buffered by batched_metric_writes(), or None when writing directly
+_pending_writes = ContextVar('pending_metric_writes', default=None)
+
+@contextmanager
+def batched_metric_writes():
+    """
+    Buffer store_metric_value() calls and write them in bulk at the end of the block.
+    
+    Useful for recalculations touching many targets: all values are upserted
+    with a few batched statements instead of one round trip per value.
+    Nested blocks share the outer buffer. The feature setting is checked once
+    for the whole block; while it is disabled, nothing is buffered.
+    """
+    if _pending_writes.get() is not None or not is_feature_enabled():
+        yield
+        return
+        
+    token = _pending_writes.set([])
+    try:
+        yield
+        pending = _pending_writes.get()
+    finally:
+        _pending_writes.reset(token)
+    
+    if pending:
+        MetricValue.bulk_store(pending)
+        logger.debug(f"Stored {len(pending)} buffered metric values")
 
 def is_feature_enabled(user=None):
     """
@@ -45,7 +103,7 @@ def is_feature_enabled(user=None):
     from .services import PerformanceCalculationService
     return PerformanceCalculationService.is_enabled(user=user)
 
-def store_metric_value(metric_name, target_object, value, source='COMPUTED'):
+def store_metric_value(metric_name, target_object, value, source='COMPUTED', value_date=None):
     """
     Store a metric value in the metrics system.
     Only creates if the performance feature is enabled.
@@ -55,18 +113,18 @@ def store_metric_value(metric_name, target_object, value, source='COMPUTED'):
         target_object: The target object (position, portfolio, transaction)
         value: Value to set
         source: Source of the value
+        value_date: Date of the value (default today)
         
     Returns:
-        MetricValue instance or None if feature is disabled
+        MetricValue instance or None if feature is disabled. Inside
+        batched_metric_writes() the instance is only saved at the end of the block.
     """
-    if not is_feature_enabled():
+    # Batches check the setting once when they start
+    if _pending_writes.get() is None and not is_feature_enabled():
         return None
     
     # Find the metric type
-    metric_type = MetricType.objects.filter(
-        name=metric_name,
-        is_system=True
-    ).first()
+    metric_type = registry.get_by_name(metric_name, is_system=True)
     
     if not metric_type:
         logger.warning(f"Metric type {metric_name} not found")
@@ -94,18 +152,21 @@ def store_metric_value(metric_name, target_object, value, source='COMPUTED'):
         except (ValueError, TypeError):
             logger.warning(f"Invalid currency value for metric {metric_name}: {value}")
     
-    # Create or update the metric value
-    metric_value, created = MetricValue.objects.update_or_create(
+    # Create or update today's value
+    metric_value = MetricValue(
         metric_type=metric_type,
-        **target_field,
-        defaults={
-            'value': formatted_value,
-            'date': date.today(),
-            'source': source
-        }
+        value=formatted_value,
+        date=value_date or date.today(),
+        source=source,
+        **target_field
     )
     
-    return metric_value
+    pending = _pending_writes.get()
+    if pending is not None:
+        pending.append(metric_value)
+        return metric_value
+        
+    return MetricValue.bulk_store([metric_value])[0]
 
 # Integration functions for different metric types
 
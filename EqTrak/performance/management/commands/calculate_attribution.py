@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+import datetime
+import logging
+
+from performance.attribution import CHUNK_SIZE, AttributionService
+from performance.services import PerformanceService
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = ('Measure all portfolios against their benchmarks and store active return, tracking error, '
+            'information ratio and attribution effects. Meant to run nightly, e.g. from cron')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=None,
+            help='Spread the portfolios over this many worker processes',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=None,
+            help=f'Portfolios analyzed together (default {CHUNK_SIZE})',
+        )
+        parser.add_argument(
+            '--date',
+            type=datetime.date.fromisoformat,
+            default=None,
+            help='Last day analyzed, YYYY-MM-DD (default today)',
+        )
+
+    def handle(self, *args, **options):
+        if not PerformanceService.is_performance_enabled():
+            self.stdout.write(self.style.WARNING('Performance calculations are disabled.'))
+            return
+
+        results = AttributionService.run_nightly(
+            processes=options['processes'], chunk_size=options['chunk_size'], end_date=options['date']
+        )
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Analyzed {results['portfolios']} portfolios and stored {results['values']} metric values."
+        ))
+        logger.info(f'Calculated benchmark attribution: {results}')
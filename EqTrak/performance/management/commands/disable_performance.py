@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand
 from django.apps import apps
 from django.core.management import call_command
+from users import flags
 
 class Command(BaseCommand):
     help = 'Disable performance tracking and clean up related metrics'
@@ -20,6 +21,8 @@ class Command(BaseCommand):
         # 2. Disable performance for all users
         user_count = UserSettings.objects.filter(performance_enabled=True).count()
         UserSettings.objects.update(performance_enabled=False)
+        # update() sends no signals, drop the cached toggles explicitly
+        flags.cache.invalidate_user()
         self.stdout.write(self.style.SUCCESS(f'Disabled performance tracking for {user_count} users'))
         
         # 3. Deactivate performance metric types using the configure_metrics command
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+import logging
+
+from performance.services import PerformanceService
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Recalculate the performance metrics of all portfolios, positions and sales'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=None,
+            help='Spread the portfolios over this many worker processes',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=None,
+            help=f'Portfolios recalculated together (default {PerformanceService.RECALCULATION_CHUNK_SIZE})',
+        )
+
+    def handle(self, *args, **options):
+        results = PerformanceService.calculate_all_performance(
+            processes=options['processes'], chunk_size=options['chunk_size']
+        )
+
+        if results is None:
+            self.stdout.write(self.style.WARNING('Performance calculations are disabled.'))
+            return
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Successfully recalculated {results['portfolios']} portfolios, "
+            f"{results['positions']} positions and {results['transactions']} transactions."
+        ))
+        logger.info(f'Recalculated performance metrics: {results}')
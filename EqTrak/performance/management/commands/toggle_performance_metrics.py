@@ -2,6 +2,7 @@ from django.core.management.base import BaseCommand
 from django.core.management import call_command
 from django.apps import apps
 import logging
+from users import flags
 
 logger = logging.getLogger(__name__)
 
@@ -107,6 +108,8 @@ class Command(BaseCommand):
                 UserSettings = apps.get_model('users', 'UserSettings')
                 count = UserSettings.objects.filter(performance_enabled=True).count()
                 UserSettings.objects.update(performance_enabled=False)
+                # update() sends no signals, drop the cached toggles explicitly
+                flags.cache.invalidate_user()
                 self.stdout.write(self.style.SUCCESS(f"Disabled performance for {count} users"))
             except Exception as e:
                 self.stdout.write(self.style.ERROR(f"Error updating UserSettings: {str(e)}"))
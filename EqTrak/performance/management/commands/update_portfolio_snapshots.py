@@ -0,0 +1,54 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.apps import apps
+import logging
+
+from performance.snapshots import SnapshotService
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Roll the daily portfolio valuation snapshots forward to today'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--portfolio',
+            help='Only update the snapshots of this portfolio ID',
+        )
+        parser.add_argument(
+            '--positions',
+            action='store_true',
+            help='Also store daily snapshots of each position',
+        )
+        parser.add_argument(
+            '--end-date',
+            help='Last date to snapshot (YYYY-MM-DD), defaults to today',
+        )
+        parser.add_argument(
+            '--rebuild',
+            action='store_true',
+            help='Delete the existing snapshots and compute them from scratch',
+        )
+
+    def handle(self, *args, **options):
+        Portfolio = apps.get_model('portfolio', 'Portfolio')
+
+        portfolios = Portfolio.objects.all()
+        if options.get('portfolio'):
+            portfolios = portfolios.filter(pk=options['portfolio'])
+
+        end_date = None
+        if options.get('end_date'):
+            try:
+                end_date = date.fromisoformat(options['end_date'])
+            except ValueError:
+                raise CommandError(f"Invalid end date: {options['end_date']}")
+
+        update = SnapshotService.rebuild if options['rebuild'] else SnapshotService.roll_forward
+        snapshot_count = update(portfolios, end_date=end_date, include_positions=options['positions'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Successfully wrote {snapshot_count} portfolio snapshots.'
+        ))
+        logger.info(f'Wrote {snapshot_count} portfolio snapshots')
@@ -0,0 +1,51 @@
+# Generated by Django 4.2.10 on 2026-10-18 01:59
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('performance', '0001_initial'),
+        ('portfolio', '0003_tax_lots'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PortfolioSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('market_value', models.DecimalField(decimal_places=4, max_digits=19)),
+                ('cash_flow', models.DecimalField(decimal_places=4, default=0, help_text='Net money invested on the day: purchases minus sales and dividends', max_digits=19)),
+                ('cost_basis', models.DecimalField(decimal_places=4, default=0, max_digits=19)),
+                ('calculation_date', models.DateTimeField(auto_now=True)),
+                ('portfolio', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='portfolio.portfolio')),
+            ],
+            options={
+                'verbose_name': 'Portfolio Snapshot',
+                'verbose_name_plural': 'Portfolio Snapshots',
+                'ordering': ['portfolio', 'date'],
+                'unique_together': {('portfolio', 'date')},
+            },
+        ),
+        migrations.CreateModel(
+            name='PositionSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('shares', models.DecimalField(decimal_places=6, max_digits=15)),
+                ('price', models.DecimalField(blank=True, decimal_places=4, max_digits=19, null=True)),
+                ('market_value', models.DecimalField(decimal_places=4, max_digits=19)),
+                ('cost_basis', models.DecimalField(decimal_places=4, default=0, max_digits=19)),
+                ('position', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='portfolio.position')),
+            ],
+            options={
+                'verbose_name': 'Position Snapshot',
+                'verbose_name_plural': 'Position Snapshots',
+                'ordering': ['position', 'date'],
+                'unique_together': {('position', 'date')},
+            },
+        ),
+    ]
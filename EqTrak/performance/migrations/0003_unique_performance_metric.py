@@ -0,0 +1,34 @@
+# Generated by Django 4.2.10 on 2026-10-18 02:17
+
+from django.db import migrations, models
+
+
+def remove_duplicate_metrics(apps, schema_editor):
+    """Keep the oldest performance metric of each object, as lookups did"""
+    PerformanceMetric = apps.get_model('performance', 'PerformanceMetric')
+    duplicates = (
+        PerformanceMetric.objects.values('content_type_id', 'object_id')
+        .annotate(count=models.Count('id'), keep=models.Min('id'))
+        .filter(count__gt=1)
+        .order_by()
+    )
+    for duplicate in duplicates:
+        PerformanceMetric.objects.filter(
+            content_type_id=duplicate['content_type_id'], object_id=duplicate['object_id']
+        ).exclude(pk=duplicate['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('performance', '0002_portfolio_snapshots'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_metrics, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='performancemetric',
+            constraint=models.UniqueConstraint(fields=('content_type', 'object_id'), name='unique_performance_metric_object'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.10 on 2026-10-18 09:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('portfolio', '0003_tax_lots'),
+        ('performance', '0003_unique_performance_metric'),
+    ]
+
+    operations = [
+        # Nullable until the generic target is removed, so the migrations can be reversed
+        migrations.AlterField(
+            model_name='performancemetric',
+            name='content_type',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype'),
+        ),
+        migrations.AlterField(
+            model_name='performancemetric',
+            name='object_id',
+            field=models.CharField(max_length=40, null=True),
+        ),
+        migrations.AddField(
+            model_name='performancemetric',
+            name='portfolio',
+            field=models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='performance_metric', to='portfolio.portfolio'),
+        ),
+        migrations.AddField(
+            model_name='performancemetric',
+            name='position',
+            field=models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='performance_metric', to='portfolio.position'),
+        ),
+        migrations.AddField(
+            model_name='performancemetric',
+            name='transaction',
+            field=models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='performance_metric', to='portfolio.transaction'),
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 4.2.10 on 2026-10-18 09:40
+
+import uuid
+
+from django.db import migrations
+
+TARGET_MODELS = ['position', 'portfolio', 'transaction']
+
+
+def copy_generic_targets(apps, schema_editor):
+    """Point each metric at its object through the typed link, dropping orphans"""
+    PerformanceMetric = apps.get_model('performance', 'PerformanceMetric')
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+
+    for target_field in TARGET_MODELS:
+        content_type = ContentType.objects.filter(app_label='portfolio', model=target_field).first()
+        if content_type is None:
+            continue
+        Target = apps.get_model('portfolio', target_field)
+
+        metrics = list(PerformanceMetric.objects.filter(content_type=content_type))
+        target_ids = {}
+        for metric in metrics:
+            try:
+                target_ids[metric.pk] = uuid.UUID(metric.object_id)
+            except ValueError:
+                pass
+        existing = set(Target.objects.filter(pk__in=target_ids.values()).values_list('pk', flat=True))
+
+        linked = []
+        for metric in metrics:
+            target_id = target_ids.get(metric.pk)
+            if target_id in existing:
+                setattr(metric, f'{target_field}_id', target_id)
+                linked.append(metric)
+        PerformanceMetric.objects.bulk_update(linked, [target_field], batch_size=500)
+
+    # Metrics of deleted objects or other models
+    PerformanceMetric.objects.filter(
+        position__isnull=True, portfolio__isnull=True, transaction__isnull=True
+    ).delete()
+
+
+def copy_typed_targets(apps, schema_editor):
+    PerformanceMetric = apps.get_model('performance', 'PerformanceMetric')
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+
+    for target_field in TARGET_MODELS:
+        content_type, _ = ContentType.objects.get_or_create(app_label='portfolio', model=target_field)
+        metrics = list(PerformanceMetric.objects.filter(**{f'{target_field}__isnull': False}))
+        for metric in metrics:
+            metric.content_type = content_type
+            metric.object_id = str(getattr(metric, f'{target_field}_id'))
+        PerformanceMetric.objects.bulk_update(metrics, ['content_type', 'object_id'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('performance', '0004_performance_metric_targets'),
+    ]
+
+    operations = [
+        migrations.RunPython(copy_generic_targets, copy_typed_targets),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.10 on 2026-10-18 09:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('performance', '0005_copy_performance_metric_targets'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='performancemetric',
+            name='unique_performance_metric_object',
+        ),
+        migrations.RemoveIndex(
+            model_name='performancemetric',
+            name='performance_content_2d77c5_idx',
+        ),
+        migrations.RemoveField(
+            model_name='performancemetric',
+            name='content_type',
+        ),
+        migrations.RemoveField(
+            model_name='performancemetric',
+            name='object_id',
+        ),
+        migrations.AddConstraint(
+            model_name='performancemetric',
+            constraint=models.CheckConstraint(check=models.Q(models.Q(('portfolio__isnull', True), ('position__isnull', False), ('transaction__isnull', True)), models.Q(('portfolio__isnull', False), ('position__isnull', True), ('transaction__isnull', True)), models.Q(('portfolio__isnull', True), ('position__isnull', True), ('transaction__isnull', False)), _connector='OR'), name='performance_metric_single_target'),
+        ),
+    ]
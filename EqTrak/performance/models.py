@@ -1,7 +1,6 @@
 from django.db import models
 from django.utils.translation import gettext_lazy as _
-from django.contrib.contenttypes.fields import GenericForeignKey
-from django.contrib.contenttypes.models import ContentType
+from users import flags
 
 class PerformanceSettings(models.Model):
     """
@@ -25,8 +24,8 @@ class PerformanceSettings(models.Model):
     
     @classmethod
     def is_feature_enabled(cls):
-        """Check if the feature is enabled"""
-        return cls.get_instance().updates_enabled
+        """Check if the feature is enabled, cached by the feature flag service"""
+        return flags.is_system_enabled('performance')
     
     @classmethod
     def set_feature_enabled(cls, enabled):
@@ -39,12 +38,21 @@ class PerformanceSettings(models.Model):
 
 class PerformanceMetric(models.Model):
     """
-    Stores performance calculations at different levels
+    Stores performance calculations at different levels.
+
+    Each row belongs to exactly one portfolio, position or transaction through
+    a one-to-one link, so list pages can load the metrics together with their
+    objects, e.g. Position.objects.select_related('performance_metric').
     """
-    # Link to related objects - use generic foreign key
-    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
-    object_id = models.CharField(max_length=40)  # Changed to CharField to support UUID primary keys
-    content_object = GenericForeignKey('content_type', 'object_id')
+    # Target links, exactly one of which is set
+    TARGET_FIELDS = ['position', 'portfolio', 'transaction']
+    
+    position = models.OneToOneField('portfolio.Position', on_delete=models.CASCADE, null=True, blank=True,
+                                    related_name='performance_metric')
+    portfolio = models.OneToOneField('portfolio.Portfolio', on_delete=models.CASCADE, null=True, blank=True,
+                                     related_name='performance_metric')
+    transaction = models.OneToOneField('portfolio.Transaction', on_delete=models.CASCADE, null=True, blank=True,
+                                       related_name='performance_metric')
     
     # Performance calculations
     cost_basis = models.DecimalField(max_digits=15, decimal_places=2, default=0)
@@ -59,11 +67,111 @@ class PerformanceMetric(models.Model):
                                     help_text="User-friendly message explaining why metrics couldn't be calculated")
     
     class Meta:
-        indexes = [
-            models.Index(fields=['content_type', 'object_id']),
+        constraints = [
+            # Ensure exactly one target object is set
+            models.CheckConstraint(
+                check=models.Q(
+                    position__isnull=False,
+                    portfolio__isnull=True,
+                    transaction__isnull=True,
+                ) | models.Q(
+                    position__isnull=True,
+                    portfolio__isnull=False,
+                    transaction__isnull=True,
+                ) | models.Q(
+                    position__isnull=True,
+                    portfolio__isnull=True,
+                    transaction__isnull=False,
+                ),
+                name='performance_metric_single_target'
+            )
         ]
         verbose_name = _('Performance Metric')
         verbose_name_plural = _('Performance Metrics')
     
     def __str__(self):
-        return f"{self.content_type.model} {self.object_id} - {self.absolute_gain_loss}"
+        target_field = self.get_target_field()
+        return f"{target_field} {getattr(self, f'{target_field}_id')} - {self.absolute_gain_loss}"
+    
+    def get_target_field(self):
+        """Get the name of the target link that is set, or None"""
+        for target_field in self.TARGET_FIELDS:
+            if getattr(self, f'{target_field}_id') is not None:
+                return target_field
+        return None
+    
+    @classmethod
+    def get_target_field_for(cls, obj):
+        """
+        Get the target link matching a portfolio, position or transaction.
+        
+        Raises:
+            ValueError: If the object's model has no performance metrics
+        """
+        target_field = obj._meta.model_name
+        if target_field not in cls.TARGET_FIELDS:
+            raise ValueError(f"No performance metrics for {obj._meta.label}")
+        return target_field
+
+
+class PortfolioSnapshot(models.Model):
+    """
+    Stores the end-of-day valuation of a portfolio.
+
+    Rows are written by SnapshotService, which rolls the series forward from
+    the last stored date and rebuilds it from the date of any back-dated change.
+    """
+    portfolio = models.ForeignKey('portfolio.Portfolio', on_delete=models.CASCADE, related_name='snapshots')
+    date = models.DateField()
+    market_value = models.DecimalField(max_digits=19, decimal_places=4)
+    cash_flow = models.DecimalField(max_digits=19, decimal_places=4, default=0,
+                                    help_text="Net money invested on the day: purchases minus sales and dividends")
+    cost_basis = models.DecimalField(max_digits=19, decimal_places=4, default=0)
+    calculation_date = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('portfolio', 'date')
+        ordering = ['portfolio', 'date']
+        verbose_name = _('Portfolio Snapshot')
+        verbose_name_plural = _('Portfolio Snapshots')
+
+    def __str__(self):
+        return f"{self.portfolio_id} {self.date}: {self.market_value}"
+
+    @classmethod
+    def get_range(cls, portfolio, start_date=None, end_date=None):
+        """
+        Get the snapshots of a portfolio between two dates, inclusive.
+
+        Served by the (portfolio, date) unique index as a range scan.
+        """
+        snapshots = cls.objects.filter(portfolio=portfolio)
+        if start_date:
+            snapshots = snapshots.filter(date__gte=start_date)
+        if end_date:
+            snapshots = snapshots.filter(date__lte=end_date)
+        return snapshots.order_by('date')
+
+
+class PositionSnapshot(models.Model):
+    """
+    Stores the end-of-day valuation of a position.
+
+    Optional companion of PortfolioSnapshot, only written for days on which
+    the position had shares or an open cost basis.
+    """
+    position = models.ForeignKey('portfolio.Position', on_delete=models.CASCADE, related_name='snapshots')
+    date = models.DateField()
+    shares = models.DecimalField(max_digits=15, decimal_places=6)
+    price = models.DecimalField(max_digits=19, decimal_places=4, null=True, blank=True)
+    market_value = models.DecimalField(max_digits=19, decimal_places=4)
+    cost_basis = models.DecimalField(max_digits=19, decimal_places=4, default=0)
+
+    class Meta:
+        unique_together = ('position', 'date')
+        ordering = ['position', 'date']
+        verbose_name = _('Position Snapshot')
+        verbose_name_plural = _('Position Snapshots')
+
+    def __str__(self):
+        return f"{self.position_id} {self.date}: {self.market_value}"
@@ -6,6 +6,7 @@ performance toggle settings.
 import logging
 from functools import wraps
 from metrics.models import MetricType
+from metrics.registry import registry
 from .models import PerformanceSettings
 from .integration import PERFORMANCE_METRICS
 
@@ -30,11 +31,8 @@ def new_get_system_metric(cls, name, scope_type=None):
         logger.debug(f"Performance feature disabled, not returning metric: {name}")
         return None
     
-    # Get the original result using the unbound method signature
-    query = {'name': name, 'is_system': True}
-    if scope_type:
-        query['scope_type'] = scope_type
-    return cls.objects.filter(**query).first()
+    # Look the metric up in the in-process registry instead of querying
+    return registry.get_by_name(name, scope_type=scope_type or None, is_system=True)
 
 # Apply the patch by replacing the classmethod
 MetricType.get_system_metric = classmethod(new_get_system_metric)
@@ -62,5 +60,24 @@ def patched_compute_value(self, target_object, *args, **kwargs):
 # Apply the patch
 MetricType.compute_value = patched_compute_value
 
+# Patch the batch version the same way
+original_compute_values = MetricType.compute_values
+
+@wraps(original_compute_values)
+def patched_compute_values(self, target_objects, *args, **kwargs):
+    """
+    Patched version of compute_values that skips performance-related calculations
+    if the performance feature is disabled.
+    """
+    is_performance_computation = self.computation_source in ['position_gain', 'portfolio_return']
+    
+    if is_performance_computation and not PerformanceSettings.is_feature_enabled():
+        logger.debug(f"Performance feature disabled, skipping computation: {self.computation_source}")
+        return {target.pk: None for target in target_objects}
+    
+    return original_compute_values(self, target_objects, *args, **kwargs)
+
+MetricType.compute_values = patched_compute_values
+
 # Log that patches were applied
 logger.info("MetricType methods patched to respect performance settings") 
\ No newline at end of file
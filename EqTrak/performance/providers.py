@@ -2,7 +2,10 @@
 Performance metric providers.
 
 This module registers performance metric calculation functions with the metrics app.
+Each metric gets a per-object provider and a batch provider computing many
+targets in one call.
 """
+import functools
 from django.apps import apps
 from .services import PerformanceCalculationService
 from .integration import (
@@ -10,7 +13,8 @@ from .integration import (
     POSITION_GAIN_ABSOLUTE,
     PORTFOLIO_RETURN,
     PORTFOLIO_RETURN_ABSOLUTE,
-    PORTFOLIO_TWR
+    PORTFOLIO_TWR,
+    RISK_METRICS
 )
 
 def register_providers():
@@ -24,7 +28,7 @@ def register_providers():
 
     # Import the provider registry
     try:
-        from metrics.providers import register_provider
+        from metrics.providers import register_batch_provider, register_provider
     except ImportError:
         return
 
@@ -35,4 +39,17 @@ def register_providers():
     # Register portfolio return providers
     register_provider(PORTFOLIO_RETURN, PerformanceCalculationService.get_portfolio_return_percentage)
     register_provider(PORTFOLIO_RETURN_ABSOLUTE, PerformanceCalculationService.get_portfolio_return_absolute)
-    register_provider(PORTFOLIO_TWR, PerformanceCalculationService.get_time_weighted_return_percentage) 
\ No newline at end of file
+    register_provider(PORTFOLIO_TWR, PerformanceCalculationService.get_time_weighted_return_percentage)
+    
+    # Register batch versions used to compute whole table columns
+    register_batch_provider(POSITION_GAIN, PerformanceCalculationService.get_positions_gain_percentage)
+    register_batch_provider(POSITION_GAIN_ABSOLUTE, PerformanceCalculationService.get_positions_gain_absolute)
+    register_batch_provider(PORTFOLIO_RETURN, PerformanceCalculationService.get_portfolios_return_percentage)
+    register_batch_provider(PORTFOLIO_RETURN_ABSOLUTE, PerformanceCalculationService.get_portfolios_return_absolute)
+    register_batch_provider(PORTFOLIO_TWR, PerformanceCalculationService.get_time_weighted_returns_percentage)
+    
+    # Risk metrics are only computed in bulk, over both positions and portfolios
+    for metric_name, field in RISK_METRICS.items():
+        register_batch_provider(
+            metric_name, functools.partial(PerformanceCalculationService.get_risk_metric_values, field)
+        )
@@ -0,0 +1,235 @@
+"""
+Coalesced performance recalculation.
+
+Saving a transaction used to recalculate the transaction, its position and
+its whole portfolio on the spot, so importing thousands of transactions ran
+thousands of full recalculations. Instead, the signal handlers mark the
+affected objects dirty here, and the pending set is recalculated once:
+
+- when the surrounding database transaction commits (transaction.on_commit),
+  or immediately when there is no surrounding transaction;
+- when the outermost suspend_recalculation() block exits, for bulk imports;
+- or, with the PERFORMANCE_RECALC_IN_BACKGROUND setting, in a background
+  worker thread after the commit.
+
+Marking the same object many times costs nothing: all dirty positions are
+recalculated in one batch, followed by the portfolios they belong to.
+"""
+import logging
+import queue
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections, transaction
+
+logger = logging.getLogger(__name__)
+
+
+class _PendingRecalculation:
+    """Dirty objects of the current context, waiting to be recalculated"""
+
+    def __init__(self):
+        self.transaction_ids = set()
+        self.position_ids = set()
+        self.portfolio_ids = set()
+        self.suspended = 0
+        # Position of the registered commit callback in the connection's list
+        self.callback_index = None
+
+    def __bool__(self):
+        return bool(self.transaction_ids or self.position_ids or self.portfolio_ids)
+
+    def run_after_commit(self):
+        _on_commit(self)
+
+    def take(self):
+        """Get the dirty ids and start over"""
+        ids = (self.transaction_ids, self.position_ids, self.portfolio_ids)
+        self.transaction_ids, self.position_ids, self.portfolio_ids = set(), set(), set()
+        return ids
+
+
+_pending = ContextVar('pending_performance_recalculation', default=None)
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def _get_pending():
+    pending = _pending.get()
+    if pending is None:
+        pending = _PendingRecalculation()
+        _pending.set(pending)
+    return pending
+
+
+def mark_transaction_dirty(transaction_id, position_id):
+    """Queue a transaction, its position and the position's portfolio"""
+    pending = _get_pending()
+    pending.transaction_ids.add(transaction_id)
+    pending.position_ids.add(position_id)
+    _schedule(pending)
+
+
+def mark_position_dirty(position_id):
+    """Queue a position and its portfolio"""
+    pending = _get_pending()
+    pending.position_ids.add(position_id)
+    _schedule(pending)
+
+
+def mark_positions_dirty(position_ids):
+    """Queue many positions and their portfolios"""
+    position_ids = set(position_ids)
+    if not position_ids:
+        return
+    pending = _get_pending()
+    pending.position_ids.update(position_ids)
+    _schedule(pending)
+
+
+def mark_portfolio_dirty(portfolio_id):
+    """Queue a portfolio"""
+    pending = _get_pending()
+    pending.portfolio_ids.add(portfolio_id)
+    _schedule(pending)
+
+
+@contextmanager
+def suspend_recalculation():
+    """
+    Collect dirty objects without recalculating them until the block exits.
+
+    Use around bulk imports: however many transactions are written inside
+    the block, each affected position and portfolio is recalculated once.
+
+    Example:
+        with suspend_recalculation():
+            for row in rows:
+                Transaction.objects.create(...)
+    """
+    pending = _get_pending()
+    pending.suspended += 1
+    try:
+        yield
+    finally:
+        pending.suspended -= 1
+        if not pending.suspended and pending:
+            _schedule(pending)
+
+
+def _schedule(pending):
+    """
+    Arrange for the pending objects to be recalculated after the commit.
+
+    One callback is registered per database transaction, when the first
+    object is marked. It is registered again if it has left the
+    connection's commit callbacks, which happens when its savepoint is
+    rolled back; the first callback to run takes all pending objects.
+    """
+    if pending.suspended:
+        return
+
+    connection = transaction.get_connection()
+    callbacks = connection.run_on_commit
+    index = pending.callback_index
+    if connection.in_atomic_block and index is not None and index < len(callbacks) \
+            and callbacks[index][1] == pending.run_after_commit:
+        return
+
+    # Runs right away outside of an atomic block
+    transaction.on_commit(pending.run_after_commit)
+    pending.callback_index = len(callbacks) - 1 if connection.in_atomic_block else None
+
+
+def _on_commit(pending):
+    pending.callback_index = None
+    if pending.suspended or not pending:
+        return
+
+    ids = pending.take()
+    if getattr(settings, 'PERFORMANCE_RECALC_IN_BACKGROUND', False):
+        _get_worker().put(ids)
+    else:
+        recalculate(*ids)
+
+
+def flush():
+    """Recalculate the pending objects of the current context now"""
+    pending = _get_pending()
+    # Objects marked from now on register a new commit callback
+    pending.callback_index = None
+    if pending:
+        recalculate(*pending.take())
+
+
+def recalculate(transaction_ids, position_ids, portfolio_ids):
+    """
+    Recalculate the performance of transactions, positions and portfolios.
+
+    Positions are recalculated in one batch, then the portfolios given and
+    those of the positions. Objects deleted in the meantime are skipped.
+    """
+    from portfolio.models import Portfolio, Position, Transaction
+    from .services import PerformanceService
+
+    with transaction.atomic():
+        sales = Transaction.objects.filter(
+            pk__in=transaction_ids, transaction_type='SELL'
+        ).select_related('position__portfolio')
+        PerformanceService.calculate_transactions_performance(sales)
+
+        positions = list(Position.objects.filter(pk__in=position_ids).select_related('portfolio'))
+        PerformanceService.calculate_positions_performance(positions)
+
+        portfolio_ids = set(portfolio_ids) | {position.portfolio_id for position in positions}
+        PerformanceService.calculate_portfolios_performance(Portfolio.objects.filter(pk__in=portfolio_ids))
+
+    logger.debug(
+        f"Recalculated performance of {len(transaction_ids)} transactions, "
+        f"{len(positions)} positions and {len(portfolio_ids)} portfolios"
+    )
+
+
+class RecalculationWorker(threading.Thread):
+    """
+    Background thread recalculating queued batches of dirty objects.
+
+    Batches waiting in the queue are merged before each run, so a burst of
+    commits is recalculated once.
+    """
+
+    def __init__(self):
+        super().__init__(name='performance-recalculation', daemon=True)
+        self.queue = queue.Queue()
+
+    def put(self, ids):
+        self.queue.put(ids)
+
+    def run(self):
+        while True:
+            batches = [self.queue.get()]
+            while not self.queue.empty():
+                batches.append(self.queue.get_nowait())
+
+            merged = tuple(set().union(*parts) for parts in zip(*batches))
+            try:
+                recalculate(*merged)
+            except Exception as e:
+                logger.error(f"Error recalculating performance in background: {e}")
+            finally:
+                # Connections are per thread, don't keep this one open between batches
+                connections.close_all()
+                for _ in batches:
+                    self.queue.task_done()
+
+
+def _get_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = RecalculationWorker()
+            _worker.start()
+        return _worker
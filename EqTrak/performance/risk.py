@@ -0,0 +1,447 @@
+"""
+Risk analytics over stored price history.
+
+Computes a risk panel for positions and portfolios from daily prices:
+
+- annualized volatility over the trailing VOLATILITY_WINDOW trading days
+- maximum drawdown
+- Sharpe and Sortino ratios
+- beta against a benchmark security
+- one-day historical and parametric (normal) value at risk
+
+Positions are measured on the closing prices of their security. Portfolios
+are measured on their time-weighted value index, the chained daily returns of
+PortfolioHistory, so cash flows don't count as gains or losses. Every series
+is sampled on a common grid of trading days (the days with a stored price).
+All metrics are then computed column-wise over the (days x series) matrix in
+one pass, however many positions or portfolios are asked for.
+
+Panels and the price series they were computed from are cached in process
+memory until a newer price date is stored. The signal handlers also drop
+them after a transaction or price correction in this process.
+
+Settings:
+    PERFORMANCE_BENCHMARK_SYMBOL: Symbol of the benchmark security of positions
+        and of portfolios without one of their own (default 'SPY')
+    PERFORMANCE_RISK_FREE_RATE: Annual risk-free rate as a fraction (default 0)
+"""
+import logging
+import threading
+import time
+import warnings
+from datetime import date
+from decimal import Decimal
+from statistics import NormalDist
+
+import numpy as np
+from django.conf import settings
+
+from .returns import PortfolioHistory, _forward_fill
+
+logger = logging.getLogger(__name__)
+
+# Metrics of a risk panel
+RISK_FIELDS = [
+    'volatility', 'max_drawdown', 'sharpe_ratio', 'sortino_ratio',
+    'beta', 'historical_var', 'parametric_var'
+]
+
+# Fields expressed as fractions, reported as percentages
+PERCENTAGE_FIELDS = {'volatility', 'max_drawdown', 'historical_var', 'parametric_var'}
+
+TRADING_DAYS_PER_YEAR = 252
+
+# Trailing trading days of the volatility
+VOLATILITY_WINDOW = 252
+
+# Calendar years of history the other metrics are measured over
+LOOKBACK_YEARS = 10
+
+VAR_CONFIDENCE = 0.95
+
+# Daily returns needed before a metric is reported
+MIN_OBSERVATIONS = 20
+
+# Seconds between checks for newer prices or holdings stored by other processes
+TOKEN_CHECK_INTERVAL = 5
+
+
+def _get_benchmark_symbol():
+    return getattr(settings, 'PERFORMANCE_BENCHMARK_SYMBOL', 'SPY')
+
+
+def _sample(series_days, series_values, grid):
+    """Value of a series on each grid day: its last value on or before the day"""
+    indexes = np.searchsorted(series_days, grid, side='right') - 1
+    sampled = series_values[np.maximum(indexes, 0)].astype(float)
+    sampled[indexes < 0] = np.nan
+    return sampled
+
+
+def compute_risk_panel(levels, benchmark_levels=None, risk_free_rate=0.0):
+    """
+    Compute the risk metrics of many series at once.
+
+    Args:
+        levels: Prices or index values (days x series) on a common grid of
+            trading days, NaN where a series has no value yet
+        benchmark_levels: Optional benchmark values on the same days
+        risk_free_rate: Annual risk-free rate as a fraction
+
+    Returns:
+        Dict mapping each of RISK_FIELDS to an array with one value per
+        series, NaN where there is not enough data. Volatility, drawdown and
+        VaR are fractions; VaR is the loss as a positive number.
+    """
+    levels = _forward_fill(np.asarray(levels, dtype=float))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = levels[1:] / levels[:-1] - 1
+    returns[~np.isfinite(returns)] = np.nan
+    enough = np.sum(~np.isnan(returns), axis=0) >= MIN_OBSERVATIONS
+    daily_risk_free = (1 + risk_free_rate) ** (1 / TRADING_DAYS_PER_YEAR) - 1
+    annualization = np.sqrt(TRADING_DAYS_PER_YEAR)
+
+    with warnings.catch_warnings(), np.errstate(divide='ignore', invalid='ignore'):
+        # Columns without data produce empty-slice warnings, they end up NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+
+        mean = np.nanmean(returns, axis=0)
+        std = np.nanstd(returns, axis=0, ddof=1)
+        excess_mean = mean - daily_risk_free
+        downside = np.sqrt(np.nanmean(np.minimum(returns - daily_risk_free, 0) ** 2, axis=0))
+        peaks = np.fmax.accumulate(levels, axis=0)
+
+        panel = {
+            'volatility': np.nanstd(returns[-VOLATILITY_WINDOW:], axis=0, ddof=1) * annualization,
+            'max_drawdown': np.nanmin(levels / peaks - 1, axis=0),
+            'sharpe_ratio': excess_mean / std * annualization,
+            'sortino_ratio': excess_mean / downside * annualization,
+            'beta': np.full(levels.shape[1], np.nan),
+            'historical_var': -np.nanpercentile(returns, (1 - VAR_CONFIDENCE) * 100, axis=0),
+            'parametric_var': -(mean + NormalDist().inv_cdf(1 - VAR_CONFIDENCE) * std),
+        }
+
+        if benchmark_levels is not None:
+            benchmark_levels = _forward_fill(np.asarray(benchmark_levels, dtype=float)[:, None])[:, 0]
+            benchmark_returns = benchmark_levels[1:] / benchmark_levels[:-1] - 1
+            benchmark_returns[~np.isfinite(benchmark_returns)] = np.nan
+            # Both series measured on the same days
+            joint = ~np.isnan(returns) & ~np.isnan(benchmark_returns)[:, None]
+            joint_returns = np.where(joint, returns, np.nan)
+            joint_benchmark = np.where(joint, benchmark_returns[:, None], np.nan)
+            joint_returns -= np.nanmean(joint_returns, axis=0)
+            joint_benchmark -= np.nanmean(joint_benchmark, axis=0)
+            panel['beta'] = np.nansum(joint_returns * joint_benchmark, axis=0) / np.nansum(joint_benchmark ** 2, axis=0)
+            panel['beta'][np.sum(joint, axis=0) < MIN_OBSERVATIONS] = np.nan
+
+    for values in panel.values():
+        values[~enough | ~np.isfinite(values)] = np.nan
+    return panel
+
+
+class RiskAnalytics:
+    """
+    Risk panels of positions and portfolios, cached per process.
+
+    Panels are dicts mapping each of RISK_FIELDS to a float, or None where
+    there is not enough price history.
+    """
+
+    _lock = threading.Lock()
+    # Latest stored price date and holdings version the cached values were computed with
+    _cache_token = None
+    _token_checked_at = None
+    # {(scope_type, target pk): panel}
+    _panels = {}
+    # {ticker: (day numbers, closes)}, None for tickers without prices
+    _series = {}
+
+    @classmethod
+    def for_positions(cls, positions, end_date=None):
+        """
+        Get the risk panels of positions, measured on their security's prices.
+
+        Positions without stored prices are measured on their Market Price
+        metric values.
+
+        Args:
+            positions: Iterable of Position instances
+            end_date: Last day measured (default today, cached)
+
+        Returns:
+            Dict mapping position_id to panel
+        """
+        positions = list(positions)
+        use_cache = end_date is None
+        panels, missing = cls._get_cached('POSITION', positions, use_cache)
+        if not missing:
+            return panels
+
+        first_day, end_day = cls._get_range(end_date)
+        tickers = {position.ticker for position in missing if position.ticker}
+        series = cls._get_price_series(tickers | {_get_benchmark_symbol()}, first_day, end_day, use_cache)
+        metric_series = PortfolioHistory.load_metric_price_series(
+            {position.pk for position in missing if series.get(position.ticker) is None}, first_day, end_day
+        )
+
+        # One column per security, shared by the positions holding it
+        columns = {}
+        for position in missing:
+            key = position.ticker if series.get(position.ticker) is not None else position.pk
+            data = series.get(key) if key == position.ticker else metric_series.get(key)
+            if data is not None:
+                columns.setdefault(key, data)
+
+        computed = cls._compute(
+            columns, series, first_day, end_day, extra_days=[days for days, _ in metric_series.values()]
+        )
+        for position in missing:
+            key = position.ticker if position.ticker in computed else position.pk
+            panels[position.pk] = computed.get(key, cls._empty_panel())
+        cls._store('POSITION', missing, panels, use_cache)
+        return panels
+
+    @classmethod
+    def for_portfolios(cls, portfolios, end_date=None):
+        """
+        Get the risk panels of portfolios, measured on their time-weighted
+        value index over the lookback period.
+
+        Args:
+            portfolios: Iterable of Portfolio instances
+            end_date: Last day measured (default today, cached)
+
+        Returns:
+            Dict mapping portfolio_id to panel
+        """
+        from portfolio.models import Position
+
+        portfolios = list(portfolios)
+        use_cache = end_date is None
+        panels, missing = cls._get_cached('PORTFOLIO', portfolios, use_cache)
+        if not missing:
+            return panels
+
+        first_day, end_day = cls._get_range(end_date)
+        tickers = set(Position.objects.filter(
+            portfolio__in=missing
+        ).exclude(ticker='').values_list('ticker', flat=True).distinct())
+        benchmarks = cls._get_benchmark_symbols(missing)
+        series = cls._get_price_series(tickers | set(benchmarks.values()), first_day, end_day, use_cache)
+        histories = PortfolioHistory.build_many(
+            missing,
+            end_date=np.datetime64(end_day, 'D').astype(object),
+            start_dates={portfolio.pk: np.datetime64(first_day, 'D').astype(object) for portfolio in missing},
+            price_series={ticker: data for ticker, data in series.items() if data is not None}
+        )
+
+        columns = {}
+        for portfolio_id, history in histories.items():
+            history_start = np.datetime64(history.start_date, 'D').astype(np.int64)
+            index = np.cumprod(1 + history.daily_returns())
+            columns[portfolio_id] = (history_start + np.arange(history.days), index)
+
+        # Portfolios measured against the same benchmark are computed together
+        price_series = {ticker: series.get(ticker) for ticker in tickers | set(benchmarks.values())}
+        computed = {}
+        for benchmark_symbol in set(benchmarks.values()):
+            computed.update(cls._compute(
+                {key: data for key, data in columns.items() if benchmarks[key] == benchmark_symbol},
+                price_series, first_day, end_day, benchmark_symbol=benchmark_symbol
+            ))
+        for portfolio in missing:
+            panels[portfolio.pk] = computed.get(portfolio.pk, cls._empty_panel())
+        cls._store('PORTFOLIO', missing, panels, use_cache)
+        return panels
+
+    @classmethod
+    def get_metric_values(cls, field, targets):
+        """
+        Get one risk metric of many positions or portfolios, as stored by the
+        metrics app: percentages for fractions, Decimals rounded to 6 places.
+
+        Returns:
+            Dict mapping target pk to value (None where unavailable)
+        """
+        from portfolio.models import Portfolio, Position
+
+        targets = list(targets)
+        positions = [target for target in targets if isinstance(target, Position)]
+        portfolios = [target for target in targets if isinstance(target, Portfolio)]
+        panels = {}
+        if positions:
+            panels.update(cls.for_positions(positions))
+        if portfolios:
+            panels.update(cls.for_portfolios(portfolios))
+
+        scale = 100 if field in PERCENTAGE_FIELDS else 1
+        values = {}
+        for target in targets:
+            value = panels.get(target.pk, {}).get(field)
+            values[target.pk] = None if value is None else Decimal(str(round(value * scale, 6)))
+        return values
+
+    @classmethod
+    def invalidate(cls, prices=False):
+        """
+        Drop the cached panels, and the cached prices too if they changed.
+        """
+        with cls._lock:
+            cls._panels = {}
+            if prices:
+                cls._series = {}
+                # Look for newer prices on the next call
+                cls._token_checked_at = None
+
+    @classmethod
+    def _compute(cls, columns, price_series, first_day, end_day, extra_days=(), benchmark_symbol=None):
+        """
+        Compute the panels of the given series on a common trading day grid.
+
+        Args:
+            columns: Dict mapping a key to (day numbers, values) of its series
+            price_series: Price series whose days make up the grid, including
+                the benchmark's
+            extra_days: Other arrays of observation days to add to the grid
+            benchmark_symbol: Benchmark the betas are measured against
+                (default the PERFORMANCE_BENCHMARK_SYMBOL setting)
+
+        Returns:
+            Dict mapping each key of columns to its panel
+        """
+        if not columns:
+            return {}
+
+        grid = cls._get_trading_days(
+            [data[0] for data in price_series.values() if data is not None] + list(extra_days),
+            first_day, end_day
+        )
+        keys = list(columns)
+        levels = np.column_stack([_sample(*columns[key], grid) for key in keys])
+        benchmark = price_series.get(benchmark_symbol or _get_benchmark_symbol())
+        benchmark_levels = _sample(*benchmark, grid) if benchmark is not None else None
+
+        results = compute_risk_panel(
+            levels, benchmark_levels, getattr(settings, 'PERFORMANCE_RISK_FREE_RATE', 0.0)
+        )
+        panels = {}
+        for column, key in enumerate(keys):
+            panels[key] = {
+                field: None if np.isnan(values[column]) else float(values[column])
+                for field, values in results.items()
+            }
+        return panels
+
+    @staticmethod
+    def _get_benchmark_symbols(portfolios):
+        """Map each portfolio to the symbol of its benchmark security"""
+        from market_data.models import Security
+
+        symbols = dict(Security.objects.filter(
+            pk__in={portfolio.benchmark_id for portfolio in portfolios if portfolio.benchmark_id}
+        ).values_list('pk', 'symbol'))
+        return {
+            portfolio.pk: symbols.get(portfolio.benchmark_id, _get_benchmark_symbol())
+            for portfolio in portfolios
+        }
+
+    @staticmethod
+    def _get_trading_days(day_arrays, first_day, end_day):
+        """
+        Days with a stored price between first_day and end_day, or the
+        business days of the range when there are none.
+        """
+        days = np.unique(np.concatenate(day_arrays)) if day_arrays else np.array([], dtype=np.int64)
+        days = days[(days >= first_day) & (days <= end_day)]
+        if len(days):
+            return days
+        calendar = np.arange(first_day, end_day + 1)
+        return calendar[np.is_busday(calendar.astype('datetime64[D]'))]
+
+    @staticmethod
+    def _get_range(end_date):
+        """First and last day numbers of the lookback period"""
+        end_day = int(np.datetime64(end_date or date.today(), 'D').astype(np.int64))
+        first_day = end_day - int(round(LOOKBACK_YEARS * 365.25))
+        return first_day, end_day
+
+    @staticmethod
+    def _empty_panel():
+        return {field: None for field in RISK_FIELDS}
+
+    @classmethod
+    def _get_cached(cls, scope_type, targets, use_cache):
+        """Split targets into the cached panels and the targets to compute"""
+        if not use_cache:
+            return {}, targets
+
+        cls._check_token()
+        panels, missing = {}, []
+        for target in targets:
+            panel = cls._panels.get((scope_type, target.pk))
+            if panel is None:
+                missing.append(target)
+            else:
+                panels[target.pk] = panel
+        return panels, missing
+
+    @classmethod
+    def _store(cls, scope_type, targets, panels, use_cache):
+        if use_cache:
+            with cls._lock:
+                for target in targets:
+                    cls._panels[(scope_type, target.pk)] = panels[target.pk]
+
+    @classmethod
+    def _check_token(cls):
+        """
+        Drop everything cached when a newer price date has been stored, or
+        when holdings or portfolios changed in any process.
+
+        The running totals of a position are written on every change to its
+        completed transactions, so their latest update time and count
+        version the holdings; portfolio saves cover benchmark changes.
+        """
+        from django.db.models import Count, Max
+        from market_data.models import PriceData
+        from portfolio.models import Portfolio, PositionAggregate
+
+        now = time.monotonic()
+        if cls._token_checked_at is not None and now - cls._token_checked_at < TOKEN_CHECK_INTERVAL:
+            return
+
+        holdings = PositionAggregate.objects.aggregate(updated_at=Max('updated_at'), count=Count('pk'))
+        token = (
+            date.today(),
+            PriceData.objects.aggregate(latest=Max('date'))['latest'],
+            holdings['updated_at'],
+            holdings['count'],
+            Portfolio.objects.aggregate(updated_at=Max('updated_at'))['updated_at'],
+        )
+        with cls._lock:
+            if token != cls._cache_token:
+                cls._panels, cls._series = {}, {}
+                cls._cache_token = token
+            cls._token_checked_at = now
+
+    @classmethod
+    def _get_price_series(cls, tickers, first_day, end_day, use_cache):
+        """
+        Get the price series of tickers over the lookback period, loading
+        only those not cached yet.
+
+        Returns:
+            Dict mapping ticker to (day numbers, closes), or None without prices
+        """
+        if not use_cache:
+            loaded = PortfolioHistory.load_price_series(sorted(tickers), first_day, end_day)
+            return {ticker: loaded.get(ticker) for ticker in tickers}
+
+        missing = sorted(ticker for ticker in tickers if ticker not in cls._series)
+        if missing:
+            loaded = PortfolioHistory.load_price_series(missing, first_day, end_day)
+            with cls._lock:
+                for ticker in missing:
+                    cls._series[ticker] = loaded.get(ticker)
+            logger.debug(f"Loaded price series of {len(loaded)} securities for risk analytics")
+        return {ticker: cls._series.get(ticker) for ticker in tickers}
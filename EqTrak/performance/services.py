@@ -1,8 +1,17 @@
 import logging
 import functools
-from datetime import date
-from django.contrib.contenttypes.models import ContentType
-from .models import PerformanceSettings, PerformanceMetric
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+import django
+from django.db import connections
+from django.db.models import prefetch_related_objects
+from django.utils import timezone
+from metrics.bulk import compute_metrics_for_positions, compute_position_metrics_bulk
+from portfolio.lots import TaxLotEngine
+from users import flags
+from .models import PerformanceMetric
+from .returns import PortfolioHistory
+from .risk import RiskAnalytics
 from .integration import (
     store_position_gain_percentage, 
     store_position_gain_absolute,
@@ -11,6 +20,7 @@ from .integration import (
     store_portfolio_twr,
     store_transaction_gain_percentage,
     store_transaction_gain_absolute,
+    batched_metric_writes,
     is_feature_enabled
 )
 
@@ -26,24 +36,15 @@ def check_performance_access(func):
         # Find user parameter
         user = kwargs.get('user')
         
-        # Check system-wide setting first
-        if not PerformanceSettings.is_feature_enabled():
+        # Check system-wide setting first, both are cached by the flag service
+        if not flags.is_system_enabled('performance'):
             logger.info("Performance feature disabled at system level")
             return None
             
-        # If no user, system setting is sufficient
-        if user is None:
-            return func(*args, **kwargs)
-            
-        # Check user-specific setting
-        try:
-            if not user.settings.performance_enabled:
-                logger.info(f"Performance feature disabled for user {user.username}")
-                return None
-        except (AttributeError, Exception) as e:
-            # If user settings don't exist, default to enabled
-            logger.debug(f"Error checking user performance settings: {e}")
-            pass
+        # Check user-specific setting, users without settings default to enabled
+        if user is not None and not flags.is_enabled('performance', user=user):
+            logger.info(f"Performance feature disabled for user {user.username}")
+            return None
             
         # Feature access allowed, call the function
         return func(*args, **kwargs)
@@ -67,6 +68,41 @@ class PerformanceService:
         """
         return PerformanceCalculationService.is_enabled(user=user)
     
+    @staticmethod
+    def attach_performance(objects):
+        """
+        Load the stored performance metrics of many objects of one model.
+        
+        Fills in the performance_metric accessor of every object with one
+        query, so templates reading it per row don't query again. Nothing is
+        recalculated: metrics are kept current when transactions are saved.
+        
+        Args:
+            objects: Iterable of Portfolio, Position or Transaction instances
+            
+        Returns:
+            List of the objects
+        """
+        objects = list(objects)
+        if objects:
+            prefetch_related_objects(objects, 'performance_metric')
+        return objects
+    
+    @staticmethod
+    @check_performance_access
+    def get_stored_performance(obj, user=None):
+        """
+        Get the stored performance metric of a portfolio, position or transaction.
+        
+        Uses the metric loaded by attach_performance() or select_related when
+        there is one, and never recalculates.
+        
+        Returns:
+            PerformanceMetric instance or None if feature is disabled or not calculated yet
+        """
+        # A missing related object raises a subclass of AttributeError
+        return getattr(obj, 'performance_metric', None)
+    
     @staticmethod
     @check_performance_access
     def calculate_portfolio_performance(portfolio, user=None):
@@ -81,38 +117,149 @@ class PerformanceService:
             PerformanceMetric instance or None if feature is disabled
         """
         # Get or create performance metric for this portfolio
-        content_type = ContentType.objects.get_for_model(portfolio)
-        metric, created = PerformanceMetric.objects.get_or_create(
-            content_type=content_type,
-            object_id=portfolio.portfolio_id
-        )
+        metric, created = PerformanceMetric.objects.get_or_create(portfolio=portfolio)
+        
+        # Calculate cost basis and current value from position metrics,
+        # computed for all positions at once
+        position_values = compute_position_metrics_bulk(portfolio, active_only=False)
+        PerformanceService._apply_portfolio_values(metric, portfolio, position_values)
+        metric.save()
+        return metric
+    
+    @staticmethod
+    @check_performance_access
+    def calculate_portfolios_performance(portfolios, user=None):
+        """
+        Calculate performance metrics for many portfolios at once.
+        
+        Same results as calculate_portfolio_performance() for each portfolio,
+        with the position metrics of all portfolios computed together and the
+        performance rows written in bulk.
+        
+        Args:
+            portfolios: Iterable of Portfolio instances
+            user: User requesting the calculation
+            
+        Returns:
+            Dict mapping portfolio_id to PerformanceMetric, or None if feature is disabled
+        """
+        portfolios = list(portfolios)
+        if not portfolios:
+            return {}
+            
+        values_by_portfolio = PerformanceService._get_position_values_by_portfolio(portfolios)
+        histories = PortfolioHistory.build_many(portfolios)
+        metrics = PerformanceService._get_performance_metrics(portfolios)
+        with batched_metric_writes():
+            for portfolio in portfolios:
+                PerformanceService._apply_portfolio_values(
+                    metrics[portfolio.pk], portfolio, values_by_portfolio[portfolio.pk], histories
+                )
+        PerformanceService._save_performance_metrics(metrics.values())
+        return metrics
+    
+    @staticmethod
+    def _get_position_values_by_portfolio(portfolios):
+        """
+        Compute the position metrics of all positions of many portfolios together.
+        
+        Returns:
+            Dict mapping portfolio_id to a dict of position metrics as returned
+            by compute_position_metrics_bulk(portfolio, active_only=False)
+        """
+        from portfolio.models import Position
+        
+        positions = Position.objects.filter(portfolio__in=portfolios)
+        portfolio_ids = dict(positions.values_list('position_id', 'portfolio_id'))
+        values_by_portfolio = {portfolio.pk: {} for portfolio in portfolios}
+        for position_id, values in compute_metrics_for_positions(positions).items():
+            values_by_portfolio[portfolio_ids[position_id]][position_id] = values
+        return values_by_portfolio
+    
+    @staticmethod
+    def _get_performance_metrics(objects):
+        """
+        Get the performance metrics of many objects of one model, with new
+        unsaved instances for objects that have none yet.
+        
+        Returns:
+            Dict mapping object primary key to PerformanceMetric
+        """
+        target_field = PerformanceMetric.get_target_field_for(objects[0])
+        objects_by_pk = {obj.pk: obj for obj in objects}
+        
+        metrics = {}
+        for metric in PerformanceMetric.objects.filter(**{f'{target_field}__in': list(objects_by_pk)}):
+            metrics[getattr(metric, f'{target_field}_id')] = metric
+            
+        for pk, obj in objects_by_pk.items():
+            if pk not in metrics:
+                metrics[pk] = PerformanceMetric(**{target_field: obj})
+        return metrics
+    
+    # Fields written by _save_performance_metrics()
+    CALCULATED_FIELDS = [
+        'cost_basis', 'current_value', 'absolute_gain_loss', 'percentage_gain_loss',
+        'is_realized', 'status_message', 'calculation_date'
+    ]
+    
+    @staticmethod
+    def _save_performance_metrics(metrics):
+        """
+        Write many performance metrics with batched upserts on their object.
+        
+        Rows are inserted without their primary key so that existing rows
+        conflict only on their unique target link and get updated in place.
+        """
+        now = timezone.now()
+        rows_by_target = {}
+        for metric in metrics:
+            metric.calculation_date = now
+            target_field = metric.get_target_field()
+            row = PerformanceMetric(**{f'{target_field}_id': getattr(metric, f'{target_field}_id')})
+            for field in PerformanceService.CALCULATED_FIELDS:
+                setattr(row, field, getattr(metric, field))
+            rows_by_target.setdefault(target_field, []).append(row)
+            
+        for target_field, rows in rows_by_target.items():
+            PerformanceMetric.objects.bulk_create(
+                rows, batch_size=500, update_conflicts=True,
+                unique_fields=[target_field],
+                update_fields=PerformanceService.CALCULATED_FIELDS
+            )
+    
+    @staticmethod
+    def _apply_portfolio_values(metric, portfolio, position_values, histories=None):
+        """
+        Set the performance of a portfolio from its position metrics and store
+        the portfolio return metric values. The caller saves the metric.
         
-        # Calculate cost basis and current value from position metrics
-        positions = portfolio.position_set.all()
+        Args:
+            metric: PerformanceMetric of the portfolio
+            portfolio: Portfolio instance
+            position_values: Dict of position metrics as computed by
+                compute_position_metrics_bulk()
+            histories: Optional prebuilt histories for the time-weighted return
+        """
         cost_basis = 0
         current_value = 0
         
         # Check if there are any positions at all
-        if not positions.exists():
+        if not position_values:
             metric.status_message = "No positions in portfolio. Add positions to track performance."
-            metric.save()
-            return metric
-            
-        for position in positions:
-            position_cost_basis = position.get_metric_value('Cost Basis')
-            position_current_value = position.get_metric_value('Current Value')
+            return
             
-            if position_cost_basis is not None:
-                cost_basis += position_cost_basis
+        for values in position_values.values():
+            if values['cost_basis'] is not None:
+                cost_basis += values['cost_basis']
                 
-            if position_current_value is not None:
-                current_value += position_current_value
+            if values['current_value'] is not None:
+                current_value += values['current_value']
                 
         # If we couldn't get any cost basis information, set a friendly message
         if cost_basis == 0:
             metric.status_message = "No cost basis data available. Add purchase transactions to positions."
-            metric.save()
-            return metric
+            return
             
         # Clear any previous status message since we can now calculate
         metric.status_message = None
@@ -128,7 +275,6 @@ class PerformanceService:
         metric.current_value = current_value
         metric.absolute_gain_loss = absolute_gain_loss
         metric.percentage_gain_loss = percentage_gain_loss
-        metric.save()
         
         # Update the metrics module with performance values
         
@@ -139,97 +285,40 @@ class PerformanceService:
         store_portfolio_return_absolute(portfolio, absolute_gain_loss)
         
         # Calculate and update the time-weighted return
-        twr_percentage = PerformanceService.calculate_time_weighted_return(portfolio)
+        twr_percentage = PerformanceService.calculate_time_weighted_return(portfolio, histories)
         if twr_percentage is not None:
             store_portfolio_twr(portfolio, twr_percentage)
-        
-        return metric
     
     @staticmethod
-    def calculate_time_weighted_return(portfolio):
+    def calculate_time_weighted_return(portfolio, histories=None):
         """
         Calculate time-weighted return for a portfolio.
         
-        This method accounts for cash flows (deposits and withdrawals) by breaking the
-        measurement period into sub-periods and calculating returns for each sub-period.
+        Builds the daily holdings and prices of the portfolio from its
+        transactions and stored prices (see performance.returns) and chains
+        the daily returns, so deposits and withdrawals do not affect the result.
         
         Args:
             portfolio: Portfolio instance to calculate TWR for
+            histories: Optional dict of prebuilt histories from
+                PortfolioHistory.build_many(), to share queries between portfolios
             
+        The result is the cumulative return over the whole history, not
+        annualized. Earlier versions stored the simple return scaled linearly
+        to a year, so values stored before the change are not comparable.
+        
         Returns:
-            Time-weighted return percentage or None if insufficient data
+            Time-weighted return percentage since the first transaction or None if insufficient data
         """
-        from portfolio.models import Transaction
-        from django.db.models import Sum, F, Q, Case, When, Value
-        from decimal import Decimal
-        
-        # Get all position transactions in chronological order
-        transactions = Transaction.objects.filter(
-            position__portfolio=portfolio,
-            status='COMPLETED'
-        ).order_by('date')
+        if histories is None:
+            histories = PortfolioHistory.build_many([portfolio])
+        history = histories.get(portfolio.pk)
         
-        if not transactions.exists():
-            return None
-            
-        # Get start date (first transaction) and end date (today or last valuation)
-        start_date = transactions.first().date
-        end_date = date.today()
-        
-        # Calculate cash flows by date
-        cash_flows = transactions.values('date').annotate(
-            flow=Sum(F('price') * F('quantity') * (
-                 Case(
-                     When(transaction_type='BUY', then=Value(-1)),
-                     When(transaction_type='SELL', then=Value(1)),
-                     default=Value(0)
-                 )
-            ) + F('fees') * (
-                 Case(
-                     When(transaction_type__in=['BUY', 'SELL'], then=Value(-1)),
-                     default=Value(0)
-                 )
-            ))
-        ).order_by('date')
-        
-        if not cash_flows:
+        if history is None or not history.inflows.any():
             return None
             
-        # Calculate portfolio values at each flow date
-        # This is a simplified approach - in a real system you'd need to retrieve 
-        # historical market prices for each position to calculate historical values
-        
-        # For now, we'll use a simplified approach where we use the current metrics
-        # and estimate historical values based on transactions
-        current_cost_basis = sum(
-            position.get_metric_value('Cost Basis') or 0 
-            for position in portfolio.position_set.all()
-        )
-        
-        current_value = sum(
-            position.get_metric_value('Current Value') or 0 
-            for position in portfolio.position_set.all()
-        )
-        
-        if current_cost_basis == 0 or current_value == 0:
-            return None
-            
-        # Calculate a simple rate of return (as a decimal)
-        simple_return = (current_value / current_cost_basis) - 1
-        
-        # Approximate TWR by adjusting for timing of cash flows
-        # This is a simplification - a real implementation would need actual historical values
-        
-        # Calculate weighted time periods for each cash flow
-        total_days = (end_date - start_date).days
-        if total_days == 0:
-            return simple_return * Decimal('100')  # Convert to percentage
-            
-        # Apply a simple time-weighting to the return
-        time_weighted_return = simple_return * Decimal(str(365 / total_days)) if total_days > 0 else simple_return
-        
-        # Convert to percentage and return
-        return time_weighted_return * Decimal('100')
+        time_weighted_return = history.time_weighted_return()
+        return Decimal(str(round(time_weighted_return * 100, 6)))
     
     @staticmethod
     @check_performance_access
@@ -245,11 +334,7 @@ class PerformanceService:
             PerformanceMetric instance or None if feature is disabled
         """
         # Get or create performance metric for this position
-        content_type = ContentType.objects.get_for_model(position)
-        metric, created = PerformanceMetric.objects.get_or_create(
-            content_type=content_type,
-            object_id=position.position_id
-        )
+        metric, created = PerformanceMetric.objects.get_or_create(position=position)
         
         # Get cost basis from position metrics
         cost_basis = position.get_metric_value('Cost Basis')
@@ -257,6 +342,48 @@ class PerformanceService:
         # Get current value from position metrics
         current_value = position.get_metric_value('Current Value')
         
+        PerformanceService._apply_position_values(metric, position, cost_basis, current_value)
+        metric.save()
+        return metric
+    
+    @staticmethod
+    @check_performance_access
+    def calculate_positions_performance(positions, user=None):
+        """
+        Calculate performance metrics for many positions at once.
+        
+        Same results as calculate_position_performance() for each position,
+        with the position metrics computed in bulk and the performance rows
+        written in bulk.
+        
+        Args:
+            positions: Iterable of Position instances
+            user: Optional user to check permission
+            
+        Returns:
+            Dict mapping position_id to PerformanceMetric, or None if feature is disabled
+        """
+        positions = list(positions)
+        if not positions:
+            return {}
+            
+        position_values = compute_metrics_for_positions(positions)
+        metrics = PerformanceService._get_performance_metrics(positions)
+        with batched_metric_writes():
+            for position in positions:
+                values = position_values.get(position.pk, {})
+                PerformanceService._apply_position_values(
+                    metrics[position.pk], position, values.get('cost_basis'), values.get('current_value')
+                )
+        PerformanceService._save_performance_metrics(metrics.values())
+        return metrics
+    
+    @staticmethod
+    def _apply_position_values(metric, position, cost_basis, current_value):
+        """
+        Set the performance of a position from its cost basis and current value
+        and store the position gain metric values. The caller saves the metric.
+        """
         # If either value is missing, we can't calculate performance
         if cost_basis is None or current_value is None:
             logger.warning(f"Missing cost basis or current value for position {position.position_id}")
@@ -268,9 +395,7 @@ class PerformanceService:
                 metric.status_message = "No current value available. Add market data to enable performance tracking."
             else:
                 metric.status_message = "Unable to calculate performance metrics with the available data."
-                
-            metric.save()
-            return metric
+            return
             
         # Clear any previous status message since we can now calculate
         metric.status_message = None
@@ -286,7 +411,6 @@ class PerformanceService:
         metric.current_value = current_value
         metric.absolute_gain_loss = absolute_gain_loss
         metric.percentage_gain_loss = percentage_gain_loss
-        metric.save()
         
         # Update the metrics module with performance values
         
@@ -295,8 +419,6 @@ class PerformanceService:
         
         # Update absolute (currency) gain/loss
         store_position_gain_absolute(position, absolute_gain_loss)
-        
-        return metric
     
     @staticmethod
     @check_performance_access
@@ -317,39 +439,61 @@ class PerformanceService:
             return None
         
         # Get or create performance metric for this transaction
-        content_type = ContentType.objects.get_for_model(transaction)
-        metric, created = PerformanceMetric.objects.get_or_create(
-            content_type=content_type,
-            object_id=transaction.transaction_id
-        )
+        metric, created = PerformanceMetric.objects.get_or_create(transaction=transaction)
+        
+        # For a sale, cost basis is the cost of the tax lots it was matched
+        # against under the portfolio's cost basis method
+        cost_basis, sale_value = TaxLotEngine.get_sale_totals(transaction)
+        
+        PerformanceService._apply_transaction_values(metric, transaction, cost_basis, sale_value)
+        metric.save()
+        return metric
+    
+    @staticmethod
+    @check_performance_access
+    def calculate_transactions_performance(transactions, user=None):
+        """
+        Calculate performance metrics for many transactions at once.
         
-        # For a sale, cost basis is the position's cost basis at time of sale
-        # multiplied by the proportion of shares sold
-        position = transaction.position
-        position_cost_basis = position.get_metric_value('Cost Basis')
+        Same results as calculate_transaction_performance() for each sale,
+        with the matched lot totals loaded in one query and the performance
+        rows written in bulk. Other transaction types are skipped.
         
-        if position_cost_basis is None:
-            logger.warning(f"Missing cost basis for position {position.position_id} to calculate transaction performance")
-            metric.status_message = "No cost basis available for this position. Add purchase transactions."
-            metric.save()
-            return metric
+        Args:
+            transactions: Iterable of Transaction instances
+            user: Optional user to check permission
             
-        position_shares = position.get_metric_value('Shares')
-        if position_shares is None or position_shares == 0:
-            logger.warning(f"Missing or zero shares for position {position.position_id}")
-            metric.status_message = "Share count is missing or zero for this position."
-            metric.save()
-            return metric
+        Returns:
+            Dict mapping transaction_id to PerformanceMetric, or None if feature is disabled
+        """
+        sales = [transaction for transaction in transactions if transaction.transaction_type == 'SELL']
+        if not sales:
+            return {}
+            
+        sale_totals = TaxLotEngine.get_sales_totals(sales)
+        metrics = PerformanceService._get_performance_metrics(sales)
+        with batched_metric_writes():
+            for sale in sales:
+                cost_basis, sale_value = sale_totals.get(sale.pk, (None, None))
+                PerformanceService._apply_transaction_values(metrics[sale.pk], sale, cost_basis, sale_value)
+        PerformanceService._save_performance_metrics(metrics.values())
+        return metrics
+    
+    @staticmethod
+    def _apply_transaction_values(metric, transaction, cost_basis, sale_value):
+        """
+        Set the realized performance of a sale from its matched cost and
+        proceeds and store the transaction gain metric values. The caller
+        saves the metric.
+        """
+        if cost_basis is None:
+            logger.warning(f"No tax lots matched for sale {transaction.transaction_id} to calculate transaction performance")
+            metric.status_message = "No purchase lots available for this sale. Add purchase transactions."
+            return
             
         # Clear any previous status message since we can now calculate
         metric.status_message = None
         
-        # Calculate cost basis proportionally to shares sold
-        cost_basis = position_cost_basis * (transaction.quantity / position_shares)
-        
-        # Sale value is the transaction amount
-        sale_value = transaction.total_with_fees
-        
         # Calculate realized gain/loss
         absolute_gain_loss = sale_value - cost_basis
         percentage_gain_loss = 0
@@ -362,7 +506,6 @@ class PerformanceService:
         metric.absolute_gain_loss = absolute_gain_loss
         metric.percentage_gain_loss = percentage_gain_loss
         metric.is_realized = True
-        metric.save()
         
         # Update the metrics module with performance values
         
@@ -371,48 +514,120 @@ class PerformanceService:
         
         # Update absolute (currency) gain/loss
         store_transaction_gain_absolute(transaction, absolute_gain_loss)
-        
-        return metric
+    
+    # Portfolios recalculated together by calculate_all_performance()
+    RECALCULATION_CHUNK_SIZE = 200
     
     @staticmethod
     @check_performance_access
-    def calculate_all_performance(user=None):
+    def calculate_all_performance(user=None, processes=None, chunk_size=None):
         """
         Recalculate all performance metrics.
         
+        Portfolios are processed in chunks. For each chunk, the positions,
+        sales, position metrics (including latest prices) and histories are
+        loaded up front with a fixed number of queries, all results are
+        computed in memory, and the performance rows and metric values are
+        written in bulk.
+        
         Args:
             user: Optional user to check permission
+            processes: Number of worker processes to spread the chunks over
+                (default: recalculate in this process)
+            chunk_size: Number of portfolios per chunk
             
         Returns:
             Dictionary with counts of metrics updated
         """
-        from portfolio.models import Portfolio, Position, Transaction
+        from portfolio.models import Portfolio
+        
+        chunk_size = chunk_size or PerformanceService.RECALCULATION_CHUNK_SIZE
+        portfolio_ids = list(Portfolio.objects.order_by('pk').values_list('pk', flat=True))
+        chunks = [portfolio_ids[i:i + chunk_size] for i in range(0, len(portfolio_ids), chunk_size)]
+        
+        if processes and processes > 1 and len(chunks) > 1:
+            # Workers open their own connections; forked copies of open
+            # connections must not be shared with them
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=processes, initializer=_init_recalculation_worker) as executor:
+                chunk_results = list(executor.map(_recalculate_portfolio_chunk, chunks))
+        else:
+            chunk_results = [PerformanceService.recalculate_portfolios(chunk) for chunk in chunks]
         
         results = {
             'portfolios': 0,
             'positions': 0,
             'transactions': 0
         }
+        for chunk_result in chunk_results:
+            for key in results:
+                results[key] += chunk_result[key]
         
-        # Recalculate all portfolio metrics
-        portfolios = Portfolio.objects.all()
-        for portfolio in portfolios:
-            PerformanceService.calculate_portfolio_performance(portfolio, user=user)
-            results['portfolios'] += 1
+        logger.info(
+            f"Recalculated performance of {results['portfolios']} portfolios, "
+            f"{results['positions']} positions and {results['transactions']} transactions"
+        )
+        return results
+    
+    @staticmethod
+    def recalculate_portfolios(portfolio_ids):
+        """
+        Recalculate the performance of portfolios and all their positions and
+        sales in one set-based pass.
         
-        # Recalculate all position metrics
-        positions = Position.objects.all()
-        for position in positions:
-            PerformanceService.calculate_position_performance(position, user=user)
-            results['positions'] += 1
+        Args:
+            portfolio_ids: Primary keys of the portfolios
+            
+        Returns:
+            Dictionary with counts of metrics updated
+        """
+        from portfolio.models import Portfolio, Position, Transaction
         
-        # Recalculate all transaction metrics
-        transactions = Transaction.objects.filter(transaction_type='SELL')
-        for transaction in transactions:
-            PerformanceService.calculate_transaction_performance(transaction, user=user)
-            results['transactions'] += 1
+        portfolios = list(Portfolio.objects.filter(pk__in=portfolio_ids))
+        positions = list(Position.objects.filter(portfolio__in=portfolio_ids))
+        sales = list(Transaction.objects.filter(position__portfolio__in=portfolio_ids, transaction_type='SELL'))
         
-        return results
+        # Everything the calculations need, loaded up front
+        position_values = compute_metrics_for_positions(positions) if positions else {}
+        values_by_portfolio = {portfolio.pk: {} for portfolio in portfolios}
+        for position in positions:
+            if position.pk in position_values:
+                values_by_portfolio[position.portfolio_id][position.pk] = position_values[position.pk]
+        histories = PortfolioHistory.build_many(portfolios)
+        sale_totals = TaxLotEngine.get_sales_totals(sales)
+        
+        metrics = {}
+        with batched_metric_writes():
+            if positions:
+                position_metrics = PerformanceService._get_performance_metrics(positions)
+                for position in positions:
+                    values = position_values.get(position.pk, {})
+                    PerformanceService._apply_position_values(
+                        position_metrics[position.pk], position, values.get('cost_basis'), values.get('current_value')
+                    )
+                metrics.update(position_metrics)
+            
+            if portfolios:
+                portfolio_metrics = PerformanceService._get_performance_metrics(portfolios)
+                for portfolio in portfolios:
+                    PerformanceService._apply_portfolio_values(
+                        portfolio_metrics[portfolio.pk], portfolio, values_by_portfolio[portfolio.pk], histories
+                    )
+                metrics.update(portfolio_metrics)
+            
+            if sales:
+                sale_metrics = PerformanceService._get_performance_metrics(sales)
+                for sale in sales:
+                    cost_basis, sale_value = sale_totals.get(sale.pk, (None, None))
+                    PerformanceService._apply_transaction_values(sale_metrics[sale.pk], sale, cost_basis, sale_value)
+                metrics.update(sale_metrics)
+        
+        PerformanceService._save_performance_metrics(metrics.values())
+        return {
+            'portfolios': len(portfolios),
+            'positions': len(positions),
+            'transactions': len(sales)
+        }
         
     @staticmethod
     def clear_all_performance_data():
@@ -431,7 +646,7 @@ class PerformanceService:
             
             # Find and delete all performance-related metrics
             for metric_name in PERFORMANCE_METRICS:
-                metric_type = MetricType.objects.filter(name=metric_name, is_system=True).first()
+                metric_type = MetricType.get_system_metric(metric_name)
                 if metric_type:
                     MetricValue.objects.filter(metric_type=metric_type).delete()
                 
@@ -440,6 +655,22 @@ class PerformanceService:
             
         return True
 
+
+def _init_recalculation_worker():
+    """Set Django up in a recalculation worker process started without fork"""
+    from django.apps import apps
+    if not apps.ready:
+        django.setup()
+
+
+def _recalculate_portfolio_chunk(portfolio_ids):
+    """Recalculate one chunk of portfolios in a worker process"""
+    try:
+        return PerformanceService.recalculate_portfolios(portfolio_ids)
+    finally:
+        connections.close_all()
+
+
 class PerformanceCalculationService:
     """
     Service providing a clean interface for performance calculations.
@@ -451,23 +682,25 @@ class PerformanceCalculationService:
     @staticmethod
     def is_enabled(user=None):
         """Check if performance calculations are enabled"""
-        # Check system-wide setting first
-        if not PerformanceSettings.is_feature_enabled():
-            return False
-            
-        # If no user, system setting is sufficient
-        if user is None:
-            return True
-            
-        # Check user-specific setting
-        try:
-            if not user.settings.performance_enabled:
-                return False
-        except (AttributeError, Exception):
-            # If user settings don't exist, default to enabled
-            pass
-            
-        return True
+        # System setting first, then the user's toggle if a user is given
+        return flags.is_enabled('performance', user=user)
+    
+    @staticmethod
+    def _stored_values(objects, field):
+        """
+        Read a field of the stored performance metrics of many objects.
+        
+        Metrics are only read here, never recalculated: the recalculation
+        queue keeps them current when transactions and prices change.
+        
+        Returns:
+            Dict mapping object pk to the field value (None if not calculated yet)
+        """
+        values = {}
+        for obj in PerformanceService.attach_performance(objects):
+            performance = getattr(obj, 'performance_metric', None)
+            values[obj.pk] = getattr(performance, field) if performance else None
+        return values
     
     @staticmethod
     def get_position_gain_percentage(position, user=None):
@@ -484,7 +717,7 @@ class PerformanceCalculationService:
         if not PerformanceService.is_performance_enabled(user=user):
             return None
             
-        performance = PerformanceService.calculate_position_performance(position, user=user)
+        performance = PerformanceService.get_stored_performance(position, user=user)
         return performance.percentage_gain_loss if performance else None
     
     @staticmethod
@@ -502,7 +735,7 @@ class PerformanceCalculationService:
         if not PerformanceService.is_performance_enabled(user=user):
             return None
             
-        performance = PerformanceService.calculate_position_performance(position, user=user)
+        performance = PerformanceService.get_stored_performance(position, user=user)
         return performance.absolute_gain_loss if performance else None
     
     @staticmethod
@@ -520,7 +753,7 @@ class PerformanceCalculationService:
         if not PerformanceService.is_performance_enabled(user=user):
             return None
             
-        performance = PerformanceService.calculate_portfolio_performance(portfolio, user=user)
+        performance = PerformanceService.get_stored_performance(portfolio, user=user)
         return performance.percentage_gain_loss if performance else None
     
     @staticmethod
@@ -538,7 +771,7 @@ class PerformanceCalculationService:
         if not PerformanceService.is_performance_enabled(user=user):
             return None
             
-        performance = PerformanceService.calculate_portfolio_performance(portfolio, user=user)
+        performance = PerformanceService.get_stored_performance(portfolio, user=user)
         return performance.absolute_gain_loss if performance else None
     
     @staticmethod
@@ -558,6 +791,114 @@ class PerformanceCalculationService:
             
         return PerformanceService.calculate_time_weighted_return(portfolio)
         
+    @staticmethod
+    def get_positions_gain_percentage(positions, user=None):
+        """
+        Get percentage gain/loss for many positions at once.
+        
+        Args:
+            positions: List of Position objects
+            user: Optional user to check permissions
+            
+        Returns:
+            Dict mapping position_id to percentage gain/loss (None if disabled/unavailable)
+        """
+        if not PerformanceService.is_performance_enabled(user=user):
+            return {}
+            
+        return PerformanceCalculationService._stored_values(positions, 'percentage_gain_loss')
+    
+    @staticmethod
+    def get_positions_gain_absolute(positions, user=None):
+        """
+        Get absolute (currency) gain/loss for many positions at once.
+        
+        Args:
+            positions: List of Position objects
+            user: Optional user to check permissions
+            
+        Returns:
+            Dict mapping position_id to absolute gain/loss (None if disabled/unavailable)
+        """
+        if not PerformanceService.is_performance_enabled(user=user):
+            return {}
+            
+        return PerformanceCalculationService._stored_values(positions, 'absolute_gain_loss')
+    
+    @staticmethod
+    def get_portfolios_return_percentage(portfolios, user=None):
+        """
+        Get percentage return for many portfolios at once.
+        
+        Args:
+            portfolios: List of Portfolio objects
+            user: Optional user to check permissions
+            
+        Returns:
+            Dict mapping portfolio_id to return percentage (None if disabled/unavailable)
+        """
+        if not PerformanceService.is_performance_enabled(user=user):
+            return {}
+            
+        return PerformanceCalculationService._stored_values(portfolios, 'percentage_gain_loss')
+    
+    @staticmethod
+    def get_portfolios_return_absolute(portfolios, user=None):
+        """
+        Get absolute (currency) return for many portfolios at once.
+        
+        Args:
+            portfolios: List of Portfolio objects
+            user: Optional user to check permissions
+            
+        Returns:
+            Dict mapping portfolio_id to return in currency (None if disabled/unavailable)
+        """
+        if not PerformanceService.is_performance_enabled(user=user):
+            return {}
+            
+        return PerformanceCalculationService._stored_values(portfolios, 'absolute_gain_loss')
+    
+    @staticmethod
+    def get_time_weighted_returns_percentage(portfolios, user=None):
+        """
+        Get time-weighted return percentage for many portfolios at once.
+        
+        Args:
+            portfolios: List of Portfolio objects
+            user: Optional user to check permissions
+            
+        Returns:
+            Dict mapping portfolio_id to TWR percentage (None if disabled/unavailable)
+        """
+        if not PerformanceService.is_performance_enabled(user=user):
+            return {}
+            
+        portfolios = list(portfolios)
+        histories = PortfolioHistory.build_many(portfolios)
+        return {
+            portfolio.pk: PerformanceService.calculate_time_weighted_return(portfolio, histories)
+            for portfolio in portfolios
+        }
+        
+    @staticmethod
+    def get_risk_metric_values(field, targets, user=None):
+        """
+        Get a risk metric for many positions or portfolios at once.
+        
+        Args:
+            field: Risk panel field, one of risk.RISK_FIELDS
+            targets: List of Position or Portfolio objects
+            user: Optional user to check permissions
+            
+        Returns:
+            Dict mapping target pk to value (None if disabled/unavailable)
+        """
+        if not PerformanceService.is_performance_enabled(user=user):
+            return {}
+            
+        return RiskAnalytics.get_metric_values(field, targets)
+        
     @staticmethod
     def get_transaction_gain_percentage(transaction, user=None):
         """
@@ -578,5 +919,5 @@ class PerformanceCalculationService:
         if not PerformanceService.is_performance_enabled(user=user):
             return None
             
-        performance = PerformanceService.calculate_transaction_performance(transaction, user=user)
-        return performance.percentage_gain_loss if performance else None 
\ No newline at end of file
+        performance = PerformanceService.get_stored_performance(transaction, user=user)
+        return performance.percentage_gain_loss if performance else None
\ No newline at end of file
@@ -1,56 +1,182 @@
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
-from django.contrib.contenttypes.models import ContentType
+from market_data.models import PriceData
+from market_data.signals import prices_stored
+from metrics.models import MetricType, MetricValue
 from portfolio.models import Position, Portfolio, Transaction
-from .models import PerformanceMetric
-from .services import PerformanceService
+from users import flags
+from . import recalc
+from .covariance import CovarianceService
+from .models import PerformanceSettings
+from .risk import RiskAnalytics
+from .snapshots import SnapshotService
 
 @receiver(post_save, sender=Position)
 def update_position_performance(sender, instance, created, **kwargs):
     """
-    Update performance metrics when a position is created or updated.
+    Queue the performance metrics of a position for recalculation when it is
+    created or updated.
     """
-    PerformanceService.calculate_position_performance(instance)
+    recalc.mark_position_dirty(instance.pk)
 
 @receiver(post_save, sender=Portfolio)
 def update_portfolio_performance(sender, instance, created, **kwargs):
     """
-    Update performance metrics when a portfolio is created or updated.
+    Queue the performance metrics of a portfolio for recalculation when it is
+    created or updated.
     """
-    PerformanceService.calculate_portfolio_performance(instance)
+    recalc.mark_portfolio_dirty(instance.pk)
 
 @receiver(post_save, sender=Transaction)
 def update_transaction_performance(sender, instance, created, **kwargs):
     """
-    Update performance metrics when a transaction is created or updated.
-    Only calculates for SELL transactions.
+    Queue a transaction and its position and portfolio for recalculation
+    when the transaction is created or updated. Only SELL transactions get
+    metrics of their own.
     """
-    if instance.transaction_type == 'SELL':
-        PerformanceService.calculate_transaction_performance(instance)
+    recalc.mark_transaction_dirty(instance.pk, instance.position_id)
     
-    # Also update the related position and portfolio metrics
-    PerformanceService.calculate_position_performance(instance.position)
-    PerformanceService.calculate_portfolio_performance(instance.position.portfolio)
+    # A transaction moved to another position also changes the old one
+    previous = None if created else getattr(instance, '_snapshot_state', None)
+    if previous is not None and previous['position_id'] != instance.position_id:
+        recalc.mark_position_dirty(previous['position_id'])
 
 @receiver(post_delete, sender=Transaction)
 def handle_transaction_delete(sender, instance, **kwargs):
     """
-    Update position and portfolio metrics when a transaction is deleted.
-    """
-    try:
-        position = instance.position
-        portfolio = position.portfolio
-        
-        # Update position and portfolio metrics
-        PerformanceService.calculate_position_performance(position)
-        PerformanceService.calculate_portfolio_performance(portfolio)
-        
-        # Clean up any performance metrics for this transaction
-        content_type = ContentType.objects.get_for_model(instance)
-        PerformanceMetric.objects.filter(
-            content_type=content_type,
-            object_id=instance.id
-        ).delete()
-    except Exception:
-        # Handle case where position or portfolio might be deleted
-        pass 
\ No newline at end of file
+    Queue the position and portfolio of a deleted transaction for
+    recalculation. The transaction's metrics are deleted with it.
+    """
+    # Positions deleted along with the transaction are skipped when recalculating
+    recalc.mark_position_dirty(instance.position_id)
+
+@receiver(post_save, sender=MetricValue)
+@receiver(post_delete, sender=MetricValue)
+def update_market_price_performance(sender, instance, raw=False, **kwargs):
+    """
+    Queue a position for recalculation when its market price is written or
+    deleted, its stored current value depends on the latest one.
+    """
+    if raw or not instance.position_id:
+        return
+    
+    market_price = MetricType.get_system_metric('Market Price', scope_type='POSITION')
+    if market_price is not None and instance.metric_type_id == market_price.pk:
+        recalc.mark_position_dirty(instance.position_id)
+
+@receiver(post_save, sender=PriceData)
+@receiver(post_delete, sender=PriceData)
+def update_price_performance(sender, instance, raw=False, **kwargs):
+    """
+    Queue the positions of a security for recalculation after a price
+    change, their stored returns are computed from the price history.
+    """
+    if not raw:
+        recalc.mark_positions_dirty(
+            Position.objects.filter(ticker=instance.security.symbol).values_list('pk', flat=True)
+        )
+
+@receiver(pre_save, sender=Transaction)
+def remember_snapshot_state(sender, instance, raw=False, **kwargs):
+    """
+    Keep the stored date and position of a transaction for invalidating
+    snapshots after the save. The portfolio app's handlers load the stored
+    state first.
+    """
+    if not raw:
+        instance._snapshot_state = getattr(instance, '_aggregate_state', None)
+
+@receiver(post_save, sender=Transaction)
+def invalidate_transaction_snapshots(sender, instance, created, raw=False, **kwargs):
+    """
+    Invalidate the portfolio snapshots from the earliest date the
+    transaction affects, before or after the change.
+    """
+    if raw:
+        return
+    
+    position_ids = [instance.position_id]
+    from_date = instance.date
+    previous = None if created else getattr(instance, '_snapshot_state', None)
+    if previous is not None:
+        position_ids.append(previous['position_id'])
+        from_date = min(from_date, previous['date'])
+    
+    SnapshotService.invalidate(
+        Position.objects.filter(pk__in=position_ids).values('portfolio_id'), from_date
+    )
+
+@receiver(post_delete, sender=Transaction)
+def invalidate_deleted_transaction_snapshots(sender, instance, **kwargs):
+    """
+    Invalidate the portfolio snapshots from the date of a deleted transaction.
+    """
+    SnapshotService.invalidate(
+        Position.objects.filter(pk=instance.position_id).values('portfolio_id'), instance.date
+    )
+
+@receiver(post_save, sender=PriceData)
+def invalidate_price_snapshots(sender, instance, raw=False, **kwargs):
+    """
+    Invalidate the snapshots of portfolios holding the security from the
+    date of a new or corrected price.
+    """
+    if not raw:
+        SnapshotService.invalidate_ticker(instance.security.symbol, instance.date)
+
+@receiver(post_save, sender=Transaction)
+@receiver(post_delete, sender=Transaction)
+def invalidate_transaction_risk(sender, instance, **kwargs):
+    """
+    Drop the cached risk panels, portfolio holdings have changed.
+    """
+    RiskAnalytics.invalidate()
+
+@receiver(post_save, sender=Portfolio)
+def invalidate_portfolio_risk(sender, instance, created, raw=False, **kwargs):
+    """
+    Drop the cached risk panels, the portfolio's benchmark may have changed.
+    """
+    if not raw and not created:
+        RiskAnalytics.invalidate()
+
+@receiver(post_save, sender=PriceData)
+@receiver(post_delete, sender=PriceData)
+def invalidate_price_risk(sender, instance, **kwargs):
+    """
+    Drop the cached risk panels and price series after a price change.
+    """
+    RiskAnalytics.invalidate(prices=True)
+
+@receiver(post_save, sender=PriceData)
+@receiver(post_delete, sender=PriceData)
+def invalidate_price_covariance(sender, instance, **kwargs):
+    """
+    Drop the cached covariance matrices computed with a corrected or deleted
+    price. Prices after their last day are added incrementally.
+    """
+    CovarianceService.invalidate_security(instance.security.symbol, instance.date)
+
+@receiver(prices_stored)
+def invalidate_stored_prices(sender, first_dates, **kwargs):
+    """
+    Invalidate what depends on prices stored in bulk: the snapshots from
+    the first date written for each security, the cached risk panels and
+    price series, the stored performance of the positions holding them and
+    the covariance matrices computed with those days.
+    """
+    SnapshotService.invalidate_tickers(first_dates)
+    RiskAnalytics.invalidate(prices=True)
+    recalc.mark_positions_dirty(
+        Position.objects.filter(ticker__in=first_dates).values_list('pk', flat=True)
+    )
+    for symbol, first_date in first_dates.items():
+        CovarianceService.invalidate_security(symbol, first_date)
+
+@receiver(post_save, sender=PerformanceSettings)
+@receiver(post_delete, sender=PerformanceSettings)
+def invalidate_performance_flag(sender, instance, **kwargs):
+    """
+    Drop the cached system setting so the change applies right away.
+    """
+    flags.cache.invalidate_system('performance')
@@ -0,0 +1,232 @@
+"""
+Daily valuation snapshots of portfolios.
+
+SnapshotService stores one PortfolioSnapshot per portfolio and day (and
+optionally one PositionSnapshot per position and day) with the market value,
+net cash flow and open cost basis at the end of the day. Values come from
+PortfolioHistory, cost bases from the tax lots.
+
+The series is maintained incrementally:
+
+- roll_forward() recomputes each portfolio from its last snapshot date, so a
+  run only loads the prices and transactions of the new days. The last stored
+  day is included, replacing a forward-filled price with the actual close.
+- Back-dated changes delete the snapshots from the affected date on (see
+  invalidate() and the signal handlers), and the next roll-forward backfills
+  them from the last snapshot that is still valid.
+"""
+import logging
+from datetime import date
+from decimal import Decimal
+
+import numpy as np
+from django.db import transaction
+from django.db.models import F, FloatField, Max
+from django.db.models.functions import Cast
+
+from portfolio.models import LotAllocation, Portfolio, Position, TaxLot
+from .models import PortfolioSnapshot, PositionSnapshot
+from .returns import PortfolioHistory, _as_float, _to_days
+
+logger = logging.getLogger(__name__)
+
+
+def _to_decimal(value, places=4):
+    """Convert a float to a Decimal with a fixed number of places, None for NaN"""
+    if not np.isfinite(value):
+        return None
+    return Decimal(f"{value:.{places}f}")
+
+
+class SnapshotService:
+    """
+    Service for maintaining the daily valuation snapshots of portfolios.
+    """
+
+    BATCH_SIZE = 1000
+
+    @classmethod
+    def roll_forward(cls, portfolios=None, end_date=None, include_positions=False):
+        """
+        Bring the snapshots of portfolios up to end_date.
+
+        Args:
+            portfolios: Portfolios to update (default all)
+            end_date: Last day to snapshot (default today)
+            include_positions: Also write PositionSnapshot rows. Without it,
+                the position snapshots from the first recomputed day on are
+                deleted rather than left stale, and the next run with
+                include_positions backfills them
+
+        Returns:
+            Number of portfolio snapshots written
+        """
+        portfolios = list(Portfolio.objects.all() if portfolios is None else portfolios)
+        end_date = end_date or date.today()
+        if not portfolios:
+            return 0
+
+        start_dates = cls._get_last_dates(portfolios, include_positions)
+        histories = PortfolioHistory.build_many(portfolios, end_date, start_dates)
+        cost_bases = cls._load_cost_bases(histories, end_date)
+
+        written = 0
+        for portfolio_id, history in histories.items():
+            with transaction.atomic():
+                cls._delete_from([portfolio_id], history.start_date)
+                written += cls._write_snapshots(
+                    portfolio_id, history, cost_bases[portfolio_id], include_positions
+                )
+
+        logger.info(f"Wrote {written} portfolio snapshots for {len(histories)} portfolios up to {end_date}")
+        return written
+
+    @classmethod
+    def rebuild(cls, portfolios=None, end_date=None, include_positions=False):
+        """Delete all snapshots of the portfolios and compute them from scratch"""
+        portfolios = list(Portfolio.objects.all() if portfolios is None else portfolios)
+        PortfolioSnapshot.objects.filter(portfolio__in=portfolios).delete()
+        PositionSnapshot.objects.filter(position__portfolio__in=portfolios).delete()
+        return cls.roll_forward(portfolios, end_date, include_positions)
+
+    @classmethod
+    def invalidate(cls, portfolio_ids, from_date):
+        """
+        Delete the snapshots of portfolios from a date on, so the next
+        roll-forward rebuilds them.
+
+        Args:
+            portfolio_ids: Portfolio primary keys, or a queryset of them
+            from_date: First day whose snapshots are no longer valid
+        """
+        cls._delete_from(portfolio_ids, from_date)
+
+    @classmethod
+    def invalidate_ticker(cls, ticker, from_date):
+        """Delete the snapshots of portfolios holding a ticker from a date on"""
+        portfolio_ids = Position.objects.filter(ticker=ticker).values('portfolio_id')
+        cls.invalidate(portfolio_ids, from_date)
+
+    @classmethod
+    def invalidate_tickers(cls, first_dates):
+        """
+        Delete the snapshots of portfolios holding any of many tickers, each
+        from its own date on.
+
+        Args:
+            first_dates: Dict mapping tickers to the first day whose
+                snapshots are no longer valid
+        """
+        tickers_by_date = {}
+        for ticker, from_date in first_dates.items():
+            tickers_by_date.setdefault(from_date, []).append(ticker)
+        for from_date, tickers in tickers_by_date.items():
+            cls.invalidate(Position.objects.filter(ticker__in=tickers).values('portfolio_id'), from_date)
+
+    @staticmethod
+    def _delete_from(portfolio_ids, from_date):
+        """Delete the portfolio and position snapshots of portfolios from a date on"""
+        PortfolioSnapshot.objects.filter(portfolio__in=portfolio_ids, date__gte=from_date).delete()
+        PositionSnapshot.objects.filter(position__portfolio__in=portfolio_ids, date__gte=from_date).delete()
+
+    @staticmethod
+    def _get_last_dates(portfolios, include_positions):
+        """
+        Get the date to resume each portfolio from: its last snapshot date.
+        Portfolios without snapshots are left out and start from scratch.
+        """
+        last_dates = dict(
+            PortfolioSnapshot.objects.filter(portfolio__in=portfolios).order_by()
+            .values('portfolio_id').annotate(last_date=Max('date')).values_list('portfolio_id', 'last_date')
+        )
+        if include_positions:
+            position_dates = dict(
+                PositionSnapshot.objects.filter(position__portfolio__in=portfolios).order_by()
+                .values('position__portfolio_id').annotate(last_date=Max('date'))
+                .values_list('position__portfolio_id', 'last_date')
+            )
+            last_dates = {
+                portfolio_id: min(last_date, position_dates[portfolio_id])
+                for portfolio_id, last_date in last_dates.items()
+                if portfolio_id in position_dates
+            }
+        return last_dates
+
+    @staticmethod
+    def _load_cost_bases(histories, end_date):
+        """
+        Compute the open cost basis per day and position from the tax lots:
+        the cost of each lot from its acquisition, less the cost of the shares
+        allocated to sales from the sale date.
+
+        Returns:
+            Dict mapping portfolio_id to a days x positions array aligned with
+            the portfolio's history
+        """
+        locations = {}
+        cost_changes = {}
+        for portfolio_id, history in histories.items():
+            cost_changes[portfolio_id] = np.zeros((history.days, len(history.position_ids)))
+            for index, position_id in enumerate(history.position_ids):
+                locations[position_id] = (portfolio_id, index)
+        if not locations:
+            return cost_changes
+
+        lot_costs = TaxLot.objects.filter(
+            position__in=list(locations), acquired_date__lte=end_date
+        ).order_by().values_list(
+            'position_id', 'acquired_date', Cast(F('quantity') * F('unit_cost'), FloatField())
+        )
+        allocation_costs = LotAllocation.objects.filter(
+            lot__position__in=list(locations), sale_transaction__date__lte=end_date
+        ).order_by().values_list('lot__position_id', 'sale_transaction__date', _as_float('cost'))
+
+        for rows, sign in [(list(lot_costs), 1.0), (list(allocation_costs), -1.0)]:
+            if not rows:
+                continue
+            position_ids, dates, costs = zip(*rows)
+            for position_id, day, cost in zip(position_ids, _to_days(dates), costs):
+                portfolio_id, index = locations[position_id]
+                start_day = np.datetime64(histories[portfolio_id].start_date, 'D').astype(np.int64)
+                # Changes before the first day are part of the opening cost basis
+                cost_changes[portfolio_id][max(day - start_day, 0), index] += sign * cost
+
+        return {
+            portfolio_id: np.cumsum(changes, axis=0)
+            for portfolio_id, changes in cost_changes.items()
+        }
+
+    @classmethod
+    def _write_snapshots(cls, portfolio_id, history, cost_basis, include_positions):
+        """Store the snapshots of one portfolio history, returning the number of portfolio rows"""
+        dates = (np.datetime64(history.start_date, 'D') + np.arange(history.days)).astype(object)
+        cash_flows = history.inflows - history.outflows
+        total_costs = cost_basis.sum(axis=1)
+
+        PortfolioSnapshot.objects.bulk_create([
+            PortfolioSnapshot(
+                portfolio_id=portfolio_id,
+                date=dates[day],
+                market_value=_to_decimal(history.values[day]),
+                cash_flow=_to_decimal(cash_flows[day]),
+                cost_basis=_to_decimal(total_costs[day]),
+            )
+            for day in range(history.days)
+        ], batch_size=cls.BATCH_SIZE)
+
+        if include_positions:
+            values = np.nan_to_num(history.holdings * history.prices)
+            held = (np.abs(history.holdings) > 1e-9) | (np.abs(cost_basis) > 1e-9)
+            PositionSnapshot.objects.bulk_create([
+                PositionSnapshot(
+                    position_id=history.position_ids[index],
+                    date=dates[day],
+                    shares=_to_decimal(history.holdings[day, index], places=6),
+                    price=_to_decimal(history.prices[day, index]),
+                    market_value=_to_decimal(values[day, index]),
+                    cost_basis=_to_decimal(cost_basis[day, index]),
+                )
+                for day, index in zip(*np.nonzero(held))
+            ], batch_size=cls.BATCH_SIZE)
+
+        return history.days
@@ -1,10 +1,9 @@
 from django import template
-from django.contrib.contenttypes.models import ContentType
 from performance.models import PerformanceSettings, PerformanceMetric
 from performance.services import PerformanceService
 from performance.integration import is_feature_enabled as is_metric_calculation_enabled, PERFORMANCE_METRICS
-from django.apps import apps
 from django.conf import settings
+from users import flags
 
 register = template.Library()
 
@@ -23,14 +22,7 @@ def get_performance_system_setting():
     if 'performance' not in settings.INSTALLED_APPS:
         return False
     
-    try:
-        PerformanceSettings = apps.get_model('performance', 'PerformanceSettings')
-        settings_obj = PerformanceSettings.objects.first()
-        if settings_obj:
-            return settings_obj.updates_enabled
-        return False
-    except Exception:
-        return False
+    return flags.is_system_enabled('performance')
 
 @register.simple_tag(takes_context=True)
 def is_performance_enabled(context):
@@ -49,26 +41,18 @@ def get_performance_metric(obj, metric_name=None):
     """
     Get performance metric for an object (position, portfolio, transaction).
     
+    Objects passed through PerformanceService.attach_performance() or loaded
+    with select_related('performance_metric') are served without a query.
+    
     Args:
         obj: The object to get metrics for
-        metric_name: Optional metric name to filter by
+        metric_name: Unused, each object has a single performance metric
     
     Returns:
-        PerformanceMetric instance or queryset
+        PerformanceMetric instance or None
     """
-    content_type = ContentType.objects.get_for_model(obj)
-    
-    if metric_name:
-        return PerformanceMetric.objects.filter(
-            content_type=content_type,
-            object_id=obj.id,
-            metric_name=metric_name
-        ).first()
-    
-    return PerformanceMetric.objects.filter(
-        content_type=content_type,
-        object_id=obj.id
-    ).first()
+    # A missing related object raises a subclass of AttributeError
+    return getattr(obj, 'performance_metric', None)
 
 @register.simple_tag
 def format_gain_loss(value, include_percent=True):
@@ -131,24 +115,29 @@ def format_currency(value, symbol='$'):
 @register.simple_tag
 def calculate_position_performance(position, user=None):
     """
-    Calculate performance for a position.
+    Get the stored performance of a position.
+    
+    Reads the metric attached by the view and never recalculates while
+    rendering; metrics are recalculated when transactions are saved.
     """
-    return PerformanceService.calculate_position_performance(position, user=user)
+    return PerformanceService.get_stored_performance(position, user=user)
 
 @register.simple_tag
 def calculate_portfolio_performance(portfolio, user=None):
     """
-    Calculate performance for a portfolio.
+    Get the stored performance of a portfolio, without recalculating.
     """
-    return PerformanceService.calculate_portfolio_performance(portfolio, user=user)
+    return PerformanceService.get_stored_performance(portfolio, user=user)
 
 @register.simple_tag
 def calculate_transaction_performance(transaction, user=None):
     """
-    Calculate performance for a transaction.
+    Get the stored performance of a transaction, without recalculating.
     Only sale transactions have meaningful performance metrics.
     """
-    return PerformanceService.calculate_transaction_performance(transaction, user=user)
+    if transaction.transaction_type != 'SELL':
+        return None
+    return PerformanceService.get_stored_performance(transaction, user=user)
 
 @register.simple_tag
 def is_performance_metric(metric_name):
@@ -225,15 +214,5 @@ def can_access_performance_metrics(context):
     if not request or not request.user.is_authenticated:
         return False
     
-    # Check system settings
-    try:
-        PerformanceSettings = apps.get_model('performance', 'PerformanceSettings')
-        system_settings = PerformanceSettings.objects.first()
-        if not system_settings or not system_settings.updates_enabled:
-            return False
-    except Exception:
-        return False
-    
-    # Check user settings
-    user = request.user
-    return user.settings.performance_enabled 
\ No newline at end of file
+    # System and user settings, resolved once per request
+    return flags.is_enabled('performance', user=request.user) 
\ No newline at end of file
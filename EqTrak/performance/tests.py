@@ -1,3 +1,579 @@
+import datetime
+from decimal import Decimal
+from unittest import mock
+
+import numpy as np
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.template import Context, Template
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from market_data.models import PriceData, Security
+from metrics.models import MetricType, MetricValue
+from portfolio.models import Portfolio, Position, PositionAggregate, Transaction
+from . import recalc
+from .attribution import AttributionService
+from .covariance import CovarianceService
+from .models import PerformanceMetric, PortfolioSnapshot, PositionSnapshot
+from .returns import PortfolioHistory
+from .risk import RiskAnalytics, compute_risk_panel
+from .services import PerformanceCalculationService, PerformanceService
+from .snapshots import SnapshotService
+
+
+class PriceHistoryMixin:
+    def setUp(self):
+        user = User.objects.create_user(username='returns', password='password')
+        self.portfolio = Portfolio.objects.create(user=user, name='Returns Portfolio')
+        self.position = Position.objects.create(portfolio=self.portfolio, ticker='ABC', position_type='STOCK')
+        security = Security.objects.create(symbol='ABC', name='ABC Corp', security_type='STOCK')
+        for day, close in [(1, '100'), (2, '110'), (3, '110'), (4, '121')]:
+            PriceData.objects.create(
+                security=security, date=datetime.date(2024, 1, day), open=close, high=close,
+                low=close, close=close, adj_close=close, volume=1000
+            )
+
+    def _transact(self, transaction_type, quantity, price, day, position=None):
+        Transaction.objects.create(
+            position=position or self.position,
+            transaction_type=transaction_type,
+            quantity=Decimal(quantity),
+            price=Decimal(price),
+            date=datetime.date(2024, 1, day),
+            status='COMPLETED'
+        )
+
+
+class PortfolioHistoryTests(PriceHistoryMixin, TestCase):
+    def _history(self):
+        return PortfolioHistory.build(self.portfolio, end_date=datetime.date(2024, 1, 4))
+
+    def test_returns_ignore_cash_flows(self):
+        self._transact('BUY', '10', '100', 1)
+        self._transact('BUY', '10', '110', 3)
+        history = self._history()
+
+        self.assertEqual(list(history.values), [1000, 1100, 2200, 2420])
+        self.assertAlmostEqual(history.time_weighted_return(), 0.21)
+        # Gain of 320 over 1000 invested for 4 days and 1100 for 2 days
+        self.assertAlmostEqual(history.modified_dietz(), 320 / 1550)
+
+        rate = history.irr(annualize=False)
+        growth = (1 + rate) ** (1 / (3 / 365.25))
+        present_value = -1000 - 1100 * growth ** (-2 / 365.25) + 2420 * growth ** (-3 / 365.25)
+        self.assertAlmostEqual(present_value, 0, places=6)
+
+    def test_sale_is_measured_against_previous_close(self):
+        self._transact('BUY', '20', '110', 3)
+        self._transact('SELL', '20', '121', 4)
+        history = self._history()
+        self.assertEqual(history.values[-1], 0)
+        self.assertAlmostEqual(history.time_weighted_return(), 0.1)
+
+    def test_transaction_prices_without_market_data(self):
+        other = Position.objects.create(portfolio=self.portfolio, ticker='XYZ', position_type='STOCK')
+        self._transact('BUY', '10', '100', 1, position=other)
+        self._transact('BUY', '10', '120', 3, position=other)
+        history = self._history()
+        self.assertEqual(list(history.values), [1000, 1000, 2400, 2400])
+        self.assertAlmostEqual(history.time_weighted_return(), 2400 / 2200 - 1)
+
+    def test_service_returns_percentage(self):
+        self.assertIsNone(PerformanceService.calculate_time_weighted_return(self.portfolio))
+        self._transact('BUY', '10', '100', 1)
+        self._transact('BUY', '10', '110', 3)
+        self.assertEqual(PerformanceService.calculate_time_weighted_return(self.portfolio), Decimal('21'))
+
+
+class PortfolioSnapshotTests(PriceHistoryMixin, TestCase):
+    def _snapshots(self):
+        return [
+            (snapshot.market_value, snapshot.cash_flow, snapshot.cost_basis)
+            for snapshot in PortfolioSnapshot.get_range(self.portfolio)
+        ]
+
+    def _position_snapshots(self):
+        return list(PositionSnapshot.objects.order_by('date').values_list('date', 'shares', 'market_value', 'cost_basis'))
+
+    def test_roll_forward_resumes_from_last_snapshot(self):
+        self._transact('BUY', '10', '100', 1)
+        self._transact('BUY', '10', '110', 3)
+
+        SnapshotService.roll_forward(end_date=datetime.date(2024, 1, 2), include_positions=True)
+        self.assertEqual(PortfolioSnapshot.objects.count(), 2)
+        # Resumes from the last snapshot: 2 to 4 January
+        self.assertEqual(SnapshotService.roll_forward(end_date=datetime.date(2024, 1, 4), include_positions=True), 3)
+
+        self.assertEqual(self._snapshots(), [
+            (Decimal('1000'), Decimal('1000'), Decimal('1000')),
+            (Decimal('1100'), Decimal('0'), Decimal('1000')),
+            (Decimal('2200'), Decimal('1100'), Decimal('2100')),
+            (Decimal('2420'), Decimal('0'), Decimal('2100')),
+        ])
+        incremental = self._position_snapshots()
+        SnapshotService.rebuild(end_date=datetime.date(2024, 1, 4), include_positions=True)
+        self.assertEqual(self._position_snapshots(), incremental)
+
+    def test_roll_forward_without_positions_drops_stale_position_snapshots(self):
+        self._transact('BUY', '10', '100', 1)
+        SnapshotService.roll_forward(end_date=datetime.date(2024, 1, 2), include_positions=True)
+
+        SnapshotService.roll_forward(end_date=datetime.date(2024, 1, 4))
+        self.assertEqual([row[0] for row in self._position_snapshots()], [datetime.date(2024, 1, 1)])
+
+        SnapshotService.roll_forward(end_date=datetime.date(2024, 1, 4), include_positions=True)
+        incremental = self._position_snapshots()
+        SnapshotService.rebuild(end_date=datetime.date(2024, 1, 4), include_positions=True)
+        self.assertEqual(self._position_snapshots(), incremental)
+
+    def test_back_dated_transaction_is_backfilled(self):
+        self._transact('BUY', '10', '100', 1)
+        SnapshotService.roll_forward(end_date=datetime.date(2024, 1, 4))
+
+        self._transact('SELL', '5', '110', 2)
+        self.assertEqual(PortfolioSnapshot.objects.count(), 1)
+
+        SnapshotService.roll_forward(end_date=datetime.date(2024, 1, 4))
+        self.assertEqual(self._snapshots(), [
+            (Decimal('1000'), Decimal('1000'), Decimal('1000')),
+            (Decimal('550'), Decimal('-550'), Decimal('500')),
+            (Decimal('550'), Decimal('0'), Decimal('500')),
+            (Decimal('605'), Decimal('0'), Decimal('500')),
+        ])
+
+    def test_prices_stored_in_bulk_invalidate_snapshots(self):
+        self._transact('BUY', '10', '100', 1)
+        SnapshotService.roll_forward(end_date=datetime.date(2024, 1, 4))
+
+        security = Security.objects.get(symbol='ABC')
+        PriceData.bulk_store([PriceData(
+            security=security, date=datetime.date(2024, 1, 3), open=120, high=120, low=120,
+            close=120, adj_close=120, volume=1000
+        )])
+        self.assertEqual(PortfolioSnapshot.objects.count(), 2)
+
+        SnapshotService.roll_forward(end_date=datetime.date(2024, 1, 4))
+        self.assertEqual(self._snapshots()[2], (Decimal('1200'), Decimal('0'), Decimal('1000')))
+
+
+class RecalculationQueueTests(PriceHistoryMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        # Nothing commits inside a TestCase, start from an empty queue
+        recalc.flush()
+
+    def _position_metric(self):
+        return PerformanceMetric.objects.filter(position=self.position).first()
+
+    def test_saves_are_recalculated_once_per_commit(self):
+        with mock.patch.object(recalc, 'recalculate', wraps=recalc.recalculate) as recalculate:
+            with self.captureOnCommitCallbacks(execute=True):
+                with transaction.atomic():
+                    for day in range(1, 4):
+                        self._transact('BUY', '10', '100', day)
+                    self.assertEqual(recalculate.call_count, 0)
+
+        self.assertEqual(recalculate.call_count, 1)
+        _, position_ids, _ = recalculate.call_args.args
+        self.assertEqual(position_ids, {self.position.pk})
+        self.assertIsNotNone(self._position_metric())
+
+    def test_one_commit_callback_per_transaction(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            with transaction.atomic():
+                for day in range(1, 4):
+                    self._transact('SELL', '1', '100', day)
+        self.assertEqual(callbacks.count(recalc._get_pending().run_after_commit), 1)
+        recalc.flush()
+
+        # A savepoint rollback discards its callback, the next mark registers another
+        with self.captureOnCommitCallbacks() as callbacks:
+            try:
+                with transaction.atomic():
+                    recalc.mark_portfolio_dirty(self.portfolio.pk)
+                    raise ValueError
+            except ValueError:
+                pass
+            recalc.mark_portfolio_dirty(self.portfolio.pk)
+        self.assertEqual(callbacks.count(recalc._get_pending().run_after_commit), 1)
+
+    def test_price_writes_are_recalculated(self):
+        self._transact('BUY', '10', '100', 1)
+        recalc.flush()
+        market_price = MetricType.get_system_metric('Market Price', scope_type='POSITION')
+
+        for price in ['10', '20']:
+            with self.captureOnCommitCallbacks(execute=True):
+                MetricValue.store(MetricValue(
+                    metric_type=market_price, position=self.position, date=datetime.date(2024, 1, 4), value=price
+                ))
+            self.assertEqual(self._position_metric().current_value, Decimal(price) * 10)
+
+        with mock.patch.object(recalc, 'recalculate') as recalculate:
+            with self.captureOnCommitCallbacks(execute=True):
+                PriceData.bulk_store([PriceData(
+                    security=Security.objects.get(symbol='ABC'), date=datetime.date(2024, 1, 5), open=130,
+                    high=130, low=130, close=130, adj_close=130, volume=1000
+                )])
+        _, position_ids, _ = recalculate.call_args.args
+        self.assertEqual(position_ids, {self.position.pk})
+
+    def test_suspended_recalculation_runs_on_exit(self):
+        with mock.patch.object(recalc, 'recalculate', wraps=recalc.recalculate) as recalculate:
+            with self.captureOnCommitCallbacks(execute=True):
+                with recalc.suspend_recalculation():
+                    for day in range(1, 4):
+                        self._transact('BUY', '10', '100', day)
+                        self._transact('SELL', '5', '110', day)
+                    self.assertEqual(recalculate.call_count, 0)
+
+        self.assertEqual(recalculate.call_count, 1)
+        transaction_ids, _, _ = recalculate.call_args.args
+        self.assertEqual(len(transaction_ids), 6)
+
+
+class BulkRecalculationTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='bulk-performance', password='password')
+        market_price = MetricType.objects.get(name='Market Price', scope_type='POSITION', is_system=True)
+        for portfolio_index in range(3):
+            portfolio = Portfolio.objects.create(user=user, name=f'Portfolio {portfolio_index}')
+            for index in range(3):
+                position = Position.objects.create(portfolio=portfolio, ticker=f'T{index}', position_type='STOCK')
+                for transaction_type, quantity, price, day in [('BUY', 10, 100 + index, 1), ('BUY', 5, 90, 2),
+                                                               ('SELL', 4, 120, 3)]:
+                    Transaction.objects.create(
+                        position=position, transaction_type=transaction_type, quantity=Decimal(quantity),
+                        price=Decimal(price), fees=Decimal('1'), date=datetime.date(2024, 1, day),
+                        status='COMPLETED'
+                    )
+                MetricValue.objects.create(
+                    position=position, metric_type=market_price,
+                    date=datetime.date(2024, 1, 4), value=Decimal(110 + portfolio_index)
+                )
+
+    def _stored_metrics(self):
+        return {
+            (metric.get_target_field(), metric.position_id or metric.portfolio_id or metric.transaction_id): (
+                metric.cost_basis, metric.current_value, metric.absolute_gain_loss,
+                metric.percentage_gain_loss, metric.is_realized, metric.status_message
+            )
+            for metric in PerformanceMetric.objects.all()
+        }
+
+    def test_matches_per_object_calculation(self):
+        for position in Position.objects.all():
+            PerformanceService.calculate_position_performance(position)
+        for portfolio in Portfolio.objects.all():
+            PerformanceService.calculate_portfolio_performance(portfolio)
+        for sale in Transaction.objects.filter(transaction_type='SELL'):
+            PerformanceService.calculate_transaction_performance(sale)
+        expected = self._stored_metrics()
+
+        PerformanceMetric.objects.all().delete()
+        results = PerformanceService.calculate_all_performance(chunk_size=2)
+
+        self.assertEqual(results, {'portfolios': 3, 'positions': 9, 'transactions': 9})
+        self.assertEqual(len(expected), 21)
+        self.assertEqual(self._stored_metrics(), expected)
+    
+    def test_metrics_load_with_their_objects(self):
+        PerformanceService.calculate_all_performance()
+        
+        with self.assertNumQueries(1):
+            positions = list(Position.objects.select_related('performance_metric'))
+            self.assertEqual(len(positions), 9)
+            for position in positions:
+                self.assertEqual(position.performance_metric.position_id, position.pk)
+        
+        portfolios = list(Portfolio.objects.all())
+        with self.assertNumQueries(1):
+            PerformanceService.attach_performance(portfolios)
+        with CaptureQueriesContext(connection) as queries, \
+                mock.patch.object(PerformanceService, 'calculate_portfolio_performance') as calculate:
+            rendered = Template(
+                '{% load performance_tags %}{% for portfolio in portfolios %}'
+                '{% calculate_portfolio_performance portfolio as performance %}{{ performance.current_value }};'
+                '{% endfor %}'
+            ).render(Context({'portfolios': portfolios}))
+        calculate.assert_not_called()
+        self.assertFalse([query for query in queries if 'performancemetric' in query['sql']])
+        self.assertEqual(rendered.split(';')[:-1], [str(p.performance_metric.current_value) for p in portfolios])
+        
+        sale = Transaction.objects.filter(transaction_type='SELL').first()
+        sale_id = sale.pk
+        sale.delete()
+        self.assertFalse(PerformanceMetric.objects.filter(transaction_id=sale_id).exists())
+
+    def test_metric_providers_read_stored_metrics(self):
+        PerformanceService.calculate_all_performance()
+        positions = list(Position.objects.all())
+        portfolios = list(Portfolio.objects.all())
+        sale = Transaction.objects.filter(transaction_type='SELL').select_related('performance_metric').first()
+
+        with mock.patch.object(PerformanceService, 'calculate_positions_performance') as calculate_positions, \
+                mock.patch.object(PerformanceService, 'calculate_portfolio_performance') as calculate_portfolio, \
+                mock.patch.object(PerformanceService, 'calculate_transaction_performance') as calculate_sale:
+            gains = PerformanceCalculationService.get_positions_gain_absolute(positions)
+            returns = PerformanceCalculationService.get_portfolios_return_percentage(portfolios)
+            single = PerformanceCalculationService.get_portfolio_return_absolute(portfolios[0])
+            sale_gain = PerformanceCalculationService.get_transaction_gain_percentage(sale)
+        calculate_positions.assert_not_called()
+        calculate_portfolio.assert_not_called()
+        calculate_sale.assert_not_called()
+        self.assertEqual(sale_gain, sale.performance_metric.percentage_gain_loss)
+
+        self.assertEqual(gains, {p.pk: p.performance_metric.absolute_gain_loss for p in positions})
+        self.assertEqual(returns, {p.pk: p.performance_metric.percentage_gain_loss for p in portfolios})
+        self.assertEqual(single, portfolios[0].performance_metric.absolute_gain_loss)
+
+        PerformanceMetric.objects.filter(position__in=positions[:1]).delete()
+        gains = PerformanceCalculationService.get_positions_gain_absolute(Position.objects.all())
+        self.assertIsNone(gains[positions[0].pk])
+        self.assertFalse(PerformanceMetric.objects.filter(position=positions[0]).exists())
+
+
+class RiskAnalyticsTests(TestCase):
+    def setUp(self):
+        RiskAnalytics.invalidate(prices=True)
+        user = User.objects.create_user(username='risk', password='password')
+        self.portfolio = Portfolio.objects.create(user=user, name='Risk Portfolio')
+        self.position = Position.objects.create(portfolio=self.portfolio, ticker='RSK', position_type='STOCK')
+
+        # The stock moves twice as much as the benchmark every day
+        rng = np.random.default_rng(7)
+        self.benchmark_returns = rng.normal(0.0005, 0.01, 59)
+        self.days = [datetime.date.today() - datetime.timedelta(days=60 - day) for day in range(60)]
+        for symbol, returns in [('SPY', self.benchmark_returns), ('RSK', 2 * self.benchmark_returns)]:
+            security = Security.objects.create(symbol=symbol, name=symbol, security_type='STOCK')
+            closes = 100 * np.cumprod(np.concatenate(([1.0], 1 + returns)))
+            PriceData.objects.bulk_create([
+                PriceData(security=security, date=day, open=close, high=close, low=close,
+                          close=round(close, 4), adj_close=round(close, 4), volume=1000)
+                for day, close in zip(self.days, closes)
+            ])
+        Transaction.objects.create(
+            position=self.position, transaction_type='BUY', quantity=Decimal('10'), price=Decimal('100'),
+            date=self.days[0], status='COMPLETED'
+        )
+
+    def test_panel_matches_definitions(self):
+        levels = np.array([100, 110, 99, 105, 120, 90, 95], dtype=float)
+        with mock.patch('performance.risk.MIN_OBSERVATIONS', 2):
+            panel = compute_risk_panel(levels[:, None], levels)
+        returns = levels[1:] / levels[:-1] - 1
+
+        self.assertAlmostEqual(panel['volatility'][0], returns.std(ddof=1) * np.sqrt(252))
+        self.assertAlmostEqual(panel['max_drawdown'][0], 90 / 120 - 1)
+        self.assertAlmostEqual(panel['sharpe_ratio'][0], returns.mean() / returns.std(ddof=1) * np.sqrt(252))
+        downside = np.sqrt(np.mean(np.minimum(returns, 0) ** 2))
+        self.assertAlmostEqual(panel['sortino_ratio'][0], returns.mean() / downside * np.sqrt(252))
+        self.assertAlmostEqual(panel['beta'][0], 1)
+        self.assertAlmostEqual(panel['historical_var'][0], -np.percentile(returns, 5))
+        self.assertAlmostEqual(panel['parametric_var'][0], -(returns.mean() - 1.6448536269514722 * returns.std(ddof=1)))
+
+    def test_position_and_portfolio_panels_are_cached(self):
+        panel = RiskAnalytics.for_positions([self.position])[self.position.pk]
+        self.assertAlmostEqual(panel['beta'], 2, places=3)
+        expected_volatility = np.std(2 * self.benchmark_returns, ddof=1) * np.sqrt(252)
+        self.assertAlmostEqual(panel['volatility'], expected_volatility, places=3)
+
+        # Fully invested in the stock from the first day
+        portfolio_panel = RiskAnalytics.for_portfolios([self.portfolio])[self.portfolio.pk]
+        self.assertAlmostEqual(portfolio_panel['beta'], 2, places=3)
+        self.assertAlmostEqual(portfolio_panel['volatility'], expected_volatility, places=3)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(RiskAnalytics.for_positions([self.position])[self.position.pk], panel)
+
+        values = PerformanceCalculationService.get_risk_metric_values('volatility', [self.position, self.portfolio])
+        self.assertAlmostEqual(float(values[self.position.pk]), expected_volatility * 100, places=1)
+
+        # A new price invalidates the cached panels
+        PriceData.objects.create(
+            security=Security.objects.get(symbol='RSK'), date=datetime.date.today(), open=1, high=1, low=1,
+            close=1, adj_close=1, volume=1
+        )
+        self.assertLess(RiskAnalytics.for_positions([self.position])[self.position.pk]['max_drawdown'], -0.9)
+
+    def test_holdings_changed_in_another_process_drop_panels(self):
+        RiskAnalytics.for_portfolios([self.portfolio])
+        self.assertIn(('PORTFOLIO', self.portfolio.pk), RiskAnalytics._panels)
+
+        # A queryset update sends no signal, like a save in another process
+        PositionAggregate.objects.filter(pk=self.position.pk).update(
+            updated_at=timezone.now() + datetime.timedelta(seconds=1)
+        )
+        RiskAnalytics._token_checked_at = None
+        RiskAnalytics._get_cached('PORTFOLIO', [self.portfolio], use_cache=True)
+        self.assertNotIn(('PORTFOLIO', self.portfolio.pk), RiskAnalytics._panels)
+
+
+class CovarianceServiceTests(TestCase):
+    symbols = ['AAA', 'BBB', 'CCC']
+
+    def setUp(self):
+        CovarianceService.clear()
+        self.user = User.objects.create_user(username='covariance', password='password')
+        self.portfolio = Portfolio.objects.create(user=self.user, name='Covariance Portfolio')
+        rng = np.random.default_rng(11)
+        self.days = [datetime.date.today() - datetime.timedelta(days=50 - day) for day in range(50)]
+        self.securities = {}
+        for symbol in self.symbols:
+            Position.objects.create(portfolio=self.portfolio, ticker=symbol, position_type='STOCK')
+            security = Security.objects.create(symbol=symbol, name=symbol, security_type='STOCK')
+            self.securities[symbol] = security
+            closes = 100 * np.cumprod(1 + rng.normal(0, 0.01, len(self.days)))
+            PriceData.objects.bulk_create([
+                PriceData(security=security, date=day, open=close, high=close, low=close,
+                          close=round(close, 4), adj_close=round(close, 4), volume=1000)
+                for day, close in zip(self.days, closes)
+            ])
+
+    def expected_returns(self, window):
+        closes = np.column_stack([
+            [float(close) for close in PriceData.objects.filter(security__symbol=symbol).order_by('date')
+             .values_list('close', flat=True)]
+            for symbol in self.symbols
+        ])
+        return (closes[1:] / closes[:-1] - 1)[-window:]
+
+    def test_matrix_matches_sample_covariance_and_is_cached(self):
+        matrix = CovarianceService.for_symbols(self.symbols, window=30)
+        expected = np.cov(self.expected_returns(30).T)
+        np.testing.assert_allclose(matrix.covariance, expected)
+        np.testing.assert_allclose(matrix.correlation, np.corrcoef(self.expected_returns(30).T))
+        self.assertEqual(matrix.last_date, self.days[-1])
+
+        # Only the last price date is looked up
+        with self.assertNumQueries(1):
+            self.assertIs(CovarianceService.for_symbols(reversed(self.symbols), window=30), matrix)
+
+        shrunk = CovarianceService.for_symbols(self.symbols, window=30, shrinkage=0.5)
+        target = np.trace(expected) / 3 * np.eye(3)
+        np.testing.assert_allclose(shrunk.covariance, 0.5 * expected + 0.5 * target)
+
+    def test_new_day_of_prices_updates_incrementally(self):
+        CovarianceService.for_symbols(self.symbols, window=30, decay=0.94)
+        new_day = self.days[-1] + datetime.timedelta(days=1)
+        for symbol, security in self.securities.items():
+            PriceData.objects.create(security=security, date=new_day, open=1, high=1, low=1,
+                                     close=Decimal('101.5'), adj_close=Decimal('101.5'), volume=1)
+
+        with mock.patch.object(CovarianceService, '_build', side_effect=AssertionError):
+            matrix = CovarianceService.for_symbols(self.symbols, window=30, decay=0.94)
+        self.assertEqual(matrix.last_date, new_day)
+
+        weights = 0.94 ** np.arange(29, -1, -1)
+        expected = np.cov(self.expected_returns(30).T, aweights=weights)
+        np.testing.assert_allclose(matrix.covariance, expected)
+
+        # Correcting a price within the window recomputes the matrix
+        PriceData.objects.filter(security__symbol='AAA', date=self.days[-5]).get().save()
+        with mock.patch.object(CovarianceService, '_build', wraps=CovarianceService._build) as build:
+            CovarianceService.for_symbols(self.symbols, window=30, decay=0.94)
+        build.assert_called_once()
+
+    def test_build_interrupted_by_invalidation_is_not_cached(self):
+        build = CovarianceService._build
+
+        def build_during_correction(*args):
+            entry = build(*args)
+            CovarianceService.invalidate_security('AAA', self.days[-5])
+            return entry
+
+        with mock.patch.object(CovarianceService, '_build', side_effect=build_during_correction):
+            matrix = CovarianceService.for_symbols(self.symbols, window=30)
+        self.assertIsNotNone(matrix)
+        self.assertIsNot(CovarianceService.for_symbols(self.symbols, window=30), matrix)
+
+    def test_portfolio_correlation_api(self):
+        self.client.login(username='covariance', password='password')
+        url = reverse('performance:api_portfolio_correlation', args=[self.portfolio.pk])
+        response = self.client.get(url, {'window': 20, 'shrinkage': 'auto'})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['symbols'], self.symbols)
+        self.assertEqual(data['observations'], 20)
+        self.assertEqual([data['correlation'][i][i] for i in range(3)], [1.0, 1.0, 1.0])
+
+        response = self.client.get(url, {'decay': 2})
+        self.assertEqual(response.status_code, 400)
+
+        # Only the API is routed, not the performance pages or the recalculation
+        with mock.patch.object(PerformanceService, 'calculate_all_performance') as calculate:
+            self.assertEqual(self.client.get('/performance/recalculate/').status_code, 404)
+        calculate.assert_not_called()
+        self.assertEqual(self.client.get(f'/performance/portfolio/{self.portfolio.pk}/').status_code, 404)
+
+
+
+class AttributionTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='attribution', password='password')
+        rng = np.random.default_rng(5)
+        self.days = [datetime.date.today() - datetime.timedelta(days=40 - day) for day in range(41)]
+        self.closes = {}
+        securities = {}
+        for symbol, security_type in [('SPY', 'etf'), ('STK', 'stock'), ('FND', 'etf')]:
+            securities[symbol] = Security.objects.create(symbol=symbol, name=symbol, security_type=security_type)
+            closes = np.round(100 * np.cumprod(1 + rng.normal(0.001, 0.01, len(self.days))), 4)
+            self.closes[symbol] = closes
+            PriceData.objects.bulk_create([
+                PriceData(security=securities[symbol], date=day, open=close, high=close, low=close,
+                          close=close, adj_close=close, volume=1000)
+                for day, close in zip(self.days, closes)
+            ])
+        self.portfolio = Portfolio.objects.create(user=user, name='Attribution Portfolio', benchmark=securities['SPY'])
+        for symbol, tag, quantity in [('STK', 'growth', 30), ('FND', 'core', 70)]:
+            position = Position.objects.create(portfolio=self.portfolio, ticker=symbol, position_type='STOCK', tag=tag)
+            Transaction.objects.create(
+                position=position, transaction_type='BUY', quantity=Decimal(quantity),
+                price=Decimal(str(self.closes[symbol][0])), date=self.days[0], status='COMPLETED'
+            )
+        SnapshotService.roll_forward([self.portfolio])
+
+    def expected(self):
+        values = 30 * self.closes['STK'] + 70 * self.closes['FND']
+        benchmark = self.closes['SPY']
+        active = np.diff(values) / values[:-1] - np.diff(benchmark) / benchmark[:-1]
+        tracking_error = np.std(active, ddof=1) * np.sqrt(252)
+        return values[-1] / values[0] - benchmark[-1] / benchmark[0], tracking_error, active.mean() * 252 / tracking_error
+
+    def test_effects_add_up_to_active_return(self):
+        active_return, tracking_error, information_ratio = self.expected()
+        result = AttributionService.analyze([self.portfolio])[self.portfolio.pk]
+
+        self.assertEqual(result['benchmark'], 'SPY')
+        self.assertAlmostEqual(result['active_return'], active_return)
+        self.assertAlmostEqual(result['tracking_error'], tracking_error)
+        self.assertAlmostEqual(result['information_ratio'], information_ratio)
+        self.assertAlmostEqual(result['allocation'] + result['selection'], active_return)
+        self.assertEqual(set(result['segments']), {'stock', 'etf'})
+        self.assertEqual(result['segments']['etf']['benchmark_weight'], 1)
+
+        self.portfolio.attribution_group = 'TAG'
+        result = AttributionService.analyze([self.portfolio])[self.portfolio.pk]
+        self.assertEqual(set(result['segments']), {'growth', 'core', 'benchmark'})
+        self.assertAlmostEqual(result['allocation'] + result['selection'], active_return)
+
+    def test_nightly_run_stores_metric_values(self):
+        for name in ['Active Return', 'Tracking Error', 'Information Ratio', 'Allocation Effect', 'Selection Effect']:
+            MetricType.objects.create(name=name, scope_type='PORTFOLIO', data_type='PERCENTAGE', is_system=True)
+        results = AttributionService.run_nightly()
+        self.assertEqual(results, {'portfolios': 1, 'values': 5})
+
+        active_return, _, _ = self.expected()
+        value = MetricValue.objects.get(
+            metric_type__name='Active Return', portfolio=self.portfolio, date=datetime.date.today()
+        )
+        self.assertAlmostEqual(float(value.value), active_return * 100, places=4)
 
-# Create your tests here.
+        self.client.login(username='attribution', password='password')
+        response = self.client.get(reverse('performance:api_portfolio_attribution', args=[self.portfolio.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertAlmostEqual(response.json()['active_return'], active_return)
@@ -3,6 +3,15 @@ from . import views
 
 app_name = 'performance'
 
+# API endpoints, the only routes mounted in the root URLconf
+api_urlpatterns = [
+    path('api/position/<uuid:position_id>/', views.api_position_performance, name='api_position'),
+    path('api/portfolio/<uuid:portfolio_id>/correlation/', views.api_portfolio_correlation,
+         name='api_portfolio_correlation'),
+    path('api/portfolio/<uuid:portfolio_id>/attribution/', views.api_portfolio_attribution,
+         name='api_portfolio_attribution'),
+]
+
 urlpatterns = [
     # Main performance dashboard
     path('', views.performance_dashboard, name='dashboard'),
@@ -20,7 +29,4 @@ urlpatterns = [
     
     # Recalculate all metrics
     path('recalculate/', views.recalculate_all, name='recalculate'),
-    
-    # API endpoints
-    path('api/position/<uuid:position_id>/', views.api_position_performance, name='api_position'),
-] 
\ No newline at end of file
+] + api_urlpatterns
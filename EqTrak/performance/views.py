@@ -3,6 +3,8 @@ from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.http import JsonResponse
 from portfolio.models import Portfolio, Position, Transaction
+from .attribution import AttributionService
+from .covariance import DEFAULT_WINDOW, CovarianceService
 from .models import PerformanceMetric, PerformanceSettings
 from .services import PerformanceService
 
@@ -16,12 +18,8 @@ def performance_dashboard(request):
         messages.warning(request, "Performance tracking is currently disabled. Please enable it in your settings.")
         return redirect('portfolio:home')
     
-    # Get user's portfolios
-    portfolios = Portfolio.objects.filter(user=request.user)
-    
-    # Calculate performance for each portfolio
-    for portfolio in portfolios:
-        PerformanceService.calculate_portfolio_performance(portfolio, user=request.user)
+    # Get user's portfolios with their stored performance
+    portfolios = PerformanceService.attach_performance(Portfolio.objects.filter(user=request.user))
     
     context = {
         'portfolios': portfolios,
@@ -42,15 +40,11 @@ def portfolio_performance(request, portfolio_id):
     
     portfolio = get_object_or_404(Portfolio, portfolio_id=portfolio_id, user=request.user)
     
-    # Calculate latest performance metrics
-    performance = PerformanceService.calculate_portfolio_performance(portfolio, user=request.user)
-    
-    # Get all positions in this portfolio
-    positions = portfolio.position_set.all()
+    # Stored metrics, kept current by the recalculation queue
+    performance = PerformanceService.get_stored_performance(portfolio, user=request.user)
     
-    # Calculate performance for each position
-    for position in positions:
-        PerformanceService.calculate_position_performance(position, user=request.user)
+    # Get all positions in this portfolio with their stored performance
+    positions = PerformanceService.attach_performance(portfolio.position_set.all())
     
     context = {
         'portfolio': portfolio,
@@ -74,15 +68,11 @@ def position_performance(request, portfolio_id, position_id):
     portfolio = get_object_or_404(Portfolio, portfolio_id=portfolio_id, user=request.user)
     position = get_object_or_404(Position, position_id=position_id, portfolio=portfolio)
     
-    # Calculate latest performance metrics
-    performance = PerformanceService.calculate_position_performance(position, user=request.user)
-    
-    # Get transactions for this position
-    transactions = position.transaction_set.filter(transaction_type='SELL')
+    # Stored metrics, kept current by the recalculation queue
+    performance = PerformanceService.get_stored_performance(position, user=request.user)
     
-    # Calculate performance for each transaction
-    for transaction in transactions:
-        PerformanceService.calculate_transaction_performance(transaction, user=request.user)
+    # Get sales of this position with their stored performance
+    transactions = PerformanceService.attach_performance(position.transaction_set.filter(transaction_type='SELL'))
     
     context = {
         'portfolio': portfolio,
@@ -113,8 +103,8 @@ def transaction_performance(request, portfolio_id, position_id, transaction_id):
         messages.info(request, "Performance metrics are only available for sell transactions.")
         return redirect('portfolio:transaction_detail', portfolio_id=portfolio_id, position_id=position_id, transaction_id=transaction_id)
     
-    # Calculate latest performance metrics
-    performance = PerformanceService.calculate_transaction_performance(transaction, user=request.user)
+    # Stored metrics, kept current by the recalculation queue
+    performance = PerformanceService.get_stored_performance(transaction, user=request.user)
     
     context = {
         'portfolio': portfolio,
@@ -165,11 +155,11 @@ def api_position_performance(request, position_id):
         if position.portfolio.user != request.user:
             return JsonResponse({'error': 'Access denied'}, status=403)
         
-        # Calculate performance
-        performance = PerformanceService.calculate_position_performance(position, user=request.user)
+        # Stored performance, kept current by the recalculation queue
+        performance = PerformanceService.get_stored_performance(position, user=request.user)
         
         if not performance:
-            return JsonResponse({'error': 'Failed to calculate performance'}, status=500)
+            return JsonResponse({'error': 'Performance has not been calculated yet'}, status=404)
         
         # Return performance data
         return JsonResponse({
@@ -182,3 +172,57 @@ def api_position_performance(request, position_id):
         })
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
+
+@login_required
+def api_portfolio_correlation(request, portfolio_id):
+    """
+    API endpoint to get the return covariance and correlation of a portfolio's
+    holdings, with the portfolio volatility they imply for current values.
+    
+    Query parameters:
+        window: Trading days of returns (default 252)
+        decay: Optional daily decay factor of exponential weighting, e.g. 0.94
+        shrinkage: Optional shrinkage intensity between 0 and 1, or 'auto'
+    """
+    # Check if performance feature is enabled
+    if not PerformanceService.is_performance_enabled(user=request.user):
+        return JsonResponse({'error': 'Performance tracking is disabled'}, status=403)
+    
+    portfolio = get_object_or_404(Portfolio, portfolio_id=portfolio_id, user=request.user)
+    
+    try:
+        window = int(request.GET.get('window', DEFAULT_WINDOW))
+        decay = float(request.GET['decay']) if request.GET.get('decay') else None
+        shrinkage = request.GET.get('shrinkage') or None
+        if shrinkage is not None and shrinkage != 'auto':
+            shrinkage = float(shrinkage)
+        matrix = CovarianceService.for_portfolio(portfolio, window=window, decay=decay, shrinkage=shrinkage)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    
+    if matrix is None:
+        return JsonResponse({'error': 'No price history for this portfolio'}, status=404)
+    
+    # Weight the holdings by their stored current values
+    values = {}
+    for ticker, current_value in PerformanceMetric.objects.filter(
+        position__portfolio=portfolio, position__is_active=True
+    ).values_list('position__ticker', 'current_value'):
+        values[ticker] = values.get(ticker, 0) + float(current_value)
+    
+    data = matrix.to_dict()
+    data['volatility'] = matrix.volatility(values)
+    return JsonResponse(data)
+
+@login_required
+def api_portfolio_attribution(request, portfolio_id):
+    """
+    API endpoint to get a portfolio's performance relative to its benchmark,
+    with the attribution of the active return to each segment.
+    """
+    # Check if performance feature is enabled
+    if not PerformanceService.is_performance_enabled(user=request.user):
+        return JsonResponse({'error': 'Performance tracking is disabled'}, status=403)
+    
+    portfolio = get_object_or_404(Portfolio.objects.select_related('benchmark'), portfolio_id=portfolio_id, user=request.user)
+    return JsonResponse(AttributionService.analyze([portfolio])[portfolio.pk])
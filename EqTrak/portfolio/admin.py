@@ -3,15 +3,17 @@ from .models import Portfolio, Position, Transaction
 
 @admin.register(Portfolio)
 class PortfolioAdmin(admin.ModelAdmin):
-    list_display = ('name', 'user', 'currency', 'is_active', 'created_at')
+    list_display = ('name', 'user', 'currency', 'benchmark', 'is_active', 'created_at')
     list_filter = ('is_active', 'currency')
+    list_select_related = ('user', 'benchmark')
+    raw_id_fields = ('benchmark',)
     search_fields = ('name', 'user__username')
 
 @admin.register(Position)
 class PositionAdmin(admin.ModelAdmin):
-    list_display = ('ticker', 'portfolio', 'position_type', 'is_active')
+    list_display = ('ticker', 'portfolio', 'position_type', 'tag', 'is_active')
     list_filter = ('position_type', 'is_active', 'portfolio')
-    search_fields = ('ticker', 'portfolio__name')
+    search_fields = ('ticker', 'tag', 'portfolio__name')
 
 @admin.register(Transaction)
 class TransactionAdmin(admin.ModelAdmin):
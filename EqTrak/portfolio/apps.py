@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class PortfolioConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'portfolio'
+
+    def ready(self):
+        """Connect the position aggregate and tax lot signals"""
+        import portfolio.signals
@@ -4,18 +4,26 @@ from .models import Portfolio, Position, Transaction
 class PortfolioForm(forms.ModelForm):
     class Meta:
         model = Portfolio
-        fields = ['name', 'description', 'currency']
+        fields = ['name', 'description', 'currency', 'cost_basis_method', 'benchmark', 'attribution_group']
         widgets = {
             'description': forms.Textarea(attrs={'rows': 3}),
+            'cost_basis_method': forms.Select(attrs={'class': 'form-select'}),
+            'benchmark': forms.Select(attrs={'class': 'form-select'}),
+            'attribution_group': forms.Select(attrs={'class': 'form-select'}),
         }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['benchmark'].queryset = self.fields['benchmark'].queryset.filter(active=True).order_by('symbol')
+
 class PositionForm(forms.ModelForm):
     class Meta:
         model = Position
-        fields = ['ticker', 'position_type']
+        fields = ['ticker', 'position_type', 'tag']
         widgets = {
             'ticker': forms.TextInput(attrs={'class': 'form-control'}),
             'position_type': forms.Select(attrs={'class': 'form-control'}),
+            'tag': forms.TextInput(attrs={'class': 'form-control'}),
         }
 
 class TransactionForm(forms.ModelForm):
@@ -0,0 +1,447 @@
+"""
+Tax lot engine.
+
+Every completed BUY opens a TaxLot and every completed SELL is matched against
+the open lots of its position according to the portfolio's cost basis method
+(FIFO, LIFO, HIFO or specific identification), producing LotAllocation rows
+with the cost and proceeds of each matched part.
+
+New sales dated after all existing lots and sales are matched incrementally:
+the open lots are read in the method's order in chunks, stopping as soon as the
+sale is filled. Anything that can change earlier matches (back-dated
+transactions, edits, deletes, a change of method) replays the position's
+history with rebuild(), which keeps the open lots in a heap ordered for the
+method, so each match costs O(log n) in the number of open lots.
+"""
+import heapq
+import itertools
+import logging
+from decimal import Decimal
+
+from django.db import transaction as db_transaction
+from django.db.models import F, Sum
+
+from .models import LotAllocation, Position, PositionAggregate, TaxLot, Transaction
+
+logger = logging.getLogger(__name__)
+
+
+class OpenLotIndex:
+    """
+    Open lots of one position, ordered by a cost basis method.
+
+    Lots are held in a heap keyed by the method's ordering and in a dict by
+    buy transaction for specific identification. Lots consumed out of heap
+    order are dropped lazily when they reach the top.
+    """
+
+    def __init__(self, method, lots=()):
+        self.method = method
+        self._heap = []
+        self._lots = {}
+        self._counter = itertools.count()
+        for lot in lots:
+            self.push(lot)
+
+    def __len__(self):
+        return len(self._lots)
+
+    def _sort_key(self, lot):
+        """Heap key of a lot: smallest first is matched first"""
+        acquired = (lot.acquired_date.toordinal(), lot.opened_at.timestamp())
+        if self.method == 'LIFO':
+            return (-acquired[0], -acquired[1])
+        elif self.method == 'HIFO':
+            return (-lot.unit_cost,) + acquired
+        # FIFO, and the default order for unspecified parts of specific-ID sales
+        return acquired
+
+    def push(self, lot):
+        """Add an open lot"""
+        self._lots[lot.buy_transaction_id] = lot
+        heapq.heappush(self._heap, (self._sort_key(lot), next(self._counter), lot))
+
+    def _discard_closed(self):
+        """Drop closed lots from the top of the heap"""
+        while self._heap and self._heap[0][2].remaining_quantity <= 0:
+            heapq.heappop(self._heap)
+
+    def allocate(self, quantity, specified=()):
+        """
+        Consume shares from the open lots.
+
+        Args:
+            quantity: Number of shares sold
+            specified: Iterable of (buy_transaction_id, quantity) pairs to
+                consume first, for specific identification
+
+        Returns:
+            Tuple of (list of (lot, quantity, is_specified), unmatched quantity)
+        """
+        remaining = quantity
+        matches = []
+
+        for buy_transaction_id, wanted in specified:
+            lot = self._lots.get(buy_transaction_id)
+            if lot is None or remaining <= 0:
+                continue
+            taken = min(wanted, lot.remaining_quantity, remaining)
+            if taken <= 0:
+                continue
+            lot.remaining_quantity -= taken
+            remaining -= taken
+            matches.append((lot, taken, True))
+            if lot.remaining_quantity <= 0:
+                del self._lots[buy_transaction_id]
+
+        self._discard_closed()
+        while remaining > 0 and self._heap:
+            lot = self._heap[0][2]
+            taken = min(lot.remaining_quantity, remaining)
+            lot.remaining_quantity -= taken
+            remaining -= taken
+            matches.append((lot, taken, False))
+            if lot.remaining_quantity <= 0:
+                heapq.heappop(self._heap)
+                self._lots.pop(lot.buy_transaction_id, None)
+                self._discard_closed()
+
+        return matches, remaining
+
+    def open_cost(self):
+        """Total cost of the shares still held"""
+        return sum((lot.open_cost for lot in self._lots.values()), Decimal('0'))
+
+
+class TaxLotEngine:
+    """Maintains TaxLot and LotAllocation rows for positions"""
+
+    # Order in which each method consumes open lots, as in OpenLotIndex, and
+    # served by the TaxLot indexes
+    LOT_ORDERINGS = {
+        'FIFO': ('acquired_date', 'opened_at', 'lot_id'),
+        'LIFO': ('-acquired_date', '-opened_at', '-lot_id'),
+        'HIFO': ('-unit_cost', 'acquired_date', 'opened_at', 'lot_id'),
+    }
+
+    # Number of open lots read at a time when matching a sale
+    MATCH_CHUNK_SIZE = 100
+
+    @staticmethod
+    def _get_method(position_id):
+        """Get the cost basis method of a position's portfolio"""
+        return Position.objects.filter(pk=position_id).values_list(
+            'portfolio__cost_basis_method', flat=True
+        ).first() or 'FIFO'
+
+    @staticmethod
+    def _new_lot(buy):
+        """Build (unsaved) the lot opened by a BUY transaction"""
+        fees = buy.fees or 0
+        return TaxLot(
+            position_id=buy.position_id,
+            buy_transaction=buy,
+            acquired_date=buy.date,
+            opened_at=buy.created_at,
+            quantity=buy.quantity,
+            remaining_quantity=buy.quantity,
+            unit_cost=(buy.quantity * buy.price + fees) / buy.quantity if buy.quantity else buy.price
+        )
+
+    @staticmethod
+    def _new_allocations(sale, matches):
+        """Build (unsaved) the allocations of a sale from lot matches"""
+        fees = sale.fees or 0
+        allocations = []
+        for lot, quantity, is_specified in matches:
+            fee_share = fees * quantity / sale.quantity if sale.quantity else 0
+            allocations.append(LotAllocation(
+                sale_transaction=sale,
+                lot=lot,
+                quantity=quantity,
+                cost=quantity * lot.unit_cost,
+                proceeds=quantity * sale.price - fee_share,
+                is_specified=is_specified
+            ))
+        return allocations
+
+    @classmethod
+    def _iter_open_lots(cls, position_id, method):
+        """
+        Yield the open lots of a position in the order the method consumes
+        them, reading MATCH_CHUNK_SIZE lots per query. The lots read are
+        locked until the end of the enclosing transaction.
+        """
+        # Unspecified parts of specific-ID sales are matched first in, first out
+        ordering = cls.LOT_ORDERINGS.get(method, cls.LOT_ORDERINGS['FIFO'])
+        open_lots = TaxLot.objects.select_for_update().filter(
+            position_id=position_id, remaining_quantity__gt=0
+        ).order_by(*ordering)
+        offset = 0
+        while True:
+            chunk = list(open_lots[offset:offset + cls.MATCH_CHUNK_SIZE])
+            yield from chunk
+            if len(chunk) < cls.MATCH_CHUNK_SIZE:
+                return
+            offset += cls.MATCH_CHUNK_SIZE
+
+    @staticmethod
+    def _is_built(position_id):
+        """Whether the lots of a position have been built"""
+        return PositionAggregate.objects.filter(position_id=position_id, open_cost__isnull=False).exists()
+
+    @staticmethod
+    def _set_open_cost(position_id, open_cost):
+        """Store the open lot cost on the position's running totals"""
+        if not PositionAggregate.objects.filter(position_id=position_id).update(open_cost=open_cost):
+            PositionAggregate.rebuild(Position.objects.filter(pk=position_id))
+            PositionAggregate.objects.filter(position_id=position_id).update(open_cost=open_cost)
+
+    @classmethod
+    def record_transaction(cls, transaction):
+        """
+        Update the lots of a position for a newly created transaction.
+
+        Appended buys and sales are applied incrementally; anything that could
+        change earlier matches rebuilds the position.
+        """
+        if transaction.status != 'COMPLETED' or transaction.transaction_type not in ('BUY', 'SELL'):
+            return
+
+        position_id = transaction.position_id
+        if not cls._is_built(position_id):
+            cls.rebuild(position_id)
+            return
+
+        # Later sales without allocations (e.g. of more shares than were
+        # held) are matched again too
+        later_sales = Transaction.objects.filter(
+            position_id=position_id,
+            status='COMPLETED',
+            transaction_type='SELL',
+            date__gt=transaction.date
+        )
+        if transaction.transaction_type == 'BUY':
+            if later_sales.exists():
+                cls.rebuild(position_id)
+            else:
+                cls.open_lot(transaction)
+        else:
+            later_lots = TaxLot.objects.filter(position_id=position_id, acquired_date__gt=transaction.date)
+            if later_sales.exists() or later_lots.exists():
+                cls.rebuild(position_id)
+            else:
+                cls.match_sale(transaction)
+
+    @classmethod
+    def open_lot(cls, buy):
+        """Open a lot for a BUY transaction dated after all existing sales"""
+        lot = cls._new_lot(buy)
+        lot.save()
+        PositionAggregate.objects.filter(position_id=buy.position_id).update(
+            open_cost=F('open_cost') + lot.open_cost
+        )
+        return lot
+
+    @classmethod
+    def match_sale(cls, sale, specified=()):
+        """
+        Match a SELL transaction dated after all existing lots and sales.
+
+        Args:
+            sale: Completed SELL transaction
+            specified: Optional (buy_transaction_id, quantity) pairs to consume first
+
+        Returns:
+            List of created LotAllocation instances
+        """
+        # Concurrent sales of the position wait for the lots read here
+        with db_transaction.atomic():
+            remaining = sale.quantity
+            matches = []
+
+            specified = list(specified)
+            chosen = {}
+            if specified:
+                chosen = {
+                    lot.buy_transaction_id: lot
+                    for lot in TaxLot.objects.select_for_update().filter(
+                        position_id=sale.position_id, remaining_quantity__gt=0,
+                        buy_transaction_id__in=[buy_transaction_id for buy_transaction_id, _ in specified]
+                    )
+                }
+            for buy_transaction_id, wanted in specified:
+                lot = chosen.get(buy_transaction_id)
+                if lot is None or remaining <= 0:
+                    continue
+                taken = min(wanted, lot.remaining_quantity, remaining)
+                if taken <= 0:
+                    continue
+                lot.remaining_quantity -= taken
+                remaining -= taken
+                matches.append((lot, taken, True))
+
+            # Only the lots needed to fill the sale are read
+            if remaining > 0:
+                for lot in cls._iter_open_lots(sale.position_id, cls._get_method(sale.position_id)):
+                    lot = chosen.get(lot.buy_transaction_id, lot)
+                    taken = min(lot.remaining_quantity, remaining)
+                    if taken <= 0:
+                        continue
+                    lot.remaining_quantity -= taken
+                    remaining -= taken
+                    matches.append((lot, taken, False))
+                    if remaining <= 0:
+                        break
+            if remaining > 0:
+                logger.warning(f"Sale {sale.transaction_id} exceeds the open lots of its position by {remaining} shares")
+
+            allocations = cls._new_allocations(sale, matches)
+            changed_lots = {lot.pk: lot for lot, _, _ in matches}
+            TaxLot.objects.bulk_update(list(changed_lots.values()), ['remaining_quantity'])
+            LotAllocation.objects.bulk_create(allocations)
+            PositionAggregate.objects.filter(position_id=sale.position_id).update(
+                open_cost=F('open_cost') - sum((allocation.cost for allocation in allocations), Decimal('0'))
+            )
+            return allocations
+
+    @classmethod
+    def rebuild(cls, position_id):
+        """
+        Replay the completed buys and sells of a position and rewrite its lots.
+
+        Explicit lot choices of specific-ID sales are kept.
+
+        Args:
+            position_id: Primary key of the position
+
+        Returns:
+            Cost of the open lots after the replay
+        """
+        specified = {}
+        for sale_id, buy_id, quantity in LotAllocation.objects.filter(
+            sale_transaction__position_id=position_id, is_specified=True
+        ).values_list('sale_transaction_id', 'lot__buy_transaction_id', 'quantity'):
+            specified.setdefault(sale_id, []).append((buy_id, quantity))
+
+        transactions = Transaction.objects.filter(
+            position_id=position_id,
+            status='COMPLETED',
+            transaction_type__in=['BUY', 'SELL']
+        ).order_by('date', 'created_at')
+
+        index = OpenLotIndex(cls._get_method(position_id))
+        lots = []
+        allocations = []
+        for transaction in transactions:
+            if transaction.transaction_type == 'BUY':
+                lot = cls._new_lot(transaction)
+                lots.append(lot)
+                index.push(lot)
+            else:
+                matches, unmatched = index.allocate(transaction.quantity, specified.get(transaction.pk, ()))
+                if unmatched > 0:
+                    logger.warning(
+                        f"Sale {transaction.transaction_id} exceeds the open lots of its position by {unmatched} shares"
+                    )
+                allocations.extend(cls._new_allocations(transaction, matches))
+
+        open_cost = index.open_cost()
+        with db_transaction.atomic():
+            TaxLot.objects.filter(position_id=position_id).delete()
+            TaxLot.objects.bulk_create(lots, batch_size=500)
+            LotAllocation.objects.bulk_create(allocations, batch_size=500)
+            cls._set_open_cost(position_id, open_cost)
+        return open_cost
+
+    @classmethod
+    def rebuild_portfolio(cls, portfolio):
+        """Rebuild the lots of every position of a portfolio"""
+        for position_id in portfolio.position_set.values_list('position_id', flat=True):
+            cls.rebuild(position_id)
+
+    @classmethod
+    def specify_lots(cls, sale, selections):
+        """
+        Choose the lots a sale consumes (specific identification).
+
+        Args:
+            sale: Completed SELL transaction
+            selections: Iterable of (buy_transaction_id, quantity) pairs; any
+                quantity not covered is matched in FIFO order
+        """
+        with db_transaction.atomic():
+            LotAllocation.objects.filter(sale_transaction=sale).delete()
+            lots = {
+                lot.buy_transaction_id: lot
+                for lot in TaxLot.objects.filter(position_id=sale.position_id)
+            }
+            # Placeholder allocations record the choice; rebuild() replays them
+            LotAllocation.objects.bulk_create([
+                LotAllocation(
+                    sale_transaction=sale, lot=lots[buy_transaction_id], quantity=quantity,
+                    cost=0, proceeds=0, is_specified=True
+                )
+                for buy_transaction_id, quantity in selections
+                if buy_transaction_id in lots
+            ])
+            cls.rebuild(sale.position_id)
+
+    @classmethod
+    def get_sale_totals(cls, sale):
+        """
+        Get the matched cost and net proceeds of a SELL transaction.
+
+        Builds the position's lots first if the sale has not been matched yet.
+
+        Returns:
+            Tuple of (cost, proceeds), or (None, None) if nothing was matched
+        """
+        totals = sale.lot_allocations.aggregate(cost=Sum('cost'), proceeds=Sum('proceeds'))
+        if totals['cost'] is None and sale.status == 'COMPLETED':
+            cls.rebuild(sale.position_id)
+            totals = sale.lot_allocations.aggregate(cost=Sum('cost'), proceeds=Sum('proceeds'))
+        return totals['cost'], totals['proceeds']
+
+    @classmethod
+    def get_sales_totals(cls, sales):
+        """
+        Get the matched cost and net proceeds of many SELL transactions with
+        one query.
+
+        Positions with completed sales that have not been matched yet are
+        rebuilt first, as in get_sale_totals().
+
+        Returns:
+            Dict mapping transaction_id to (cost, proceeds); sales without
+            allocations are left out
+        """
+        sales = list(sales)
+        if not sales:
+            return {}
+
+        def load_totals():
+            return {
+                row['sale_transaction_id']: (row['cost'], row['proceeds'])
+                for row in LotAllocation.objects.filter(
+                    sale_transaction__in=[sale.pk for sale in sales]
+                ).order_by().values('sale_transaction_id').annotate(cost=Sum('cost'), proceeds=Sum('proceeds'))
+            }
+
+        totals = load_totals()
+        unmatched = {sale.position_id for sale in sales if sale.pk not in totals and sale.status == 'COMPLETED'}
+        if unmatched:
+            for position_id in unmatched:
+                cls.rebuild(position_id)
+            totals = load_totals()
+        return totals
+
+    @staticmethod
+    def get_realized_gain(position):
+        """Total realized gain or loss of a position's matched sales"""
+        totals = LotAllocation.objects.filter(lot__position=position).aggregate(
+            cost=Sum('cost'), proceeds=Sum('proceeds')
+        )
+        if totals['cost'] is None:
+            return Decimal('0')
+        return totals['proceeds'] - totals['cost']
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.apps import apps
+import logging
+
+from portfolio.lots import TaxLotEngine
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Recompute the running totals and tax lots of positions from their transactions'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--portfolio',
+            help='Only rebuild the positions of this portfolio ID',
+        )
+
+    def handle(self, *args, **options):
+        Position = apps.get_model('portfolio', 'Position')
+        PositionAggregate = apps.get_model('portfolio', 'PositionAggregate')
+        
+        positions = Position.objects.all()
+        if options.get('portfolio'):
+            positions = positions.filter(portfolio_id=options['portfolio'])
+        
+        aggregate_count = PositionAggregate.rebuild(positions)
+        
+        # Rebuilding the totals resets the open lot cost, match the lots again
+        for position_id in positions.values_list('position_id', flat=True):
+            TaxLotEngine.rebuild(position_id)
+        
+        self.stdout.write(self.style.SUCCESS(
+            f'Successfully rebuilt {aggregate_count} position aggregates and their tax lots.'
+        ))
+        logger.info(f'Rebuilt {aggregate_count} position aggregates and their tax lots')
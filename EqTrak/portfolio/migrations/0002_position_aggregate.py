@@ -0,0 +1,60 @@
+# Generated by Django 4.2.10 on 2026-10-18 01:33
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import ExpressionWrapper, F, Max, Q, Sum
+
+
+def populate_position_aggregates(apps, schema_editor):
+    """Compute the running totals of existing positions from their transactions"""
+    Position = apps.get_model('portfolio', 'Position')
+    PositionAggregate = apps.get_model('portfolio', 'PositionAggregate')
+
+    completed = Q(transaction__status='COMPLETED')
+    buys = completed & Q(transaction__transaction_type='BUY')
+    sells = completed & Q(transaction__transaction_type='SELL')
+    amount_field = models.DecimalField(max_digits=30, decimal_places=8)
+    trade_amount = ExpressionWrapper(F('transaction__quantity') * F('transaction__price'), output_field=amount_field)
+
+    rows = Position.objects.order_by().annotate(
+        bought=Sum('transaction__quantity', filter=buys, output_field=amount_field),
+        sold=Sum('transaction__quantity', filter=sells, output_field=amount_field),
+        buy_cost=Sum(trade_amount + F('transaction__fees'), filter=buys, output_field=amount_field),
+        sell_proceeds=Sum(trade_amount - F('transaction__fees'), filter=sells, output_field=amount_field),
+        last_date=Max('transaction__date', filter=completed),
+    ).values_list('position_id', 'bought', 'sold', 'buy_cost', 'sell_proceeds', 'last_date')
+
+    PositionAggregate.objects.bulk_create([
+        PositionAggregate(
+            position_id=position_id,
+            total_shares=(bought or 0) - (sold or 0),
+            total_buy_quantity=bought or 0,
+            total_buy_cost=buy_cost or 0,
+            realized_proceeds=sell_proceeds or 0,
+            last_transaction_date=last_date
+        )
+        for position_id, bought, sold, buy_cost, sell_proceeds, last_date in rows
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PositionAggregate',
+            fields=[
+                ('position', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='aggregate', serialize=False, to='portfolio.position')),
+                ('total_shares', models.DecimalField(decimal_places=8, default=0, max_digits=24)),
+                ('total_buy_quantity', models.DecimalField(decimal_places=8, default=0, max_digits=24)),
+                ('total_buy_cost', models.DecimalField(decimal_places=8, default=0, help_text='Quantity times price plus fees of all buys', max_digits=24)),
+                ('realized_proceeds', models.DecimalField(decimal_places=8, default=0, help_text='Quantity times price minus fees of all sells', max_digits=24)),
+                ('last_transaction_date', models.DateField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(populate_position_aggregates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 4.2.10 on 2026-10-18 01:37
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0002_position_aggregate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='portfolio',
+            name='cost_basis_method',
+            field=models.CharField(choices=[('FIFO', 'First In, First Out'), ('LIFO', 'Last In, First Out'), ('HIFO', 'Highest Cost First'), ('SPECIFIC_ID', 'Specific Lot Identification')], default='FIFO', help_text='How sales are matched against purchase lots', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='positionaggregate',
+            name='open_cost',
+            field=models.DecimalField(blank=True, decimal_places=8, help_text='Cost of the open tax lots, maintained by portfolio.lots (null until the lots are built)', max_digits=24, null=True),
+        ),
+        migrations.CreateModel(
+            name='TaxLot',
+            fields=[
+                ('lot_id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('acquired_date', models.DateField()),
+                ('opened_at', models.DateTimeField(help_text='Creation time of the buy, orders lots acquired on the same date')),
+                ('quantity', models.DecimalField(decimal_places=6, max_digits=15)),
+                ('remaining_quantity', models.DecimalField(decimal_places=6, max_digits=15)),
+                ('unit_cost', models.DecimalField(decimal_places=8, help_text='Price plus fees per share', max_digits=24)),
+                ('buy_transaction', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='tax_lot', to='portfolio.transaction')),
+                ('position', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tax_lots', to='portfolio.position')),
+            ],
+            options={
+                'ordering': ['acquired_date', 'opened_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='LotAllocation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.DecimalField(decimal_places=6, max_digits=15)),
+                ('cost', models.DecimalField(decimal_places=8, max_digits=24)),
+                ('proceeds', models.DecimalField(decimal_places=8, help_text='Sale price times quantity, net of a pro-rata share of fees', max_digits=24)),
+                ('is_specified', models.BooleanField(default=False, help_text='Lot chosen explicitly (specific identification)')),
+                ('sale_transaction', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lot_allocations', to='portfolio.transaction')),
+                ('lot', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='allocations', to='portfolio.taxlot')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='taxlot',
+            index=models.Index(fields=['position', 'remaining_quantity'], name='tax_lot_open_lots'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.10 on 2026-10-18 03:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market_data', '0001_initial'),
+        ('portfolio', '0003_tax_lots'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='portfolio',
+            name='attribution_group',
+            field=models.CharField(choices=[('SECURITY_TYPE', 'Security Type'), ('TAG', 'Position Tag')], default='SECURITY_TYPE', help_text='How positions are grouped in performance attribution', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='portfolio',
+            name='benchmark',
+            field=models.ForeignKey(blank=True, help_text="Security the portfolio's performance is measured against", null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='benchmarked_portfolios', to='market_data.security'),
+        ),
+        migrations.AddField(
+            model_name='position',
+            name='tag',
+            field=models.CharField(blank=True, default='', help_text='Free-form label grouping positions, e.g. in performance attribution', max_length=50),
+        ),
+    ]
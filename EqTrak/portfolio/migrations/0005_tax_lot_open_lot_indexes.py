@@ -0,0 +1,25 @@
+# Generated by Django 4.2.10 on 2026-10-18 05:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0004_portfolio_benchmark_and_position_tag'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='taxlot',
+            name='tax_lot_open_lots',
+        ),
+        migrations.AddIndex(
+            model_name='taxlot',
+            index=models.Index(condition=models.Q(('remaining_quantity__gt', 0)), fields=['position', 'acquired_date', 'opened_at', 'lot_id'], name='tax_lot_open_by_date'),
+        ),
+        migrations.AddIndex(
+            model_name='taxlot',
+            index=models.Index(condition=models.Q(('remaining_quantity__gt', 0)), fields=['position', '-unit_cost', 'acquired_date', 'opened_at', 'lot_id'], name='tax_lot_open_by_cost'),
+        ),
+    ]
@@ -1,15 +1,43 @@
 from django.db import models
+from django.db.models import ExpressionWrapper, F, Max, Q, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
 from django.contrib.auth.models import User
+from django.utils import timezone
 from django.core.validators import MinValueValidator, MaxValueValidator
 import uuid
 from metrics.models import MetricType, MetricValue
+from metrics.registry import registry
 
 class Portfolio(models.Model):
+    COST_BASIS_METHODS = [
+        ('FIFO', 'First In, First Out'),
+        ('LIFO', 'Last In, First Out'),
+        ('HIFO', 'Highest Cost First'),
+        ('SPECIFIC_ID', 'Specific Lot Identification'),
+    ]
+    ATTRIBUTION_GROUPS = [
+        ('SECURITY_TYPE', 'Security Type'),
+        ('TAG', 'Position Tag'),
+    ]
+
     portfolio_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     name = models.CharField(max_length=100)
     description = models.TextField(blank=True, null=True)
     currency = models.CharField(max_length=3, default='USD')
+    cost_basis_method = models.CharField(
+        max_length=20, choices=COST_BASIS_METHODS, default='FIFO',
+        help_text="How sales are matched against purchase lots"
+    )
+    benchmark = models.ForeignKey(
+        'market_data.Security', on_delete=models.SET_NULL, null=True, blank=True,
+        related_name='benchmarked_portfolios',
+        help_text="Security the portfolio's performance is measured against"
+    )
+    attribution_group = models.CharField(
+        max_length=20, choices=ATTRIBUTION_GROUPS, default='SECURITY_TYPE',
+        help_text="How positions are grouped in performance attribution"
+    )
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -17,10 +45,17 @@ class Portfolio(models.Model):
     def __str__(self):
         return f"{self.name} ({self.user.username})"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored method so a change can rematch the tax lots
+        instance._loaded_cost_basis_method = instance.__dict__.get('cost_basis_method')
+        return instance
+
     def get_metric_value(self, metric_name, system_only=True):
         """Get the latest value for a specific metric"""
         metric = MetricType.get_system_metric(metric_name, 'PORTFOLIO') if system_only else \
-                MetricType.objects.filter(name=metric_name, scope_type='PORTFOLIO').first()
+                registry.get_by_name(metric_name, scope_type='PORTFOLIO', is_system=None)
         
         if not metric:
             return None
@@ -34,7 +69,7 @@ class Portfolio(models.Model):
     def get_metric_values(self, metric_name, start_date, end_date=None, system_only=True):
         """Get all values for a specific metric within a date range"""
         metric = MetricType.get_system_metric(metric_name, 'PORTFOLIO') if system_only else \
-                MetricType.objects.filter(name=metric_name, scope_type='PORTFOLIO').first()
+                registry.get_by_name(metric_name, scope_type='PORTFOLIO', is_system=None)
         
         if not metric:
             return []
@@ -56,6 +91,8 @@ class Position(models.Model):
     portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE)
     ticker = models.CharField(max_length=10)
     position_type = models.CharField(max_length=10, choices=POSITION_TYPES)
+    tag = models.CharField(max_length=50, blank=True, default='',
+                           help_text="Free-form label grouping positions, e.g. in performance attribution")
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -101,7 +138,7 @@ class Position(models.Model):
     def get_metric_value(self, metric_name, system_only=True):
         """Get the latest value for a specific metric"""
         metric = MetricType.get_system_metric(metric_name, 'POSITION') if system_only else \
-                MetricType.objects.filter(name=metric_name, scope_type='POSITION').first()
+                registry.get_by_name(metric_name, scope_type='POSITION', is_system=None)
         
         if not metric:
             return None
@@ -115,7 +152,7 @@ class Position(models.Model):
     def get_metric_values(self, metric_name, start_date, end_date=None, system_only=True):
         """Get all values for a specific metric within a date range"""
         metric = MetricType.get_system_metric(metric_name, 'POSITION') if system_only else \
-                MetricType.objects.filter(name=metric_name, scope_type='POSITION').first()
+                registry.get_by_name(metric_name, scope_type='POSITION', is_system=None)
         
         if not metric:
             return []
@@ -155,10 +192,26 @@ class Transaction(models.Model):
     status = models.CharField(max_length=10, choices=TRANSACTION_STATUS, default='PENDING')
     notes = models.TextField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    
+    # Fields that determine the transaction's contribution to PositionAggregate
+    AGGREGATE_FIELDS = ['position_id', 'transaction_type', 'status', 'quantity', 'price', 'fees', 'date']
 
     def __str__(self):
         return f"{self.transaction_type} {self.quantity} {self.position.ticker}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored state so saves can update PositionAggregate incrementally
+        instance._aggregate_state = instance.get_aggregate_state()
+        return instance
+
+    def get_aggregate_state(self):
+        """Get the values of AGGREGATE_FIELDS, or None if any of them is deferred"""
+        if any(field not in self.__dict__ for field in self.AGGREGATE_FIELDS):
+            return None
+        return {field: self.__dict__[field] for field in self.AGGREGATE_FIELDS}
+
     @property
     def total_amount(self):
         """Calculate the total amount of the transaction"""
@@ -190,7 +243,7 @@ class Transaction(models.Model):
     def get_metric_value(self, metric_name, system_only=True):
         """Get the latest value for a specific metric"""
         metric = MetricType.get_system_metric(metric_name, 'TRANSACTION') if system_only else \
-                MetricType.objects.filter(name=metric_name, scope_type='TRANSACTION').first()
+                registry.get_by_name(metric_name, scope_type='TRANSACTION', is_system=None)
         
         if not metric:
             return None
@@ -204,7 +257,7 @@ class Transaction(models.Model):
     def get_metric_values(self, metric_name, start_date, end_date=None, system_only=True):
         """Get all values for a specific metric within a date range"""
         metric = MetricType.get_system_metric(metric_name, 'TRANSACTION') if system_only else \
-                MetricType.objects.filter(name=metric_name, scope_type='TRANSACTION').first()
+                registry.get_by_name(metric_name, scope_type='TRANSACTION', is_system=None)
         
         if not metric:
             return []
@@ -213,4 +266,257 @@ class Transaction(models.Model):
 
     def get_all_metrics(self, include_system=True):
         """Get all metrics associated with this transaction"""
-        return MetricType.get_metrics_for_scope('TRANSACTION', include_system) 
\ No newline at end of file
+        return MetricType.get_metrics_for_scope('TRANSACTION', include_system)
+
+
+class PositionAggregate(models.Model):
+    """
+    Running totals of a position's completed transactions.
+    
+    Updated incrementally by the Transaction save/delete signal handlers in
+    portfolio.signals, so shares, average price and cost basis can be read
+    without summing the transaction history. Writes that bypass signals
+    (queryset updates, bulk_create) must call rebuild() for the affected
+    positions afterwards.
+    """
+    AMOUNT_FIELD_KWARGS = {'max_digits': 24, 'decimal_places': 8, 'default': 0}
+    
+    position = models.OneToOneField(Position, on_delete=models.CASCADE, primary_key=True, related_name='aggregate')
+    total_shares = models.DecimalField(**AMOUNT_FIELD_KWARGS)
+    total_buy_quantity = models.DecimalField(**AMOUNT_FIELD_KWARGS)
+    total_buy_cost = models.DecimalField(**AMOUNT_FIELD_KWARGS, help_text="Quantity times price plus fees of all buys")
+    realized_proceeds = models.DecimalField(**AMOUNT_FIELD_KWARGS, help_text="Quantity times price minus fees of all sells")
+    last_transaction_date = models.DateField(null=True, blank=True)
+    open_cost = models.DecimalField(
+        max_digits=24, decimal_places=8, null=True, blank=True,
+        help_text="Cost of the open tax lots, maintained by portfolio.lots (null until the lots are built)"
+    )
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"Aggregate for {self.position_id}"
+    
+    @staticmethod
+    def average_price(total_shares, total_buy_quantity, total_buy_cost, open_cost):
+        """
+        Average cost per share held.
+        
+        Uses the cost of the open tax lots when they are built, falling back
+        to the average over all buys. Returns 0 for a closed position.
+        """
+        if not total_shares:
+            return 0
+        if open_cost is not None:
+            return open_cost / total_shares
+        if not total_buy_quantity:
+            return 0
+        return total_buy_cost / total_buy_quantity
+    
+    @property
+    def avg_price(self):
+        """Average cost per share held, or 0 for a closed position"""
+        return self.average_price(self.total_shares, self.total_buy_quantity, self.total_buy_cost, self.open_cost)
+    
+    @property
+    def cost_basis(self):
+        """Cost basis of the shares currently held"""
+        return self.total_shares * self.avg_price
+    
+    @staticmethod
+    def contribution(transaction_type, status, quantity, price, fees):
+        """
+        Get the amounts a transaction adds to its position's totals.
+        
+        Returns:
+            Dict of field name to amount, empty if the transaction does not count
+        """
+        if status != 'COMPLETED':
+            return {}
+        fees = fees or 0
+        if transaction_type == 'BUY':
+            return {
+                'total_shares': quantity,
+                'total_buy_quantity': quantity,
+                'total_buy_cost': quantity * price + fees,
+            }
+        elif transaction_type == 'SELL':
+            return {
+                'total_shares': -quantity,
+                'realized_proceeds': quantity * price - fees,
+            }
+        return {}
+    
+    @classmethod
+    def apply(cls, position_id, delta, transaction_date=None, rebuild_missing=True):
+        """
+        Add amounts to a position's totals with a single UPDATE.
+        
+        Args:
+            position_id: Primary key of the position
+            delta: Dict of field name to amount to add
+            transaction_date: Date of a completed transaction that was added
+            rebuild_missing: Rebuild the position from its transactions if it
+                has no aggregate yet; otherwise it is left missing
+        """
+        updates = {field: F(field) + amount for field, amount in delta.items() if amount}
+        if transaction_date is not None:
+            updates['last_transaction_date'] = Greatest(
+                Coalesce(F('last_transaction_date'), Value(transaction_date)), Value(transaction_date)
+            )
+        if not updates:
+            return
+            
+        updates['updated_at'] = timezone.now()
+        if not cls.objects.filter(position_id=position_id).update(**updates) and rebuild_missing:
+            cls.rebuild(Position.objects.filter(pk=position_id))
+    
+    @classmethod
+    def refresh_last_transaction_date(cls, position_id):
+        """Recompute the last transaction date after a transaction was removed"""
+        last_date = Transaction.objects.filter(
+            position_id=position_id, status='COMPLETED'
+        ).aggregate(last_date=Max('date'))['last_date']
+        cls.objects.filter(position_id=position_id).update(last_transaction_date=last_date)
+    
+    @classmethod
+    def compute(cls, positions):
+        """
+        Compute the totals of positions from their transactions, without
+        saving them.
+        
+        The cost of the open tax lots is left unset (None).
+        
+        Args:
+            positions: Position queryset
+            
+        Returns:
+            List of unsaved PositionAggregate instances, one per position
+        """
+        completed = Q(transaction__status='COMPLETED')
+        buys = completed & Q(transaction__transaction_type='BUY')
+        sells = completed & Q(transaction__transaction_type='SELL')
+        amount_field = models.DecimalField(max_digits=30, decimal_places=8)
+        trade_amount = ExpressionWrapper(F('transaction__quantity') * F('transaction__price'), output_field=amount_field)
+        
+        rows = positions.order_by().annotate(
+            bought=Sum('transaction__quantity', filter=buys, output_field=amount_field),
+            sold=Sum('transaction__quantity', filter=sells, output_field=amount_field),
+            buy_cost=Sum(trade_amount + F('transaction__fees'), filter=buys, output_field=amount_field),
+            sell_proceeds=Sum(trade_amount - F('transaction__fees'), filter=sells, output_field=amount_field),
+            last_date=Max('transaction__date', filter=completed),
+        ).values_list('position_id', 'bought', 'sold', 'buy_cost', 'sell_proceeds', 'last_date')
+        
+        return [
+            cls(
+                position_id=position_id,
+                total_shares=(bought or 0) - (sold or 0),
+                total_buy_quantity=bought or 0,
+                total_buy_cost=buy_cost or 0,
+                realized_proceeds=sell_proceeds or 0,
+                last_transaction_date=last_date,
+                open_cost=None
+            )
+            for position_id, bought, sold, buy_cost, sell_proceeds, last_date in rows
+        ]
+    
+    @classmethod
+    def rebuild(cls, positions=None):
+        """
+        Recompute the totals of positions from their transactions.
+        
+        The cost of the open tax lots is reset, so the lots are rebuilt from
+        the same transactions when the position's next transaction is
+        recorded, or by the rebuild_position_aggregates command.
+        
+        Args:
+            positions: Position queryset to rebuild, defaults to all positions
+            
+        Returns:
+            Number of aggregates written
+        """
+        if positions is None:
+            positions = Position.objects.all()
+            
+        aggregates = cls.compute(positions)
+        cls.objects.bulk_create(
+            aggregates,
+            batch_size=500,
+            update_conflicts=True,
+            unique_fields=['position'],
+            update_fields=['total_shares', 'total_buy_quantity', 'total_buy_cost',
+                           'realized_proceeds', 'last_transaction_date', 'open_cost', 'updated_at']
+        )
+        return len(aggregates)
+    
+    @classmethod
+    def get_for_position(cls, position):
+        """
+        Get the aggregate of a position.
+        
+        Nothing is written: a position without an aggregate gets unsaved
+        totals computed from its transactions, and one whose tax lots are not
+        built yet has its average price taken over all buys.
+        """
+        try:
+            return position.aggregate
+        except cls.DoesNotExist:
+            computed = cls.compute(Position.objects.filter(pk=position.pk))
+            return computed[0] if computed else cls(position_id=position.pk)
+
+
+class TaxLot(models.Model):
+    """
+    Shares acquired by one completed BUY transaction.
+    
+    Sales consume lots according to the portfolio's cost basis method (see
+    portfolio.lots); remaining_quantity is what is still held.
+    """
+    lot_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    position = models.ForeignKey(Position, on_delete=models.CASCADE, related_name='tax_lots')
+    buy_transaction = models.OneToOneField(Transaction, on_delete=models.CASCADE, related_name='tax_lot')
+    acquired_date = models.DateField()
+    opened_at = models.DateTimeField(help_text="Creation time of the buy, orders lots acquired on the same date")
+    quantity = models.DecimalField(max_digits=15, decimal_places=6)
+    remaining_quantity = models.DecimalField(max_digits=15, decimal_places=6)
+    unit_cost = models.DecimalField(max_digits=24, decimal_places=8, help_text="Price plus fees per share")
+    
+    class Meta:
+        ordering = ['acquired_date', 'opened_at']
+        # Open lots of a position in the orders portfolio.lots matches them:
+        # by date for FIFO (LIFO scans it backwards) and by cost for HIFO
+        indexes = [
+            models.Index(
+                fields=['position', 'acquired_date', 'opened_at', 'lot_id'],
+                condition=models.Q(remaining_quantity__gt=0), name='tax_lot_open_by_date'
+            ),
+            models.Index(
+                fields=['position', '-unit_cost', 'acquired_date', 'opened_at', 'lot_id'],
+                condition=models.Q(remaining_quantity__gt=0), name='tax_lot_open_by_cost'
+            ),
+        ]
+    
+    def __str__(self):
+        return f"{self.remaining_quantity}/{self.quantity} acquired {self.acquired_date} at {self.unit_cost}"
+    
+    @property
+    def open_cost(self):
+        """Cost of the shares still held in this lot"""
+        return self.remaining_quantity * self.unit_cost
+
+
+class LotAllocation(models.Model):
+    """Part of a SELL transaction matched against one tax lot"""
+    sale_transaction = models.ForeignKey(Transaction, on_delete=models.CASCADE, related_name='lot_allocations')
+    lot = models.ForeignKey(TaxLot, on_delete=models.CASCADE, related_name='allocations')
+    quantity = models.DecimalField(max_digits=15, decimal_places=6)
+    cost = models.DecimalField(max_digits=24, decimal_places=8)
+    proceeds = models.DecimalField(max_digits=24, decimal_places=8, help_text="Sale price times quantity, net of a pro-rata share of fees")
+    is_specified = models.BooleanField(default=False, help_text="Lot chosen explicitly (specific identification)")
+    
+    def __str__(self):
+        return f"{self.quantity} of lot {self.lot_id} sold by {self.sale_transaction_id}"
+    
+    @property
+    def realized_gain(self):
+        """Realized gain or loss of this allocation"""
+        return self.proceeds - self.cost
@@ -0,0 +1,124 @@
+"""
+Signal handlers for the portfolio app.
+
+Keeps PositionAggregate in step with transaction writes by applying the
+difference between a transaction's old and new contribution, and keeps the
+tax lots of positions matched (see portfolio.lots).
+"""
+from django.db.models import QuerySet
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from .lots import TaxLotEngine
+from .models import Portfolio, Position, PositionAggregate, Transaction
+
+
+def _contribution(state):
+    """Get the aggregate contribution of a transaction state dict"""
+    if state is None:
+        return {}
+    return PositionAggregate.contribution(
+        state['transaction_type'], state['status'], state['quantity'], state['price'], state['fees']
+    )
+
+
+@receiver(pre_save, sender=Transaction)
+def remember_previous_state(sender, instance, raw=False, **kwargs):
+    """Load the stored state of a transaction that was not loaded from the database"""
+    if raw or instance._state.adding or getattr(instance, '_aggregate_state', None) is not None:
+        return
+    instance._aggregate_state = Transaction.objects.filter(
+        pk=instance.pk
+    ).values(*Transaction.AGGREGATE_FIELDS).first()
+
+
+@receiver(post_save, sender=Transaction)
+def update_position_state(sender, instance, created, raw=False, **kwargs):
+    """Update the running totals and tax lots of the transaction's position"""
+    if raw:
+        return
+        
+    previous = None if created else getattr(instance, '_aggregate_state', None)
+    current = instance.get_aggregate_state()
+    instance._aggregate_state = current
+    
+    _update_aggregate(instance, previous, current)
+    _update_tax_lots(instance, created, previous, current)
+
+
+def _update_aggregate(instance, previous, current):
+    """Apply the change in the transaction's contribution to its position's totals"""
+    if current is None:
+        # Saved with deferred fields, recompute from scratch
+        PositionAggregate.rebuild(Position.objects.filter(pk=instance.position_id))
+        return
+    
+    new_contribution = _contribution(current)
+    old_contribution = _contribution(previous)
+    
+    if previous is not None and previous['position_id'] != current['position_id']:
+        # Moved to another position
+        PositionAggregate.apply(
+            previous['position_id'],
+            {field: -amount for field, amount in old_contribution.items()},
+            rebuild_missing=False
+        )
+        PositionAggregate.refresh_last_transaction_date(previous['position_id'])
+        old_contribution = {}
+    
+    delta = dict(new_contribution)
+    for field, amount in old_contribution.items():
+        delta[field] = delta.get(field, 0) - amount
+    
+    added_date = current['date'] if new_contribution else None
+    PositionAggregate.apply(current['position_id'], delta, transaction_date=added_date)
+    
+    if old_contribution and (previous['date'] != current['date'] or not new_contribution):
+        PositionAggregate.refresh_last_transaction_date(current['position_id'])
+
+
+def _update_tax_lots(instance, created, previous, current):
+    """Match a new transaction against the lots, or replay the position after an edit"""
+    if created:
+        TaxLotEngine.record_transaction(instance)
+        return
+        
+    if previous is not None and previous == current:
+        return
+        
+    if previous is not None and previous['position_id'] != instance.position_id:
+        TaxLotEngine.rebuild(previous['position_id'])
+    TaxLotEngine.rebuild(instance.position_id)
+
+
+@receiver(post_delete, sender=Transaction)
+def remove_from_position_state(sender, instance, origin=None, **kwargs):
+    """Remove a deleted transaction from its position's totals and tax lots"""
+    state = getattr(instance, '_aggregate_state', None) or instance.get_aggregate_state()
+    contribution = _contribution(state)
+    if not contribution:
+        return
+        
+    # Do not rebuild a missing aggregate here: during a cascading delete of the
+    # position it has already been removed
+    PositionAggregate.apply(
+        state['position_id'],
+        {field: -amount for field, amount in contribution.items()},
+        rebuild_missing=False
+    )
+    PositionAggregate.refresh_last_transaction_date(state['position_id'])
+    
+    origin_model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    if origin is None or origin_model is Transaction:
+        TaxLotEngine.rebuild(state['position_id'])
+
+
+@receiver(post_save, sender=Portfolio)
+def rematch_lots_on_method_change(sender, instance, created, raw=False, **kwargs):
+    """Replay the tax lots of every position when the cost basis method changes"""
+    if raw or created:
+        return
+        
+    if getattr(instance, '_loaded_cost_basis_method', None) != instance.cost_basis_method:
+        TaxLotEngine.rebuild_portfolio(instance)
+        instance._loaded_cost_basis_method = instance.cost_basis_method
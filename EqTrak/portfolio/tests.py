@@ -1,3 +1,214 @@
+import datetime
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from metrics.bulk import compute_metrics_for_positions
+from metrics.models import MetricType
+from .lots import TaxLotEngine
+from .models import LotAllocation, Portfolio, Position, PositionAggregate, TaxLot, Transaction
+
+
+class PositionAggregateTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='aggregate', password='password')
+        portfolio = Portfolio.objects.create(user=user, name='Aggregate Portfolio')
+        self.position = Position.objects.create(portfolio=portfolio, ticker='AAPL', position_type='STOCK')
+
+    def _transact(self, transaction_type, quantity, price, day, status='COMPLETED', fees='0'):
+        return Transaction.objects.create(
+            position=self.position,
+            transaction_type=transaction_type,
+            quantity=Decimal(quantity),
+            price=Decimal(price),
+            fees=Decimal(fees),
+            date=datetime.date(2024, 1, day),
+            status=status
+        )
+
+    def _aggregate(self):
+        return PositionAggregate.objects.get(pk=self.position.pk)
+
+    def _assert_matches_rebuild(self):
+        incremental = self._aggregate()
+        PositionAggregate.rebuild(Position.objects.filter(pk=self.position.pk))
+        rebuilt = self._aggregate()
+        for field in ['total_shares', 'total_buy_quantity', 'total_buy_cost',
+                      'realized_proceeds', 'last_transaction_date']:
+            self.assertEqual(getattr(incremental, field), getattr(rebuilt, field), field)
+
+    def test_incremental_updates(self):
+        self._transact('BUY', '10', '100', 1, fees='5')
+        self._transact('BUY', '10', '200', 3)
+        sell = self._transact('SELL', '5', '250', 5, fees='1')
+
+        aggregate = self._aggregate()
+        self.assertEqual(aggregate.total_shares, Decimal('15'))
+        self.assertEqual(aggregate.open_cost, Decimal('2502.5'))
+        self.assertEqual(aggregate.avg_price, Decimal('2502.5') / 15)
+        self.assertEqual(aggregate.realized_proceeds, Decimal('1249'))
+        self.assertEqual(aggregate.last_transaction_date, datetime.date(2024, 1, 5))
+        self._assert_matches_rebuild()
+
+        sell.quantity = Decimal('2')
+        sell.date = datetime.date(2024, 1, 2)
+        sell.save()
+        self.assertEqual(self._aggregate().total_shares, Decimal('18'))
+        self.assertEqual(self._aggregate().last_transaction_date, datetime.date(2024, 1, 3))
+        self._assert_matches_rebuild()
+
+    def test_status_changes_and_deletes(self):
+        pending = self._transact('BUY', '10', '100', 1, status='PENDING')
+        self._transact('BUY', '4', '50', 2)
+        self.assertEqual(self._aggregate().total_shares, Decimal('4'))
+
+        loaded = Transaction.objects.get(pk=pending.pk)
+        loaded.status = 'COMPLETED'
+        loaded.save()
+        self.assertEqual(self._aggregate().total_shares, Decimal('14'))
+
+        loaded.delete()
+        self.assertEqual(self._aggregate().total_shares, Decimal('4'))
+        self.assertEqual(self._aggregate().last_transaction_date, datetime.date(2024, 1, 2))
+        self._assert_matches_rebuild()
+
+    def test_reading_does_not_write(self):
+        self._transact('BUY', '10', '100', 1)
+        self._transact('SELL', '4', '120', 2)
+        PositionAggregate.objects.all().delete()
+        position = Position.objects.get(pk=self.position.pk)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(PositionAggregate.get_for_position(position).total_shares, Decimal('6'))
+            metrics = compute_metrics_for_positions([position])
+        self.assertEqual(metrics[position.pk]['shares'], Decimal('6'))
+        self.assertFalse([query for query in queries if not query['sql'].startswith('SELECT')])
+        self.assertFalse(PositionAggregate.objects.exists())
+
+    def test_reading_shares_does_not_scan_transactions(self):
+        for day in range(1, 11):
+            self._transact('BUY', '1', '10', day)
+        position = Position.objects.get(pk=self.position.pk)
+        MetricType.get_system_metric('Total Shares', scope_type='POSITION')
+        with self.assertNumQueries(1):
+            self.assertEqual(position.get_metric_value('Total Shares'), Decimal('10'))
+
+
+class TaxLotEngineTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='lots', password='password')
+        self.portfolio = Portfolio.objects.create(user=user, name='Lot Portfolio')
+        self.position = Position.objects.create(portfolio=self.portfolio, ticker='MSFT', position_type='STOCK')
+
+    def _transact(self, transaction_type, quantity, price, day, fees='0'):
+        return Transaction.objects.create(
+            position=self.position,
+            transaction_type=transaction_type,
+            quantity=Decimal(quantity),
+            price=Decimal(price),
+            fees=Decimal(fees),
+            date=datetime.date(2024, 1, day),
+            status='COMPLETED'
+        )
+
+    def _buy_three_lots(self):
+        return [
+            self._transact('BUY', '10', '100', 1),
+            self._transact('BUY', '10', '300', 2),
+            self._transact('BUY', '10', '200', 3),
+        ]
+
+    def _open_cost(self):
+        return PositionAggregate.objects.get(pk=self.position.pk).open_cost
+
+    def test_matching_methods(self):
+        self._buy_three_lots()
+        sale = self._transact('SELL', '15', '250', 4, fees='3')
+        self.assertEqual(TaxLotEngine.get_sale_totals(sale), (Decimal('2500'), Decimal('3747')))
+        self.assertEqual(self._open_cost(), Decimal('3500'))
+
+        expected = {'LIFO': Decimal('3500'), 'HIFO': Decimal('4000'), 'FIFO': Decimal('2500')}
+        for method, cost in expected.items():
+            self.portfolio.cost_basis_method = method
+            self.portfolio.save()
+            self.assertEqual(TaxLotEngine.get_sale_totals(sale)[0], cost, method)
+            self.assertEqual(self._open_cost(), Decimal('6000') - cost, method)
+
+    def test_back_dated_transactions_rebuild(self):
+        self._transact('BUY', '10', '100', 2)
+        sale = self._transact('SELL', '5', '150', 5)
+        self.assertEqual(TaxLotEngine.get_sale_totals(sale)[0], Decimal('500'))
+
+        # An earlier buy becomes the first lot in FIFO order
+        self._transact('BUY', '10', '50', 1)
+        self.assertEqual(TaxLotEngine.get_sale_totals(sale)[0], Decimal('250'))
+        self.assertEqual(self._open_cost(), Decimal('1250'))
+        self.assertEqual(TaxLot.objects.get(acquired_date=datetime.date(2024, 1, 1)).remaining_quantity, Decimal('5'))
+
+    def test_back_dated_buy_matches_unallocated_sale(self):
+        # Nothing is held yet, so the sale gets no allocations
+        sale = self._transact('SELL', '5', '150', 5)
+        self.assertFalse(LotAllocation.objects.filter(sale_transaction=sale).exists())
+
+        self._transact('BUY', '10', '100', 1)
+        self.assertEqual(self._open_cost(), Decimal('500'))
+        self.assertEqual(
+            list(LotAllocation.objects.filter(sale_transaction=sale).values_list('quantity', 'cost')),
+            [(Decimal('5'), Decimal('500'))]
+        )
+
+    def test_specific_identification_survives_rebuild(self):
+        self.portfolio.cost_basis_method = 'SPECIFIC_ID'
+        self.portfolio.save()
+        buys = self._buy_three_lots()
+        sale = self._transact('SELL', '15', '250', 4)
+
+        TaxLotEngine.specify_lots(sale, [(buys[2].pk, Decimal('10'))])
+        self.assertEqual(TaxLotEngine.get_sale_totals(sale)[0], Decimal('2500'))
+
+        # The remaining 5 shares fall back to FIFO, before and after a rebuild
+        TaxLotEngine.rebuild(self.position.pk)
+        allocations = LotAllocation.objects.filter(sale_transaction=sale)
+        self.assertEqual(
+            sorted((a.lot.buy_transaction_id, a.quantity, a.is_specified) for a in allocations),
+            sorted([(buys[2].pk, Decimal('10'), True), (buys[0].pk, Decimal('5'), False)])
+        )
+        position = Position.objects.get(pk=self.position.pk)
+        self.assertEqual(PositionAggregate.get_for_position(position).avg_price, Decimal('3500') / 15)
+
+    def test_incremental_sales_match_rebuild(self):
+        for method in ['FIFO', 'LIFO', 'HIFO']:
+            self.portfolio.cost_basis_method = method
+            self.portfolio.save()
+            for index, price in enumerate(['120', '80', '150', '100', '90']):
+                self._transact('BUY', '4', price, index + 1)
+            # Each sale spans lots read in more than one chunk
+            with mock.patch.object(TaxLotEngine, 'MATCH_CHUNK_SIZE', 2):
+                sales = [self._transact('SELL', '9', '130', 10), self._transact('SELL', '6', '130', 11)]
+            incremental = [TaxLotEngine.get_sale_totals(sale) for sale in sales]
+            open_cost = self._open_cost()
+
+            TaxLotEngine.rebuild(self.position.pk)
+            self.assertEqual([TaxLotEngine.get_sale_totals(sale) for sale in sales], incremental, method)
+            self.assertEqual(self._open_cost(), open_cost, method)
+            self.position.transaction_set.all().delete()
+
+    def test_aggregate_rebuild_resets_lots(self):
+        self._buy_three_lots()
+        self._transact('SELL', '15', '250', 4)
+        PositionAggregate.rebuild(Position.objects.filter(pk=self.position.pk))
+        self.assertIsNone(self._open_cost())
+
+        # Reading does not build the lots, the average is taken over all buys
+        position = Position.objects.get(pk=self.position.pk)
+        self.assertEqual(PositionAggregate.get_for_position(position).avg_price, Decimal('200'))
+        self.assertIsNone(self._open_cost())
 
-# Create your tests here.
+        call_command('rebuild_position_aggregates', stdout=StringIO())
+        self.assertEqual(self._open_cost(), Decimal('3500'))
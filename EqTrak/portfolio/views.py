@@ -3,7 +3,8 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth import logout
 from django.contrib import messages
 from django.http import JsonResponse
-from .models import Portfolio, Position, Transaction
+from .lots import TaxLotEngine
+from .models import Portfolio, Position, PositionAggregate, Transaction
 from .forms import PortfolioForm, PositionForm, TransactionForm
 import datetime
 from itertools import groupby
@@ -18,7 +19,7 @@ from user_metrics.models import UserDefinedMetric
 
 @login_required
 def portfolio_list(request):
-    portfolios = Portfolio.objects.filter(user=request.user, is_active=True)
+    portfolios = list(Portfolio.objects.filter(user=request.user, is_active=True))
     
     # Get system metrics for portfolio card display only
     # We intentionally filter to ONLY system metrics (no user-defined metrics)
@@ -31,6 +32,9 @@ def portfolio_list(request):
         data_type__in=['CURRENCY', 'PERCENTAGE']
     ).exclude(data_type='MEMO').order_by('computation_order', 'name')
     
+    # Compute each card metric for all portfolios with one call per metric
+    MetricType.prime_cache(card_metrics, portfolios)
+    
     return render(request, 'portfolio/portfolio_list.html', {
         'portfolios': portfolios,
         'card_metrics': card_metrics,  # Only used for the portfolio cards
@@ -67,10 +71,14 @@ def custom_logout(request):
 @login_required
 def portfolio_detail(request, portfolio_id):
     portfolio = get_object_or_404(Portfolio, portfolio_id=portfolio_id, user=request.user)
-    positions = portfolio.position_set.filter(is_active=True)  # Get active positions
+    positions = list(portfolio.position_set.filter(is_active=True))  # Get active positions
     portfolio_metrics = get_portfolio_metrics(portfolio)  # Get portfolio metrics
     position_metrics = Position.get_display_metrics()  # Get position system metrics
     
+    # Load the stored values shown in the positions table in one query and
+    # compute each computed column with one call
+    MetricType.prime_cache(position_metrics, positions)
+    
     # Check if market data updates are enabled for this user
     market_data_updates_enabled = MarketDataService.is_updates_enabled(user=request.user)
     
@@ -113,10 +121,7 @@ def position_create(request, portfolio_id):
             
             # Create market price metric if provided
             if market_price and market_date:
-                market_price_metric = MetricType.objects.get(
-                    name='Market Price',
-                    is_system=True
-                )
+                market_price_metric = MetricType.get_system_metric('Market Price', scope_type='POSITION')
                 MetricValue.objects.create(
                     position=position,
                     metric_type=market_price_metric,
@@ -146,6 +151,9 @@ def position_delete(request, portfolio_id, position_id):
     if request.method == 'POST':
         # Soft delete all related transactions
         position.transaction_set.all().update(status='CANCELLED')
+        # The queryset update bypasses the transaction signals
+        PositionAggregate.rebuild(Position.objects.filter(pk=position.pk))
+        TaxLotEngine.rebuild(position.pk)
         
         # Soft delete the position
         position.is_active = False
@@ -1,5 +1,6 @@
 from django import forms
 from .models import UserDefinedMetric
+from metrics.formulas import CompiledFormula, FormulaError
 from metrics.models import MetricType, MetricValue
 
 class UserDefinedMetricForm(forms.ModelForm):
@@ -24,6 +25,13 @@ class UserDefinedMetricForm(forms.ModelForm):
         help_text="Optional: Add tags to categorize your metric (space-separated)"
     )
     
+    formula = forms.CharField(
+        max_length=500,
+        required=False,
+        help_text="Optional: Compute this metric from other metrics, e.g. Current Value / Cost Basis - 1. "
+                  "Use [brackets] around names containing operators."
+    )
+    
     class Meta:
         model = UserDefinedMetric
         fields = ['name', 'description', 'is_active']
@@ -42,15 +50,38 @@ class UserDefinedMetricForm(forms.ModelForm):
             self.fields['data_type'].initial = instance.metric_type.data_type
             self.fields['scope_type'].initial = instance.metric_type.scope_type
             self.fields['tags'].initial = instance.metric_type.tags
+            self.fields['formula'].initial = instance.metric_type.formula
         
         # Add helpful descriptions
         self.fields['description'].help_text = "Describe what this metric measures or tracks"
     
+    def clean(self):
+        cleaned_data = super().clean()
+        formula = (cleaned_data.get('formula') or '').strip()
+        scope_type = cleaned_data.get('scope_type')
+        cleaned_data['formula'] = formula or None
+        
+        if formula and scope_type:
+            if cleaned_data.get('data_type') == 'MEMO':
+                self.add_error('formula', "Memo metrics cannot have a formula.")
+                return cleaned_data
+            try:
+                compiled = CompiledFormula(formula, scope_type)
+            except FormulaError as e:
+                self.add_error('formula', str(e))
+                return cleaned_data
+            
+            metric_type = self.instance.metric_type if self.instance.pk else None
+            if metric_type and any(d.metric_id == metric_type.metric_id for d in compiled.dependencies):
+                self.add_error('formula', "A formula cannot reference its own metric.")
+        return cleaned_data
+    
     def save(self, commit=True):
         # Get or create the metric_type first
         data_type = self.cleaned_data.get('data_type')
         scope_type = self.cleaned_data.get('scope_type')
         tags = self.cleaned_data.get('tags')
+        formula = self.cleaned_data.get('formula')
         name = self.cleaned_data.get('name')
         
         instance = super().save(commit=False)
@@ -66,6 +97,8 @@ class UserDefinedMetricForm(forms.ModelForm):
             metric_type.data_type = data_type
             metric_type.scope_type = scope_type
             metric_type.tags = tags
+            metric_type.formula = formula
+            metric_type.is_computed = bool(formula)
             # Add a user reference to the name to help differentiate
             if not metric_type.name.endswith(f" ({instance.user.username})"):
                 metric_type.name = f"{name} ({instance.user.username})"
@@ -78,7 +111,8 @@ class UserDefinedMetricForm(forms.ModelForm):
                 scope_type=scope_type,
                 tags=tags,
                 is_system=False,
-                is_computed=False
+                is_computed=bool(formula),
+                formula=formula
             )
             instance.metric_type = metric_type
         
@@ -146,23 +146,26 @@ def add_metric_value(request, metric_id, portfolio_id=None, position_id=None, tr
                 metric_value.transaction = transaction
             
             metric_value.source = 'USER'
-            metric_value.save()
+            if metric_value.is_duplicate():
+                form.add_error('date', f'A value of "{user_metric.name}" is already stored for this date. Edit it instead.')
+            else:
+                metric_value.save()
             
-            # Update the latest_value reference
-            user_metric.latest_value = metric_value
-            user_metric.save()
+                # Update the latest_value reference
+                user_metric.latest_value = metric_value
+                user_metric.save()
             
-            messages.success(request, f'Value added to "{user_metric.name}" successfully!')
+                messages.success(request, f'Value added to "{user_metric.name}" successfully!')
             
-            # Determine redirect target
-            if transaction:
-                return redirect('metrics:transaction_metrics', portfolio_id=portfolio.portfolio_id, 
-                              position_id=position.position_id, transaction_id=transaction.transaction_id)
-            elif position:
-                return redirect('metrics:position_metrics', portfolio_id=portfolio.portfolio_id, 
-                              position_id=position.position_id)
-            else:
-                return redirect('metrics:portfolio_metrics', portfolio_id=portfolio.portfolio_id)
+                # Determine redirect target
+                if transaction:
+                    return redirect('metrics:transaction_metrics', portfolio_id=portfolio.portfolio_id, 
+                                  position_id=position.position_id, transaction_id=transaction.transaction_id)
+                elif position:
+                    return redirect('metrics:position_metrics', portfolio_id=portfolio.portfolio_id, 
+                                  position_id=position.position_id)
+                else:
+                    return redirect('metrics:portfolio_metrics', portfolio_id=portfolio.portfolio_id)
     else:
         form = UserMetricValueForm(
             metric_type=metric_type,
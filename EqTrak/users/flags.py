@@ -0,0 +1,217 @@
+"""
+Cached resolution of the app feature flags.
+
+Each optional app (performance, market data) is switched by a system-wide
+settings singleton and by a toggle in the user's UserSettings. These used to
+be read from the database on every decorated service call and template tag,
+so a single page paid dozens of identical settings queries.
+
+Resolved values are kept in process memory:
+
+- system settings and user toggles are cached for FEATURE_FLAG_CACHE_TTL
+  seconds (default 30), which bounds how long other processes see a stale
+  value;
+- saving or deleting a settings row invalidates the entries of this process
+  right away (see the signal handlers of each app);
+- while a request is active (see FeatureFlagMiddleware or resolved_flags()),
+  every flag is resolved once per request, so a page sees consistent values.
+
+Example:
+    from users import flags
+
+    if flags.is_enabled('performance', user=request.user):
+        ...
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.apps import apps
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Flag name -> (system settings model, UserSettings toggle field)
+FLAGS = {
+    'performance': ('performance.PerformanceSettings', 'performance_enabled'),
+    'market_data': ('market_data.MarketDataSettings', 'market_data_enabled'),
+}
+
+DEFAULT_TTL = 30
+
+# Users kept in the cache before expired entries are dropped
+MAX_CACHED_USERS = 10000
+
+
+def _get_ttl():
+    return getattr(settings, 'FEATURE_FLAG_CACHE_TTL', DEFAULT_TTL)
+
+
+class FeatureFlagCache:
+    """
+    Process-wide cache of system settings and user toggles.
+
+    Entries are stored as {flag: (enabled, expires_at)} for the system
+    settings and {user_pk: (toggles, expires_at)} for the users, where
+    toggles holds all UserSettings toggle fields loaded in one query.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._system = {}
+        self._users = {}
+
+    def is_system_enabled(self, flag):
+        """Check the system-wide setting of a flag"""
+        now = time.monotonic()
+        entry = self._system.get(flag)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+
+        model_label, _ = FLAGS[flag]
+        # get_instance() creates the singleton with its defaults if needed
+        enabled = apps.get_model(model_label).get_instance().updates_enabled
+        with self._lock:
+            self._system[flag] = (enabled, now + _get_ttl())
+        return enabled
+
+    def is_user_enabled(self, flag, user):
+        """
+        Check a user's toggle of a flag, ignoring the system setting.
+
+        Users without settings, including anonymous users, default to enabled.
+        """
+        if user is None or user.pk is None:
+            return True
+
+        now = time.monotonic()
+        entry = self._users.get(user.pk)
+        if entry is None or entry[1] <= now:
+            entry = (self._load_user_toggles(user.pk), now + _get_ttl())
+            with self._lock:
+                if len(self._users) >= MAX_CACHED_USERS:
+                    self._users = {pk: cached for pk, cached in self._users.items() if cached[1] > now}
+                    if len(self._users) >= MAX_CACHED_USERS:
+                        self._users.clear()
+                self._users[user.pk] = entry
+
+        _, user_field = FLAGS[flag]
+        return entry[0].get(user_field, True)
+
+    @staticmethod
+    def _load_user_toggles(user_pk):
+        UserSettings = apps.get_model('users', 'UserSettings')
+        fields = [user_field for _, user_field in FLAGS.values()]
+        return UserSettings.objects.filter(user_id=user_pk).values(*fields).first() or {}
+
+    def invalidate_system(self, flag=None):
+        """Drop the cached system setting of a flag, or of all flags"""
+        with self._lock:
+            if flag is None:
+                self._system.clear()
+            else:
+                self._system.pop(flag, None)
+
+    def invalidate_user(self, user_pk=None):
+        """Drop the cached toggles of a user, or of all users"""
+        with self._lock:
+            if user_pk is None:
+                self._users.clear()
+            else:
+                self._users.pop(user_pk, None)
+
+    def clear(self):
+        """Drop all cached values"""
+        self.invalidate_system()
+        self.invalidate_user()
+
+
+cache = FeatureFlagCache()
+
+
+class ResolvedFlags:
+    """
+    Flags of one request, each resolved at most once.
+
+    Flags can be read as attributes, e.g. request.feature_flags.performance
+    in a template, which combines the system setting and the request user's
+    toggle.
+    """
+
+    def __init__(self, user=None):
+        self.user = user
+        self._resolved = {}
+
+    def is_enabled(self, flag, with_user=True):
+        key = (flag, with_user)
+        if key not in self._resolved:
+            enabled = cache.is_system_enabled(flag)
+            if enabled and with_user:
+                enabled = cache.is_user_enabled(flag, self.user)
+            self._resolved[key] = enabled
+        return self._resolved[key]
+
+    def __getattr__(self, flag):
+        if flag not in FLAGS:
+            raise AttributeError(flag)
+        return self.is_enabled(flag)
+
+
+_active_flags = ContextVar('resolved_feature_flags', default=None)
+
+
+@contextmanager
+def resolved_flags(user=None):
+    """
+    Resolve each flag once within the block.
+
+    Yields:
+        ResolvedFlags for the given user
+    """
+    resolved = ResolvedFlags(user)
+    token = _active_flags.set(resolved)
+    try:
+        yield resolved
+    finally:
+        _active_flags.reset(token)
+
+
+def _get_resolved(user):
+    """Get the active request's flags when they apply to the given user"""
+    resolved = _active_flags.get()
+    if resolved is None:
+        return None
+    if user is None or (resolved.user is not None and resolved.user.pk == user.pk):
+        return resolved
+    return None
+
+
+def is_system_enabled(flag):
+    """Check if a flag is enabled at the system level"""
+    resolved = _get_resolved(None)
+    if resolved is not None:
+        return resolved.is_enabled(flag, with_user=False)
+    return cache.is_system_enabled(flag)
+
+
+def is_enabled(flag, user=None):
+    """
+    Check if a flag is enabled, considering both system and user settings.
+    System settings override user preferences.
+
+    Args:
+        flag: Flag name, one of FLAGS
+        user: Optional user to check settings for. If None, only the system setting is checked.
+
+    Returns:
+        bool: True if the flag is enabled
+    """
+    if user is None:
+        return is_system_enabled(flag)
+
+    resolved = _get_resolved(user)
+    if resolved is not None:
+        return resolved.is_enabled(flag)
+    return cache.is_system_enabled(flag) and cache.is_user_enabled(flag, user)
@@ -0,0 +1,17 @@
+from . import flags
+
+
+class FeatureFlagMiddleware:
+    """
+    Resolve the feature flags once per request and expose them as
+    request.feature_flags, so service checks and template tags rendering
+    the page don't query the settings again.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with flags.resolved_flags(getattr(request, 'user', None)) as resolved:
+            request.feature_flags = resolved
+            return self.get_response(request)
@@ -1,6 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 
 from .fields import EncryptedCharField
@@ -75,3 +75,9 @@ def save_user_settings(sender, instance, **kwargs):
         UserSettings.objects.create(user=instance)
     else:
         instance.settings.save()
+
+@receiver(post_save, sender=UserSettings)
+@receiver(post_delete, sender=UserSettings)
+def invalidate_user_flags(sender, instance, **kwargs):
+    from .flags import cache
+    cache.invalidate_user(instance.user_id)
@@ -1,3 +1,40 @@
+from django.contrib.auth.models import User
 from django.test import TestCase
 
-# Create your tests here.
+from market_data.models import MarketDataSettings
+from performance.models import PerformanceSettings
+from performance.services import PerformanceService
+from . import flags
+
+
+class FeatureFlagTests(TestCase):
+    def setUp(self):
+        flags.cache.clear()
+        self.user = User.objects.create_user(username='flags', password='password')
+
+    def test_settings_are_cached_until_changed(self):
+        self.assertTrue(PerformanceService.is_performance_enabled(user=self.user))
+        self.assertTrue(MarketDataSettings.is_updates_enabled())
+        with self.assertNumQueries(0):
+            for _ in range(3):
+                self.assertTrue(PerformanceService.is_performance_enabled(user=self.user))
+                self.assertTrue(MarketDataSettings.is_updates_enabled())
+
+        self.user.settings.performance_enabled = False
+        self.user.settings.save()
+        self.assertFalse(flags.is_enabled('performance', user=self.user))
+        self.assertTrue(flags.is_enabled('market_data', user=self.user))
+
+        PerformanceSettings.set_feature_enabled(False)
+        self.assertFalse(PerformanceService.is_performance_enabled())
+        PerformanceSettings.set_feature_enabled(True)
+        self.assertTrue(PerformanceService.is_performance_enabled())
+
+    def test_request_resolves_each_flag_once(self):
+        with flags.resolved_flags(self.user) as resolved:
+            self.assertTrue(resolved.performance)
+            self.user.settings.performance_enabled = False
+            self.user.settings.save()
+            # Consistent for the rest of the request
+            self.assertTrue(flags.is_enabled('performance', user=self.user))
+        self.assertFalse(flags.is_enabled('performance', user=self.user))